@@ -5,11 +5,16 @@ import json
 import os
 import uuid
 import shutil
-from flask import Flask, request, send_from_directory
+from flask import Flask, request, send_from_directory, jsonify
 from decouple import config
 
 # --- ИМПОРТИРУЕМ HOT-RELOAD ---
 from app.modules.hot_reload import start_hot_reload, get_current_graph
+from app.modules.update_dispatcher import UpdateDispatcher, update_chat_key, ACCEPTED, REJECTED
+from app.modules.telegram_sender import wrap_bot, get_outbound_sender
+from app.modules.http_transport import (
+    HTTP_POOL_ENABLED, HTTP_WARMUP, configure_telegram_transport, transport_stats, warm_up
+)
 
 # --- Вспомогательные функции ---
 def load_graph(filename: str) -> dict:
@@ -28,6 +33,12 @@ GRAPH_PATH = config("GRAPH_PATH", default="/data/default_interview.json")
 SERVER_URL = config("SERVER_URL")
 WEBHOOK_SECRET = config("WEBHOOK_SECRET", default=str(uuid.uuid4()))
 
+# Асинхронный приём апдейтов: webhook только ставит апдейт в очередь чата и сразу отвечает 200
+WEBHOOK_ASYNC = config("WEBHOOK_ASYNC", default=False, cast=bool)
+WEBHOOK_WORKERS = config("WEBHOOK_WORKERS", default=8, cast=int)
+WEBHOOK_MAX_PENDING = config("WEBHOOK_MAX_PENDING", default=10000, cast=int)
+WEBHOOK_MAX_PER_CHAT = config("WEBHOOK_MAX_PER_CHAT", default=100, cast=int)
+
 # Проверка наличия критически важных переменных
 if not BOT_TOKEN or not SERVER_URL:
     raise ValueError("TELEGRAM_BOT_TOKEN and SERVER_URL must be set in Amvera secrets/environment variables.")
@@ -42,7 +53,34 @@ app = Flask(__name__)
 def health_check():
     return "Bot is alive and listening!", 200
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Один пул keep-alive соединений к Bot API на все потоки (HTTP_POOL_ENABLED)
+if HTTP_POOL_ENABLED:
+    configure_telegram_transport()
+
+# В асинхронном режиме обработчики выполняются в воркерах диспетчера,
+# поэтому собственный пул потоков telebot отключается (иначе теряется порядок внутри чата)
+bot = telebot.TeleBot(BOT_TOKEN, threaded=not WEBHOOK_ASYNC)
+# Исходящие запросы обработчиков — через очередь с лимитами (OUTBOUND_ENABLED), иначе напрямую
+outbound_bot = wrap_bot(bot)
+
+def process_dispatched(item):
+    """Элемент очереди чата: апдейт Telegram или узел сценария, до которого дошел таймер."""
+    if callable(item):
+        item()
+    else:
+        bot.process_new_updates([item])
+
+update_dispatcher = None
+if WEBHOOK_ASYNC:
+    update_dispatcher = UpdateDispatcher(
+        process_dispatched,
+        workers=WEBHOOK_WORKERS,
+        max_pending=WEBHOOK_MAX_PENDING,
+        max_per_chat=WEBHOOK_MAX_PER_CHAT,
+    ).start()
+    # Узлы после пауз и таймаутов — в очередь своего чата, вместе с нажатиями игрока
+    from app.modules.timing_engine import set_node_callback_runner
+    set_node_callback_runner(lambda chat_id, callback: update_dispatcher.submit(chat_id, callback) == ACCEPTED)
 
 # --- Регистрация вебхука в Telegram ---
 try:
@@ -73,11 +111,27 @@ graph_data = get_current_graph()
 
 if graph_data:
     from app.modules.telegram_handler import register_handlers
-    register_handlers(bot, graph_data)
+    register_handlers(outbound_bot, graph_data)
     print("Обработчики успешно зарегистрированы.")
+    # Таймеры, ожидавшие срабатывания до рестарта (ENABLE_PERSISTENCE_TIMERS)
+    from app.modules.timing_engine import recover_persistent_timers
+    recover_persistent_timers()
+    # Фоновое обновление агрегатов аналитики (ANALYTICS_MODE=periodic|on_write)
+    from app.modules.database.analytics import start_analytics_refresher
+    start_analytics_refresher()
 else:
     print("Критическая ошибка: не удалось загрузить граф сценариев.")
 
+# --- ПРОГРЕВ СОЕДИНЕНИЙ (TLS и токен GigaChat до первого игрока) ---
+if HTTP_WARMUP:
+    warmup = [("Telegram", bot.get_me)]
+    try:
+        from app.modules.gigachat_handler import warmup_targets
+        warmup += warmup_targets()
+    except Exception as e:
+        print(f"[HTTP] ⚠️ Клиенты LLM недоступны для прогрева: {e}")
+    warm_up(warmup)
+
 # --- ОБРАБОТКА КАРТИНОК ---
 @app.route('/images/<path:filename>')
 def serve_image(filename):
@@ -98,10 +152,58 @@ def webhook():
     if request.headers.get('content-type') == 'application/json':
         json_string = request.get_data().decode('utf-8')
         update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        if update_dispatcher is None:
+            bot.process_new_updates([update])
+            return '', 200
+        result = update_dispatcher.submit(update_chat_key(update), update)
+        if result == REJECTED:
+            # Очередь переполнена: Telegram повторит доставку позже
+            return 'Queue is full', 503
+        if result != ACCEPTED:
+            print(f"[DISPATCHER] ⚠️ Апдейт {update.update_id} отброшен: переполнена очередь чата")
         return '', 200
     else:
         return 'Bad Request', 400
 
+# --- Метрики очереди апдейтов ---
+@app.route('/health/queue', methods=['GET'])
+def queue_stats():
+    if update_dispatcher is None:
+        return jsonify({"mode": "sync"}), 200
+    return jsonify({"mode": "async", **update_dispatcher.stats()}), 200
+
+# --- Метрики очереди исходящих ---
+@app.route('/health/outbound', methods=['GET'])
+def outbound_stats():
+    sender = get_outbound_sender()
+    if sender is None:
+        return jsonify({"mode": "direct"}), 200
+    return jsonify({"mode": "queued", **sender.stats()}), 200
+
+# --- Метрики фоновых заданий ИИ ---
+@app.route('/health/ai', methods=['GET'])
+def ai_jobs_stats():
+    from app.modules.ai_jobs import get_ai_executor
+    from app.modules.ai_cache import get_response_cache
+    from app.modules.ai_prefetch import get_prefetcher
+    from app.modules.ai_resilience import resilience_stats
+    from app.modules.database.crud import memory_cache
+    return jsonify({**get_ai_executor().stats(), "cache": get_response_cache().stats(),
+                    "prefetch": get_prefetcher().stats(), "memory": memory_cache.stats(), **resilience_stats()}), 200
+
+# --- Агрегаты аналитики: состояние фонового обновления ---
+@app.route('/health/analytics', methods=['GET'])
+def analytics_stats():
+    from app.modules.database.analytics import ANALYTICS_MODE, get_analytics_refresher
+    refresher = get_analytics_refresher()
+    if refresher is None:
+        return jsonify({"mode": ANALYTICS_MODE, "running": False}), 200
+    return jsonify({"running": True, **refresher.stats()}), 200
+
+# --- Метрики HTTP-соединений (переиспользование keep-alive) ---
+@app.route('/health/http', methods=['GET'])
+def http_stats():
+    return jsonify(transport_stats()), 200
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8443)
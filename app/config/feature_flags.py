@@ -1,6 +1,8 @@
 # app/config/feature_flags.py
 # Feature Flags для поэтапного развертывания новых функций
 
+from decouple import config
+
 class FeatureFlags:
     """
     Централизованное управление функциональностью.
@@ -15,7 +17,7 @@ class FeatureFlags:
     ENABLE_DELAYED_MESSAGES = False       # Отложенные сообщения
     ENABLE_TIMEOUTS = False               # Таймауты для узлов
     ENABLE_COOLDOWNS = False              # Кулдауны между действиями
-    ENABLE_PERSISTENCE_TIMERS = False     # Сохранение таймеров при рестарте
+    ENABLE_PERSISTENCE_TIMERS = config("ENABLE_PERSISTENCE_TIMERS", default=False, cast=bool)  # Сохранение таймеров при рестарте
     
     # === СПРИНТ 2: BEHAVIORAL EFFECTS ===
     ENABLE_AI_THINKING_DELAY = False      # ИИ "думает" перед ответом
@@ -24,8 +26,8 @@ class FeatureFlags:
     
     # === СПРИНТ 3: MEMORY MANAGEMENT ===
     ENABLE_SMART_CONTEXT = False          # Умное управление контекстом ИИ
-    ENABLE_AI_SUMMARIZATION = False       # ИИ-суммаризация старых событий
-    ENABLE_HIERARCHICAL_MEMORY = False    # Иерархическая память (важные + summaries)
+    ENABLE_AI_SUMMARIZATION = config("ENABLE_AI_SUMMARIZATION", default=False, cast=bool)        # ИИ-суммаризация старых событий
+    ENABLE_HIERARCHICAL_MEMORY = config("ENABLE_HIERARCHICAL_MEMORY", default=False, cast=bool)  # Иерархическая память (последние события + сводки)
     
     # === СПРИНТ 4: GROUP MECHANICS ===
     ENABLE_GROUP_RESEARCH = False         # Групповые исследования
@@ -0,0 +1,201 @@
+# app/modules/ai_cache.py
+"""
+Кеш ответов проактивных узлов ИИ (ai_proactive:role("task")).
+
+В групповых сессиях десятки игроков одновременно приходят в один и тот же узел
+с одинаковыми ролью, задачей, вариантами и близким состоянием — и каждый раньше
+порождал отдельный запрос к LLM. Кеш отдает один ответ всем, у кого совпал
+отпечаток (fingerprint): роль, задача, тексты вариантов и выбранные ключи
+состояния, округленные до корзин (AI_CACHE_STATE_KEYS="score:10000" —
+score с шагом 10000). История игрока в отпечаток не входит — ответ общий.
+
+Записи живут AI_CACHE_TTL секунд, при переполнении вытесняются по LRU.
+Одновременные одинаковые запросы схлопываются (single-flight): первый игрок
+запускает генерацию, остальные ждут ее результат без занятых потоков.
+
+Кеш выключен по умолчанию (AI_CACHE_ENABLED). В COMPLIANCE_MODE он работает
+только при явном AI_CACHE_IN_COMPLIANCE=true. В узле отключается полем
+"ai_cache": false, а список ключей состояния можно задать в узле:
+"ai_cache": ["score:50000", "risk"].
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from decouple import config
+
+AI_CACHE_ENABLED = config("AI_CACHE_ENABLED", default=False, cast=bool)
+AI_CACHE_IN_COMPLIANCE = config("AI_CACHE_IN_COMPLIANCE", default=False, cast=bool)
+AI_CACHE_TTL = config("AI_CACHE_TTL", default=600.0, cast=float)
+AI_CACHE_MAX_ENTRIES = config("AI_CACHE_MAX_ENTRIES", default=1000, cast=int)
+AI_CACHE_STATE_KEYS = config("AI_CACHE_STATE_KEYS", default="score:10000")
+
+# Результат single_flight
+HIT = "hit"          # ответ из кеша
+JOINED = "joined"    # такой же запрос уже выполняется — ждем его
+LEADER = "leader"    # запускаем генерацию сами
+
+
+def parse_state_keys(spec) -> Dict[str, float]:
+    """'score:10000, risk' или ['score:10000', 'risk'] -> {'score': 10000.0, 'risk': 0.0} (0 — точное значение)."""
+    items = spec.split(",") if isinstance(spec, str) else list(spec or ())
+    keys = {}
+    for item in items:
+        name, _, bucket = str(item).strip().partition(":")
+        if not name:
+            continue
+        try:
+            keys[name.strip()] = float(bucket) if bucket.strip() else 0.0
+        except ValueError:
+            print(f"[AI-CACHE] ⚠️ Некорректный шаг корзины '{item}', используется точное значение")
+            keys[name.strip()] = 0.0
+    return keys
+
+
+def bucket_value(value, step: float):
+    """Числа (и числовые строки из user_states) — номер корзины шага step; прочее — как есть."""
+    if step <= 0 or value is None or isinstance(value, bool):
+        return value
+    try:
+        return int(float(value) // step)
+    except (TypeError, ValueError):
+        return value
+
+
+def fingerprint(role, task, options, states: dict, state_keys: Dict[str, float]) -> str:
+    """Отпечаток запроса проактивного узла."""
+    option_texts = [opt['text'] if isinstance(opt, dict) else opt.text for opt in options or ()]
+    bucketed = {key: bucket_value(states.get(key), step) for key, step in sorted(state_keys.items())}
+    payload = json.dumps([str(role), task or "", option_texts, bucketed], ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def is_cacheable(value: Optional[str]) -> bool:
+    """Пустые ответы и сообщения об ошибке (⚠️) не кешируются."""
+    return bool(value) and not value.startswith("⚠️")
+
+
+class ResponseCache:
+    """TTL + LRU кеш ответов с single-flight дедупликацией."""
+
+    def __init__(self, ttl: float = AI_CACHE_TTL, max_entries: int = AI_CACHE_MAX_ENTRIES,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl = float(ttl)
+        self.max_entries = max(1, int(max_entries))
+        self._clock = clock
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()   # key -> (expires_at, value)
+        self._inflight: Dict[str, List[Callable[[Optional[str]], None]]] = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "joined": 0, "stored": 0, "expired": 0, "evictions": 0}
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._get_locked(key)
+
+    def put(self, key: str, value: str):
+        if not is_cacheable(value):
+            return
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            self._stats["stored"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def single_flight(self, key: str, start: Callable[[Callable[[Optional[str]], None]], None],
+                      waiter: Callable[[Optional[str]], None],
+                      on_leader_failed: Optional[Callable[[], None]] = None) -> str:
+        """
+        Ответ для key: из кеша (waiter вызывается сразу), из уже идущей генерации
+        или из новой — тогда вызывается start(complete), и генерация обязана
+        вызвать complete(ответ или None) ровно один раз.
+
+        Ожидающие получают None, если генерация лидера не удалась; тогда для них
+        вызывается on_leader_failed (например, свой запрос без кеша).
+        """
+        with self._lock:
+            value = self._get_locked(key)
+            if value is None:
+                waiters = self._inflight.get(key)
+                if waiters is not None:
+                    self._stats["joined"] += 1
+                    if on_leader_failed is not None:
+                        waiters.append(lambda v: waiter(v) if v is not None else on_leader_failed())
+                    else:
+                        waiters.append(waiter)
+                    return JOINED
+                self._inflight[key] = [waiter]
+        if value is not None:
+            waiter(value)
+            return HIT
+
+        def complete(result: Optional[str]):
+            if result is not None:
+                self.put(key, result)
+            with self._lock:
+                waiters = self._inflight.pop(key, [])
+            for callback in waiters:
+                try:
+                    callback(result)
+                except Exception as e:
+                    print(f"[AI-CACHE] ❌ Ошибка доставки ответа из кеша: {e}")
+
+        try:
+            start(complete)
+        except Exception:
+            complete(None)
+            raise
+        return LEADER
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {**self._stats, "entries": len(self._entries), "inflight": len(self._inflight),
+                    "hit_rate": round((self._stats["hits"] + self._stats["joined"]) / lookups, 3) if lookups else 0.0}
+
+    # --- internal ---
+    def _get_locked(self, key: str) -> Optional[str]:
+        item = self._entries.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at > self._clock():
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return value
+            del self._entries[key]
+            self._stats["expired"] += 1
+        self._stats["misses"] += 1
+        return None
+
+
+_response_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    global _response_cache
+    if _response_cache is None:
+        with _cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache()
+    return _response_cache
+
+
+def cache_key_for_node(node, states: dict, compliance_mode: bool) -> Optional[str]:
+    """Ключ кеша для проактивного узла или None, если кеш для узла выключен."""
+    setting = node.raw.get("ai_cache")
+    if setting is False or not AI_CACHE_ENABLED:
+        return None
+    if compliance_mode and not AI_CACHE_IN_COMPLIANCE:
+        return None
+    state_keys = parse_state_keys(setting if isinstance(setting, (list, str)) else AI_CACHE_STATE_KEYS)
+    return fingerprint(node.ai_role, node.ai_task, node.options, states, state_keys)
@@ -0,0 +1,309 @@
+# app/modules/ai_jobs.py
+"""
+Фоновые задания ИИ: обработчик апдейта не ждет LLM.
+
+Обработчик отправляет заглушку «⏳ ...», собирает контекст и ставит задание в очередь
+бэкенда (gigachat / vsegpt). Для каждого бэкенда — своя ограниченная очередь и свой
+пул воркеров: число воркеров и есть лимит одновременных запросов к этому бэкенду.
+Когда ответ готов, задание само правит заглушку и пишет AIDialogue (on_done).
+
+Задания привязаны к игровой сессии: при завершении или перезапуске игры
+незапущенные задания снимаются, а у выполняющихся взводится cancel_event —
+он прерывает паузу между повторами в get_ai_response, результат отбрасывается.
+"""
+
+import itertools
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+from decouple import config
+
+AI_JOB_QUEUE_MAX = config("AI_JOB_QUEUE_MAX", default=200, cast=int)            # на бэкенд
+AI_CONCURRENCY_GIGACHAT = config("AI_CONCURRENCY_GIGACHAT", default=4, cast=int)
+AI_CONCURRENCY_VSEGPT = config("AI_CONCURRENCY_VSEGPT", default=8, cast=int)
+AI_CONCURRENCY_DEFAULT = config("AI_CONCURRENCY_DEFAULT", default=4, cast=int)
+
+# Статусы задания
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+REJECTED = "rejected"      # очередь бэкенда переполнена
+
+
+class AIJob:
+    """
+    Задание: work(cancel_event) -> результат; затем on_done(job) или on_cancel(job).
+    on_done вызывается ровно один раз для DONE / FAILED / REJECTED
+    (для REJECTED — сразу, в потоке вызвавшего submit).
+    """
+
+    __slots__ = ("job_id", "backend", "session_id", "work", "on_done", "on_cancel", "cancel_event",
+                 "status", "result", "error", "enqueued_at", "started_at", "finished_at")
+
+    def __init__(self, job_id, backend, session_id, work, on_done, on_cancel):
+        self.job_id = job_id
+        self.backend = backend
+        self.session_id = session_id
+        self.work = work
+        self.on_done = on_done
+        self.on_cancel = on_cancel
+        self.cancel_event = threading.Event()
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    @property
+    def ok(self) -> bool:
+        return self.status == DONE
+
+
+class _Backend:
+    __slots__ = ("name", "limit", "queue", "running", "threads")
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = max(1, int(limit))
+        self.queue = deque()
+        self.running = 0
+        self.threads = []
+
+
+class AIJobExecutor:
+    """
+    Пулы воркеров по бэкендам с ограниченными очередями.
+
+    Args:
+        limits: {backend: максимум одновременных запросов}; прочие бэкенды — default_limit
+        max_queue: максимум ожидающих заданий на бэкенд (сверх — REJECTED)
+    """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None, max_queue: int = AI_JOB_QUEUE_MAX,
+                 default_limit: int = AI_CONCURRENCY_DEFAULT, name: str = "AIJobs"):
+        if limits is None:
+            limits = {"gigachat": AI_CONCURRENCY_GIGACHAT, "vsegpt": AI_CONCURRENCY_VSEGPT}
+        self._limits = dict(limits)
+        self._default_limit = default_limit
+        self._max_queue = max(1, int(max_queue))
+        self._name = name
+        self._backends: Dict[str, _Backend] = {}
+        self._by_session: Dict[Any, set] = {}
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+        self._stopping = False
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "cancelled": 0, "rejected": 0}
+        self._wait_total = 0.0
+        self._run_total = 0.0
+
+    # --- public API ---
+    def submit(self, backend: str, session_id, work: Callable[[threading.Event], Any],
+               on_done: Optional[Callable[[AIJob], None]] = None,
+               on_cancel: Optional[Callable[[AIJob], None]] = None) -> AIJob:
+        job = AIJob(next(self._ids), backend, session_id, work, on_done, on_cancel)
+        with self._cond:
+            state = self._backend(backend)
+            self._stats["submitted"] += 1
+            if self._stopping or len(state.queue) >= self._max_queue:
+                job.status = REJECTED
+                self._stats["rejected"] += 1
+            else:
+                state.queue.append(job)
+                self._by_session.setdefault(session_id, set()).add(job)
+                self._cond.notify_all()
+        if job.status == REJECTED:
+            print(f"[AI-JOBS] ⚠️ Очередь {backend} переполнена ({self._max_queue}), задание сессии {session_id} отклонено")
+            self._callback(job.on_done, job)
+        return job
+
+    def cancel_session(self, session_id) -> int:
+        """Снимает все задания сессии. Возвращает число отмененных."""
+        with self._cond:
+            jobs = self._by_session.pop(session_id, set())
+        cancelled = self._cancel_jobs(jobs)
+        if cancelled:
+            print(f"[AI-JOBS] ⏹️ Сессия {session_id}: отменено заданий: {cancelled}")
+        return cancelled
+
+    def cancel(self, job: AIJob) -> bool:
+        """Снимает одно задание (например, ненужную предвыборку)."""
+        with self._cond:
+            jobs = self._by_session.get(job.session_id)
+            if jobs is not None:
+                jobs.discard(job)
+                if not jobs:
+                    self._by_session.pop(job.session_id, None)
+        return self._cancel_jobs([job]) == 1
+
+    def queue_length(self, backend: Optional[str] = None) -> int:
+        with self._cond:
+            states = [self._backends[backend]] if backend in self._backends else (
+                [] if backend is not None else list(self._backends.values()))
+            return sum(len(s.queue) for s in states)
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Ждет, пока все очереди опустеют и воркеры освободятся."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while any(s.queue or s.running for s in self._backends.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout: Optional[float] = None):
+        """Новые задания отклоняются, ожидающие дорабатываются."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads = [t for s in self._backends.values() for t in s.threads]
+        for thread in threads:
+            thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            now = time.monotonic()
+            backends = {}
+            for name, s in self._backends.items():
+                backends[name] = {
+                    "queued": len(s.queue),
+                    "running": s.running,
+                    "limit": s.limit,
+                    "oldest_wait_seconds": round(now - s.queue[0].enqueued_at, 3) if s.queue else 0.0,
+                }
+            finished = self._stats["completed"] + self._stats["failed"]
+            return {
+                **self._stats,
+                "queued": sum(b["queued"] for b in backends.values()),
+                "running": sum(b["running"] for b in backends.values()),
+                "avg_wait_seconds": round(self._wait_total / finished, 3) if finished else 0.0,
+                "avg_run_seconds": round(self._run_total / finished, 3) if finished else 0.0,
+                "max_queue": self._max_queue,
+                "backends": backends,
+            }
+
+    # --- internal ---
+    def _cancel_jobs(self, jobs) -> int:
+        """Незапущенные задания снимаются с очереди, у выполняющихся взводится cancel_event."""
+        with self._cond:
+            cancelled = []
+            for job in jobs:
+                if job.status in (QUEUED, RUNNING) and not job.cancelled:
+                    job.cancel_event.set()
+                    cancelled.append(job)
+                    if job.status == QUEUED:
+                        self._backends[job.backend].queue.remove(job)
+                        job.status = CANCELLED
+                        self._stats["cancelled"] += 1
+            self._cond.notify_all()
+        for job in cancelled:
+            if job.status == CANCELLED:
+                self._callback(job.on_cancel, job)
+        return len(cancelled)
+
+    def _backend(self, name) -> _Backend:
+        """Пул бэкенда создается при первом задании (под self._cond)."""
+        state = self._backends.get(name)
+        if state is None:
+            state = _Backend(name, self._limits.get(name, self._default_limit))
+            for i in range(state.limit):
+                thread = threading.Thread(target=self._worker, args=(state,), daemon=True,
+                                          name=f"{self._name}-{name}-{i}")
+                state.threads.append(thread)
+                thread.start()
+            self._backends[name] = state
+        return state
+
+    def _worker(self, state: _Backend):
+        while True:
+            with self._cond:
+                while not state.queue and not self._stopping:
+                    self._cond.wait()
+                if not state.queue:
+                    return
+                job = state.queue.popleft()
+                job.status = RUNNING
+                job.started_at = time.monotonic()
+                state.running += 1
+
+            try:
+                job.result = job.work(job.cancel_event)
+                status = DONE
+            except Exception as e:
+                job.error = e
+                status = FAILED
+                print(f"[AI-JOBS] ❌ Задание {job.job_id} ({job.backend}) упало: {type(e).__name__}: {e}")
+                traceback.print_exc()
+            job.finished_at = time.monotonic()
+
+            with self._cond:
+                jobs = self._by_session.get(job.session_id)
+                if jobs is not None:
+                    jobs.discard(job)
+                    if not jobs:
+                        self._by_session.pop(job.session_id, None)
+                if job.cancelled:
+                    status = CANCELLED
+                    self._stats["cancelled"] += 1
+                else:
+                    self._stats["completed" if status == DONE else "failed"] += 1
+                    self._wait_total += job.started_at - job.enqueued_at
+                    self._run_total += job.finished_at - job.started_at
+                job.status = status
+
+            # Колбэк — вне блокировки; воркер считается занятым до его конца (join ждет и его)
+            self._callback(job.on_cancel if status == CANCELLED else job.on_done, job)
+            with self._cond:
+                state.running -= 1
+                self._cond.notify_all()
+
+    @staticmethod
+    def _callback(callback, job: AIJob):
+        if callback is None:
+            return
+        try:
+            callback(job)
+        except Exception:
+            print(f"[AI-JOBS] ❌ Ошибка в обработчике результата задания {job.job_id}")
+            traceback.print_exc()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_ai_executor() -> AIJobExecutor:
+    """Общий исполнитель заданий ИИ процесса (создается при первом обращении)."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = AIJobExecutor()
+    return _executor
+
+
+def submit_ai_job(backend: str, session_id, work, on_done=None, on_cancel=None) -> AIJob:
+    return get_ai_executor().submit(backend, session_id, work, on_done, on_cancel)
+
+
+def cancel_ai_job(job: AIJob) -> bool:
+    if _executor is None:
+        return False
+    return _executor.cancel(job)
+
+
+def cancel_session_jobs(session_id) -> int:
+    if _executor is None:
+        return 0
+    return _executor.cancel_session(session_id)
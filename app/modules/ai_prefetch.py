@@ -0,0 +1,196 @@
+# app/modules/ai_prefetch.py
+"""
+Предвыборка (speculative prefetch) ответов проактивных узлов ИИ.
+
+Пока игрок читает вопрос, для каждого варианта, ведущего (через state/condition)
+в узел ai_proactive, промпт собирается «как после этого выбора» (crud.context_after_choice)
+и генерация ставится в очередь ai_jobs. Когда игрок приходит в узел, промпт собирается
+заново: если он совпал с предсказанным, заглушка сразу получает готовый (или уже
+идущий) ответ, остальные предвыборки сессии снимаются.
+
+Включается AI_PREFETCH_ENABLED=true; узел исключается полем "ai_prefetch": false.
+Расход ограничен на граф: не больше AI_PREFETCH_MAX_INFLIGHT одновременных
+предвыборок и AI_PREFETCH_TOKENS_PER_HOUR токенов промпта в час (оценка prompt_budget).
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+from decouple import config
+
+from app.modules.prompt_budget import estimate_tokens
+
+AI_PREFETCH_ENABLED = config("AI_PREFETCH_ENABLED", default=False, cast=bool)
+AI_PREFETCH_MAX_INFLIGHT = config("AI_PREFETCH_MAX_INFLIGHT", default=10, cast=int)             # на граф
+AI_PREFETCH_TOKENS_PER_HOUR = config("AI_PREFETCH_TOKENS_PER_HOUR", default=200000, cast=int)   # на граф, 0 — без лимита
+
+SPEND_WINDOW_SECONDS = 3600.0
+
+
+class PrefetchEntry:
+    """Одна предвыборка: ответ для target_node_id, если игрок выберет option_text в source_node_id."""
+
+    __slots__ = ("graph_id", "session_id", "source_node_id", "option_text", "target_node_id", "prompt",
+                 "job", "started_at", "ready_at", "claimed_at", "result", "done", "_callbacks")
+
+    def __init__(self, graph_id, session_id, source_node_id, option_text, target_node_id, prompt, started_at):
+        self.graph_id = graph_id
+        self.session_id = session_id
+        self.source_node_id = source_node_id
+        self.option_text = option_text
+        self.target_node_id = target_node_id
+        self.prompt = prompt
+        self.job = None
+        self.started_at = started_at
+        self.ready_at = None
+        self.claimed_at = None
+        self.result = None
+        self.done = False
+        self._callbacks: List[Callable[[Optional[str]], None]] = []
+
+
+class Prefetcher:
+    def __init__(self, max_inflight: int = AI_PREFETCH_MAX_INFLIGHT,
+                 tokens_per_hour: int = AI_PREFETCH_TOKENS_PER_HOUR,
+                 cancel_job: Optional[Callable] = None, clock: Callable[[], float] = time.monotonic):
+        self.max_inflight = max(1, int(max_inflight))
+        self.tokens_per_hour = int(tokens_per_hour)
+        self._cancel_job = cancel_job
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._sessions: Dict[int, List[PrefetchEntry]] = {}
+        self._inflight: Dict[str, int] = {}          # graph_id -> генерации в работе
+        self._spend: Dict[str, deque] = {}           # graph_id -> (время, токены)
+        self._stats = {"started": 0, "skipped_cap": 0, "hits": 0, "misses": 0, "wasted": 0,
+                       "dropped_before_start": 0, "saved_seconds": 0.0}
+
+    def start(self, graph_id, session_id, source_node_id, option_text, target_node_id, prompt: str,
+              submit: Callable[[Callable, Callable], object]) -> bool:
+        """
+        Ставит предвыборку. submit(on_done, on_cancel) отправляет задание в ai_jobs и возвращает AIJob.
+        False — лимит расхода графа исчерпан.
+        """
+        tokens = estimate_tokens(prompt)
+        now = self._clock()
+        with self._lock:
+            spend = self._spend.setdefault(graph_id, deque())
+            while spend and now - spend[0][0] > SPEND_WINDOW_SECONDS:
+                spend.popleft()
+            spent = sum(t for _, t in spend)
+            if self._inflight.get(graph_id, 0) >= self.max_inflight or (
+                    self.tokens_per_hour > 0 and spent + tokens > self.tokens_per_hour):
+                self._stats["skipped_cap"] += 1
+                return False
+            spend.append((now, tokens))
+            self._inflight[graph_id] = self._inflight.get(graph_id, 0) + 1
+            entry = PrefetchEntry(graph_id, session_id, source_node_id, option_text, target_node_id, prompt, now)
+            self._sessions.setdefault(session_id, []).append(entry)
+            self._stats["started"] += 1
+        print(f"[AI-PREFETCH] 🔮 Сессия {session_id}: «{option_text}» -> {target_node_id} (~{tokens} ток.)")
+        entry.job = submit(lambda job: self._finish(entry, job.result if job.ok else None),
+                           lambda job: self._finish(entry, None))
+        return True
+
+    def choose(self, session_id, source_node_id, option_text):
+        """Игрок выбрал вариант: предвыборки других вариантов больше не нужны."""
+        self._drop(session_id, lambda e: e.source_node_id == source_node_id and e.option_text == option_text)
+
+    def claim(self, session_id, target_node_id, build_prompt: Callable[[], str]) -> Optional[PrefetchEntry]:
+        """
+        Игрок пришел в проактивный узел. Возвращает предвыборку, если ее промпт совпал
+        с фактическим (build_prompt вызывается, только если предвыборка для узла есть).
+        Все прочие предвыборки сессии снимаются.
+        """
+        with self._lock:
+            candidates = [e for e in self._sessions.get(session_id, ()) if e.target_node_id == target_node_id]
+        if not candidates:
+            self._drop(session_id)
+            return None
+        prompt = build_prompt()
+        match = next((e for e in candidates if e.prompt == prompt), None)
+        self._drop(session_id, lambda e: e is match)
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._stats["hits" if match else "misses"] += 1
+            if match is not None:
+                match.claimed_at = self._clock()
+                if match.done and match.result:
+                    # Ответ готов к приходу игрока — сэкономлена вся генерация
+                    self._stats["saved_seconds"] += match.ready_at - match.started_at
+        if match is None:
+            print(f"[AI-PREFETCH] ❎ Сессия {session_id}, узел {target_node_id}: промпт изменился, генерируем заново")
+        return match
+
+    def when_ready(self, entry: PrefetchEntry, callback: Callable[[Optional[str]], None]):
+        """callback(ответ или None) — сразу, если предвыборка готова, иначе по готовности."""
+        with self._lock:
+            if not entry.done:
+                entry._callbacks.append(callback)
+                return
+        callback(entry.result)
+
+    def drop_session(self, session_id):
+        self._drop(session_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            claimed = self._stats["hits"] + self._stats["misses"]
+            return {**self._stats, "saved_seconds": round(self._stats["saved_seconds"], 3),
+                    "hit_rate": round(self._stats["hits"] / claimed, 3) if claimed else 0.0,
+                    "pending": sum(len(v) for v in self._sessions.values()),
+                    "inflight_by_graph": dict(self._inflight)}
+
+    # --- internal ---
+    def _finish(self, entry: PrefetchEntry, result: Optional[str]):
+        with self._lock:
+            if entry.done:
+                return
+            entry.done, entry.result, entry.ready_at = True, result, self._clock()
+            self._inflight[entry.graph_id] = max(0, self._inflight.get(entry.graph_id, 1) - 1)
+            callbacks, entry._callbacks = entry._callbacks, []
+            if entry.claimed_at is not None and result:
+                # Игрок пришел раньше готовности — сэкономлено время от старта до прихода
+                self._stats["saved_seconds"] += max(0.0, min(entry.ready_at, entry.claimed_at) - entry.started_at)
+        for callback in callbacks:
+            try:
+                callback(result)
+            except Exception as e:
+                print(f"[AI-PREFETCH] ❌ Ошибка доставки предвыборки: {e}")
+
+    def _drop(self, session_id, keep: Callable[[PrefetchEntry], bool] = lambda e: False):
+        with self._lock:
+            entries = self._sessions.get(session_id, [])
+            dropped = [e for e in entries if not keep(e)]
+            if not dropped:
+                return
+            kept = [e for e in entries if keep(e)]
+            if kept:
+                self._sessions[session_id] = kept
+            else:
+                self._sessions.pop(session_id, None)
+            for e in dropped:
+                job_started = e.job is not None and getattr(e.job, "started_at", None) is not None
+                self._stats["wasted" if job_started or e.done else "dropped_before_start"] += 1
+        for e in dropped:
+            if not e.done and e.job is not None and self._cancel_job is not None:
+                self._cancel_job(e.job)
+
+
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+
+def get_prefetcher() -> Prefetcher:
+    global _prefetcher
+    if _prefetcher is None:
+        with _prefetcher_lock:
+            if _prefetcher is None:
+                from app.modules.ai_jobs import cancel_ai_job
+                _prefetcher = Prefetcher(cancel_job=cancel_ai_job)
+    return _prefetcher
+
+
+def is_prefetchable(node) -> bool:
+    return AI_PREFETCH_ENABLED and node.raw.get("ai_prefetch", True) is not False
@@ -0,0 +1,229 @@
+# app/modules/ai_resilience.py
+"""
+Устойчивость вызовов LLM: предохранитель (circuit breaker) и дублирующие запросы (hedging).
+
+Предохранитель — на каждую модель из MODELS. После AI_BREAKER_FAILURES ошибок подряд
+он размыкается (open): запросы к модели сразу получают отказ, без трех попыток
+с паузами 2 + 4 сек. Через AI_BREAKER_RESET_SECONDS пропускается один пробный запрос
+(half-open): успех замыкает цепь, ошибка — снова размыкает.
+
+Hedging (только COMPLIANCE_MODE=false): если основная модель VseGPT не ответила
+за свой p95 задержки, параллельно уходит запрос к AI_HEDGE_MODEL; берется тот ответ,
+что пришел первым. p95 считается по последним успешным ответам модели; пока их меньше
+AI_HEDGE_MIN_SAMPLES, используется AI_HEDGE_DEFAULT_DELAY.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Optional
+
+from decouple import config
+
+AI_BREAKER_FAILURES = config("AI_BREAKER_FAILURES", default=3, cast=int)
+AI_BREAKER_RESET_SECONDS = config("AI_BREAKER_RESET_SECONDS", default=30.0, cast=float)
+AI_HEDGE_MODEL = config("AI_HEDGE_MODEL", default="")            # пусто — hedging выключен
+AI_HEDGE_DEFAULT_DELAY = config("AI_HEDGE_DEFAULT_DELAY", default=8.0, cast=float)
+AI_HEDGE_MIN_DELAY = config("AI_HEDGE_MIN_DELAY", default=1.0, cast=float)
+AI_HEDGE_MIN_SAMPLES = config("AI_HEDGE_MIN_SAMPLES", default=20, cast=int)
+AI_HEDGE_WORKERS = config("AI_HEDGE_WORKERS", default=16, cast=int)
+
+# Состояния предохранителя
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """Модель временно отключена предохранителем."""
+
+
+class CircuitBreaker:
+    """Предохранитель одной модели: closed -> open -> half_open -> closed/open."""
+
+    def __init__(self, name: str, failure_threshold: int = AI_BREAKER_FAILURES,
+                 reset_timeout: float = AI_BREAKER_RESET_SECONDS, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = float(reset_timeout)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._stats = {"successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def allow(self) -> bool:
+        """True — запрос можно отправить (в half_open — только один пробный)."""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self._stats["rejected"] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._stats["successes"] += 1
+            if self._state != CLOSED:
+                print(f"[AI-BREAKER] ✅ {self.name}: модель снова доступна")
+            self._state, self._failures, self._probe_in_flight = CLOSED, 0, False
+
+    def record_failure(self):
+        with self._lock:
+            self._stats["failures"] += 1
+            self._failures += 1
+            state = self._current_state()
+            if state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if state != OPEN:
+                    self._stats["opened"] += 1
+                    print(f"[AI-BREAKER] 🔌 {self.name}: {self._failures} ошибок подряд, "
+                          f"запросы отключены на {self.reset_timeout:.0f} сек")
+                self._state, self._opened_at, self._probe_in_flight = OPEN, self._clock(), False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "state": self._current_state(), "consecutive_failures": self._failures}
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+        return self._state
+
+
+class LatencyTracker:
+    """Задержки последних успешных ответов модели (скользящее окно)."""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._samples)
+
+
+_lock = threading.Lock()
+_breakers: Dict[str, CircuitBreaker] = {}
+_latencies: Dict[str, LatencyTracker] = {}
+_hedge_stats = {"calls": 0, "hedged": 0, "primary_wins": 0, "hedge_wins": 0, "both_failed": 0}
+_hedge_pool = None
+
+
+def get_breaker(model_name: str) -> CircuitBreaker:
+    with _lock:
+        breaker = _breakers.get(model_name)
+        if breaker is None:
+            breaker = _breakers[model_name] = CircuitBreaker(model_name)
+        return breaker
+
+
+def get_latency(model_name: str) -> LatencyTracker:
+    with _lock:
+        tracker = _latencies.get(model_name)
+        if tracker is None:
+            tracker = _latencies[model_name] = LatencyTracker()
+        return tracker
+
+
+def hedge_delay(model_name: str) -> float:
+    """Сколько ждать основную модель до дублирующего запроса: её p95 (или дефолт)."""
+    tracker = get_latency(model_name)
+    if len(tracker) < AI_HEDGE_MIN_SAMPLES:
+        return AI_HEDGE_DEFAULT_DELAY
+    return max(AI_HEDGE_MIN_DELAY, tracker.percentile(0.95))
+
+
+def call_with_breaker(model_name: str, call: Callable[[], str]) -> str:
+    """Вызов модели через её предохранитель; успешные задержки идут в p95."""
+    breaker = get_breaker(model_name)
+    if not breaker.allow():
+        raise CircuitOpenError(f"{model_name}: предохранитель разомкнут")
+    started = time.monotonic()
+    try:
+        result = call()
+    except Exception:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+    get_latency(model_name).record(time.monotonic() - started)
+    return result
+
+
+def hedged_call(primary_name: str, primary: Callable[[], str], hedge_name: str, hedge: Callable[[], str],
+                delay: Optional[float] = None) -> str:
+    """
+    Основной запрос; если за delay (по умолчанию p95 основной модели) нет ответа —
+    дублирующий к hedge_name. Возвращает первый успешный ответ; если упали оба —
+    пробрасывает ошибку основного. Проигравший запрос дорабатывает в фоне.
+    """
+    pool = _get_hedge_pool()
+    delay = hedge_delay(primary_name) if delay is None else delay
+    with _lock:
+        _hedge_stats["calls"] += 1
+
+    first = pool.submit(call_with_breaker, primary_name, primary)
+    done, _ = wait([first], timeout=delay)
+    if done or get_breaker(hedge_name).state != CLOSED:
+        return first.result()
+
+    print(f"[AI-HEDGE] ⏱️ {primary_name} молчит дольше {delay:.1f} сек, дублирую запрос в {hedge_name}")
+    second = pool.submit(call_with_breaker, hedge_name, hedge)
+    names = {first: "primary_wins", second: "hedge_wins"}
+    with _lock:
+        _hedge_stats["hedged"] += 1
+    pending = {first, second}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                with _lock:
+                    _hedge_stats[names[future]] += 1
+                return future.result()
+    with _lock:
+        _hedge_stats["both_failed"] += 1
+    return first.result()
+
+
+def resilience_stats() -> dict:
+    with _lock:
+        breakers = dict(_breakers)
+        latencies = dict(_latencies)
+        hedging = dict(_hedge_stats)
+    hedged = hedging["hedged"]
+    hedging["hedge_win_rate"] = round(hedging["hedge_wins"] / hedged, 3) if hedged else 0.0
+    hedging["model"] = AI_HEDGE_MODEL or None
+    return {
+        "breakers": {name: breaker.stats() for name, breaker in breakers.items()},
+        "latency_p95_seconds": {name: round(t.percentile(0.95) or 0.0, 3) for name, t in latencies.items()},
+        "hedging": hedging,
+    }
+
+
+def _get_hedge_pool() -> ThreadPoolExecutor:
+    global _hedge_pool
+    with _lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=AI_HEDGE_WORKERS, thread_name_prefix="AIHedge")
+        return _hedge_pool
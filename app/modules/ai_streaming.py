@@ -0,0 +1,145 @@
+# app/modules/ai_streaming.py
+"""
+Потоковые ответы ИИ: текст появляется в Telegram по мере генерации.
+
+Дельты читаются из стримингового API клиентов (GigaChat.stream и OpenAI-совместимый
+chat.completions с stream=True — оба отдают SSE-чанки с choices[0].delta.content).
+StreamingMessage правит заглушку «⏳ ...» накопленным текстом, но не чаще одного раза
+в AI_STREAM_EDIT_INTERVAL секунд на чат: лимит Bot API на правки общий для чата,
+а промежуточные правки — «косметика» (edit_cosmetic: низкий приоритет, схлопывание).
+Финальную правку с разметкой делает обработчик.
+"""
+
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+from decouple import config
+
+from app.modules.telegram_sender import edit_cosmetic
+
+AI_STREAM_EDIT_INTERVAL = config("AI_STREAM_EDIT_INTERVAL", default=1.5, cast=float)
+STREAM_CURSOR = " ▌"
+
+
+def openai_deltas(client, model_id: str, messages: list, temperature: float) -> Iterator[str]:
+    """Фрагменты текста из OpenAI-совместимого API (VseGPT) в режиме stream=True."""
+    stream = client.chat.completions.create(
+        model=model_id, messages=messages, temperature=temperature, stream=True
+    )
+    try:
+        for chunk in stream:
+            if chunk.choices:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+    finally:
+        stream.close()
+
+
+def gigachat_deltas(client, chat) -> Iterator[str]:
+    """Фрагменты текста из GigaChat.stream(Chat(...))."""
+    for chunk in client.stream(chat):
+        if chunk.choices:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+
+def collect_stream(deltas, on_text, cancel_event, backend_name: str = "LLM") -> str:
+    """
+    Собирает ответ из фрагментов, передавая накопленный текст в on_text.
+    Обрыв после первых фрагментов не повторяется (игрок уже видит начало) — отдаем что есть.
+    """
+    text = ""
+    first_chunk_at = None
+    start_time = time.time()
+    try:
+        for delta in deltas:
+            if first_chunk_at is None:
+                first_chunk_at = time.time()
+                print(f"[AI] ⚡ Первый фрагмент {backend_name} через {int((first_chunk_at - start_time) * 1000)}ms")
+            text += delta
+            on_text(text)
+            if cancel_event is not None and cancel_event.is_set():
+                print("[AI] ⏹️ Генерация прервана (сессия завершена)")
+                break
+    except Exception as e:
+        if not text:
+            raise
+        print(f"[AI] ⚠️ Поток {backend_name} оборвался ({type(e).__name__}), отдаем полученные {len(text)} символов")
+    finally:
+        close = getattr(deltas, "close", None)
+        if close:
+            close()
+    if not text:
+        raise ValueError(f"{backend_name} вернул пустой ответ")
+    return text
+
+
+class EditThrottle:
+    """Не чаще одной правки в interval секунд на чат (общий для всех потоков чата)."""
+
+    def __init__(self, interval: float = AI_STREAM_EDIT_INTERVAL, clock: Callable[[], float] = time.monotonic):
+        self.interval = float(interval)
+        self._clock = clock
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def allow(self, chat_id) -> bool:
+        """True — правку можно отправить сейчас (время правки сразу резервируется)."""
+        now = self._clock()
+        with self._lock:
+            last = self._last.get(chat_id)
+            if last is not None and now - last < self.interval:
+                return False
+            self._last[chat_id] = now
+            # Записи старше интервала не нужны — не даем словарю расти
+            if len(self._last) > 10000:
+                self._last = {k: v for k, v in self._last.items() if now - v < self.interval}
+            return True
+
+
+_default_throttle = EditThrottle()
+
+
+class StreamingMessage:
+    """
+    Заглушка, которая дописывается по мере генерации.
+
+    update(text) получает весь накопленный текст; правка уходит, только если
+    троттлинг чата разрешает, иначе текст дождется следующего фрагмента или финала.
+    """
+
+    def __init__(self, bot, chat_id, message_id, header: str = "", throttle: Optional[EditThrottle] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.header = header
+        self.throttle = throttle or _default_throttle
+        self._clock = clock
+        self.started_at = clock()
+        self.first_edit_at = None
+        self.edits = 0
+        self.skipped = 0
+        self.text = ""
+
+    def update(self, text: str):
+        self.text = text
+        if not text.strip() or not self.throttle.allow(self.chat_id):
+            self.skipped += 1
+            return
+        try:
+            # Без parse_mode: незакрытая разметка в середине ответа ломает Markdown
+            edit_cosmetic(self.bot, f"{self.header}{text}{STREAM_CURSOR}", self.chat_id, self.message_id)
+        except Exception as e:
+            print(f"[AI-STREAM] ⚠️ Промежуточная правка не выполнена: {e}")
+            return
+        self.edits += 1
+        if self.first_edit_at is None:
+            self.first_edit_at = self._clock()
+
+    @property
+    def first_edit_latency(self) -> Optional[float]:
+        return None if self.first_edit_at is None else self.first_edit_at - self.started_at
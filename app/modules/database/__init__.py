@@ -12,4 +12,7 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def init_db():
     # Комментарий: Эта функция создает таблицы в базе данных на основе моделей.
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+
+# Единица работы на апдейт: одна сессия и одна транзакция (см. unit_of_work.py)
+from .unit_of_work import unit_of_work, current_session, in_unit_of_work  # noqa: E402
@@ -0,0 +1,175 @@
+# app/modules/database/ai_context.py
+"""
+Накопитель контекста ИИ по сессии: история ответов и изменения состояния в памяти.
+
+Раньше каждый вызов ИИ перечитывал все responses и user_states сессии — стоимость
+росла с длиной игры. Теперь сессия загружается из БД один раз (при первом вызове ИИ),
+а дальше create_response и изменения состояния (запись user_states или кеш состояния
+до записи) дописывают события в накопитель.
+Блоки промпта (досье, хронология, последние действия, история переменных) хранятся
+готовыми строками, поэтому сборка промпта стоит O(новых событий), а не O(длины сессии).
+
+Если транзакция апдейта откатывается, накопитель сессии сбрасывается и при следующем
+обращении восстанавливается из БД (rebuild). История переменной (первое, предыдущее и текущее
+значения) хранится в строке user_states, поэтому пересобранный промпт совпадает с живым.
+"""
+
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from . import models
+
+# Ответы с такими подстроками в node_id — социально-демографический профиль (досье)
+PROFILE_KEYS = ('возраст', 'пол', 'образование', 'доход', 'риск', 'приоритет', 'стратегия', 'цель')
+RECENT_LIMIT = 3
+
+
+def _squash(text) -> str:
+    return ' '.join((text or '').split())
+
+
+class SessionContext:
+    """Контекст одной сессии. Заполняется через add_response / add_states (при загрузке — set_state)."""
+
+    __slots__ = ('profile_lines', 'history_lines', 'profile_text', 'history_text', 'recent',
+                 'last_action', 'states', 'responses', 'memory')
+
+    def __init__(self):
+        self.profile_lines = 0
+        self.history_lines = 0
+        self.profile_text = ""     # «- ответ» построчно
+        self.history_text = ""     # «- Событие: ... / - Решение игрока: ...»
+        self.recent = deque(maxlen=RECENT_LIMIT)
+        self.last_action = ""
+        self.states: Dict[str, List[Optional[str]]] = {}   # key -> [initial, previous, current]
+        self.responses = 0
+        self.memory = None         # снимок session_memory (только в предвыборке: контекст «после выбора»)
+
+    def add_response(self, node_id, node_text, answer_text):
+        self.responses += 1
+        event_text, choice_text = _squash(node_text), _squash(answer_text)
+        if any(key in (node_id or "").lower() for key in PROFILE_KEYS):
+            line = f"- {choice_text}"
+            self.profile_text = f"{self.profile_text}\n{line}" if self.profile_lines else line
+            self.profile_lines += 1
+        else:
+            line = f"- Событие: «{event_text}»\n  - Решение игрока: «{choice_text}»"
+            self.history_text = f"{self.history_text}\n{line}" if self.history_lines else line
+            self.history_lines += 1
+        self.recent.append(f"- {event_text} → {choice_text}")
+
+        node, ans = (node_text or "").strip(), (answer_text or "").strip()
+        self.last_action = f"{node} — {ans}" if node and ans else (node or ans or "")
+
+    def add_states(self, mapping: dict):
+        for key, value in mapping.items():
+            value = str(value)
+            seq = self.states.get(key)
+            if seq is None:
+                self.states[key] = [value, None, value]
+            else:
+                # Каждая запись — шаг истории (delta=0, если значение не изменилось)
+                seq[1], seq[2] = seq[2], value
+
+    def set_state(self, key: str, initial: Optional[str], previous: Optional[str], current: str):
+        """История переменной из строки user_states (первое, предыдущее, текущее значения)."""
+        # Строки до появления initial_value: первое значение неизвестно, как у новой переменной
+        self.states[key] = [current if initial is None else initial, previous, current]
+
+    def recent_history(self) -> str:
+        return "\n".join(self.recent)
+
+    def copy(self) -> "SessionContext":
+        """Снимок для сборки промпта: строки неизменяемы, копируются только мелкие контейнеры."""
+        other = SessionContext()
+        for name in ('profile_lines', 'history_lines', 'profile_text', 'history_text', 'last_action', 'responses'):
+            setattr(other, name, getattr(self, name))
+        other.recent = deque(self.recent, maxlen=RECENT_LIMIT)
+        other.states = {key: list(seq) for key, seq in self.states.items()}
+        return other
+
+
+class SessionContextCache:
+    """
+    Накопители контекста активных сессий (LRU по числу сессий).
+
+    События для сессий, которых нет в кеше, игнорируются: они уже в БД
+    и попадут в накопитель при его загрузке.
+    """
+
+    def __init__(self, max_sessions: int = 5000):
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[int, SessionContext]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._stats = {'hits': 0, 'rebuilds': 0, 'events': 0, 'invalidations': 0}
+
+    def get(self, db: Session, user_id: int, session_id: int,
+            pending: Optional[Callable[[int], dict]] = None) -> SessionContext:
+        """
+        Снимок контекста сессии (при промахе — одна загрузка из БД).
+        pending(session_id) — изменения состояния, еще не записанные в user_states: при загрузке дописываются шагом.
+        """
+        with self._lock:
+            ctx = self._sessions.get(session_id)
+            if ctx is not None:
+                self._sessions.move_to_end(session_id)
+                self._stats['hits'] += 1
+                return ctx.copy()
+        ctx = self.rebuild(db, user_id, session_id)
+        if pending is not None:
+            changes = pending(session_id)
+            if changes:
+                ctx.add_states(changes)
+        with self._lock:
+            # Параллельная загрузка той же сессии: оставляем первую
+            ctx = self._sessions.setdefault(session_id, ctx)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            return ctx.copy()
+
+    def rebuild(self, db: Session, user_id: int, session_id: int) -> SessionContext:
+        """Полная загрузка из БД: два запроса на сессию."""
+        ctx = SessionContext()
+        responses = db.query(models.Response.node_id, models.Response.node_text, models.Response.answer_text)\
+            .filter(models.Response.session_id == session_id).order_by(models.Response.id).all()
+        for node_id, node_text, answer_text in responses:
+            ctx.add_response(node_id, node_text, answer_text)
+        states = db.query(models.UserState.state_key, models.UserState.initial_value,
+                          models.UserState.previous_value, models.UserState.state_value).filter(
+            models.UserState.user_id == user_id, models.UserState.session_id == session_id
+        ).order_by(models.UserState.id).all()
+        for key, initial, previous, current in states:
+            ctx.set_state(key, initial, previous, current)
+        with self._lock:
+            self._stats['rebuilds'] += 1
+        return ctx
+
+    def record_response(self, session_id: int, node_id, node_text, answer_text):
+        with self._lock:
+            ctx = self._sessions.get(session_id)
+            if ctx is not None:
+                ctx.add_response(node_id, node_text, answer_text)
+                self._stats['events'] += 1
+
+    def record_states(self, session_id: int, mapping: dict):
+        with self._lock:
+            ctx = self._sessions.get(session_id)
+            if ctx is not None:
+                ctx.add_states(mapping)
+                self._stats['events'] += 1
+
+    def invalidate(self, session_id: int):
+        with self._lock:
+            if self._sessions.pop(session_id, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, 'sessions': len(self._sessions)}
@@ -0,0 +1,454 @@
+# app/modules/database/analytics.py
+"""
+Агрегаты аналитики сценариев, обновляемые инкрементально (ANALYTICS_MODE).
+
+Раньше каждое обновление дашборда пересчитывало по сырым responses распределения выборов,
+отвалы и время между узлами. Дельта-задание refresh_analytics() дописывает в агрегатные
+таблицы (models.Analytics*) только строки, появившиеся после курсора:
+
+  - analytics_node_choices — число ответов (graph_id, node_id, answer_text);
+  - analytics_funnel, analytics_graph_stats — воронка по шагам, начатые и завершенные сессии;
+  - analytics_node_stats, analytics_dwell_histogram — ответы на узле, отвалы (незавершенные
+    сессии, остановившиеся после ответа на узел) и время на узле: от предыдущего ответа
+    (или начала сессии) до ответа на этот узел.
+
+Курсоры (analytics_cursors): id последней учтенной сессии и ответа, (end_time, id) последнего
+учтенного завершения. Состояние сессии между запусками — analytics_session_progress (строка на
+сессию). Строки моложе ANALYTICS_SETTLE_SECONDS ждут следующего запуска: транзакция апдейта
+открыта и во время синхронных отправок в Telegram (до OUTBOUND_SEND_TIMEOUT), а время строки в
+PostgreSQL — начало транзакции, поэтому строки фиксируются не в порядке id. Окно не короче самой
+долгой единицы работы — как EXPORT_SETTLE_SECONDS у выгрузки, — иначе курсор уходит за строку
+с меньшим id, зафиксированную позже, и она не учитывается никогда.
+
+Режимы ANALYTICS_MODE:
+  off      — фонового обновления нет (refresh вручную: tools/analytics.py refresh);
+  periodic — фоновый поток раз в ANALYTICS_REFRESH_INTERVAL сек;
+  on_write — то же, плюс проход через ANALYTICS_WRITE_DELAY + ANALYTICS_SETTLE_SECONDS сек
+             после коммита ответа или завершения сессии (раньше строка еще «свежая»). Счетчики не обновляются в транзакции апдейта: строки
+             популярных узлов стали бы общей блокировкой для всех игроков.
+
+Запросы (choice_distribution, funnel, node_dropoff, dwell_histogram) читают только агрегаты.
+"""
+
+import threading
+import time
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from decouple import config
+from sqlalchemy import and_, not_
+from sqlalchemy.orm import Session
+
+from . import models
+
+ANALYTICS_MODE = config("ANALYTICS_MODE", default="off").strip().lower()
+ANALYTICS_REFRESH_INTERVAL = config("ANALYTICS_REFRESH_INTERVAL", default=60.0, cast=float)
+ANALYTICS_WRITE_DELAY = config("ANALYTICS_WRITE_DELAY", default=1.0, cast=float)
+ANALYTICS_BATCH_SIZE = config("ANALYTICS_BATCH_SIZE", default=5000, cast=int)
+ANALYTICS_SETTLE_SECONDS = config("ANALYTICS_SETTLE_SECONDS", default=60.0, cast=float)
+
+# Нижние границы интервалов гистограммы времени на узле, сек
+DWELL_BUCKETS = (0, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600)
+
+AGGREGATE_MODELS = (
+    models.AnalyticsNodeChoice, models.AnalyticsDwellBucket, models.AnalyticsNodeStats,
+    models.AnalyticsFunnelStep, models.AnalyticsGraphStats, models.AnalyticsSessionProgress,
+    models.AnalyticsCursor,
+)
+_IN_CHUNK = 500
+
+
+def dwell_bucket(seconds: float) -> int:
+    return max(0, bisect_right(DWELL_BUCKETS, seconds) - 1)
+
+
+def _utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Время без зоны (SQLite) и с зоной (PostgreSQL) к одному виду: наивное UTC."""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _is_fresh(value: Optional[datetime], settled: datetime) -> bool:
+    return value is not None and _utc(value) > _utc(settled)
+
+
+def _seconds_between(later, earlier) -> Optional[float]:
+    later, earlier = _utc(later), _utc(earlier)
+    if later is None or earlier is None:
+        return None
+    return max(0.0, (later - earlier).total_seconds())
+
+
+class _Delta:
+    """Приращения агрегатов одного прохода; применяются UPSERT-ом пачкой на таблицу."""
+
+    def __init__(self):
+        self.graphs = defaultdict(lambda: {"sessions": 0, "completed": 0, "responses": 0})
+        self.funnel = defaultdict(lambda: {"sessions": 0})
+        self.nodes = defaultdict(lambda: {"visits": 0, "dropoffs": 0, "dwell_count": 0, "dwell_seconds": 0.0})
+        self.choices = defaultdict(lambda: {"count": 0})
+        self.dwell = defaultdict(lambda: {"count": 0})
+
+    def apply(self, db: Session):
+        _increment(db, models.AnalyticsGraphStats, ("graph_id",), self.graphs)
+        _increment(db, models.AnalyticsFunnelStep, ("graph_id", "step"), self.funnel)
+        _increment(db, models.AnalyticsNodeStats, ("graph_id", "node_id"), self.nodes)
+        _increment(db, models.AnalyticsNodeChoice, ("graph_id", "node_id", "answer_text"), self.choices)
+        _increment(db, models.AnalyticsDwellBucket, ("graph_id", "node_id", "bucket"), self.dwell)
+
+
+def _increment(db: Session, model, key_columns: tuple, deltas: dict):
+    """UPSERT приращений (value = value + excluded.value); для других СУБД — чтение и запись."""
+    if not deltas:
+        return
+    rows = [{**dict(zip(key_columns, key)), **values} for key, values in deltas.items()]
+    value_columns = [column for column in rows[0] if column not in key_columns]
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        for row in rows:
+            obj = db.get(model, tuple(row[column] for column in key_columns))
+            if obj is None:
+                db.add(model(**row))
+            else:
+                for column in value_columns:
+                    setattr(obj, column, getattr(obj, column) + row[column])
+        db.flush()
+        return
+
+    table = model.__table__
+    for start in range(0, len(rows), _IN_CHUNK):
+        stmt = insert(table).values(rows[start:start + _IN_CHUNK])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(key_columns),
+            set_={column: table.c[column] + stmt.excluded[column] for column in value_columns},
+        )
+        db.execute(stmt)
+
+
+def _cursor(db: Session, name: str) -> models.AnalyticsCursor:
+    # FOR UPDATE: параллельные проходы (несколько инстансов) выполняются по очереди
+    cursor = db.get(models.AnalyticsCursor, name, with_for_update=True)
+    if cursor is None:
+        cursor = models.AnalyticsCursor(name=name, position=0)
+        db.add(cursor)
+        db.flush()
+    return cursor
+
+
+def _load_progress(db: Session, progress: dict, session_ids):
+    missing = [sid for sid in set(session_ids) if sid not in progress]
+    for start in range(0, len(missing), _IN_CHUNK):
+        for p in db.query(models.AnalyticsSessionProgress).filter(
+                models.AnalyticsSessionProgress.session_id.in_(missing[start:start + _IN_CHUNK])):
+            progress[p.session_id] = p
+
+
+def _count_sessions(db: Session, delta: _Delta, progress: dict, batch_size: int, settled: datetime) -> tuple:
+    cursor = _cursor(db, "sessions")
+    rows = db.query(models.Session.id, models.Session.graph_id, models.Session.start_time).filter(
+        models.Session.id > cursor.position
+    ).order_by(models.Session.id).limit(batch_size).all()
+    counted = 0
+    for row in rows:
+        if _is_fresh(row.start_time, settled):
+            break
+        progress[row.id] = p = models.AnalyticsSessionProgress(
+            session_id=row.id, graph_id=row.graph_id, steps=0, last_response_id=0,
+            last_timestamp=row.start_time, completed=False)
+        db.add(p)
+        delta.graphs[row.graph_id]["sessions"] += 1
+        delta.funnel[(row.graph_id, 0)]["sessions"] += 1
+        cursor.position = row.id
+        counted += 1
+    return counted, len(rows) == batch_size and counted > 0
+
+
+def _count_responses(db: Session, delta: _Delta, progress: dict, batch_size: int, settled: datetime) -> tuple:
+    cursor = _cursor(db, "responses")
+    rows = db.query(models.Response.id, models.Response.session_id, models.Response.node_id,
+                    models.Response.answer_text, models.Response.timestamp).filter(
+        models.Response.id > cursor.position
+    ).order_by(models.Response.id).limit(batch_size).all()
+    _load_progress(db, progress, [row.session_id for row in rows])
+    counted = advanced = 0
+    for row in rows:
+        p = progress.get(row.session_id)
+        if p is None or _is_fresh(row.timestamp, settled):
+            break   # сессия еще не учтена или строка слишком свежая — следующий проход
+        cursor.position = row.id
+        advanced += 1
+        if row.id <= p.last_response_id:
+            continue   # уже учтен
+        graph, node = p.graph_id, delta.nodes[(p.graph_id, row.node_id)]
+        p.steps += 1
+        delta.graphs[graph]["responses"] += 1
+        delta.funnel[(graph, p.steps)]["sessions"] += 1
+        delta.choices[(graph, row.node_id, row.answer_text)]["count"] += 1
+        node["visits"] += 1
+        seconds = _seconds_between(row.timestamp, p.last_timestamp)
+        if seconds is not None:
+            node["dwell_count"] += 1
+            node["dwell_seconds"] += seconds
+            delta.dwell[(graph, row.node_id, dwell_bucket(seconds))]["count"] += 1
+        if not p.completed:
+            # Отвал «переезжает» с прошлого узла сессии на текущий
+            if p.last_node_id is not None:
+                delta.nodes[(graph, p.last_node_id)]["dropoffs"] -= 1
+            node["dropoffs"] += 1
+        p.last_response_id, p.last_node_id, p.last_timestamp = row.id, row.node_id, row.timestamp
+        counted += 1
+    return counted, len(rows) == batch_size and advanced > 0
+
+
+def _count_completions(db: Session, delta: _Delta, progress: dict, batch_size: int, settled: datetime) -> tuple:
+    cursor = _cursor(db, "completions")
+    end_time = models.Session.end_time
+    query = db.query(models.Session.id, end_time).filter(end_time.isnot(None), end_time <= settled)
+    if cursor.stamp is not None:
+        # Ключ (end_time, id): сессии, завершенные в одну секунду, не теряются между пачками
+        query = query.filter(end_time >= cursor.stamp,
+                             not_(and_(end_time == cursor.stamp, models.Session.id <= cursor.position)))
+    rows = query.order_by(end_time, models.Session.id).limit(batch_size).all()
+    _load_progress(db, progress, [row.id for row in rows])
+    counted = advanced = 0
+    for row in rows:
+        p = progress.get(row.id)
+        if p is None:
+            break
+        cursor.stamp, cursor.position = row.end_time, row.id
+        advanced += 1
+        if p.completed:
+            continue
+        p.completed = True
+        delta.graphs[p.graph_id]["completed"] += 1
+        if p.last_node_id is not None:
+            delta.nodes[(p.graph_id, p.last_node_id)]["dropoffs"] -= 1
+        counted += 1
+    return counted, len(rows) == batch_size and advanced > 0
+
+
+_refresh_lock = threading.Lock()
+
+
+def refresh_analytics(session_factory=None, batch_size: int = ANALYTICS_BATCH_SIZE,
+                      settle_seconds: float = ANALYTICS_SETTLE_SECONDS) -> dict:
+    """
+    Дельта-задание: учитывает новые сессии, ответы и завершения после курсоров.
+    Пачки по batch_size строк, каждая — одна транзакция (курсоры и агрегаты фиксируются вместе).
+    Возвращает {"sessions", "responses", "completions", "ms"}.
+    """
+    if session_factory is None:
+        from . import SessionLocal as session_factory
+    totals = {"sessions": 0, "responses": 0, "completions": 0}
+    started = time.perf_counter()
+    with _refresh_lock:
+        more = True
+        while more:
+            settled = datetime.now(timezone.utc) - timedelta(seconds=settle_seconds)
+            db = session_factory()
+            try:
+                delta, progress = _Delta(), {}
+                passes = {"sessions": _count_sessions, "responses": _count_responses,
+                          "completions": _count_completions}
+                more = False
+                for name, count in passes.items():
+                    counted, has_more = count(db, delta, progress, batch_size, settled)
+                    totals[name] += counted
+                    more = more or has_more
+                db.flush()
+                delta.apply(db)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+    totals["ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return totals
+
+
+def rebuild_analytics(session_factory=None, batch_size: int = ANALYTICS_BATCH_SIZE,
+                      settle_seconds: float = ANALYTICS_SETTLE_SECONDS) -> dict:
+    """Очищает агрегаты и курсоры и пересчитывает все с начала (смена формулы, ручные правки БД)."""
+    if session_factory is None:
+        from . import SessionLocal as session_factory
+    with _refresh_lock:
+        db = session_factory()
+        try:
+            for model in AGGREGATE_MODELS:
+                db.query(model).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+    return refresh_analytics(session_factory, batch_size, settle_seconds)
+
+
+# === ФОНОВОЕ ОБНОВЛЕНИЕ ===
+
+class AnalyticsRefresher:
+    """Поток дельта-задания: раз в interval сек и когда строка после nudge() устоится (ANALYTICS_MODE=on_write)."""
+
+    def __init__(self, interval: float = ANALYTICS_REFRESH_INTERVAL, write_delay: float = ANALYTICS_WRITE_DELAY,
+                 session_factory=None, settle_seconds: float = ANALYTICS_SETTLE_SECONDS):
+        self.interval = interval
+        self.write_delay = write_delay
+        self.settle_seconds = settle_seconds
+        self.session_factory = session_factory
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {"runs": 0, "errors": 0, "nudges": 0, "sessions": 0, "responses": 0, "completions": 0,
+                       "last_ms": 0.0}
+
+    def start(self) -> "AnalyticsRefresher":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True, name="AnalyticsRefresher")
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def nudge(self):
+        with self._lock:
+            self._stats["nudges"] += 1
+        self._wake.set()
+
+    def run_once(self) -> Optional[dict]:
+        try:
+            result = refresh_analytics(self.session_factory, settle_seconds=self.settle_seconds)
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            print(f"[ANALYTICS] ❌ Ошибка обновления агрегатов: {e}")
+            return None
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["last_ms"] = result["ms"]
+            for key in ("sessions", "responses", "completions"):
+                self._stats[key] += result[key]
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"mode": ANALYTICS_MODE, **self._stats}
+
+    def _loop(self):
+        while not self._stop.is_set():
+            if self._wake.wait(self.interval) and not self._stop.is_set():
+                # Ответы соседних игроков, пришедшие за паузу, уйдут одним проходом;
+                # до конца окна устоявшихся строк проход их все равно не учел бы
+                self._stop.wait(self.write_delay + self.settle_seconds)
+            self._wake.clear()
+            if not self._stop.is_set():
+                self.run_once()
+
+
+_refresher: Optional[AnalyticsRefresher] = None
+
+
+def start_analytics_refresher() -> Optional[AnalyticsRefresher]:
+    """Запуск фонового обновления при ANALYTICS_MODE=periodic|on_write (из app/__main__.py)."""
+    global _refresher
+    if ANALYTICS_MODE not in ("periodic", "on_write") or _refresher is not None:
+        return _refresher
+    _refresher = AnalyticsRefresher().start()
+    print(f"[ANALYTICS] 📊 Агрегаты обновляются в фоне: режим {ANALYTICS_MODE}, раз в {ANALYTICS_REFRESH_INTERVAL} сек")
+    return _refresher
+
+
+def get_analytics_refresher() -> Optional[AnalyticsRefresher]:
+    return _refresher
+
+
+def notify_write(db: Session):
+    """Ответ или завершение сессии записаны: в режиме on_write — проход после коммита апдейта."""
+    if ANALYTICS_MODE == "on_write" and _refresher is not None:
+        from .unit_of_work import after_commit
+        after_commit(db, _refresher.nudge)
+
+
+# === ЗАПРОСЫ К АГРЕГАТАМ ===
+
+def choice_distribution(db: Session, graph_id: str, node_id: str = None) -> list:
+    """Выборы на узлах сценария: [{node_id, answer_text, count, share}] (share — доля на своем узле)."""
+    query = db.query(models.AnalyticsNodeChoice).filter(models.AnalyticsNodeChoice.graph_id == graph_id)
+    if node_id is not None:
+        query = query.filter(models.AnalyticsNodeChoice.node_id == node_id)
+    rows = query.order_by(models.AnalyticsNodeChoice.node_id, models.AnalyticsNodeChoice.count.desc()).all()
+    totals = defaultdict(int)
+    for row in rows:
+        totals[row.node_id] += row.count
+    return [{"node_id": row.node_id, "answer_text": row.answer_text, "count": row.count,
+             "share": round(row.count / totals[row.node_id], 4) if totals[row.node_id] else 0.0} for row in rows]
+
+
+def funnel(db: Session, graph_id: str) -> dict:
+    """Воронка сценария: начатые и завершенные сессии и сколько дошло до каждого шага (ответа)."""
+    graph = db.get(models.AnalyticsGraphStats, graph_id)
+    started = graph.sessions if graph else 0
+    completed = graph.completed if graph else 0
+    steps = db.query(models.AnalyticsFunnelStep).filter(
+        models.AnalyticsFunnelStep.graph_id == graph_id).order_by(models.AnalyticsFunnelStep.step).all()
+    return {
+        "graph_id": graph_id, "sessions": started, "completed": completed,
+        "completion_rate": round(completed / started, 4) if started else 0.0,
+        "responses": graph.responses if graph else 0,
+        "steps": [{"step": s.step, "sessions": s.sessions,
+                   "share": round(s.sessions / started, 4) if started else 0.0} for s in steps],
+    }
+
+
+def node_dropoff(db: Session, graph_id: str) -> list:
+    """
+    Узлы по убыванию отвалов: [{node_id, visits, dropoffs, dropoff_rate, avg_dwell_seconds}].
+    dropoffs — незавершенные сессии, последний ответ которых дан на этом узле (включая идущие сейчас).
+    """
+    rows = db.query(models.AnalyticsNodeStats).filter(models.AnalyticsNodeStats.graph_id == graph_id).order_by(
+        models.AnalyticsNodeStats.dropoffs.desc(), models.AnalyticsNodeStats.node_id).all()
+    return [{"node_id": row.node_id, "visits": row.visits, "dropoffs": row.dropoffs,
+             "dropoff_rate": round(row.dropoffs / row.visits, 4) if row.visits else 0.0,
+             "avg_dwell_seconds": round(row.dwell_seconds / row.dwell_count, 2) if row.dwell_count else None}
+            for row in rows]
+
+
+def _bucket_quantile(counts: list, total: int, q: float) -> float:
+    """Квантиль по гистограмме: линейная интерполяция внутри интервала (у последнего — нижняя граница)."""
+    target, seen = q * total, 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= target:
+            if i + 1 >= len(DWELL_BUCKETS):
+                return float(DWELL_BUCKETS[i])
+            low, high = DWELL_BUCKETS[i], DWELL_BUCKETS[i + 1]
+            return round(low + (high - low) * (target - seen) / count, 2)
+        seen += count
+    return 0.0
+
+
+def dwell_histogram(db: Session, graph_id: str, node_id: str) -> dict:
+    """Время на узле: интервалы [{from, to, count}], среднее и оценки медианы и p90 по гистограмме."""
+    counts = [0] * len(DWELL_BUCKETS)
+    for row in db.query(models.AnalyticsDwellBucket).filter(
+            models.AnalyticsDwellBucket.graph_id == graph_id, models.AnalyticsDwellBucket.node_id == node_id):
+        counts[row.bucket] = row.count
+    stats = db.get(models.AnalyticsNodeStats, (graph_id, node_id))
+    total = sum(counts)
+    return {
+        "graph_id": graph_id, "node_id": node_id, "count": total,
+        "mean_seconds": round(stats.dwell_seconds / stats.dwell_count, 2) if stats and stats.dwell_count else None,
+        "p50_seconds": _bucket_quantile(counts, total, 0.5) if total else None,
+        "p90_seconds": _bucket_quantile(counts, total, 0.9) if total else None,
+        "buckets": [{"from": DWELL_BUCKETS[i], "to": DWELL_BUCKETS[i + 1] if i + 1 < len(DWELL_BUCKETS) else None,
+                     "count": count} for i, count in enumerate(counts)],
+    }
@@ -5,13 +5,73 @@
 # - build_persona_prompt стал универсальным для всех ролей из prompts.json.
 # - Сохранена и улучшена сложная логика для build_financial_advisor_prompt.
 # - Сохранена логика v8.1 для get_all_user_states для защиты от дубликатов.
-
-
+# ВЕРСИЯ 8.3: Кеш состояния сессии в памяти (SessionStateCache) с отложенной записью в user_states.
+# ВЕРСИЯ 8.4: bulk_update_user_states — все изменения клика одним INSERT ... ON CONFLICT DO UPDATE.
+# ВЕРСИЯ 8.5: Внутри unit_of_work() хелперы делают flush вместо commit — один коммит на апдейт.
+# ВЕРСИЯ 8.6: Контекст ИИ собирается из накопителя сессии (ai_context), без перечитывания всей истории.
+# ВЕРСИЯ 8.7: Бюджет токенов на роль (prompts.json -> token_budgets): секции промпта урезаются по приоритету.
+# ВЕРСИЯ 8.8: Сборщики промптов принимают готовый снимок контекста (context_after_choice для предвыборки).
+# ВЕРСИЯ 8.9: Иерархическая память сессии (session_memory): старые события сворачиваются в сводки фоном.
+# ВЕРСИЯ 9.0: Агрегаты аналитики (analytics): ответ и завершение сессии будят дельта-задание (ANALYTICS_MODE=on_write).
+# ВЕРСИЯ 9.1: История изменений состояния (STATE_HISTORY_ENABLED) — шаги траекторий для исследований.
+# ВЕРСИЯ 9.2: user_states хранит initial_value и previous_value — промпт ИИ одинаков из памяти и после пересборки.
+# ВЕРСИЯ 9.3: Кеш состояния сам дописывает изменения в накопитель контекста ИИ — вызов ИИ не сбрасывает кеш в БД.
+
+
+import atexit
 import json
 import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
 from sqlalchemy.orm import Session
 from sqlalchemy import func
-from . import models
+from decouple import config
+from app.config.feature_flags import FeatureFlags
+from app.modules.prompt_budget import PromptSection, fit_sections
+from . import analytics, models
+from .ai_context import SessionContext, SessionContextCache
+from .session_memory import (
+    SessionMemoryCache, ai_summarize, dialogue_event_text, extractive_summary, is_profile_node, response_event_text
+)
+from .unit_of_work import after_commit, in_unit_of_work, on_rollback
+
+
+# --- Режим записи кеша состояний ---
+# sync    — каждое изменение сразу пишется в БД (по умолчанию)
+# batched — изменения копятся и сбрасываются фоном раз в STATE_FLUSH_INTERVAL сек и на границах узлов
+# on_end  — изменения пишутся только при завершении сессии (и при вытеснении из кеша)
+STATE_CACHE_MODE = config("STATE_CACHE_MODE", default="sync").strip().lower()
+STATE_FLUSH_INTERVAL = config("STATE_FLUSH_INTERVAL", default=2.0, cast=float)
+STATE_CACHE_MAX_SESSIONS = config("STATE_CACHE_MAX_SESSIONS", default=10000, cast=int)
+# Каждый клик с изменением состояния дописывает строки в user_state_history (один INSERT на клик)
+STATE_HISTORY_ENABLED = config("STATE_HISTORY_ENABLED", default=False, cast=bool)
+AI_CONTEXT_MAX_SESSIONS = config("AI_CONTEXT_MAX_SESSIONS", default=5000, cast=int)
+# Бюджет токенов для ролей без записи в prompts.json -> token_budgets (0 — без ограничения)
+AI_DEFAULT_TOKEN_BUDGET = config("AI_DEFAULT_TOKEN_BUDGET", default=0, cast=int)
+
+# Накопители контекста ИИ по сессиям: события дописываются по мере игры
+context_cache = SessionContextCache(AI_CONTEXT_MAX_SESSIONS)
+
+
+def _summarize_events(texts: list) -> str:
+    """Сводка для памяти: ИИ при ENABLE_AI_SUMMARIZATION, иначе выжимка без сети."""
+    if FeatureFlags.ENABLE_AI_SUMMARIZATION:
+        return ai_summarize(texts)
+    return extractive_summary(texts)
+
+
+def _schedule_memory_fold(session_id: int, work, skipped):
+    """Свертка памяти — фоновое задание ai_jobs (отдельная очередь "memory")."""
+    from app.modules.ai_jobs import REJECTED, submit_ai_job
+    submit_ai_job("memory", session_id, lambda cancel_event: work(),
+                  on_done=lambda job: skipped() if job.status == REJECTED else None,
+                  on_cancel=lambda job: skipped())
+
+
+# Иерархическая память сессий (FeatureFlags.ENABLE_HIERARCHICAL_MEMORY)
+memory_cache = SessionMemoryCache(summarize=_summarize_events, schedule=_schedule_memory_fold)
 
 
 # --- Кеш для промптов ---
@@ -31,7 +91,8 @@ def load_prompts():
         if os.path.exists(prompts_path):
             with open(prompts_path, 'r', encoding='utf-8') as f:
                 _prompts_cache = json.load(f)
-                print(f"--- [ПРОМПТЫ] Загружено {len(_prompts_cache)} ролей из {prompts_path} ---")
+                roles = sum(1 for v in _prompts_cache.values() if isinstance(v, str))
+                print(f"--- [ПРОМПТЫ] Загружено {roles} ролей из {prompts_path} ---")
                 return _prompts_cache
     except Exception as e:
         print(f"--- [ПРОМПТЫ] Ошибка загрузки {prompts_path}: {e} ---")
@@ -46,30 +107,65 @@ def load_prompts():
     return _prompts_cache
 
 
+def get_token_budget(persona_key: str) -> int:
+    """Бюджет токенов роли из prompts.json -> token_budgets (роль, затем default); 0 — без ограничения."""
+    budgets = load_prompts().get("token_budgets") or {}
+    try:
+        return int(budgets.get(persona_key, budgets.get("default", AI_DEFAULT_TOKEN_BUDGET)))
+    except (TypeError, ValueError):
+        return AI_DEFAULT_TOKEN_BUDGET
+
+
 # --- Базовые CRUD функции ---
+def _commit(db: Session, obj=None):
+    """Коммит вне единицы работы; внутри нее — только flush (id уже назначены, коммит в конце апдейта)."""
+    if in_unit_of_work(db):
+        db.flush()
+        return
+    db.commit()
+    if obj is not None:
+        db.refresh(obj)
+
+
+def _track_context(db: Session, session_id: int):
+    """Откат транзакции апдейта — накопитель контекста и память сессии перестраиваются из БД."""
+    def invalidate():
+        context_cache.invalidate(session_id)
+        memory_cache.invalidate(session_id)
+    on_rollback(db, invalidate)
+
+
+def _remember(db: Session, session_id: int, kind: str, event_id, text: str):
+    """Событие в память сессии; свертка проверяется после коммита апдейта."""
+    memory_cache.record(session_id, kind, event_id, text)
+    after_commit(db, lambda: memory_cache.maybe_fold(session_id))
+
+
 def get_or_create_user(db: Session, telegram_id: int):
     user = db.query(models.User).filter(models.User.telegram_id == str(telegram_id)).first()
     if not user:
         user = models.User(telegram_id=str(telegram_id))
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        _commit(db, user)
     return user
 
 
 def create_session(db: Session, user_id: int, graph_id: str):
     session = models.Session(user_id=user_id, graph_id=graph_id)
     db.add(session)
-    db.commit()
-    db.refresh(session)
+    _commit(db, session)
     return session
 
 
 def end_session(db: Session, session_id: int):
+    state_cache.end(db, session_id)
+    context_cache.invalidate(session_id)
+    memory_cache.invalidate(session_id)
     session = db.query(models.Session).filter(models.Session.id == session_id).first()
     if session and session.end_time is None:
         session.end_time = func.now()
-        db.commit()
+        _commit(db)
+        analytics.notify_write(db)
 
 
 def create_response(db: Session, session_id: int, node_id: str, node_text: str, answer_text: str):
@@ -80,8 +176,12 @@ def create_response(db: Session, session_id: int, node_id: str, node_text: str,
         answer_text=answer_text
     )
     db.add(response)
-    db.commit()
-    db.refresh(response)
+    _commit(db, response)
+    context_cache.record_response(session_id, node_id, node_text, answer_text)
+    analytics.notify_write(db)
+    if FeatureFlags.ENABLE_HIERARCHICAL_MEMORY and not is_profile_node(node_id):
+        _remember(db, session_id, "response", response.id, response_event_text(node_text, answer_text))
+    _track_context(db, session_id)
     return response
 
 
@@ -97,6 +197,13 @@ def get_user_state(db: Session, user_id: int, session_id: int, key: str, default
 
 def update_user_state(db: Session, user_id: int, session_id: int, key: str, value: any):
     """Обновляет или создает (UPSERT) переменную состояния, предотвращая дубликаты."""
+    state = _upsert_user_state(db, user_id, session_id, key, value)
+    context_cache.record_states(session_id, {key: value})
+    _track_context(db, session_id)
+    return state
+
+
+def _upsert_user_state(db: Session, user_id: int, session_id: int, key: str, value: any):
     existing_state = db.query(models.UserState).filter(
         models.UserState.user_id == user_id,
         models.UserState.session_id == session_id,
@@ -104,72 +211,384 @@ def update_user_state(db: Session, user_id: int, session_id: int, key: str, valu
     ).first()
 
     if existing_state:
+        existing_state.previous_value = existing_state.state_value
         existing_state.state_value = str(value)
         existing_state.timestamp = func.now()
-        db.commit()
-        db.refresh(existing_state)
-        return existing_state
+        _commit(db, existing_state)
+        state = existing_state
     else:
-        new_state = models.UserState(
+        state = models.UserState(
             user_id=user_id, session_id=session_id,
-            state_key=key, state_value=str(value)
+            state_key=key, state_value=str(value), initial_value=str(value)
         )
-        db.add(new_state)
-        db.commit()
-        db.refresh(new_state)
-        return new_state
+        db.add(state)
+        _commit(db, state)
+    return state
+
+
+def bulk_update_user_states(db: Session, user_id: int, session_id: int, mapping: dict) -> int:
+    """
+    UPSERT набора переменных одним запросом и одним коммитом.
+    Опирается на уникальный ключ (user_id, session_id, state_key) — см. migrations.migrate_user_states_unique.
+    """
+    if not mapping:
+        return 0
+    written = _upsert_user_states(db, user_id, session_id, mapping)
+    context_cache.record_states(session_id, mapping)
+    _track_context(db, session_id)
+    return written
+
+
+def _upsert_user_states(db: Session, user_id: int, session_id: int, mapping: dict) -> int:
+    """Запись в user_states без событий накопителя контекста (их дописывает вызывающий)."""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        for key, value in mapping.items():
+            _upsert_user_state(db, user_id, session_id, key, value)
+        return len(mapping)
+
+    rows = [
+        {"user_id": user_id, "session_id": session_id, "state_key": key, "state_value": str(value),
+         "initial_value": str(value)}
+        for key, value in mapping.items()
+    ]
+    stmt = insert(models.UserState).values(rows)
+    # initial_value остается от первой записи, previous_value — значение до этой
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "session_id", "state_key"],
+        set_={"state_value": stmt.excluded.state_value, "previous_value": models.UserState.state_value,
+              "timestamp": func.now()},
+    )
+    db.execute(stmt)
+    _commit(db)
+    return len(rows)
 
 
 def create_ai_dialogue(db: Session, session_id: int, node_id: str, user_message: str, ai_response: str):
     dialogue = models.AIDialogue(session_id=session_id, node_id=node_id, user_message=user_message, ai_response=ai_response)
     db.add(dialogue)
-    db.commit()
+    _commit(db)
+    if FeatureFlags.ENABLE_HIERARCHICAL_MEMORY:
+        _remember(db, session_id, "dialogue", dialogue.id, dialogue_event_text(user_message, ai_response))
+        _track_context(db, session_id)
     return dialogue
 
 
 def get_all_user_states(db: Session, user_id: int, session_id: int) -> dict:
     """Получает ПОСЛЕДНЕЕ состояние для каждой переменной, избегая проблем с дубликатами."""
-    from . import models
     try:
-        subquery = db.query(
-            models.UserState.state_key,
-            func.max(models.UserState.id).label('max_id')
-        ).filter(
-            models.UserState.user_id == user_id,
-            models.UserState.session_id == session_id
-        ).group_by(models.UserState.state_key).subquery()
-
-        user_states = db.query(models.UserState).join(
-            subquery,
-            (models.UserState.state_key == subquery.c.state_key) & 
-            (models.UserState.id == subquery.c.max_id)
-        ).all()
-        
-        states_dict = {state.state_key: state.state_value for state in user_states}
-        
-        for key, value in states_dict.items():
-            if isinstance(value, str):
-                try:
-                    states_dict[key] = float(value) if '.' in value else int(value)
-                except (ValueError, TypeError):
-                    pass
-        
-        states_dict.setdefault('score', 0)
-        states_dict.setdefault('capital_before', 0)
-
-        if not isinstance(states_dict.get('score'), (int, float)):
-            print(f"🚨 [ЗАЩИТА] Некорректный тип для 'score': {type(states_dict['score'])}. Сброс на 0.")
-            states_dict['score'] = 0
-        if not isinstance(states_dict.get('capital_before'), (int, float)):
-            states_dict['capital_before'] = 0
-
-        return states_dict
-        
+        return _load_user_states(db, user_id, session_id)
     except Exception as e:
         print(f"❌ КРИТИЧЕСКАЯ ОШИБКА в get_all_user_states: {e}")
         return {'score': 0, 'capital_before': 0}
 
 
+def _load_user_states(db: Session, user_id: int, session_id: int) -> dict:
+    """Читает состояние сессии из user_states. Ошибки БД пробрасываются."""
+    subquery = db.query(
+        models.UserState.state_key,
+        func.max(models.UserState.id).label('max_id')
+    ).filter(
+        models.UserState.user_id == user_id,
+        models.UserState.session_id == session_id
+    ).group_by(models.UserState.state_key).subquery()
+
+    user_states = db.query(models.UserState).join(
+        subquery,
+        (models.UserState.state_key == subquery.c.state_key) & 
+        (models.UserState.id == subquery.c.max_id)
+    ).all()
+    
+    states_dict = {state.state_key: state.state_value for state in user_states}
+    
+    for key, value in states_dict.items():
+        if isinstance(value, str):
+            try:
+                states_dict[key] = float(value) if '.' in value else int(value)
+            except (ValueError, TypeError):
+                pass
+    
+    states_dict.setdefault('score', 0)
+    states_dict.setdefault('capital_before', 0)
+
+    if not isinstance(states_dict.get('score'), (int, float)):
+        print(f"🚨 [ЗАЩИТА] Некорректный тип для 'score': {type(states_dict['score'])}. Сброс на 0.")
+        states_dict['score'] = 0
+    if not isinstance(states_dict.get('capital_before'), (int, float)):
+        states_dict['capital_before'] = 0
+
+    return states_dict
+
+
+# =========================
+# КЕШ СОСТОЯНИЯ СЕССИИ
+# =========================
+def _write_states(db: Session, user_id: int, session_id: int, mapping: dict):
+    """
+    Записывает набор переменных состояния в user_states (один запрос на набор).
+    Накопитель контекста ИИ получает изменения раньше — в SessionStateCache.apply.
+    """
+    _upsert_user_states(db, user_id, session_id, mapping)
+
+
+_MISSING = object()
+
+
+class _CachedSession:
+    __slots__ = ('user_id', 'states', 'dirty')
+
+    def __init__(self, user_id: int, states: dict):
+        self.user_id = user_id
+        self.states = states
+        self.dirty = set()
+
+
+class SessionStateCache:
+    """
+    Состояние активных сессий в памяти процесса.
+
+    Состояние загружается из user_states один раз на сессию, дальше чтения идут из памяти,
+    а результаты формул применяются на месте и помечаются «грязными».
+    Запись грязных ключей в БД зависит от режима (sync / batched / on_end).
+    Накопитель контекста ИИ получает изменения сразу в apply, поэтому промпт не ждет записи в БД.
+    """
+
+    MODES = ('sync', 'batched', 'on_end')
+
+    def __init__(self, mode: str = 'sync', flush_interval: float = 2.0, max_sessions: int = 10000):
+        if mode not in self.MODES:
+            print(f"⚠️ [STATE-CACHE] Неизвестный режим '{mode}', используется 'sync'")
+            mode = 'sync'
+        self.mode = mode
+        self.flush_interval = flush_interval
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.RLock()
+        self._flusher = None
+        self._stats = {'hits': 0, 'loads': 0, 'flushes': 0, 'keys_written': 0, 'evictions': 0}
+
+    def get_states(self, db: Session, user_id: int, session_id: int) -> dict:
+        """Копия текущего состояния сессии (из памяти, при промахе — одна загрузка из БД)."""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                self._sessions.move_to_end(session_id)
+                self._stats['hits'] += 1
+                return dict(entry.states)
+        try:
+            states = _load_user_states(db, user_id, session_id)
+        except Exception as e:
+            # Ошибочные значения по умолчанию не кешируем
+            print(f"❌ [STATE-CACHE] Ошибка загрузки состояния session={session_id}: {e}")
+            return {'score': 0, 'capital_before': 0}
+        evicted = []
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                entry = self._sessions[session_id] = _CachedSession(user_id, states)
+                self._stats['loads'] += 1
+                while len(self._sessions) > self.max_sessions:
+                    evicted.append(self._sessions.popitem(last=False))
+            result = dict(entry.states)
+        for old_session_id, old_entry in evicted:
+            self._stats['evictions'] += 1
+            self._write_entry(db, old_session_id, old_entry, set(old_entry.dirty))
+        return result
+
+    def apply(self, db: Session, user_id: int, session_id: int, changes: dict):
+        """Применяет изменения к состоянию сессии; в режиме sync сразу пишет их в БД."""
+        if not changes:
+            return
+        self.get_states(db, user_id, session_id)
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                previous = {k: entry.states.get(k, _MISSING) for k in changes}
+                clean = {k for k in changes if k not in entry.dirty}
+                entry.states.update(changes)
+                entry.dirty.update(changes)
+        if entry is not None:
+            # Откат апдейта возвращает значения до него — иначе следующий сброс записал бы откатившийся результат
+            on_rollback(db, lambda: self._restore(entry, previous, clean))
+        context_cache.record_states(session_id, changes)
+        _track_context(db, session_id)
+        if entry is None:
+            # Состояние не удалось закешировать — пишем напрямую
+            _write_states(db, user_id, session_id, changes)
+        elif self.mode == 'sync':
+            self.flush(db, session_id)
+        elif self.mode == 'batched':
+            self._ensure_flusher()
+
+    def flush(self, db: Session = None, session_id: int = None) -> int:
+        """Сбрасывает грязные ключи одной сессии (или всех) в БД. Возвращает число записанных ключей."""
+        with self._lock:
+            if session_id is not None:
+                entry = self._sessions.get(session_id)
+                targets = [(session_id, entry)] if entry is not None and entry.dirty else []
+            else:
+                targets = [(sid, e) for sid, e in self._sessions.items() if e.dirty]
+            batch = []
+            for sid, entry in targets:
+                batch.append((sid, entry, set(entry.dirty)))
+                entry.dirty.clear()
+        if not batch:
+            return 0
+        own_db = db is None
+        if own_db:
+            from . import SessionLocal
+            db = SessionLocal()
+        written = 0
+        try:
+            for sid, entry, keys in batch:
+                written += self._write_entry(db, sid, entry, keys)
+        finally:
+            if own_db:
+                db.close()
+        return written
+
+    def checkpoint(self, db: Session, session_id: int):
+        """Граница узла: в режиме batched сбрасывает грязные ключи сессии."""
+        if self.mode == 'batched':
+            self.flush(db, session_id)
+
+    def pending(self, session_id: int) -> dict:
+        """Изменения сессии, еще не записанные в БД (для пересборки накопителя контекста)."""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return {}
+            return {k: entry.states[k] for k in entry.dirty if k in entry.states}
+
+    def end(self, db: Session, session_id: int):
+        """Сбрасывает состояние завершённой сессии и удаляет его из памяти (при откате апдейта оно вернется)."""
+        self.flush(db, session_id)
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, 'mode': self.mode, 'sessions': len(self._sessions),
+                    'dirty_keys': sum(len(e.dirty) for e in self._sessions.values())}
+
+    # --- internal ---
+    def _write_entry(self, db: Session, session_id: int, entry: _CachedSession, keys: set) -> int:
+        if not keys:
+            return 0
+        with self._lock:
+            mapping = {k: entry.states[k] for k in keys if k in entry.states}
+        try:
+            _write_states(db, entry.user_id, session_id, mapping)
+        except Exception as e:
+            print(f"❌ [STATE-CACHE] Ошибка записи состояния session={session_id}: {e}")
+            # Ключи остаются грязными до следующей попытки
+            self._requeue(session_id, entry, keys)
+            if in_unit_of_work(db):
+                # Откат всей транзакции апдейта делает unit_of_work
+                raise
+            try:
+                db.rollback()
+            except Exception:
+                pass
+            return 0
+        # Запись еще не закоммичена: если транзакция апдейта откатится, ключи снова станут грязными
+        # (значения, измененные самим апдейтом, при этом откатывает _restore)
+        on_rollback(db, lambda: self._requeue(session_id, entry, keys))
+        with self._lock:
+            self._stats['flushes'] += 1
+            self._stats['keys_written'] += len(mapping)
+        return len(mapping)
+
+    def _restore(self, entry: _CachedSession, previous: dict, clean: set):
+        with self._lock:
+            for key, value in previous.items():
+                if value is _MISSING:
+                    entry.states.pop(key, None)
+                else:
+                    entry.states[key] = value
+            # Ключи, чистые до апдейта, совпадают с БД; грязные остаются — их прежние значения еще не записаны
+            entry.dirty.difference_update(clean)
+
+    def _requeue(self, session_id: int, entry: _CachedSession, keys: set):
+        """
+        Запись не состоялась: ключи снова грязные. Вытесненная или завершенная сессия
+        к этому моменту уже убрана из памяти — возвращаем ее, иначе изменения потеряются.
+        """
+        with self._lock:
+            current = self._sessions.get(session_id)
+            if current is None:
+                self._sessions[session_id] = entry
+                self._sessions.move_to_end(session_id, last=False)   # первой на следующее вытеснение
+            elif current is not entry:
+                # Сессию успели загрузить заново из БД, где этих значений нет; более новые изменения не трогаем
+                keys = {k for k in keys if k not in current.dirty and k in entry.states}
+                current.states.update({k: entry.states[k] for k in keys})
+                entry = current
+            entry.dirty.update(keys)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True, name="StateCacheFlusher")
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+
+state_cache = SessionStateCache(STATE_CACHE_MODE, STATE_FLUSH_INTERVAL, STATE_CACHE_MAX_SESSIONS)
+if state_cache.mode != 'sync':
+    # Не теряем накопленные изменения при штатной остановке процесса
+    atexit.register(state_cache.flush)
+
+
+def get_session_states(db: Session, user_id: int, session_id: int) -> dict:
+    """Текущее состояние сессии из кеша (без запроса к БД после первой загрузки)."""
+    return state_cache.get_states(db, user_id, session_id)
+
+
+def update_session_states(db: Session, user_id: int, session_id: int, changes: dict):
+    """Применяет изменения состояния (например, результат формулы) с учетом STATE_CACHE_MODE."""
+    if STATE_HISTORY_ENABLED and changes:
+        record_state_history(db, session_id, changes)
+    state_cache.apply(db, user_id, session_id, changes)
+
+
+def record_state_history(db: Session, session_id: int, changes: dict):
+    """
+    Шаг траектории: изменения одного клика в user_state_history с общим timestamp.
+    Пишется сразу при любом STATE_CACHE_MODE — отложенная запись склеила бы шаги.
+    """
+    stamp = models.utc_now()
+    db.execute(models.UserStateHistory.__table__.insert(), [
+        {"session_id": session_id, "state_key": key, "state_value": str(value), "timestamp": stamp}
+        for key, value in changes.items()
+    ])
+    _commit(db)
+
+
+def flush_session_states(db: Session = None, session_id: int = None) -> int:
+    """Принудительно записывает накопленные изменения состояния в БД."""
+    return state_cache.flush(db, session_id)
+
+
+def checkpoint_session_states(db: Session, session_id: int):
+    """Граница узла (игрок ждет ввода): в режиме batched сбрасывает изменения сессии."""
+    state_cache.checkpoint(db, session_id)
+
+
 # =========================
 # УНИВЕРСАЛЬНОЕ СОСТОЯНИЕ
 # =========================
@@ -196,21 +615,41 @@ def _format_number(number):
     if isinstance(number, float) and number.is_integer(): number = int(number)
     try: return f"{number:,}".replace(",", " ")
     except Exception: return str(number)
-def _last_user_action_text(db: Session, session_id: int) -> str:
-    last_resp = db.query(models.Response).filter(models.Response.session_id == session_id).order_by(models.Response.id.desc()).first()
-    if not last_resp: return ""
-    node = (last_resp.node_text or "").strip()
-    ans = (last_resp.answer_text or "").strip()
-    if node and ans: return f"{node} — {ans}"
-    return node or ans or ""
-def build_universal_state_summary(db: Session, user_id: int, session_id: int) -> str:
-    hist = collect_state_history(db, user_id, session_id)
-    if not hist: return "Игровое состояние: нет данных."
-    last_action = _last_user_action_text(db, session_id)
+def _option_text(opt) -> str:
+    """Текст варианта: dict из JSON или CompiledOption из graph_compiler."""
+    return opt['text'] if isinstance(opt, dict) else opt.text
+def context_after_choice(db: Session, user_id: int, session_id: int, node_id: str, node_text: str,
+                         answer_text: str, changes: dict) -> SessionContext:
+    """Снимок контекста сессии таким, каким он станет после ответа игрока (create_response + changes)."""
+    ctx = _session_context(db, user_id, session_id)
+    if changes:
+        ctx.add_states(changes)
+    ctx.add_response(node_id, node_text, answer_text)
+    if FeatureFlags.ENABLE_HIERARCHICAL_MEMORY:
+        ctx.memory = memory_cache.get(db, session_id)
+        if not is_profile_node(node_id):
+            ctx.memory.add_event("response", None, response_event_text(node_text, answer_text))
+    return ctx
+
+
+def _session_context(db: Session, user_id: int, session_id: int) -> SessionContext:
+    """Снимок накопителя; при пересборке из БД дописываются еще не сброшенные изменения кеша состояния."""
+    return context_cache.get(db, user_id, session_id, pending=state_cache.pending)
+
+
+def _memory_history(db: Session, session_id: int, ctx: SessionContext) -> str:
+    """Блок истории из иерархической памяти (снимок из ctx для предвыборки)."""
+    memory = ctx.memory if ctx.memory is not None else memory_cache.get(db, session_id)
+    return memory.render()
+
+
+def build_universal_state_summary(db: Session, user_id: int, session_id: int, ctx: SessionContext = None) -> str:
+    # История переменных и последнее действие — из накопителя сессии, без запросов к БД
+    ctx = ctx or _session_context(db, user_id, session_id)
+    if not ctx.states: return "Игровое состояние: нет данных."
+    last_action = ctx.last_action
     lines = ["Игровое состояние:"]
-    for key, seq in hist.items():
-        initial_str, current_str = (seq[0][1] if seq else None), (seq[-1][1] if seq else None)
-        previous_str = seq[-2][1] if len(seq) >= 2 else None
+    for key, (initial_str, previous_str, current_str) in ctx.states.items():
         initial, previous, current = _safe_to_number(initial_str), _safe_to_number(previous_str), _safe_to_number(current_str)
         delta, total = (current - previous if (current is not None and previous is not None) else None), (current - initial if (current is not None and initial is not None) else None)
         label, cur_txt, prev_txt, delta_txt, total_txt = STATE_ALIASES.get(key, key), _format_number(current), _format_number(previous), _format_delta(delta), _format_delta(total)
@@ -233,79 +672,106 @@ def build_full_context_for_ai(
     options: list,
     event_type: str = None,
     ai_persona: str = "default",
-    ai_risk_appetite: int = 3
+    ai_risk_appetite: int = 3,
+    ctx: SessionContext = None
 ) -> str:
     """
     Главный роутер для сборки контекста ИИ с поддержкой разных ролей.
+    ctx — готовый снимок накопителя (предвыборка: контекст «после выбора»).
     """
     prompts = load_prompts()
     persona_key = str(ai_persona).strip().lower() if ai_persona else "default"
     system_template = prompts.get(persona_key, prompts.get("default", ""))
+    if not isinstance(system_template, str):
+        system_template = prompts.get("default", "")
     
     print(f"--- [AI-CONTEXT] Роль: '{persona_key}', Шаблон: '{system_template[:30]}...'")
 
     if system_template == "current_complex_prompt":
         print("--- [AI-CONTEXT] Вызов сложного сборщика для financial_advisor ---")
         return build_financial_advisor_prompt(
-            db, session_id, user_id, task_prompt, options, event_type, ai_risk_appetite
+            db, session_id, user_id, task_prompt, options, event_type, ai_risk_appetite, ctx
         )
     else:
         print(f"--- [AI-CONTEXT] Вызов универсального сборщика для '{persona_key}' ---")
         return build_persona_prompt(
-            db, session_id, user_id, task_prompt, options, system_template
+            db, session_id, user_id, task_prompt, options, system_template, persona_key, ctx
         )
 
+
+def _fit_prompt(persona_key: str, render, sections: list) -> str:
+    """Укладывает секции в бюджет роли; render(texts) собирает промпт из {имя секции: текст}."""
+    texts, report = fit_sections(render({sec.name: "" for sec in sections}), sections, get_token_budget(persona_key))
+    if report.changed:
+        print(f"--- [AI-BUDGET] '{persona_key}': {report.format()} ---")
+    return render(texts)
+
 def build_financial_advisor_prompt(
     db: Session, session_id: int, user_id: int, current_question: str, options: list,
-    event_type: str = None, ai_risk_appetite: int = 3
+    event_type: str = None, ai_risk_appetite: int = 3, ctx: SessionContext = None
 ) -> str:
     """Собирает детализированный промпт для роли 'financial_advisor'."""
     risk_philosophy_map = {1: "...", 2: "...", 3: "...", 4: "...", 5: "..."}
     ai_philosophy = risk_philosophy_map.get(ai_risk_appetite, "Сбалансированная...")
     
-    all_responses = db.query(models.Response).filter(models.Response.session_id == session_id).order_by(models.Response.id).all()
-    soc_dem_keys, profile_info, game_history = ['возраст', 'пол', 'образование', 'доход', 'риск', 'приоритет', 'стратегия', 'цель'], [], []
-    
-    for r in all_responses:
-        is_profile_data = any(key in (r.node_id or "").lower() for key in soc_dem_keys)
-        event_text, choice_text = ' '.join((r.node_text or "").split()), ' '.join((r.answer_text or "").split())
-        if is_profile_data: profile_info.append(f"- {choice_text}")
-        else: game_history.append(f"- Событие: «{event_text}»\n  - Решение игрока: «{choice_text}»")
-    
-    profile_block = "\n".join(profile_info) or "Еще не собран."
-    history_block = "\n".join(game_history) or "Это первое действие."
-    state_summary = build_universal_state_summary(db, user_id, session_id)
-    options_text = "\n".join([f"- {opt['text']}" for opt in options]) if options else "Вариантов ответа нет."
+    # Досье и хронология уже собраны накопителем сессии (ai_context.PROFILE_KEYS)
+    ctx = ctx or _session_context(db, user_id, session_id)
+    profile_block = ctx.profile_text or "Еще не собран."
+    if FeatureFlags.ENABLE_HIERARCHICAL_MEMORY:
+        history_block = _memory_history(db, session_id, ctx) or "Это первое действие."
+    else:
+        history_block = ctx.history_text or "Это первое действие."
+    state_summary = build_universal_state_summary(db, user_id, session_id, ctx)
+    options_text = "\n".join([f"- {_option_text(opt)}" for opt in options]) if options else "Вариантов ответа нет."
     task_description = f"ТЕКУЩАЯ ЗАДАЧА: {current_question.strip()}" if current_question else ""
-    
-    return (f"Ты — AI-ассистент, финансовый консультант. Твоя философия: {ai_philosophy}\n\n"
-            f"1. ДОСЬЕ НА ИГРОКА:\n{profile_block}\n\n"
-            f"2. ХРОНОЛОГИЯ РЕШЕНИЙ:\n{history_block}\n\n"
-            f"3. ФИНАНСОВОЕ СОСТОЯНИЕ:\n{state_summary}\n\n"
-            f"{task_description}\n\n"
-            f"ДОСТУПНЫЕ ИГРОКУ ВАРИАНТЫ:\n{options_text}\n\n"
-            "ТВОЙ ПЛАН: Проанализируй всю информацию и дай краткий, но емкий совет в своей роли.")
+
+    def render(t):
+        return (f"Ты — AI-ассистент, финансовый консультант. Твоя философия: {ai_philosophy}\n\n"
+                f"1. ДОСЬЕ НА ИГРОКА:\n{t['profile']}\n\n"
+                f"2. ХРОНОЛОГИЯ РЕШЕНИЙ:\n{t['history']}\n\n"
+                f"3. ФИНАНСОВОЕ СОСТОЯНИЕ:\n{t['state']}\n\n"
+                f"{task_description}\n\n"
+                f"ДОСТУПНЫЕ ИГРОКУ ВАРИАНТЫ:\n{t['options']}\n\n"
+                "ТВОЙ ПЛАН: Проанализируй всю информацию и дай краткий, но емкий совет в своей роли.")
+
+    # Порядок — приоритет урезания при превышении бюджета
+    return _fit_prompt("financial_advisor", render, [
+        PromptSection("profile", profile_block),
+        PromptSection("history", history_block),
+        PromptSection("state", state_summary, keep="head"),
+        PromptSection("options", options_text, keep="head"),
+    ])
 
 def build_persona_prompt(
-    db: Session, session_id: int, user_id: int, task_prompt: str, options: list, persona_template: str
+    db: Session, session_id: int, user_id: int, task_prompt: str, options: list, persona_template: str,
+    persona_key: str = "default", ctx: SessionContext = None
 ) -> str:
     """Собирает универсальный промпт для любой роли, используя готовый шаблон."""
-    recent_responses = db.query(models.Response).filter(models.Response.session_id == session_id).order_by(models.Response.id.desc()).limit(3).all()
-    recent_history = [f"- {' '.join((r.node_text or '').split())} → {' '.join((r.answer_text or '').split())}" for r in reversed(recent_responses)]
-    history_block = "\n".join(recent_history) or "Это начало диалога."
-    
-    state_summary = build_universal_state_summary(db, user_id, session_id)
-    options_text = "\n".join([f"- {opt['text']}" for opt in options]) if options else "Вариантов нет."
+    ctx = ctx or _session_context(db, user_id, session_id)
+    if FeatureFlags.ENABLE_HIERARCHICAL_MEMORY:
+        history_block = _memory_history(db, session_id, ctx) or "Это начало диалога."
+    else:
+        history_block = ctx.recent_history() or "Это начало диалога."
     
-    return (
-        f"{persona_template}\n\n"
-        f"### КОНТЕКСТ ДИАЛОГА ###\n"
-        f"**Последние действия игрока:**\n{history_block}\n\n"
-        f"**Текущее состояние игрока:**\n{state_summary}\n\n"
-        f"**Твоя задача или вопрос от игрока:**\n{task_prompt.strip()}\n\n"
-        f"**Варианты, доступные игроку:**\n{options_text}\n\n"
-        f"Ответь в своей роли, кратко и по существу."
-    )
+    state_summary = build_universal_state_summary(db, user_id, session_id, ctx)
+    options_text = "\n".join([f"- {_option_text(opt)}" for opt in options]) if options else "Вариантов нет."
+
+    def render(t):
+        return (
+            f"{persona_template}\n\n"
+            f"### КОНТЕКСТ ДИАЛОГА ###\n"
+            f"**Последние действия игрока:**\n{t['history']}\n\n"
+            f"**Текущее состояние игрока:**\n{t['state']}\n\n"
+            f"**Твоя задача или вопрос от игрока:**\n{task_prompt.strip()}\n\n"
+            f"**Варианты, доступные игроку:**\n{t['options']}\n\n"
+            f"Ответь в своей роли, кратко и по существу."
+        )
+
+    return _fit_prompt(persona_key, render, [
+        PromptSection("history", history_block),
+        PromptSection("state", state_summary, keep="head"),
+        PromptSection("options", options_text, keep="head"),
+    ])
 
 # --- Доп. утилиты (сохранены для совместимости) ---
 def get_simple_profile_context(db: Session, session_id: int) -> str:
@@ -323,11 +789,11 @@ def pause_session(db: Session, session_id: int):
     session = db.query(models.Session).filter(models.Session.id == session_id).first()
     if session:
         session.is_paused = True
-        db.commit()
+        _commit(db)
 
 def resume_session(db: Session, session_id: int):
     """Снимает сессию с паузы"""
     session = db.query(models.Session).filter(models.Session.id == session_id).first()
     if session:
         session.is_paused = False
-        db.commit()
\ No newline at end of file
+        _commit(db)
\ No newline at end of file
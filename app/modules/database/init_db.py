@@ -2,6 +2,7 @@
 
 from .database import engine  # Точка означает "из текущего пакета"
 from . import models
+from .migrations import run_migrations
 
 def create_tables():
     """
@@ -12,6 +13,9 @@ def create_tables():
         # Эта одна команда делает всю магию
         models.Base.metadata.create_all(bind=engine)
         print("--- [init_db] Таблицы успешно созданы или уже существуют. ---")
+        # Изменения существующих таблиц (индексы, ограничения)
+        run_migrations(engine)
+        print("--- [init_db] Миграции применены. ---")
     except Exception as e:
         print(f"!!! [init_db] КРИТИЧЕСКАЯ ОШИБКА при создании таблиц: {e} !!!")
         # Важно выбросить ошибку дальше, чтобы остановить запуск, если БД недоступна
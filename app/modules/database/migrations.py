@@ -0,0 +1,102 @@
+# app/modules/database/migrations.py
+"""
+Идемпотентные миграции схемы, которые не покрывает create_all (он не меняет существующие таблицы).
+Запускаются из init_db.create_tables() при каждом старте контейнера.
+"""
+
+from sqlalchemy import inspect, text
+
+
+def _has_index(engine, table: str, name: str) -> bool:
+    inspector = inspect(engine)
+    names = {i["name"] for i in inspector.get_indexes(table)}
+    names |= {c["name"] for c in inspector.get_unique_constraints(table)}
+    return name in names
+
+
+def migrate_user_states_unique(engine):
+    """
+    Уникальный ключ (user_id, session_id, state_key) для user_states.
+    Перед созданием индекса удаляет дубликаты, оставляя последнюю запись (max id) —
+    именно её раньше возвращал get_all_user_states. Если ключ уже есть, дубликатов быть
+    не может — полный проход по таблице на каждом старте не нужен.
+    """
+    if _has_index(engine, "user_states", "uq_user_states_user_session_key"):
+        return
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            # Анти-join: без NOT IN по подзапросу, который не помещается в work_mem
+            delete = """
+                DELETE FROM user_states a USING user_states b
+                WHERE a.user_id = b.user_id AND a.session_id = b.session_id
+                  AND a.state_key = b.state_key AND a.id < b.id
+            """
+        else:
+            delete = """
+                DELETE FROM user_states WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (
+                            PARTITION BY user_id, session_id, state_key ORDER BY id DESC) AS rn
+                        FROM user_states
+                    ) ranked WHERE rn > 1
+                )
+            """
+        deleted = conn.execute(text(delete)).rowcount
+        if deleted:
+            print(f"--- [migrations] user_states: удалено дубликатов: {deleted} ---")
+        conn.execute(text("""
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_user_states_user_session_key
+            ON user_states (user_id, session_id, state_key)
+        """))
+
+
+def migrate_active_timers_index(engine):
+    """Индекс (status, target_timestamp) для загрузки ожидающих таймеров одним запросом при старте."""
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS ix_active_timers_status_target
+            ON active_timers (status, target_timestamp)
+        """))
+
+
+def migrate_session_id_indexes(engine):
+    """
+    Индексы по session_id для responses и ai_dialogues: выборка событий одной сессии
+    или диапазона сессий (параллельная выгрузка tools/export_data.py --workers) без полного скана.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_responses_session_id ON responses (session_id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ai_dialogues_session_id ON ai_dialogues (session_id)"))
+
+
+def migrate_sessions_end_time_index(engine):
+    """Индекс sessions.end_time: дельта-задание аналитики читает только завершения после курсора."""
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_sessions_end_time ON sessions (end_time)"))
+
+
+def migrate_user_states_value_history(engine):
+    """
+    Колонки initial_value и previous_value в user_states: первое значение переменной в сессии
+    и значение до последней записи (previous/delta/total в промпте ИИ). У старых строк — NULL.
+    """
+    columns = {c["name"] for c in inspect(engine).get_columns("user_states")}
+    with engine.begin() as conn:
+        for name in ("initial_value", "previous_value"):
+            if name not in columns:
+                conn.execute(text(f"ALTER TABLE user_states ADD COLUMN {name} VARCHAR"))
+
+
+MIGRATIONS = [
+    migrate_user_states_unique,
+    migrate_active_timers_index,
+    migrate_session_id_indexes,
+    migrate_sessions_end_time_index,
+    migrate_user_states_value_history,
+]
+
+
+def run_migrations(engine):
+    for migration in MIGRATIONS:
+        print(f"--- [migrations] {migration.__name__} ---")
+        migration(engine)
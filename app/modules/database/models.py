@@ -2,7 +2,7 @@
 # Финальная версия 6.0: Этап 0 - добавлены новые модели + исправлен deprecated datetime.utcnow
 
 from datetime import datetime, timezone
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, JSON, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, JSON, Boolean, Float, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
@@ -29,6 +29,10 @@ class User(Base):
 class Session(Base):
     """Модель сессии. Каждая новая команда /start создает новую сессию."""
     __tablename__ = 'sessions'
+    # Дельта-задание аналитики: завершения после курсора (end_time, id)
+    __table_args__ = (
+        Index('ix_sessions_end_time', 'end_time'),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -53,6 +57,10 @@ class Session(Base):
 class Response(Base):
     """Модель ответа пользователя на узел сценария."""
     __tablename__ = 'responses'
+    # События сессии и диапазона сессий (параллельная выгрузка): WHERE session_id ...
+    __table_args__ = (
+        Index('ix_responses_session_id', 'session_id'),
+    )
     
     id = Column(Integer, primary_key=True)
     session_id = Column(Integer, ForeignKey('sessions.id'), nullable=False)
@@ -74,6 +82,10 @@ class Response(Base):
 class AIDialogue(Base):
     """Модель для хранения диалогов пользователя с AI-ассистентом."""
     __tablename__ = 'ai_dialogues'
+    # См. Response: выборка по session_id
+    __table_args__ = (
+        Index('ix_ai_dialogues_session_id', 'session_id'),
+    )
     
     id = Column(Integer, primary_key=True)
     session_id = Column(Integer, ForeignKey('sessions.id'), nullable=False)
@@ -88,23 +100,53 @@ class AIDialogue(Base):
 class UserState(Base):
     """Модель для хранения произвольных состояний пользователя в рамках сессии."""
     __tablename__ = "user_states"
+    # Одна строка на переменную сессии: нужна для INSERT ... ON CONFLICT в bulk_update_user_states
+    __table_args__ = (
+        UniqueConstraint('user_id', 'session_id', 'state_key', name='uq_user_states_user_session_key'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
     state_key = Column(String, nullable=False, index=True)
     state_value = Column(String, nullable=False)
+    # Первое значение в сессии и значение до последней записи: строка одна на переменную,
+    # а промпт ИИ показывает previous/delta/total (ai_context.SessionContextCache.rebuild)
+    initial_value = Column(String, nullable=True)
+    previous_value = Column(String, nullable=True)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
 
     user = relationship("User", back_populates="states")
     session = relationship("Session", back_populates="states")
 
 
+class UserStateHistory(Base):
+    """
+    История изменений состояния (STATE_HISTORY_ENABLED): user_states хранит только последнее
+    значение ключа. Строки одного клика пишутся с общим timestamp — это один шаг траектории
+    (tools/export_trajectories.py).
+    """
+    __tablename__ = "user_state_history"
+    __table_args__ = (
+        Index('ix_user_state_history_session', 'session_id', 'timestamp'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
+    state_key = Column(String, nullable=False)
+    state_value = Column(String, nullable=False)
+    timestamp = Column(DateTime(timezone=True), nullable=False, default=utc_now)
+
+
 # === НОВЫЕ МОДЕЛИ ДЛЯ ЭТАПА 0 ===
 
 class ActiveTimer(Base):
     """Активные таймеры для timing механик"""
     __tablename__ = 'active_timers'
+    # Восстановление при старте: WHERE status = 'pending' ORDER BY target_timestamp
+    __table_args__ = (
+        Index('ix_active_timers_status_target', 'status', 'target_timestamp'),
+    )
     
     id = Column(Integer, primary_key=True)
     session_id = Column(Integer, ForeignKey('sessions.id'))
@@ -155,3 +197,80 @@ class GroupEvent(Base):
     event_data = Column(JSON, default={})  # данные события
     round_number = Column(Integer, default=1)
     created_at = Column(DateTime, default=utc_now)  # ИСПРАВЛЕНО: современный UTC
+
+
+# === АГРЕГАТЫ АНАЛИТИКИ (app/modules/database/analytics.py) ===
+# Обновляются инкрементально по курсорам; дашборды читают их вместо полного скана responses.
+
+class AnalyticsCursor(Base):
+    """Курсор дельта-задания аналитики: до какого id / времени строки уже учтены."""
+    __tablename__ = 'analytics_cursors'
+
+    name = Column(String(50), primary_key=True)   # sessions, responses, completions
+    position = Column(Integer, nullable=False, default=0)
+    stamp = Column(DateTime(timezone=True), nullable=True)
+    updated_at = Column(DateTime(timezone=True), default=utc_now, onupdate=utc_now)
+
+
+class AnalyticsSessionProgress(Base):
+    """Прогресс сессии для инкрементального расчета воронки, отвалов и времени на узле."""
+    __tablename__ = 'analytics_session_progress'
+
+    session_id = Column(Integer, primary_key=True)
+    graph_id = Column(String, nullable=False)
+    steps = Column(Integer, nullable=False, default=0)
+    last_response_id = Column(Integer, nullable=False, default=0)
+    last_node_id = Column(String, nullable=True)
+    last_timestamp = Column(DateTime(timezone=True), nullable=True)
+    completed = Column(Boolean, nullable=False, default=False)
+
+
+class AnalyticsGraphStats(Base):
+    """Итоги сценария: начатые и завершенные сессии, число ответов."""
+    __tablename__ = 'analytics_graph_stats'
+
+    graph_id = Column(String, primary_key=True)
+    sessions = Column(Integer, nullable=False, default=0)
+    completed = Column(Integer, nullable=False, default=0)
+    responses = Column(Integer, nullable=False, default=0)
+
+
+class AnalyticsFunnelStep(Base):
+    """Воронка: сколько сессий сценария дошли до step-го ответа (step 0 — начали)."""
+    __tablename__ = 'analytics_funnel'
+
+    graph_id = Column(String, primary_key=True)
+    step = Column(Integer, primary_key=True)
+    sessions = Column(Integer, nullable=False, default=0)
+
+
+class AnalyticsNodeStats(Base):
+    """Узел: ответы, незавершенные сессии, остановившиеся на нем, и суммарное время на узле."""
+    __tablename__ = 'analytics_node_stats'
+
+    graph_id = Column(String, primary_key=True)
+    node_id = Column(String, primary_key=True)
+    visits = Column(Integer, nullable=False, default=0)
+    dropoffs = Column(Integer, nullable=False, default=0)
+    dwell_count = Column(Integer, nullable=False, default=0)
+    dwell_seconds = Column(Float, nullable=False, default=0.0)
+
+
+class AnalyticsNodeChoice(Base):
+    """Распределение выборов: число ответов answer_text на узле."""
+    __tablename__ = 'analytics_node_choices'
+
+    graph_id = Column(String, primary_key=True)
+    node_id = Column(String, primary_key=True)
+    answer_text = Column(Text, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class AnalyticsDwellBucket(Base):
+    """Гистограмма времени на узле: bucket — индекс в analytics.DWELL_BUCKETS."""
+    __tablename__ = 'analytics_dwell_histogram'
+
+    graph_id = Column(String, primary_key=True)
+    node_id = Column(String, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,288 @@
+# app/modules/database/session_memory.py
+"""
+Иерархическая память сессии для контекста ИИ (FeatureFlags.ENABLE_HIERARCHICAL_MEMORY).
+
+Три уровня:
+  - последние события (ответы игрока и реплики ИИ) — дословно;
+  - сводки блоков по MEMORY_CHUNK_EVENTS старых событий;
+  - общая сводка (digest), в которую вливаются самые старые сводки блоков,
+    когда их больше MEMORY_MAX_CHUNKS.
+
+Свертка идет фоном (ai_jobs, бэкенд "memory") после коммита апдейта — обработчик
+не ждет. Сводку пишет ИИ при FeatureFlags.ENABLE_AI_SUMMARIZATION, иначе — или если
+ИИ не ответил — экстрактивная сжатая выжимка. Итог хранится в
+Session.session_metadata["memory"] вместе с id последних свернутых событий, поэтому
+после рестарта из БД читаются только несвернутые события, а повторной суммаризации нет.
+
+Размер блока памяти в промпте ограничен независимо от длины игры:
+digest + MEMORY_MAX_CHUNKS сводок (каждая не длиннее MEMORY_SUMMARY_CHARS) +
+не больше MEMORY_RECENT_EVENTS + MEMORY_CHUNK_EVENTS дословных событий.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+from decouple import config
+from sqlalchemy.orm import Session
+
+from . import models
+from .ai_context import PROFILE_KEYS
+
+MEMORY_RECENT_EVENTS = config("MEMORY_RECENT_EVENTS", default=6, cast=int)
+MEMORY_CHUNK_EVENTS = config("MEMORY_CHUNK_EVENTS", default=6, cast=int)
+MEMORY_MAX_CHUNKS = config("MEMORY_MAX_CHUNKS", default=4, cast=int)
+MEMORY_SUMMARY_CHARS = config("MEMORY_SUMMARY_CHARS", default=600, cast=int)
+MEMORY_MAX_SESSIONS = config("MEMORY_MAX_SESSIONS", default=5000, cast=int)
+
+METADATA_KEY = "memory"
+EVENT_TEXT_LIMIT = 300
+SUMMARY_SYSTEM_PROMPT = (
+    "Ты ведешь протокол игровой сессии. Сожми события в 2-3 предложения: ключевые решения игрока, "
+    "их последствия и советы ИИ. Без оценок и вступлений, только факты."
+)
+
+
+def _squash(text, limit: int = EVENT_TEXT_LIMIT) -> str:
+    text = ' '.join((text or '').split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def is_profile_node(node_id) -> bool:
+    """Ответы досье (ai_context.PROFILE_KEYS) идут в профиль, а не в память событий."""
+    return any(key in (node_id or "").lower() for key in PROFILE_KEYS)
+
+
+def response_event_text(node_text, answer_text) -> str:
+    return f"Событие: «{_squash(node_text)}» → решение игрока: «{_squash(answer_text)}»"
+
+
+def dialogue_event_text(user_message, ai_response) -> str:
+    if (user_message or "").startswith("PROACTIVE:"):
+        return f"Реплика ИИ: «{_squash(ai_response)}»"
+    return f"Игрок спросил ИИ: «{_squash(user_message)}» → ответ ИИ: «{_squash(ai_response)}»"
+
+
+def extractive_summary(texts: List[str], max_chars: int = MEMORY_SUMMARY_CHARS) -> str:
+    """Сводка без ИИ: сокращенные строки событий подряд, не длиннее max_chars."""
+    per_item = max(40, max_chars // max(1, len(texts)))
+    return _squash("; ".join(_squash(t, per_item) for t in texts), max_chars)
+
+
+class SessionMemory:
+    """Память одной сессии. events — несвернутые события [(kind, id, text)], kind: 'response' | 'dialogue'."""
+
+    __slots__ = ("digest", "chunks", "events", "covered", "folding")
+
+    def __init__(self, digest: str = "", chunks=None, covered=None):
+        self.digest = digest
+        self.chunks: List[str] = list(chunks or [])
+        self.events: List[tuple] = []
+        self.covered = {"response": 0, "dialogue": 0, **(covered or {})}
+        self.folding = False
+
+    @classmethod
+    def from_metadata(cls, data: Optional[dict]) -> "SessionMemory":
+        data = data or {}
+        return cls(data.get("digest", ""), data.get("chunks"), data.get("covered"))
+
+    def to_metadata(self) -> dict:
+        return {"digest": self.digest, "chunks": list(self.chunks), "covered": dict(self.covered)}
+
+    def add_event(self, kind: str, event_id, text: str):
+        if event_id is not None and event_id <= self.covered.get(kind, 0):
+            return  # уже в сводке
+        self.events.append((kind, event_id, text))
+
+    def needs_fold(self) -> bool:
+        return not self.folding and len(self.events) > MEMORY_RECENT_EVENTS + MEMORY_CHUNK_EVENTS
+
+    def copy(self) -> "SessionMemory":
+        other = SessionMemory(self.digest, self.chunks, self.covered)
+        other.events = list(self.events)
+        return other
+
+    def render(self) -> str:
+        lines = []
+        if self.digest:
+            lines.append(f"- Давние события (сводка): {self.digest}")
+        for chunk in self.chunks:
+            lines.append(f"- Ранее: {chunk}")
+        recent = self.events[-(MEMORY_RECENT_EVENTS + MEMORY_CHUNK_EVENTS):]
+        skipped = len(self.events) - len(recent)
+        if skipped:
+            lines.append(f"- … (ещё {skipped} событий ожидают свертки)")
+        lines.extend(f"- {text}" for _, _, text in recent)
+        return "\n".join(lines)
+
+
+class SessionMemoryCache:
+    """
+    Память активных сессий (LRU). События для сессий, которых нет в кеше, игнорируются:
+    они уже в БД и будут прочитаны при загрузке.
+
+    Args:
+        summarize: (тексты событий или сводок) -> сводка; вызывается в фоне
+        schedule: (session_id, work, skipped) -> запуск work() вне потока апдейта; если задание
+            не будет выполнено (очередь полна, отмена), вызывается skipped(). None — сразу
+    """
+
+    def __init__(self, max_sessions: int = MEMORY_MAX_SESSIONS,
+                 summarize: Callable[[List[str]], str] = extractive_summary,
+                 schedule: Optional[Callable] = None, session_factory=None):
+        self.max_sessions = max_sessions
+        self.summarize = summarize
+        self.schedule = schedule
+        self.session_factory = session_factory
+        self._sessions: "OrderedDict[int, SessionMemory]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._stats = {"loads": 0, "hits": 0, "folds": 0, "merges": 0, "fold_errors": 0}
+
+    def get(self, db: Session, session_id: int) -> SessionMemory:
+        """Снимок памяти сессии (при промахе — загрузка сводок и несвернутых событий из БД)."""
+        with self._lock:
+            memory = self._sessions.get(session_id)
+            if memory is not None:
+                self._sessions.move_to_end(session_id)
+                self._stats["hits"] += 1
+                return memory.copy()
+        memory = self.load(db, session_id)
+        with self._lock:
+            memory = self._sessions.setdefault(session_id, memory)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            snapshot = memory.copy()
+        self._maybe_fold(session_id)
+        return snapshot
+
+    def load(self, db: Session, session_id: int) -> SessionMemory:
+        session = db.query(models.Session.session_metadata).filter(models.Session.id == session_id).first()
+        memory = SessionMemory.from_metadata(((session[0] if session else None) or {}).get(METADATA_KEY))
+        responses = db.query(models.Response.id, models.Response.node_id, models.Response.node_text,
+                             models.Response.answer_text, models.Response.timestamp).filter(
+            models.Response.session_id == session_id, models.Response.id > memory.covered["response"]
+        ).order_by(models.Response.id).all()
+        dialogues = db.query(models.AIDialogue.id, models.AIDialogue.node_id, models.AIDialogue.user_message,
+                             models.AIDialogue.ai_response, models.AIDialogue.timestamp).filter(
+            models.AIDialogue.session_id == session_id, models.AIDialogue.id > memory.covered["dialogue"]
+        ).order_by(models.AIDialogue.id).all()
+
+        # Слияние двух таблиц в порядке игры. Метки времени совпадают в пределах секунды,
+        # поэтому при равенстве реплика ИИ в узле идет перед ответом игрока на этот узел.
+        pending = list(dialogues)
+        for r in responses:
+            while pending and (pending[0].timestamp is None or r.timestamp is None or
+                               pending[0].timestamp < r.timestamp or
+                               (pending[0].timestamp == r.timestamp and pending[0].node_id == r.node_id)):
+                d = pending.pop(0)
+                memory.add_event("dialogue", d.id, dialogue_event_text(d.user_message, d.ai_response))
+            if not is_profile_node(r.node_id):
+                memory.add_event("response", r.id, response_event_text(r.node_text, r.answer_text))
+        for d in pending:
+            memory.add_event("dialogue", d.id, dialogue_event_text(d.user_message, d.ai_response))
+        with self._lock:
+            self._stats["loads"] += 1
+        return memory
+
+    def record(self, session_id: int, kind: str, event_id, text: str):
+        with self._lock:
+            memory = self._sessions.get(session_id)
+            if memory is not None:
+                memory.add_event(kind, event_id, text)
+
+    def maybe_fold(self, session_id: int):
+        """Вызывается после коммита апдейта: при переполнении ставит свертку в фон."""
+        self._maybe_fold(session_id)
+
+    def invalidate(self, session_id: int):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "sessions": len(self._sessions)}
+
+    # --- internal ---
+    def _maybe_fold(self, session_id: int):
+        with self._lock:
+            memory = self._sessions.get(session_id)
+            if memory is None or not memory.needs_fold():
+                return
+            memory.folding = True
+        work = lambda: self._fold(session_id, memory)
+        if self.schedule is None:
+            work()
+        else:
+            self.schedule(session_id, work, lambda: self._release(memory))
+
+    def _release(self, memory: SessionMemory):
+        with self._lock:
+            memory.folding = False
+
+    def _fold(self, session_id: int, memory: SessionMemory):
+        """Свертка старейшего блока событий (и при необходимости слияние сводок в digest)."""
+        try:
+            with self._lock:
+                chunk = memory.events[:MEMORY_CHUNK_EVENTS]
+            summary = self._summarize([text for _, _, text in chunk])
+
+            with self._lock:
+                if self._sessions.get(session_id) is not memory or memory.events[:len(chunk)] != chunk:
+                    return  # память сброшена (откат/конец сессии) — свертка устарела
+                del memory.events[:len(chunk)]
+                memory.chunks.append(summary)
+                for kind, event_id, _ in chunk:
+                    if event_id is not None:
+                        memory.covered[kind] = max(memory.covered.get(kind, 0), event_id)
+                overflow = memory.chunks[:max(0, len(memory.chunks) - MEMORY_MAX_CHUNKS)]
+                digest = memory.digest
+                self._stats["folds"] += 1
+
+            if overflow:
+                merged = self._summarize(([f"Ранее: {digest}"] if digest else []) + overflow)
+                with self._lock:
+                    if memory.chunks[:len(overflow)] == overflow:
+                        del memory.chunks[:len(overflow)]
+                        memory.digest = merged
+                        self._stats["merges"] += 1
+
+            self._persist(session_id, memory)
+        except Exception as e:
+            with self._lock:
+                self._stats["fold_errors"] += 1
+            print(f"[MEMORY] ❌ Ошибка свертки памяти сессии {session_id}: {e}")
+        finally:
+            self._release(memory)
+        self._maybe_fold(session_id)
+
+    def _summarize(self, texts: List[str]) -> str:
+        try:
+            summary = self.summarize(texts)
+        except Exception as e:
+            print(f"[MEMORY] ⚠️ Сводка ИИ не получена ({e}), используется выжимка")
+            summary = ""
+        if not summary or summary.startswith("⚠️"):
+            summary = extractive_summary(texts)
+        return _squash(summary, MEMORY_SUMMARY_CHARS)
+
+    def _persist(self, session_id: int, memory: SessionMemory):
+        from .unit_of_work import unit_of_work
+        with self._lock:
+            data = memory.to_metadata()
+        with unit_of_work(self.session_factory) as db:
+            session = db.query(models.Session).filter(models.Session.id == session_id).first()
+            if session is not None:
+                # JSON-колонка: новое значение целиком, иначе SQLAlchemy не увидит изменения
+                session.session_metadata = {**(session.session_metadata or {}), METADATA_KEY: data}
+        print(f"[MEMORY] 🗜️ Сессия {session_id}: сводок {len(data['chunks'])}, "
+              f"свернуто до response={data['covered']['response']}, dialogue={data['covered']['dialogue']}")
+
+
+def ai_summarize(texts: List[str]) -> str:
+    """Сводка через текущую модель ИИ (FeatureFlags.ENABLE_AI_SUMMARIZATION)."""
+    from app.modules import gigachat_handler
+    return gigachat_handler.get_ai_response("\n".join(f"- {t}" for t in texts), system_prompt=SUMMARY_SYSTEM_PROMPT)
@@ -0,0 +1,117 @@
+# app/modules/database/unit_of_work.py
+"""
+Единица работы (unit of work) на один апдейт Telegram.
+
+Обработка апдейта идет в одной сессии SQLAlchemy: одно получение соединения из пула
+и одна транзакция. Хелперы crud внутри единицы работы делают flush вместо commit,
+поэтому ответы, изменения состояния и обновления сессии фиксируются вместе при выходе
+из блока. Вложенный unit_of_work() в том же потоке (process_node внутри обработчика
+кнопки) переиспользует внешнюю сессию.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from sqlalchemy.orm import Session
+
+_UOW_KEY = "unit_of_work"
+_ON_ROLLBACK_KEY = "uow_on_rollback"
+_AFTER_COMMIT_KEY = "uow_after_commit"
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {"units": 0, "commits": 0, "rollbacks": 0, "total_ms": 0.0}
+
+
+def in_unit_of_work(db) -> bool:
+    """True, если сессия открыта через unit_of_work() (коммит делает единица работы)."""
+    info = getattr(db, "info", None)
+    return bool(info and info.get(_UOW_KEY))
+
+
+def current_session() -> Optional[Session]:
+    """Сессия активной единицы работы в текущем потоке или None."""
+    return getattr(_local, "db", None)
+
+
+def on_rollback(db, callback: Callable[[], None]):
+    """
+    Регистрирует действие, которое выполнится, если транзакция единицы работы откатится.
+    Действия выполняются в обратном порядке регистрации, как отмена шагов.
+    """
+    if in_unit_of_work(db):
+        db.info.setdefault(_ON_ROLLBACK_KEY, []).append(callback)
+
+
+def after_commit(db, callback: Callable[[], None]):
+    """
+    Действие после фиксации транзакции (например, фоновая задача по записанным строкам).
+    Вне единицы работы crud уже закоммитил — выполняется сразу.
+    """
+    if in_unit_of_work(db):
+        db.info.setdefault(_AFTER_COMMIT_KEY, []).append(callback)
+    else:
+        _run_callbacks([callback], "после коммита")
+
+
+@contextmanager
+def unit_of_work(session_factory=None):
+    """
+    with unit_of_work() as db:
+        ... # crud.* без промежуточных коммитов
+    # commit при успехе, rollback при исключении, close всегда
+    """
+    outer = current_session()
+    if outer is not None:
+        yield outer
+        return
+
+    if session_factory is None:
+        from . import SessionLocal as session_factory
+    db = session_factory()
+    db.info[_UOW_KEY] = True
+    _local.db = db
+    started = time.perf_counter()
+    committed = False
+    try:
+        yield db
+        db.commit()
+        committed = True
+        _run_callbacks(db.info.pop(_AFTER_COMMIT_KEY, []), "после коммита")
+    except BaseException:
+        _rollback(db)
+        raise
+    finally:
+        _local.db = None
+        db.info.pop(_UOW_KEY, None)
+        db.info.pop(_ON_ROLLBACK_KEY, None)
+        db.info.pop(_AFTER_COMMIT_KEY, None)
+        db.close()
+        with _stats_lock:
+            _stats["units"] += 1
+            _stats["commits" if committed else "rollbacks"] += 1
+            _stats["total_ms"] += (time.perf_counter() - started) * 1000
+
+
+def stats() -> dict:
+    with _stats_lock:
+        units = _stats["units"]
+        return {**_stats, "avg_ms": round(_stats["total_ms"] / units, 2) if units else 0.0}
+
+
+def _rollback(db):
+    try:
+        db.rollback()
+    except Exception as e:
+        print(f"❌ [UOW] Ошибка отката транзакции: {e}")
+    _run_callbacks(reversed(db.info.pop(_ON_ROLLBACK_KEY, [])), "отката")
+
+
+def _run_callbacks(callbacks, what: str):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            print(f"❌ [UOW] Ошибка обработчика {what}: {e}")
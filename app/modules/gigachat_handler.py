@@ -1,5 +1,11 @@
 # app/modules/gigachat_handler.py
 # Версия 4.1: Добавлена настройка температуры генерации (AI_TEMPERATURE)
+# Версия 4.2: Пауза между повторами прерывается cancel_event (фоновые задания ai_jobs)
+# Версия 4.3: Потоковый режим (AI_STREAMING): текст отдается в on_text по мере генерации
+# Версия 4.4: Размер отправленного промпта в логе каждого вызова (оценка и usage.prompt_tokens)
+# Версия 4.5: Предохранитель на модель (ai_resilience) и дублирующие запросы (AI_HEDGE_MODEL)
+# Версия 4.6: Адреса API и таймаут клиентов из .env (прогоны на заглушке tools/fake_llm_server.py)
+# Версия 4.7: Пуловые keep-alive HTTP-клиенты (HTTP_POOL_ENABLED, http_transport) и прогрев соединений
 
 """
 === ИНСТРУКЦИЯ ПО ВЫБОРУ МОДЕЛИ ===
@@ -27,8 +33,16 @@
 - COMPLIANCE_MODE=true/false
 - ACTIVE_MODEL=deepseek-main
 - AI_TEMPERATURE=0.6 (0.0 - строгий робот, 1.0 - креатив/хаос)
+- AI_STREAMING=true/false (ответ дописывается в чате по мере генерации)
+- AI_STREAM_EDIT_INTERVAL=1.5 (не чаще одной правки сообщения в N сек на чат)
+- AI_BREAKER_FAILURES=3, AI_BREAKER_RESET_SECONDS=30 (отключение модели после N ошибок подряд)
+- AI_HEDGE_MODEL=deepseek-fast (только эксперимент: дубль запроса, если основная модель медлит)
 - GIGACHAT_CREDENTIALS=...
 - VSEGPT_API_KEY=sk-...
+- GIGACHAT_BASE_URL, GIGACHAT_AUTH_URL, VSEGPT_BASE_URL (пусто — боевые адреса; для заглушки — её адрес)
+- AI_REQUEST_TIMEOUT=0 (таймаут HTTP-запроса к модели, сек; 0 — по умолчанию клиента)
+- VSEGPT_SDK_RETRIES=2 (собственные повторы клиента openai поверх наших трех попыток)
+- HTTP_POOL_ENABLED=true (общий пул соединений с долгим keep-alive, см. http_transport)
 """
 
 import time
@@ -37,6 +51,13 @@ from gigachat import GigaChat
 from gigachat.models import Chat, Messages, MessagesRole
 from decouple import config
 
+from app.modules.ai_resilience import (
+    AI_HEDGE_MODEL, OPEN, CircuitOpenError, call_with_breaker, get_breaker, hedged_call
+)
+from app.modules.ai_streaming import collect_stream, gigachat_deltas, openai_deltas
+from app.modules.http_transport import HTTP_POOL_ENABLED, llm_http_client, llm_timeout
+from app.modules.prompt_budget import estimate_tokens
+
 # Попытка импорта openai для VseGPT
 try:
     import openai
@@ -51,6 +72,14 @@ COMPLIANCE_MODE = config("COMPLIANCE_MODE", default=True, cast=bool)
 ACTIVE_MODEL = config("ACTIVE_MODEL", default="deepseek-main")
 # Температура: 0.5-0.7 оптимум для ролеплея. Ниже - суше, выше - бред.
 AI_TEMPERATURE = config("AI_TEMPERATURE", default=0.6, cast=float)
+# Потоковая генерация: игрок видит первые слова через время первого чанка, а не всего ответа
+AI_STREAMING = config("AI_STREAMING", default=False, cast=bool)
+# Адреса API: пусто — боевые; нагрузочные прогоны направляют клиентов на заглушку
+GIGACHAT_BASE_URL = config("GIGACHAT_BASE_URL", default="")
+GIGACHAT_AUTH_URL = config("GIGACHAT_AUTH_URL", default="")
+VSEGPT_BASE_URL = config("VSEGPT_BASE_URL", default="https://api.vsegpt.ru/v1")
+AI_REQUEST_TIMEOUT = config("AI_REQUEST_TIMEOUT", default=0.0, cast=float)
+VSEGPT_SDK_RETRIES = config("VSEGPT_SDK_RETRIES", default=2, cast=int)
 
 # === МОДЕЛИ ===
 MODELS = {
@@ -86,8 +115,24 @@ if GIGACHAT_CREDENTIALS:
         print("Инициализация клиента GigaChat...")
         gigachat_client = GigaChat(
             credentials=GIGACHAT_CREDENTIALS,
-            verify_ssl_certs=False
+            verify_ssl_certs=False,
+            base_url=GIGACHAT_BASE_URL or None,
+            auth_url=GIGACHAT_AUTH_URL or None,
+            timeout=AI_REQUEST_TIMEOUT or None
         )
+        if HTTP_POOL_ENABLED:
+            # Публичного параметра для своего httpx-клиента у GigaChat нет: клиент создается
+            # лениво в _client_instance, подставляем пуловый до первого запроса.
+            # Это внутренности библиотеки (проверено на gigachat==0.2.3, см. requirements.txt)
+            settings = getattr(gigachat_client, "_settings", None)
+            if hasattr(gigachat_client, "_client_instance") and hasattr(settings, "base_url"):
+                gigachat_client._client_instance = llm_http_client(
+                    "gigachat", base_url=settings.base_url, verify=False,
+                    read_timeout=AI_REQUEST_TIMEOUT or None
+                )
+            else:
+                print("[HTTP] ⚠️ GigaChat: не найден _client_instance/_settings.base_url "
+                      "(другая версия библиотеки?) — используется стандартный клиент без общего пула")
         print("-> GigaChat клиент готов")
     except Exception as e:
         print(f"!!! ОШИБКА инициализации GigaChat: {e}")
@@ -101,9 +146,17 @@ if OPENAI_AVAILABLE:
     if VSEGPT_API_KEY:
         try:
             print("Инициализация клиента VseGPT...")
+            client_options = {"timeout": AI_REQUEST_TIMEOUT} if AI_REQUEST_TIMEOUT else {}
+            if HTTP_POOL_ENABLED:
+                client_options = {
+                    "timeout": llm_timeout(AI_REQUEST_TIMEOUT or None),
+                    "http_client": llm_http_client("vsegpt", read_timeout=AI_REQUEST_TIMEOUT or None),
+                }
             vsegpt_client = openai.OpenAI(
                 api_key=VSEGPT_API_KEY,
-                base_url="https://api.vsegpt.ru/v1"
+                base_url=VSEGPT_BASE_URL,
+                max_retries=VSEGPT_SDK_RETRIES,
+                **client_options
             )
             print("-> VseGPT клиент готов")
         except Exception as e:
@@ -125,37 +178,97 @@ if COMPLIANCE_MODE:
     print("🛡️  R-BOT AI MODE: COMPLIANCE_MODE=TRUE (OFFICIAL RESEARCH)")
     print("    Provider locked: GigaChat only")
     print(f"    Temperature: {AI_TEMPERATURE}")
+    print(f"    Streaming: {AI_STREAMING}")
 else:
     print("🔬 R-BOT AI MODE: COMPLIANCE_MODE=FALSE (EXPERIMENT)")
     print(f"    Selected model: {ACTIVE_MODEL}")
     print(f"    Temperature: {AI_TEMPERATURE}")
+    print(f"    Streaming: {AI_STREAMING}")
+    print(f"    Hedge model: {AI_HEDGE_MODEL or 'off'}")
     print(f"    Description: {MODELS.get(ACTIVE_MODEL, {}).get('description', 'N/A')}")
 print("=" * 72 + "\n")
 
 
-def get_ai_response(user_message: str, system_prompt: str) -> str:
+def selected_model_name() -> str:
+    """Модель с учётом compliance-режима."""
+    return "gigachat-pro" if COMPLIANCE_MODE else ACTIVE_MODEL
+
+
+def active_backend() -> str:
+    """Бэкенд выбранной модели (ключ очереди в ai_jobs)."""
+    return MODELS[selected_model_name()]["backend"]
+
+
+def hedge_model_name():
+    """Модель для дублирующих запросов или None (только эксперимент, VseGPT, без стриминга)."""
+    primary = selected_model_name()
+    if COMPLIANCE_MODE or not AI_HEDGE_MODEL or AI_HEDGE_MODEL == primary:
+        return None
+    if AI_HEDGE_MODEL not in MODELS:
+        print(f"[AI-HEDGE] ⚠️ AI_HEDGE_MODEL={AI_HEDGE_MODEL} нет в MODELS, hedging выключен")
+        return None
+    if MODELS[primary]["backend"] != "vsegpt" or MODELS[AI_HEDGE_MODEL]["backend"] != "vsegpt":
+        return None
+    return AI_HEDGE_MODEL
+
+
+def warmup_targets() -> list:
+    """Легкие запросы для прогрева соединений (http_transport.warm_up): токен и список моделей."""
+    targets = []
+    if gigachat_client:
+        targets.append(("GigaChat", gigachat_client.get_models))
+    if vsegpt_client and not COMPLIANCE_MODE:
+        targets.append(("VseGPT", vsegpt_client.models.list))
+    return targets
+
+
+def _failure_response() -> str:
+    # КРИТИЧНО: Если в compliance-режиме упал GigaChat → игра на паузу
+    if COMPLIANCE_MODE:
+        return "⚠️ Сервис временно недоступен. Пожалуйста, попробуйте позже или обратитесь к администратору."
+    return ""
+
+
+def get_ai_response(user_message: str, system_prompt: str, cancel_event=None, on_text=None) -> str:
     """
     Отправляет запрос к AI с автоматическими повторами при сбоях.
     
     Args:
         user_message: сообщение пользователя
         system_prompt: системный промпт (роль, контекст)
+        cancel_event: threading.Event задания; если взведен — повторы прекращаются
+        on_text: потоковый режим — вызывается с накопленным текстом после каждого фрагмента
     
     Returns:
         str: ответ AI или специальное сообщение об ошибке (начинается с ⚠️)
     """
     
-    # Определяем модель с учётом compliance-режима
-    if COMPLIANCE_MODE:
-        selected_model = "gigachat-pro"
-    else:
-        selected_model = ACTIVE_MODEL
-    
-    config_model = MODELS[selected_model]
+    model_name = selected_model_name()
+    config_model = MODELS[model_name]
     backend = config_model["backend"]
     model_id = config_model["model_id"]
+    breaker = get_breaker(model_name)
+    hedge_name = None if on_text else hedge_model_name()
     
     MAX_RETRIES = 3
+
+    # Размер запроса: оценка до отправки; фактический usage бэкенд пишет после ответа
+    prompt_chars = len(system_prompt or "") + len(user_message or "")
+    print(f"[AI] 📏 Промпт: {prompt_chars} симв., ~{estimate_tokens(system_prompt) + estimate_tokens(user_message)} ток.")
+
+    def call_model():
+        if backend == "gigachat" and on_text:
+            return _stream_gigachat(user_message, system_prompt, model_id, on_text, cancel_event)
+        if backend == "gigachat":
+            return _call_gigachat(user_message, system_prompt, model_id)
+        if backend == "vsegpt" and on_text:
+            return _stream_vsegpt(user_message, system_prompt, model_id, on_text, cancel_event)
+        if backend == "vsegpt":
+            return _call_vsegpt(user_message, system_prompt, model_id)
+        raise ValueError(f"Неизвестный backend: {backend}")
+
+    def call_hedge():
+        return _call_vsegpt(user_message, system_prompt, MODELS[hedge_name]["model_id"])
     
     for attempt in range(1, MAX_RETRIES + 1):
         start_time = time.time()
@@ -163,13 +276,11 @@ def get_ai_response(user_message: str, system_prompt: str) -> str:
         try:
             print(f"[AI] Попытка {attempt}/{MAX_RETRIES} | {backend}/{model_id}")
             
-            # Вызов бэкенда
-            if backend == "gigachat":
-                response = _call_gigachat(user_message, system_prompt, model_id)
-            elif backend == "vsegpt":
-                response = _call_vsegpt(user_message, system_prompt, model_id)
+            # Вызов бэкенда (через предохранитель модели)
+            if hedge_name:
+                response = hedged_call(model_name, call_model, hedge_name, call_hedge)
             else:
-                raise ValueError(f"Неизвестный backend: {backend}")
+                response = call_with_breaker(model_name, call_model)
             
             # Успех
             latency_ms = int((time.time() - start_time) * 1000)
@@ -179,24 +290,23 @@ def get_ai_response(user_message: str, system_prompt: str) -> str:
         except Exception as e:
             latency_ms = int((time.time() - start_time) * 1000)
             error_type = type(e).__name__
-            is_retryable = _is_retryable_error(e)
+            is_retryable = _is_retryable_error(e) and breaker.state != OPEN
             
             print(f"[AI] ❌ Ошибка на попытке {attempt}: {error_type}")
             
-            # Если это последняя попытка ИЛИ ошибка непоправимая
+            # Если это последняя попытка ИЛИ ошибка непоправимая ИЛИ модель отключена предохранителем
             if attempt == MAX_RETRIES or not is_retryable:
                 print(f"[AI] 🚫 Отказ после {attempt} попыток: {e}")
-                
-                # КРИТИЧНО: Если в compliance-режиме упал GigaChat → игра на паузу
-                if COMPLIANCE_MODE:
-                    return "⚠️ Сервис временно недоступен. Пожалуйста, попробуйте позже или обратитесь к администратору."
-                else:
-                    return ""
+                return _failure_response()
             
             # Экспоненциальная задержка перед следующей попыткой
             delay = 2 ** attempt
             print(f"[AI] 🔄 Повтор через {delay} сек...")
-            time.sleep(delay)
+            if cancel_event is None:
+                time.sleep(delay)
+            elif cancel_event.wait(delay):
+                print("[AI] ⏹️ Запрос отменен (сессия завершена)")
+                return ""
     
     return "⚠️ Сервис временно недоступен."
 
@@ -217,6 +327,7 @@ def _call_gigachat(user_message: str, system_prompt: str, model_id: str) -> str:
         temperature=AI_TEMPERATURE  # NEW: Температура
     ))
     
+    _log_usage(response)
     if response.choices and response.choices[0].message.content:
         return response.choices[0].message.content
     else:
@@ -237,14 +348,54 @@ def _call_vsegpt(user_message: str, system_prompt: str, model_id: str) -> str:
         temperature=AI_TEMPERATURE  # NEW: Температура
     )
     
+    _log_usage(response)
     if response.choices and response.choices[0].message.content:
         return response.choices[0].message.content
     else:
         raise ValueError("VseGPT вернул пустой ответ")
 
 
+def _stream_gigachat(user_message: str, system_prompt: str, model_id: str, on_text, cancel_event=None) -> str:
+    """Потоковый вызов GigaChat API"""
+    if not gigachat_client:
+        raise RuntimeError("GigaChat клиент не инициализирован")
+
+    chat = Chat(
+        messages=[
+            Messages(role=MessagesRole.SYSTEM, content=system_prompt),
+            Messages(role=MessagesRole.USER, content=user_message)
+        ],
+        model=model_id,
+        temperature=AI_TEMPERATURE
+    )
+    return collect_stream(gigachat_deltas(gigachat_client, chat), on_text, cancel_event, "GigaChat")
+
+
+def _stream_vsegpt(user_message: str, system_prompt: str, model_id: str, on_text, cancel_event=None) -> str:
+    """Потоковый вызов VseGPT API (OpenAI-compatible, stream=True)"""
+    if not vsegpt_client:
+        raise RuntimeError("VseGPT клиент не инициализирован")
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+    return collect_stream(openai_deltas(vsegpt_client, model_id, messages, AI_TEMPERATURE),
+                           on_text, cancel_event, "VseGPT")
+
+
+def _log_usage(response):
+    """Фактический расход токенов по ответу API (если бэкенд его вернул)."""
+    usage = getattr(response, "usage", None)
+    if usage is not None and getattr(usage, "prompt_tokens", None) is not None:
+        print(f"[AI] 📏 Токены: prompt={usage.prompt_tokens}, completion={getattr(usage, 'completion_tokens', '?')}")
+
+
 def _is_retryable_error(error: Exception) -> bool:
     """Определяет, стоит ли повторять запрос при данной ошибке"""
+    if isinstance(error, CircuitOpenError):
+        return False
+
     error_str = str(error).lower()
     
     # Сетевые ошибки → retry
@@ -0,0 +1,230 @@
+# app/modules/graph_compiler.py
+"""
+Компиляция JSON-сценария в неизменяемое представление CompiledGraph.
+
+Граф компилируется один раз при (пере)загрузке в hot_reload: типы узлов сводятся
+к NodeKind, переходы условий и рандомизаторов извлекаются заранее, строки тайминга
+и ai_proactive разбираются, формулы и условия компилируются в code-объекты.
+Обработчики Telegram получают готовые атрибуты без regex и разбора строк на каждом апдейте.
+"""
+
+import re
+import sys
+from dataclasses import dataclass, field
+from enum import Enum
+from types import CodeType, MappingProxyType
+from typing import Any, Mapping, Optional, Tuple
+
+from app.modules.state_calculator import CompiledFormula, FormulaError, compile_condition, compile_formula
+from app.modules.timing_engine import parse_timing_config
+
+INTERACTIVE_NODE_TYPES = ["task", "input_text", "question", "Задача", "Вопрос"]
+AUTOMATIC_NODE_TYPES = ["condition", "randomizer", "state", "Условие", "Рандомизатор", "Состояние"]
+
+AI_PROACTIVE_PATTERNS = (
+    re.compile(r'ai_proactive:\s*([a-zA-Z0-9_]+)\s*\("(.+?)"\)'),
+    re.compile(r'ai_proactive:\s*([a-zA-Z0-9_]+)\s*\((.+?)\)'),
+)
+CONDITION_VAR_RE = re.compile(r'\{([a-zA-Z_]\w*)\}')
+
+
+class NodeKind(Enum):
+    INTERACTIVE = "interactive"
+    AI_PROACTIVE = "ai_proactive"
+    STATE = "state"
+    CONDITION = "condition"
+    RANDOMIZER = "randomizer"
+    FINAL = "final"  # неизвестный тип — завершение игры
+
+    @property
+    def is_automatic(self) -> bool:
+        return self in (NodeKind.STATE, NodeKind.CONDITION, NodeKind.RANDOMIZER)
+
+
+_KIND_BY_TYPE = {
+    "state": NodeKind.STATE, "Состояние": NodeKind.STATE,
+    "condition": NodeKind.CONDITION, "Условие": NodeKind.CONDITION,
+    "randomizer": NodeKind.RANDOMIZER, "Рандомизатор": NodeKind.RANDOMIZER,
+    **{t: NodeKind.INTERACTIVE for t in INTERACTIVE_NODE_TYPES},
+}
+
+
+@dataclass(frozen=True)
+class CompiledOption:
+    text: str
+    next_node_id: Optional[str] = None
+    formula: Optional[str] = None
+    compiled_formula: Optional[CompiledFormula] = None
+    interpretation: Optional[str] = None
+
+    @property
+    def answer_text(self) -> str:
+        """Текст, который сохраняется в responses (трактовка или текст кнопки)."""
+        return self.interpretation if self.interpretation is not None else self.text
+
+
+@dataclass(frozen=True)
+class CompiledNode:
+    id: str
+    kind: NodeKind
+    type: str
+    text: Optional[str] = None
+    image_id: Optional[str] = None
+    options: Tuple[CompiledOption, ...] = ()
+    next_node_id: Optional[str] = None
+    shuffle_options: bool = False
+    is_input_text: bool = False
+    ai_enabled: Any = None
+    # ai_proactive:role("task")
+    ai_role: Optional[str] = None
+    ai_task: Optional[str] = None
+    # condition
+    condition_source: Optional[str] = None
+    condition_code: Optional[CodeType] = None
+    then_node_id: Optional[str] = None
+    else_node_id: Optional[str] = None
+    # randomizer
+    branch_targets: Tuple[Optional[str], ...] = ()
+    branch_weights: Tuple[float, ...] = ()
+    # timing
+    timing_source: Optional[str] = None
+    timing: tuple = ()
+    raw: Mapping[str, Any] = field(default_factory=dict, repr=False, compare=False)
+
+
+@dataclass(frozen=True)
+class CompiledGraph:
+    graph_id: str
+    start_node_id: str
+    nodes: Mapping[str, CompiledNode]
+    warnings: Tuple[str, ...] = ()
+
+    def get(self, node_id) -> Optional[CompiledNode]:
+        return self.nodes.get(str(node_id)) if node_id is not None else None
+
+
+def _intern(value) -> Optional[str]:
+    return sys.intern(str(value)) if value not in (None, "") else None
+
+
+def extract_condition_targets(node: dict):
+    then_id = node.get("then_node_id") or node.get("then")
+    else_id = node.get("else_node_id") or node.get("else")
+    if not (then_id and else_id):
+        options = node.get("options", [])
+        for opt in options:
+            label = (opt.get("label") or opt.get("text") or "").strip().lower()
+            if label in ("then", "тогда") and not then_id:
+                then_id = opt.get("next_node_id")
+            elif label in ("else", "иначе") and not else_id:
+                else_id = opt.get("next_node_id")
+    return then_id, else_id
+
+
+def parse_ai_proactive(type_str: str):
+    """'ai_proactive:role("task")' -> (role, task) или (None, None)."""
+    for p in AI_PROACTIVE_PATTERNS:
+        m = p.search(type_str or "")
+        if m:
+            return m.groups()
+    return None, None
+
+
+def _compile_option(node_id: str, opt: dict, warnings: list) -> CompiledOption:
+    formula = opt.get("formula")
+    compiled_formula = None
+    if formula:
+        try:
+            compiled_formula = compile_formula(str(formula))
+        except FormulaError as e:
+            warnings.append(f"узел '{node_id}': ошибка в формуле '{formula}': {e}")
+    return CompiledOption(
+        text=opt.get("text", ""),
+        next_node_id=_intern(opt.get("next_node_id")),
+        formula=str(formula) if formula else None,
+        compiled_formula=compiled_formula,
+        interpretation=opt.get("interpretation"),
+    )
+
+
+def compile_node(node_id: str, node: dict, warnings: list) -> CompiledNode:
+    node_id = sys.intern(str(node_id))
+    type_str = node.get("type", "") or ""
+    if type_str.startswith("ai_proactive"):
+        kind = NodeKind.AI_PROACTIVE
+    else:
+        kind = _KIND_BY_TYPE.get(type_str, NodeKind.FINAL)
+
+    fields = dict(
+        id=node_id, kind=kind, type=type_str,
+        text=node.get("text"),
+        image_id=node.get("image_id"),
+        options=tuple(_compile_option(node_id, o, warnings) for o in node.get("options", [])),
+        next_node_id=_intern(node.get("next_node_id")),
+        shuffle_options=bool((type_str in ("task", "Задача") or kind is NodeKind.AI_PROACTIVE)
+                             and node.get("randomize_options", False)),
+        is_input_text=(type_str == "input_text"),
+        ai_enabled=node.get("ai_enabled"),
+        raw=MappingProxyType(node),
+    )
+
+    if kind is NodeKind.AI_PROACTIVE:
+        fields["ai_role"], fields["ai_task"] = parse_ai_proactive(type_str)
+    elif kind is NodeKind.CONDITION:
+        expr = node.get("text") or node.get("condition_string") or "False"
+        fields["condition_source"] = expr
+        try:
+            fields["condition_code"] = compile_condition(CONDITION_VAR_RE.sub(r'\1', expr))
+        except FormulaError as e:
+            warnings.append(f"узел '{node_id}': ошибка в условии '{expr}': {e}")
+        then_id, else_id = extract_condition_targets(node)
+        fields["then_node_id"], fields["else_node_id"] = _intern(then_id), _intern(else_id)
+    elif kind is NodeKind.RANDOMIZER:
+        branches = node.get("branches", [])
+        fields["branch_targets"] = tuple(_intern(b.get("next_node_id")) for b in branches)
+        fields["branch_weights"] = tuple(b.get("weight", 1) for b in branches)
+
+    timing = node.get("timing")
+    if timing:
+        fields["timing_source"] = timing
+        fields["timing"] = parse_timing_config(timing)
+
+    compiled = CompiledNode(**fields)
+    if kind is NodeKind.FINAL and (node.get("branches") or any(t is not None for t in _edge_targets(compiled))):
+        # Обработчик завершает игру на узле неизвестного типа — его переходы никогда не выполнятся
+        warnings.append(f"узел '{node_id}': неизвестный тип '{type_str}', переходы не выполняются — игра на нем завершается")
+    return compiled
+
+
+def _edge_targets(node: CompiledNode):
+    yield node.next_node_id
+    for opt in node.options:
+        yield opt.next_node_id
+    yield node.then_node_id
+    yield node.else_node_id
+    yield from node.branch_targets
+
+
+def compile_graph(graph: dict) -> CompiledGraph:
+    """Компилирует JSON-сценарий. Висячие ссылки не считаются ошибкой, а попадают в warnings."""
+    warnings = []
+    nodes = {}
+    for node_id, node in (graph.get("nodes") or {}).items():
+        compiled = compile_node(node_id, node, warnings)
+        nodes[compiled.id] = compiled
+
+    for node in nodes.values():
+        for target in _edge_targets(node):
+            if target is not None and target not in nodes:
+                warnings.append(f"узел '{node.id}': переход на несуществующий узел '{target}'")
+
+    start = _intern(graph.get("start_node_id"))
+    if start not in nodes:
+        warnings.append(f"стартовый узел '{start}' не найден")
+
+    return CompiledGraph(
+        graph_id=graph.get("graph_id", "default"),
+        start_node_id=start,
+        nodes=MappingProxyType(nodes),
+        warnings=tuple(warnings),
+    )
@@ -2,6 +2,7 @@
 """
 Модуль автоматического обновления сценария без перезапуска приложения.
 Отслеживает изменения файла graph_data и обновляет глобальные переменные.
+При каждой загрузке сценарий компилируется в CompiledGraph (см. graph_compiler).
 """
 
 import os
@@ -10,8 +11,11 @@ import threading
 import time
 from typing import Optional, Callable
 
+from app.modules.graph_compiler import CompiledGraph, compile_graph
+
 # Глобальные переменные для сценария (будут обновляться автоматически)
 graph_data: Optional[dict] = None
+compiled_graph: Optional[CompiledGraph] = None
 current_graph_path: Optional[str] = None
 
 def load_graph_from_file(filepath: str) -> dict:
@@ -24,12 +28,16 @@ def reload_graph_data(filepath: str):
     Обновляет глобальную переменную graph_data из файла.
     В случае ошибки сохраняет предыдущую версию.
     """
-    global graph_data
+    global graph_data, compiled_graph
     try:
         new_graph = load_graph_from_file(filepath)
-        graph_data = new_graph
+        new_compiled = compile_graph(new_graph)
+        # Обе версии меняются вместе, только после успешной компиляции
+        graph_data, compiled_graph = new_graph, new_compiled
         print(f"[HOT-RELOAD] ✅ Сценарий успешно обновлен из {filepath}")
-        print(f"[HOT-RELOAD] Загружено узлов: {len(graph_data.get('nodes', {})) if graph_data else 0}")
+        print(f"[HOT-RELOAD] Загружено узлов: {len(compiled_graph.nodes)}")
+        for warning in compiled_graph.warnings:
+            print(f"[HOT-RELOAD] ⚠️ {warning}")
     except Exception as e:
         print(f"[HOT-RELOAD] ❌ Ошибка обновления сценария: {e}")
         print(f"[HOT-RELOAD] Сохраняется предыдущая версия сценария.")
@@ -97,3 +105,7 @@ def start_hot_reload(filepath: str, poll_interval: int = 30) -> threading.Thread
 def get_current_graph() -> Optional[dict]:
     """Возвращает актуальную версию graph_data."""
     return graph_data
+
+def get_compiled_graph() -> Optional[CompiledGraph]:
+    """Возвращает скомпилированную версию актуального сценария."""
+    return compiled_graph
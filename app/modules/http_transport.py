@@ -0,0 +1,206 @@
+# app/modules/http_transport.py
+"""
+Общий HTTP-транспорт исходящих вызовов: Telegram Bot API и оба клиента LLM.
+
+По умолчанию telebot держит свою requests-сессию в каждом потоке (пул соединений
+не делится между воркерами, а сессия пересоздается раз в 10 минут), а httpx-клиенты
+GigaChat и openai закрывают простаивающие соединения через 5 секунд — первый запрос
+после паузы платит TCP + TLS. С HTTP_POOL_ENABLED=true:
+
+- Telegram: одна requests-сессия на процесс с пулом HTTP_POOL_MAXSIZE соединений
+  (через apihelper.CUSTOM_REQUEST_SENDER), таймауты HTTP_CONNECT_TIMEOUT / HTTP_TELEGRAM_READ_TIMEOUT;
+- LLM: httpx.Client с пулом HTTP_POOL_MAXSIZE и keep-alive HTTP_KEEPALIVE_EXPIRY сек,
+  таймаут чтения — AI_REQUEST_TIMEOUT (или DEFAULT_LLM_READ_TIMEOUT);
+- HTTP_WARMUP=true: при старте в фоне открываются соединения (getMe, список моделей LLM).
+
+Статистика переиспользования соединений — transport_stats() (/health/http).
+"""
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import httpx
+import requests
+from decouple import config
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+
+HTTP_POOL_ENABLED = config("HTTP_POOL_ENABLED", default=False, cast=bool)
+HTTP_POOL_MAXSIZE = config("HTTP_POOL_MAXSIZE", default=32, cast=int)               # соединений на хост
+HTTP_KEEPALIVE_EXPIRY = config("HTTP_KEEPALIVE_EXPIRY", default=120.0, cast=float)  # сек простоя (httpx)
+HTTP_CONNECT_TIMEOUT = config("HTTP_CONNECT_TIMEOUT", default=5.0, cast=float)
+HTTP_TELEGRAM_READ_TIMEOUT = config("HTTP_TELEGRAM_READ_TIMEOUT", default=30.0, cast=float)
+HTTP_WARMUP = config("HTTP_WARMUP", default=False, cast=bool)
+
+DEFAULT_LLM_READ_TIMEOUT = 60.0
+
+
+class EndpointStats:
+    """Счетчики одной группы вызовов: запросы, новые соединения, TLS-рукопожатия, ошибки."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._counts = {"requests": 0, "connections": 0, "tls_handshakes": 0, "errors": 0}
+        self._total_seconds = 0.0
+        self.connection_source: Optional[Callable[[], int]] = None   # счетчик соединений самого пула
+
+    def add(self, key: str, value: int = 1):
+        with self._lock:
+            self._counts[key] += value
+
+    def observe(self, seconds: float, ok: bool = True):
+        with self._lock:
+            self._counts["requests"] += 1
+            self._total_seconds += seconds
+            if not ok:
+                self._counts["errors"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+            total = self._total_seconds
+        if self.connection_source is not None:
+            counts["connections"] = self.connection_source()
+        requests = counts["requests"]
+        reused = max(0, requests - counts["connections"])
+        return {**counts, "reused": reused,
+                "reuse_rate": round(reused / requests, 3) if requests else 0.0,
+                "avg_ms": round(total / requests * 1000, 1) if requests else 0.0}
+
+
+_lock = threading.Lock()
+_endpoints: Dict[str, EndpointStats] = {}
+_telegram_session = None
+
+
+def endpoint_stats(name: str) -> EndpointStats:
+    with _lock:
+        stats = _endpoints.get(name)
+        if stats is None:
+            stats = _endpoints[name] = EndpointStats(name)
+        return stats
+
+
+def transport_stats() -> dict:
+    with _lock:
+        endpoints = dict(_endpoints)
+    return {"pooled": HTTP_POOL_ENABLED, "pool_maxsize": HTTP_POOL_MAXSIZE,
+            "keepalive_expiry": HTTP_KEEPALIVE_EXPIRY,
+            "endpoints": {name: stats.snapshot() for name, stats in endpoints.items()}}
+
+
+# === Telegram (telebot -> requests) ===
+
+def configure_telegram_transport(pool_maxsize: int = HTTP_POOL_MAXSIZE,
+                                 connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+                                 read_timeout: float = HTTP_TELEGRAM_READ_TIMEOUT):
+    """Одна пуловая requests-сессия для всех вызовов telebot (до создания бота или в любой момент)."""
+    global _telegram_session
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(1, int(pool_maxsize)))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    stats = endpoint_stats("telegram")
+    stats.connection_source = lambda: _urllib3_connections(adapter)
+
+    def send(method, url, params=None, files=None, timeout=None, proxies=None):
+        started = time.monotonic()
+        try:
+            result = session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+        except Exception:
+            stats.observe(time.monotonic() - started, ok=False)
+            raise
+        stats.observe(time.monotonic() - started, ok=result.status_code < 500)
+        return result
+
+    apihelper.CONNECT_TIMEOUT = connect_timeout
+    apihelper.READ_TIMEOUT = read_timeout
+    apihelper.CUSTOM_REQUEST_SENDER = send
+    _telegram_session = session
+    print(f"[HTTP] 🔗 Telegram: общий пул на {pool_maxsize} соединений, таймауты {connect_timeout}/{read_timeout} сек")
+    return session
+
+
+def _urllib3_connections(adapter) -> int:
+    """Сколько соединений открыли пулы urllib3 адаптера (num_connections растет только при новом соединении)."""
+    pools = adapter.poolmanager.pools
+    total = 0
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is not None:
+            total += pool.num_connections
+    return total
+
+
+# === LLM (httpx) ===
+
+class CountingTransport(httpx.HTTPTransport):
+    """httpx-транспорт со счетчиками: вызовы, ошибки, новые соединения и TLS-рукопожатия."""
+
+    def __init__(self, stats: EndpointStats, **kwargs):
+        super().__init__(**kwargs)
+        self._stats = stats
+
+    def _trace(self, event: str, info: dict):
+        # События httpcore: новое TCP-соединение и TLS-рукопожатие
+        if event == "connection.connect_tcp.complete":
+            self._stats.add("connections")
+        elif event == "connection.start_tls.complete":
+            self._stats.add("tls_handshakes")
+
+    def handle_request(self, request):
+        request.extensions["trace"] = self._trace
+        started = time.monotonic()
+        try:
+            response = super().handle_request(request)
+        except Exception:
+            self._stats.observe(time.monotonic() - started, ok=False)
+            raise
+        # Для потоковых ответов — время до заголовков
+        self._stats.observe(time.monotonic() - started, ok=response.status_code < 500)
+        return response
+
+
+def llm_http_client(name: str, base_url: Optional[str] = None, verify=True,
+                    read_timeout: Optional[float] = None, pool_maxsize: int = HTTP_POOL_MAXSIZE,
+                    keepalive_expiry: float = HTTP_KEEPALIVE_EXPIRY,
+                    connect_timeout: float = HTTP_CONNECT_TIMEOUT):
+    """httpx.Client с пулом и долгим keep-alive; вызовы, новые соединения и TLS идут в статистику name."""
+    transport = CountingTransport(
+        endpoint_stats(name), verify=verify,
+        limits=httpx.Limits(max_connections=max(1, int(pool_maxsize)),
+                            max_keepalive_connections=max(1, int(pool_maxsize)),
+                            keepalive_expiry=keepalive_expiry),
+    )
+    kwargs = {"base_url": base_url} if base_url else {}
+    return httpx.Client(transport=transport, timeout=llm_timeout(read_timeout, connect_timeout), **kwargs)
+
+
+def llm_timeout(read_timeout: Optional[float] = None, connect_timeout: float = HTTP_CONNECT_TIMEOUT):
+    return httpx.Timeout(read_timeout or DEFAULT_LLM_READ_TIMEOUT, connect=connect_timeout)
+
+
+# === Прогрев ===
+
+def warm_up(targets: List[tuple], background: bool = True):
+    """
+    targets: [(имя, вызов)] — легкие запросы, открывающие соединения заранее.
+    Ошибки прогрева только логируются.
+    """
+    def run():
+        for name, call in targets:
+            started = time.monotonic()
+            try:
+                call()
+                print(f"[HTTP] 🔥 Прогрев {name}: {int((time.monotonic() - started) * 1000)}ms")
+            except Exception as e:
+                print(f"[HTTP] ⚠️ Прогрев {name} не удался: {type(e).__name__}: {e}")
+
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(target=run, name="HTTPWarmup", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,74 @@
+# app/modules/node_logic.py
+"""
+Правила переходов по скомпилированному графу без Telegram и БД.
+
+Общие для telegram_handler и headless-симулятора (simulator.py): вычисление условий,
+выбор ветки рандомизатора, переход после кнопки, прогноз узла для предвыборки ИИ.
+Состояние сессии передается словарем.
+"""
+
+import random
+from typing import Optional, Tuple
+
+from app.modules.graph_compiler import CompiledNode, CompiledOption, NodeKind
+from app.modules.state_calculator import FORMULA_GLOBALS
+
+
+def evaluate_condition(node: CompiledNode, states: dict) -> Tuple[bool, Optional[str]]:
+    """Результат условия узла и текст ошибки (ошибка => False, как в обработчике)."""
+    if node.condition_code is None:
+        return False, "условие не скомпилировано"
+    try:
+        return bool(eval(node.condition_code, FORMULA_GLOBALS, states)), None
+    except Exception as e:
+        return False, str(e)
+
+
+def choose_branch(node: CompiledNode, rng=random) -> Optional[str]:
+    """Ветка рандомизатора с учетом весов."""
+    if not node.branch_targets:
+        return None
+    return rng.choices(node.branch_targets, weights=node.branch_weights, k=1)[0]
+
+
+def automatic_next(node: CompiledNode, states: dict, rng=random) -> Tuple[Optional[str], Optional[str]]:
+    """Следующий узел после автоматического узла (state / condition / randomizer) и ошибка условия."""
+    kind = node.kind
+    if kind is NodeKind.STATE:
+        return node.next_node_id, None
+    if kind is NodeKind.CONDITION:
+        result, error = evaluate_condition(node, states)
+        return (node.then_node_id if result else node.else_node_id), error
+    if kind is NodeKind.RANDOMIZER:
+        return choose_branch(node, rng), None
+    return None, None
+
+
+def option_changes(option: CompiledOption, states: dict) -> dict:
+    """Изменения состояния от формулы кнопки (только ключи из writes)."""
+    if option.compiled_formula is None:
+        return {}
+    return option.compiled_formula.changes(states)
+
+
+def option_next(node: CompiledNode, option: CompiledOption) -> Optional[str]:
+    """Переход после нажатия кнопки: переход кнопки, иначе переход узла."""
+    return option.next_node_id or node.next_node_id
+
+
+def predict_arrival(graph, node_id: Optional[str], states: dict, max_hops: int = 5) -> Optional[CompiledNode]:
+    """
+    Узел, на котором игрок остановится после перехода в node_id: цепочка state/condition
+    проходится с данным состоянием. None — исход не определен (рандомизатор, ошибка условия).
+    """
+    node = graph.get(node_id)
+    for _ in range(max_hops):
+        if node is None or node.kind is NodeKind.RANDOMIZER:
+            return None
+        if node.kind not in (NodeKind.STATE, NodeKind.CONDITION):
+            return node
+        next_node_id, error = automatic_next(node, states)
+        if error:
+            return None
+        node = graph.get(next_node_id)
+    return None
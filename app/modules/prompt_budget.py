@@ -0,0 +1,127 @@
+# app/modules/prompt_budget.py
+"""
+Бюджет токенов для контекста ИИ.
+
+Токены оцениваются локально, без сети и токенизатора: для GigaChat и DeepSeek
+кириллица дает ~2.5 символа на токен, латиница и цифры — ~4. Оценка чуть
+завышена, чтобы бюджет не превышался на практике.
+
+Промпт собирается из неизменной части (роль, задача, инструкции) и секций.
+Если оценка превышает бюджет роли (data/prompts.json -> "token_budgets"),
+секции урезаются в порядке приоритета: сначала досье, потом хронология,
+сводка состояния и варианты ответа. Секция сначала обрезается по записям
+(хронология сохраняет последние события), и только если этого мало — заменяется
+пометкой об опущенном блоке.
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+CHARS_PER_TOKEN_ASCII = 4.0
+CHARS_PER_TOKEN_OTHER = 2.5
+OMITTED_TEXT = "(опущено: превышен лимит контекста)"
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Быстрая оценка числа токенов (O(len), в C: encode вместо посимвольного цикла)."""
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return int(ascii_chars / CHARS_PER_TOKEN_ASCII + (len(text) - ascii_chars) / CHARS_PER_TOKEN_OTHER) + 1
+
+
+@dataclass
+class PromptSection:
+    """Секция промпта; keep — что сохранять при обрезке: 'tail' (новые записи) или 'head'."""
+    name: str
+    text: str
+    keep: str = "tail"
+
+
+@dataclass
+class BudgetReport:
+    budget: int
+    tokens_before: int
+    tokens_after: int
+    trimmed: List[str] = field(default_factory=list)
+    dropped: List[str] = field(default_factory=list)
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.trimmed or self.dropped)
+
+    def format(self) -> str:
+        parts = [f"~{self.tokens_before} -> ~{self.tokens_after} ток. (бюджет {self.budget or '∞'})"]
+        if self.trimmed:
+            parts.append("обрезано: " + ", ".join(self.trimmed))
+        if self.dropped:
+            parts.append("опущено: " + ", ".join(self.dropped))
+        return "; ".join(parts)
+
+
+def _entries(text: str) -> List[str]:
+    """Записи секции: строка «- ...» вместе с продолжениями (строки с отступом)."""
+    entries = []
+    for line in text.split("\n"):
+        if entries and line.startswith((" ", "\t")):
+            entries[-1] += "\n" + line
+        else:
+            entries.append(line)
+    return entries
+
+
+def _trim(section: PromptSection, max_tokens: int) -> Optional[str]:
+    """Обрезает секцию по записям до max_tokens; None — не помещается ни одна запись."""
+    entries = _entries(section.text)
+    ordered = reversed(entries) if section.keep == "tail" else entries
+    kept, used = [], 0
+    for entry in ordered:
+        cost = estimate_tokens(entry) + 1
+        if used + cost > max_tokens:
+            break
+        kept.append(entry)
+        used += cost
+    if not kept:
+        return None
+    omitted = len(entries) - len(kept)
+    if section.keep == "tail":
+        kept.reverse()
+        return f"… (ранее: ещё {omitted})\n" + "\n".join(kept)
+    return "\n".join(kept) + f"\n… (и ещё {omitted})"
+
+
+def fit_sections(fixed_text: str, sections: List[PromptSection], budget: int):
+    """
+    Урезает секции (в порядке списка = порядке приоритета удаления), пока оценка
+    fixed_text + секций не уложится в budget. budget <= 0 — без ограничения.
+
+    Returns:
+        ({имя секции: текст}, BudgetReport)
+    """
+    texts: Dict[str, str] = {s.name: s.text for s in sections}
+    costs = {s.name: estimate_tokens(s.text) for s in sections}
+    fixed = estimate_tokens(fixed_text)
+    total = fixed + sum(costs.values())
+    report = BudgetReport(budget=budget, tokens_before=total, tokens_after=total)
+    if budget <= 0 or total <= budget:
+        return texts, report
+
+    for section in sections:
+        excess = total - budget
+        if excess <= 0:
+            break
+        if costs[section.name] <= estimate_tokens(OMITTED_TEXT):
+            continue  # короче пометки — урезать нечего
+        target = costs[section.name] - excess
+        trimmed = _trim(section, target) if target > 0 else None
+        if trimmed is not None and len(trimmed) < len(section.text):
+            new_text = trimmed
+            report.trimmed.append(section.name)
+        else:
+            new_text = OMITTED_TEXT
+            report.dropped.append(section.name)
+        new_cost = estimate_tokens(new_text)
+        total += new_cost - costs[section.name]
+        texts[section.name], costs[section.name] = new_text, new_cost
+    report.tokens_after = total
+    return texts, report
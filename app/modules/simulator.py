@@ -0,0 +1,332 @@
+# app/modules/simulator.py
+"""
+Headless-симулятор сценария: прогон тысяч синтетических игроков без Telegram и БД.
+
+Узлы исполняются по тем же правилам, что и в telegram_handler (node_logic + CompiledGraph):
+интерактивные узлы, state / condition / randomizer, формулы кнопок. Состояние хранится
+в словаре (как в кеше сессии), сообщения уходят в NullBot. Тайминги не выдерживаются —
+симулятор проверяет маршрут, а не темп.
+
+Используется как бенчмарк (сессий в секунду) и как проверка сценария перед деплоем:
+покрытие узлов и переходов, тупики, ссылки на несуществующие узлы, ошибки условий и шаблонов.
+"""
+
+import random
+import statistics
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.modules.graph_compiler import CompiledGraph, CompiledNode, CompiledOption, NodeKind, compile_graph
+from app.modules.node_logic import automatic_next, option_changes, option_next
+
+# Начальное состояние — как у новой сессии в crud._load_user_states
+INITIAL_STATES = {'score': 0, 'capital_before': 0}
+MAX_STEPS = 1000
+
+# Итоги сессии
+FINISHED = "finished"            # дошли до конца сценария
+STUCK = "stuck"                  # узел без кнопок, ввода и перехода — игроку некуда нажать
+MISSING_NODE = "missing_node"    # переход на несуществующий узел
+LOOP = "loop"                    # превышен MAX_STEPS
+
+# policy(node, options, states, rng) -> индекс кнопки в node.options
+Policy = Callable[[CompiledNode, Tuple[CompiledOption, ...], dict, random.Random], int]
+
+
+def random_policy(node, options, states, rng) -> int:
+    return rng.randrange(len(options))
+
+
+def first_policy(node, options, states, rng) -> int:
+    return 0
+
+
+def scripted_policy(script: Dict[str, object], fallback: Policy = random_policy) -> Policy:
+    """
+    Сценарий ответов: {node_id: индекс | текст кнопки | [варианты для 1-го, 2-го... посещения]}.
+    Для узлов вне сценария используется fallback.
+    """
+    def policy(node, options, states, rng):
+        choice = script.get(node.id)
+        if isinstance(choice, list):
+            visits = states.setdefault('__visits__', Counter())
+            n = visits[node.id]
+            visits[node.id] += 1
+            choice = choice[n] if n < len(choice) else None
+        if isinstance(choice, int) and 0 <= choice < len(options):
+            return choice
+        if isinstance(choice, str):
+            for i, opt in enumerate(options):
+                if opt.text == choice:
+                    return i
+        return fallback(node, options, states, rng)
+    return policy
+
+
+class NullBot:
+    """Бот-заглушка: считает исходящие сообщения и ничего не отправляет."""
+
+    class _Message:
+        __slots__ = ('message_id',)
+
+        def __init__(self, message_id):
+            self.message_id = message_id
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        return self._Message(self.sent)
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+@dataclass
+class SessionResult:
+    status: str
+    path: List[str]
+    final_node_id: Optional[str]
+    states: dict
+    edges: List[Tuple[str, str]] = field(default_factory=list)
+
+
+@dataclass
+class SimulationReport:
+    graph_id: str
+    sessions: int
+    seconds: float
+    steps: int
+    messages: int
+    statuses: Counter
+    final_nodes: Counter
+    node_visits: Counter
+    edge_visits: Counter
+    total_nodes: int
+    total_edges: int
+    unreached_nodes: List[str]
+    scores: List[float]
+    issues: Counter
+    graph_warnings: Tuple[str, ...] = ()
+    unreachable_nodes: List[str] = field(default_factory=list)
+
+    @property
+    def sessions_per_second(self) -> float:
+        return self.sessions / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def node_coverage(self) -> float:
+        return len(self.node_visits) / self.total_nodes if self.total_nodes else 0.0
+
+    @property
+    def edge_coverage(self) -> float:
+        return len(self.edge_visits) / self.total_edges if self.total_edges else 0.0
+
+    @property
+    def ok(self) -> bool:
+        """
+        Проверка перед деплоем: все сессии завершились штатно, без ошибок условий/шаблонов
+        и без узлов, до которых по правилам обработчика не дойти из стартового.
+        """
+        return set(self.statuses) <= {FINISHED} and not self.issues and not self.unreachable_nodes
+
+    def score_summary(self) -> Dict[str, float]:
+        if not self.scores:
+            return {}
+        s = sorted(self.scores)
+        q = lambda p: s[min(len(s) - 1, int(len(s) * p))]
+        return {'min': s[0], 'p10': q(0.1), 'p50': q(0.5), 'p90': q(0.9), 'max': s[-1],
+                'mean': round(statistics.mean(s), 2)}
+
+    def score_histogram(self, bins: int = 10) -> List[Tuple[float, float, int]]:
+        if not self.scores:
+            return []
+        lo, hi = min(self.scores), max(self.scores)
+        if lo == hi:
+            return [(lo, hi, len(self.scores))]
+        width = (hi - lo) / bins
+        counts = [0] * bins
+        for v in self.scores:
+            counts[min(bins - 1, int((v - lo) / width))] += 1
+        return [(lo + i * width, lo + (i + 1) * width, c) for i, c in enumerate(counts)]
+
+    def format(self, top: int = 10) -> str:
+        lines = [
+            f"=== Симуляция сценария '{self.graph_id}' ===",
+            f"Сессий: {self.sessions} за {self.seconds:.2f}s ({self.sessions_per_second:.0f} сессий/с), "
+            f"шагов: {self.steps}, сообщений: {self.messages}",
+            f"Итоги: " + ", ".join(f"{k}={v}" for k, v in self.statuses.most_common()),
+            f"Финальные узлы: " + ", ".join(f"{k}={v}" for k, v in self.final_nodes.most_common(top)),
+            f"Покрытие узлов: {len(self.node_visits)}/{self.total_nodes} ({self.node_coverage:.0%}), "
+            f"переходов: {len(self.edge_visits)}/{self.total_edges} ({self.edge_coverage:.0%})",
+        ]
+        if self.unreached_nodes:
+            lines.append(f"Не посещены игроками: {', '.join(self.unreached_nodes)}")
+        summary = self.score_summary()
+        if summary:
+            lines.append("score: " + ", ".join(f"{k}={v}" for k, v in summary.items()))
+            for lo, hi, count in self.score_histogram():
+                bar = "█" * max(1, int(40 * count / self.sessions)) if count else ""
+                lines.append(f"  [{lo:>12.1f} .. {hi:>12.1f}) {count:>7} {bar}")
+        lines.append("Самые горячие узлы:")
+        for node_id, count in self.node_visits.most_common(top):
+            lines.append(f"  {node_id:<30} {count:>8} ({count / self.sessions:.2f} на сессию)")
+        for warning in self.graph_warnings:
+            lines.append(f"⚠️ Граф: {warning}")
+        if self.unreachable_nodes:
+            lines.append(f"❌ Недостижимые узлы ({len(self.unreachable_nodes)}): {', '.join(self.unreachable_nodes)}")
+        for issue, count in self.issues.most_common():
+            lines.append(f"❌ {issue} (x{count})")
+        return "\n".join(lines)
+
+
+class GraphSimulator:
+    """
+    Прогон синтетических игроков по CompiledGraph.
+
+    Args:
+        graph: CompiledGraph или JSON-словарь сценария
+        policy: выбор кнопки (random_policy, first_policy, scripted_policy(...))
+        seed: зерно для воспроизводимости
+    """
+
+    def __init__(self, graph, policy: Policy = random_policy, seed: Optional[int] = None,
+                 max_steps: int = MAX_STEPS, bot=None):
+        self.graph: CompiledGraph = graph if isinstance(graph, CompiledGraph) else compile_graph(graph)
+        self.policy = policy
+        self.rng = random.Random(seed)
+        self.max_steps = max_steps
+        self.bot = bot or NullBot()
+        self.issues = Counter()
+
+    def play(self, chat_id: int = 0) -> SessionResult:
+        """Одна сессия: от стартового узла до финала, тупика или лимита шагов."""
+        graph, rng = self.graph, self.rng
+        states = dict(INITIAL_STATES)
+        path, edges = [], []
+        node_id = graph.start_node_id
+        prev = None
+        for _ in range(self.max_steps):
+            node = graph.get(node_id)
+            if node is None:
+                self.issues[f"переход на несуществующий узел '{node_id}'"] += 1
+                return SessionResult(MISSING_NODE, path, prev, self._public(states), edges)
+            if prev is not None:
+                edges.append((prev, node.id))
+            path.append(node.id)
+            prev = node.id
+
+            kind = node.kind
+            if kind.is_automatic:
+                if kind is NodeKind.STATE and node.text:
+                    self._send(chat_id, node, states)
+                next_id, error = automatic_next(node, states, rng)
+                if error:
+                    self.issues[f"узел '{node.id}': ошибка условия: {error}"] += 1
+            elif kind is NodeKind.FINAL:
+                if any(target is not None for target in self._targets(node)):
+                    self.issues[f"узел '{node.id}': неизвестный тип '{node.type}', "
+                                f"переходы не выполняются — игра завершается"] += 1
+                if node.text:
+                    self._send(chat_id, node, states)
+                self.bot.send_message(chat_id, "Игра завершена. /start для новой игры")
+                return SessionResult(FINISHED, path, node.id, self._public(states), edges)
+            else:
+                # INTERACTIVE и AI_PROACTIVE (ответ ИИ в симуляции не запрашивается)
+                self._send(chat_id, node, states)
+                if node.options:
+                    option = node.options[self.policy(node, node.options, states, rng)]
+                    states.update(option_changes(option, states))
+                    next_id = option_next(node, option)
+                elif node.is_input_text:
+                    next_id = node.next_node_id
+                else:
+                    return SessionResult(STUCK, path, node.id, self._public(states), edges)
+
+            if not next_id:
+                # Как _graceful_finish: конец сценария без перехода
+                self.bot.send_message(chat_id, "Игра завершена. /start для новой игры")
+                return SessionResult(FINISHED, path, node.id, self._public(states), edges)
+            node_id = next_id
+        self.issues["превышен лимит шагов (цикл без выхода?)"] += 1
+        return SessionResult(LOOP, path, prev, self._public(states), edges)
+
+    def run(self, players: int) -> SimulationReport:
+        self.issues = Counter()
+        statuses, finals, visits, edge_visits = Counter(), Counter(), Counter(), Counter()
+        scores = []
+        steps = 0
+        sent_before = getattr(self.bot, 'sent', 0)
+        started = time.perf_counter()
+        for chat_id in range(players):
+            result = self.play(chat_id)
+            statuses[result.status] += 1
+            finals[result.final_node_id] += 1
+            visits.update(result.path)
+            edge_visits.update(result.edges)
+            steps += len(result.path)
+            score = result.states.get('score')
+            if isinstance(score, (int, float)):
+                scores.append(score)
+        seconds = time.perf_counter() - started
+
+        all_edges = self._all_edges()
+        return SimulationReport(
+            graph_id=self.graph.graph_id, sessions=players, seconds=seconds, steps=steps,
+            messages=getattr(self.bot, 'sent', 0) - sent_before,
+            statuses=statuses, final_nodes=finals, node_visits=visits,
+            edge_visits=Counter({e: c for e, c in edge_visits.items() if e in all_edges}),
+            total_nodes=len(self.graph.nodes), total_edges=len(all_edges),
+            unreached_nodes=sorted(set(self.graph.nodes) - set(visits)),
+            scores=scores, issues=Counter(self.issues), graph_warnings=self.graph.warnings,
+            unreachable_nodes=sorted(set(self.graph.nodes) - self._reachable()),
+        )
+
+    # --- internal ---
+    def _send(self, chat_id, node: CompiledNode, states: dict):
+        text = node.text if node.text is not None else "(нет текста)"
+        try:
+            text = text.format(**states)
+        except Exception as e:
+            # В Telegram ушел бы неотформатированный текст — автору сценария стоит знать
+            self.issues[f"узел '{node.id}': ошибка шаблона текста: {e!r}"] += 1
+        self.bot.send_message(chat_id, text)
+
+    @staticmethod
+    def _public(states: dict) -> dict:
+        return {k: v for k, v in states.items() if not k.startswith('__')}
+
+    @staticmethod
+    def _targets(node: CompiledNode) -> list:
+        targets = [node.next_node_id, node.then_node_id, node.else_node_id, *node.branch_targets]
+        targets += [opt.next_node_id for opt in node.options]
+        return targets
+
+    def _all_edges(self) -> set:
+        edges = set()
+        for node in self.graph.nodes.values():
+            for target in self._targets(node):
+                if target is not None and target in self.graph.nodes:
+                    edges.add((node.id, target))
+        return edges
+
+    def _reachable(self) -> set:
+        """Узлы, достижимые из стартового по переходам, которые выполняет обработчик (с финальных — никаких)."""
+        nodes = self.graph.nodes
+        seen, stack = set(), [self.graph.start_node_id]
+        while stack:
+            node = nodes.get(stack.pop())
+            if node is None or node.id in seen:
+                continue
+            seen.add(node.id)
+            if node.kind is not NodeKind.FINAL:
+                stack.extend(t for t in self._targets(node) if t is not None)
+        return seen
+
+
+def simulate(graph, players: int = 1000, policy: Policy = random_policy, seed: Optional[int] = None) -> SimulationReport:
+    """Короткий вызов: прогнать players игроков и вернуть отчет."""
+    return GraphSimulator(graph, policy=policy, seed=seed).run(players)
@@ -1,8 +1,19 @@
 # app/modules/state_calculator.py
 # Исправлена проблема с рандомом
+# Формулы кнопок компилируются один раз: AST-проверка по белому списку + кеш code-объектов по тексту формулы
 
+import ast
+import io
+import math
 import random
 import time
+import tokenize
+from dataclasses import dataclass
+from functools import lru_cache
+from types import CodeType
+from typing import Optional, Tuple
+
+from decouple import config
 
 # Инициализируем генератор случайных чисел с текущим временем
 random.seed(int(time.time() * 1000000) % 1000000)
@@ -39,3 +50,183 @@ def calculate_new_state(formula: str, current_state: dict) -> any:
     except Exception as e:
         print(f"!!! ОШИБКА при вычислении формулы '{formula}': {e} !!!")
         return None
+
+
+FORMULA_CACHE_SIZE = config("FORMULA_CACHE_SIZE", default=4096, cast=int)
+
+# Окружение вычисления формул кнопок и условий сценария
+FORMULA_GLOBALS = {"__builtins__": None, "random": random, "math": math,
+                   "int": int, "float": float, "round": round, "max": max, "min": min, "abs": abs,
+                   "True": True, "False": False, "None": None}
+_SAFE_FUNCTIONS = frozenset({"int", "float", "round", "max", "min", "abs"})
+_SAFE_MODULES = frozenset({"random", "math"})
+
+_ALLOWED_NODES = (
+    ast.Module, ast.Expression, ast.Expr, ast.Assign, ast.AugAssign,
+    ast.Name, ast.Load, ast.Store, ast.Constant, ast.Attribute, ast.Call,
+    ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    ast.List, ast.Tuple, ast.Set, ast.Dict, ast.Subscript, ast.Slice,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.UAdd, ast.USub, ast.Not, ast.And, ast.Or,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn,
+)
+
+
+class FormulaError(ValueError):
+    """Формула не прошла синтаксическую проверку или белый список AST."""
+
+
+@dataclass(frozen=True)
+class CompiledFormula:
+    """
+    Скомпилированная формула.
+
+    statements: кортеж (переменная, code) — результат code записывается в переменную
+    reads: ключи состояния, которые формула читает до их записи
+    writes: ключи состояния, которые формула записывает
+    """
+    source: str
+    statements: Tuple[Tuple[str, CodeType], ...]
+    reads: frozenset
+    writes: frozenset
+
+    def evaluate(self, current_state: dict) -> dict:
+        """Возвращает новое состояние; при ошибке вычисления — исходное."""
+        local_vars = dict(current_state)
+        try:
+            for target, code in self.statements:
+                local_vars[target] = eval(code, FORMULA_GLOBALS, local_vars)
+            return local_vars
+        except Exception as e:
+            print(f"⚠️ Ошибка формулы '{self.source}': {e}")
+            return current_state
+
+    def changes(self, current_state: dict) -> dict:
+        """Только изменившиеся ключи из writes."""
+        new_state = self.evaluate(current_state)
+        return {k: new_state[k] for k in self.writes
+                if k in new_state and (k not in current_state or current_state[k] != new_state[k])}
+
+
+def _split_statements(source: str) -> list:
+    """Делит формулу по запятым верхнего уровня: 'a = 1, b = max(a, 2)' -> ['a = 1', 'b = max(a, 2)']."""
+    parts, depth, start = [], 0, 0
+    lines = source.splitlines(keepends=True)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(source).readline):
+            if tok.type != tokenize.OP:
+                continue
+            if tok.string in "([{":
+                depth += 1
+            elif tok.string in ")]}":
+                depth -= 1
+            elif tok.string == "," and depth == 0:
+                pos = offsets[tok.start[0] - 1] + tok.start[1]
+                parts.append(source[start:pos])
+                start = pos + 1
+    except (tokenize.TokenError, IndentationError) as e:
+        raise FormulaError(f"синтаксическая ошибка: {e}")
+    parts.append(source[start:])
+    return [p.strip() for p in parts if p.strip()]
+
+
+def _validate(tree: ast.AST, source: str):
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise FormulaError(f"недопустимая конструкция {type(node).__name__} в '{source}'")
+        if isinstance(node, ast.Name) and node.id.startswith("_"):
+            raise FormulaError(f"недопустимое имя '{node.id}' в '{source}'")
+        if isinstance(node, ast.Attribute):
+            if not (isinstance(node.value, ast.Name) and node.value.id in _SAFE_MODULES) or node.attr.startswith("_"):
+                raise FormulaError(f"недопустимый атрибут '{node.attr}' в '{source}'")
+        if isinstance(node, ast.Call):
+            func = node.func
+            if not ((isinstance(func, ast.Name) and func.id in _SAFE_FUNCTIONS) or isinstance(func, ast.Attribute)):
+                raise FormulaError(f"недопустимый вызов в '{source}'")
+
+
+def _loaded_names(tree: ast.AST) -> set:
+    return {n.id for n in ast.walk(tree)
+            if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load) and n.id not in FORMULA_GLOBALS}
+
+
+def _compile_statement(stmt: str, source: str) -> Tuple[str, ast.expr]:
+    try:
+        tree = ast.parse(stmt, mode="exec")
+    except SyntaxError as e:
+        raise FormulaError(f"синтаксическая ошибка в '{stmt}': {e.msg}")
+    _validate(tree, source)
+    if len(tree.body) != 1:
+        raise FormulaError(f"ожидался один оператор: '{stmt}'")
+    node = tree.body[0]
+    if isinstance(node, ast.Expr):
+        # Выражение без присваивания записывается в score
+        return "score", node.value
+    if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+        return node.targets[0].id, node.value
+    if isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+        target = node.target.id
+        return target, ast.BinOp(left=ast.Name(id=target, ctx=ast.Load()), op=node.op, right=node.value)
+    raise FormulaError(f"поддерживаются только выражения и присваивания переменной: '{stmt}'")
+
+
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def compile_formula(source: str) -> CompiledFormula:
+    """
+    Компилирует формулу кнопки ('score + 100', 'score = score * 2, coins = 5').
+    Результат кешируется по тексту формулы. Ошибки — FormulaError.
+    """
+    if not source or not isinstance(source, str):
+        raise FormulaError("пустая формула")
+    statements, reads, writes = [], set(), set()
+    for stmt in _split_statements(source):
+        target, expr = _compile_statement(stmt, source)
+        reads |= _loaded_names(expr) - writes
+        writes.add(target)
+        code = compile(ast.fix_missing_locations(ast.Expression(body=expr)), "<formula>", "eval")
+        statements.append((target, code))
+    return CompiledFormula(source, tuple(statements), frozenset(reads), frozenset(writes))
+
+
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def compile_condition(source: str) -> CodeType:
+    """Компилирует условие сценария ('score >= 350000') с той же проверкой AST."""
+    try:
+        tree = ast.parse(source, mode="eval")
+    except SyntaxError as e:
+        raise FormulaError(f"синтаксическая ошибка в '{source}': {e.msg}")
+    _validate(tree, source)
+    return compile(tree, "<condition>", "eval")
+
+
+class SafeStateCalculator:
+    """
+    Калькулятор формул кнопок: 'score + 100', 'score = score * 2, coins = 5'.
+    Выражение без присваивания записывается в score.
+    """
+    SAFE_GLOBALS = FORMULA_GLOBALS
+
+    @classmethod
+    def compile(cls, formula: str) -> Optional[CompiledFormula]:
+        """Компилирует формулу (с кешем). Вызывается при загрузке сценария (см. graph_compiler)."""
+        if not formula or not isinstance(formula, str):
+            return None
+        return compile_formula(formula)
+
+    @classmethod
+    def calculate(cls, formula, current_state: dict) -> dict:
+        """Выполняет формулу (строку или CompiledFormula) над копией состояния."""
+        if isinstance(formula, str):
+            if not formula:
+                return current_state
+            try:
+                formula = compile_formula(formula)
+            except FormulaError as e:
+                print(f"⚠️ Ошибка формулы '{formula}': {e}")
+                return current_state
+        if formula is None:
+            return current_state
+        return formula.evaluate(current_state)
@@ -1,34 +1,56 @@
 # -*- coding: utf-8 -*-
 # app/modules/telegram_handler.py
 # ВЕРСИЯ 4.0.4 (15.01.2026): Добавлена AI_DEFAULT_ROLE и красивые заголовки ролей
+# ВЕРСИЯ 4.1.0: Узлы берутся из CompiledGraph (hot_reload.get_compiled_graph), без разбора строк на апдейт
+# ВЕРСИЯ 4.2.0: Один апдейт = одна единица работы (unit_of_work): одна сессия БД и один коммит
+# ВЕРСИЯ 4.2.1: Обработчик таймеров, восстановленных из active_timers после рестарта
+# ВЕРСИЯ 4.2.2: Правила переходов вынесены в node_logic (общие с headless-симулятором)
+# ВЕРСИЯ 4.3.0: Запросы к ИИ — фоновые задания (ai_jobs): обработчик не ждет LLM
+# ВЕРСИЯ 4.3.1: Потоковый режим ИИ (AI_STREAMING): заглушка дописывается по мере генерации
+# ВЕРСИЯ 4.3.2: Кеш ответов проактивных узлов (ai_cache) с single-flight для одинаковых запросов
+# ВЕРСИЯ 4.3.3: Предвыборка ответов проактивных узлов, следующих за вопросом (ai_prefetch)
+# ВЕРСИЯ 4.3.4: Ошибка обработки откатывает всю единицу работы апдейта, а не только упавший шаг
+# ВЕРСИЯ 4.3.5: Ответы заданий ИИ обрабатываются в очереди чата (run_node_callback), а не в потоке задания
 # Возврат к последней полностью рабочей версии 30 октября до экспериментов со второй функцией тайминга
 
 import random
-import math
-import re
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 import traceback
+from contextlib import contextmanager
 from sqlalchemy.orm import Session
 from decouple import config
 
 try:
-    from app.modules.database import SessionLocal, crud
+    from app.modules.database import crud
+    from app.modules.database.unit_of_work import unit_of_work
     from app.modules.database import models  # NEW: для проверки is_paused
     from app.modules import gigachat_handler
-    from app.modules.hot_reload import get_current_graph
-    from app.modules.timing_engine import process_node_timing
+    from app.modules.ai_jobs import submit_ai_job, cancel_session_jobs
+    from app.modules.ai_cache import cache_key_for_node, get_response_cache
+    from app.modules.ai_prefetch import AI_PREFETCH_ENABLED, get_prefetcher, is_prefetchable
+    from app.modules.ai_streaming import StreamingMessage
+    from app.modules.hot_reload import get_compiled_graph
+    from app.modules.timing_engine import process_node_timing, run_node_callback, set_timer_resume_handler
     AI_AVAILABLE = True
 except Exception as e:
     print(f"⚠️ Модули частично недоступны ({e}). Включены заглушки.")
     AI_AVAILABLE = False
+    AI_PREFETCH_ENABLED = False
+
+    def get_compiled_graph(): return None
+    @contextmanager
+    def unit_of_work(session_factory=None):
+        yield None
 
-    def get_current_graph(): return None
-    def SessionLocal(): return None
     def process_node_timing(user_id, session_id, node_id, timing_config, callback, **context):
         print("⚠️ Timing engine заглушка: немедленный вызов callback")
         callback()
 
+    def set_timer_resume_handler(handler): pass
+
+    def run_node_callback(chat_id, callback): callback()
+
     class crud:
         @staticmethod
         def get_or_create_user(db, telegram_id): return type('obj', (), {'id': 1, 'telegram_id': telegram_id})()
@@ -45,39 +67,43 @@ except Exception as e:
         @staticmethod
         def get_all_user_states(db, user_id, session_id): return {'score': 0}
         @staticmethod
+        def get_session_states(db, user_id, session_id): return {'score': 0}
+        @staticmethod
+        def update_session_states(db, user_id, session_id, changes): pass
+        @staticmethod
+        def checkpoint_session_states(db, session_id): pass
+        @staticmethod
         def create_ai_dialogue(db, session_id, node_id, user_message, ai_response): pass
         @staticmethod
         def build_full_context_for_ai(db, s_id, u_id, q, opts, et, ap): return "Контекст для AI"
 
+from app.modules.graph_compiler import NodeKind
+from app.modules.node_logic import choose_branch, evaluate_condition, option_changes, option_next, predict_arrival
+
 # NEW: Дефолтное имя роли для заголовков
 AI_DEFAULT_ROLE = config("AI_DEFAULT_ROLE", default="Мастер Игры")
-
-class SafeStateCalculator:
-    SAFE_GLOBALS = {"__builtins__": None, "random": random, "math": math,
-                    "int": int, "float": float, "round": round, "max": max, "min": min, "abs": abs,
-                    "True": True, "False": False, "None": None}
-    assign_re = re.compile(r"^\s*[A-Za-z_][A-Za-z0-9_]*\s*=")
-
-    @classmethod
-    def calculate(cls, formula: str, current_state: dict) -> dict:
-        if not formula or not isinstance(formula, str):
-            return current_state
-        statements = [s.strip() for s in formula.split(',') if s.strip()]
-        local_vars = dict(current_state)
-        try:
-            for stmt in statements:
-                if cls.assign_re.match(stmt):
-                    exec(stmt, cls.SAFE_GLOBALS, local_vars)
-                else:
-                    local_vars["score"] = eval(stmt, cls.SAFE_GLOBALS, local_vars)
-            return local_vars
-        except Exception as e:
-            print(f"⚠️ Ошибка формулы '{formula}': {e}")
-            return current_state
+AI_BUSY_TEXT = "⏳ Сейчас слишком много запросов к ИИ. Попробуйте чуть позже."
 
 user_sessions = {}
-INTERACTIVE_NODE_TYPES = ["task", "input_text", "question", "Задача", "Вопрос"]
-AUTOMATIC_NODE_TYPES = ["condition", "randomizer", "state", "Условие", "Рандомизатор", "Состояние"]
+
+
+class NodeProcessingError(Exception):
+    """Узел не обработан; игрок уже уведомлен, единица работы апдейта откатывается."""
+
+
+@contextmanager
+def _update_unit():
+    """
+    Единица работы обработчика апдейта. Ошибка любого шага откатывает все записи апдейта
+    (состояние, ответ, сессию) и только логируется — обработчик не падает.
+    """
+    try:
+        with unit_of_work() as db:
+            yield db
+    except NodeProcessingError:
+        pass
+    except Exception:
+        traceback.print_exc()
 
 def _normalize_newlines(text: str) -> str:
     return text.replace('\\n', '\n') if isinstance(text, str) else text
@@ -85,7 +111,7 @@ def _normalize_newlines(text: str) -> str:
 def _format_text(db, chat_id, t):
     s = user_sessions.get(chat_id, {})
     try:
-        states = crud.get_all_user_states(db, s.get('user_id'), s.get('session_id'))
+        states = crud.get_session_states(db, s.get('user_id'), s.get('session_id'))
     except Exception:
         states = {}
     try:
@@ -93,28 +119,13 @@ def _format_text(db, chat_id, t):
     except Exception:
         return t
 
-def _extract_condition_targets(node):
-    then_id = node.get("then_node_id") or node.get("then")
-    else_id = node.get("else_node_id") or node.get("else")
-    if not (then_id and else_id):
-        options = node.get("options", [])
-        for opt in options:
-            label = (opt.get("label") or opt.get("text") or "").strip().lower()
-            if label in ("then", "тогда") and not then_id:
-                then_id = opt.get("next_node_id")
-            elif label in ("else", "иначе") and not else_id:
-                else_id = opt.get("next_node_id")
-    return then_id, else_id
-
-def _evaluate_condition_enhanced(db, user_id, session_id, condition_str):
-    states = crud.get_all_user_states(db, user_id, session_id) if AI_AVAILABLE else {'score': 0}
-    normalized_expr = re.sub(r'\{([a-zA-Z_]\w*)\}', r'\1', condition_str or "False")
-    print(f"🔍 [CONDITION DEBUG] '{condition_str}' -> '{normalized_expr}', states={states}")
-    try:
-        return bool(eval(normalized_expr, SafeStateCalculator.SAFE_GLOBALS, states))
-    except Exception as e:
-        print(f"❌ [CONDITION ERROR] '{condition_str}' -> '{normalized_expr}': {e}")
-        return False
+def _evaluate_condition_enhanced(db, user_id, session_id, node):
+    states = crud.get_session_states(db, user_id, session_id) if AI_AVAILABLE else {'score': 0}
+    print(f"🔍 [CONDITION DEBUG] '{node.condition_source}', states={states}")
+    result, error = evaluate_condition(node, states)
+    if error:
+        print(f"❌ [CONDITION ERROR] '{node.condition_source}': {error}")
+    return result
 
 def _save_shuffled_options(chat_id, node_id, options):
     sess = user_sessions.setdefault(chat_id, {})
@@ -132,8 +143,15 @@ def _clear_shuffled_options(chat_id, node_id):
     if str(node_id) in store:
         del store[str(node_id)]
 
+def _display_role(role):
+    # Отображаемое имя роли в заголовке ответа ИИ
+    if str(role).lower() in ('true', '1', 'yes', 'on', 'default'):
+        return AI_DEFAULT_ROLE
+    return role
+
+
 def register_handlers(bot: telebot.TeleBot, initial_graph_data: dict):
-    print(f"✅ [HANDLER v4.0.4] Регистрация обработчиков... AI_AVAILABLE={AI_AVAILABLE}")
+    print(f"✅ [HANDLER v4.3.0] Регистрация обработчиков... AI_AVAILABLE={AI_AVAILABLE}")
 
     def _graceful_finish(db, chat_id, node):
         s = user_sessions.get(chat_id)
@@ -143,181 +161,311 @@ def register_handlers(bot: telebot.TeleBot, initial_graph_data: dict):
             print("🏁 [FINISH] Уже завершено -> skip")
             return
         s['finished'] = True
-        if node.get('text') and node.get('type') not in AUTOMATIC_NODE_TYPES:
-            _send_message(bot, chat_id, node, _format_text(db, chat_id, node.get('text')))
+        if node.text and not node.kind.is_automatic:
+            _send_message(bot, chat_id, node, _format_text(db, chat_id, node.text))
         bot.send_message(chat_id, "Игра завершена. /start для новой игры")
         if s.get('session_id') and AI_AVAILABLE:
             crud.end_session(db, s['session_id'])
+            cancel_session_jobs(s['session_id'])
+            get_prefetcher().drop_session(s['session_id'])
         user_sessions.pop(chat_id, None)
 
     def process_node(chat_id, node_id):
-        db = SessionLocal()
+        # Внутри обработчика апдейта переиспользует его единицу работы
+        with unit_of_work() as db:
+            _process_node(db, chat_id, node_id)
+
+    def _process_node(db, chat_id, node_id):
         try:
             s = user_sessions.get(chat_id)
             if s and s.get('finished'):
                 print("🚫 [PROCESS] Сессия уже завершена -> skip")
                 return
-            graph = get_current_graph()
+            graph = get_compiled_graph()
             if not graph:
                 bot.send_message(chat_id, "Критическая ошибка: сценарий не загружен.")
                 return
             if not s:
                 bot.send_message(chat_id, "Ошибка сессии. /start")
                 return
-            node = graph["nodes"].get(str(node_id))
+            node = graph.get(node_id)
             if not node:
                 bot.send_message(chat_id, f"Ошибка сценария: узел '{node_id}' не найден.")
                 return
+            node_id = node.id
 
-            timing_config = node.get("timing")
-            if timing_config:
-                print(f"⏱️ [TIMING DETECTED] Узел {node_id}, конфиг: {timing_config}")
+            if node.timing_source:
+                print(f"⏱️ [TIMING DETECTED] Узел {node_id}, конфиг: {node.timing_source}")
 
                 def execute_node_callback():
-                    callback_db = SessionLocal()
-                    try:
+                    # Таймер срабатывает в другом потоке — своя единица работы
+                    with unit_of_work() as callback_db:
                         _execute_node_logic(callback_db, bot, chat_id, node_id, node)
-                    finally:
-                        callback_db.close()
 
                 context = {
                     'bot': bot, 'chat_id': chat_id,
                     'telegram_user_id': s.get('user_id'),
                     'session_reference': s.get('session_id'),
                     'current_node_id': node_id,  # ИСПРАВЛЕНО: было 'node_id'
-                    'node_text': node.get('text', ''),
-                    'buttons': node.get('options', []),
-                    'next_node_id': node.get('next_node_id'),
+                    'node_text': node.text or '',
+                    'buttons': node.options,
+                    'next_node_id': node.next_node_id,
                     'question_message_id': user_sessions.get(chat_id, {}).get('question_message_id')
                 }
 
                 process_node_timing(
                     user_id=s.get('user_id'), session_id=s.get('session_id'),
-                    node_id=node_id, timing_config=timing_config,
+                    node_id=node_id, timing_config=node.timing,
                     callback=execute_node_callback, **context
                 )
             else:
                 _execute_node_logic(db, bot, chat_id, node_id, node)
 
-        except Exception:
+        except NodeProcessingError:
+            raise
+        except Exception as e:
             traceback.print_exc()
             bot.send_message(chat_id, "Критическая ошибка движка. /start")
-        finally:
-            if db: db.close()
+            # Записи апдейта до ошибки не фиксируются (и сессия БД после сбоя flush не коммитится)
+            raise NodeProcessingError(node_id) from e
 
     def _execute_node_logic(db, bot, chat_id, node_id, node):
         s = user_sessions.get(chat_id)
         if not s:
             return
         s['current_node_id'] = node_id
-        node_type = node.get("type", "")
-        if node_type.startswith("ai_proactive"):
+        kind = node.kind
+        if kind is NodeKind.AI_PROACTIVE:
             _handle_proactive_ai_node(db, bot, chat_id, node_id, node)
-        elif node_type in AUTOMATIC_NODE_TYPES:
+        elif kind.is_automatic:
             _handle_automatic_node(db, bot, chat_id, node)
-        elif node_type in INTERACTIVE_NODE_TYPES:
+        elif kind is NodeKind.INTERACTIVE:
             _handle_interactive_node(db, bot, chat_id, node_id, node)
         else:
             _graceful_finish(db, chat_id, node)
 
+    def _resume_persisted_timer(timer):
+        """Таймер узла, переживший рестарт: восстанавливаем сессию игрока и выполняем узел."""
+        chat_id = (timer.data or {}).get('chat_id')
+        graph = get_compiled_graph()
+        node = graph.get(timer.node_id) if graph else None
+        if chat_id is None or node is None:
+            return
+        with unit_of_work() as db:
+            session = db.query(models.Session).filter(models.Session.id == timer.session_id).first()
+            if not session or session.end_time is not None:
+                return
+            s = user_sessions.get(chat_id)
+            if s is None:
+                user_sessions[chat_id] = {'session_id': session.id, 'user_id': session.user_id,
+                                          'last_message_id': None, 'finished': False}
+            elif s.get('session_id') != session.id:
+                return  # игрок уже начал новую игру
+            print(f"⏱️ [TIMER RECOVERY] Сессия {session.id}: узел {node.id} ({timer.timer_type})")
+            _execute_node_logic(db, bot, chat_id, node.id, node)
+
+    set_timer_resume_handler(_resume_persisted_timer)
+
+    def _is_current_session(chat_id, session_id):
+        s = user_sessions.get(chat_id)
+        return bool(s) and s.get('session_id') == session_id and not s.get('finished')
+
+    def _drop_placeholder(chat_id, message_id):
+        try:
+            bot.delete_message(chat_id, message_id)
+        except Exception:
+            pass
+
+    def _deliver_ai_answer(db, chat_id, session_id, wait_msg, display_role, ai_response, reply_to=None):
+        """Правит заглушку ответом ИИ. False — сервис недоступен, сессия поставлена на паузу."""
+        if ai_response.startswith("⚠️"):
+            bot.edit_message_text(ai_response, chat_id, wait_msg.message_id)
+            crud.pause_session(db, session_id)
+            return False
+
+        # NEW: Добавляем заголовок с ролью
+        final_text = f"🎭 *{display_role}:*\n{ai_response}"
+
+        try:
+            bot.edit_message_text(
+                _normalize_newlines(final_text),
+                chat_id,
+                wait_msg.message_id,
+                parse_mode="Markdown"
+            )
+        except Exception as e:
+            print(f"⚠️ Edit error: {e}")
+            bot.delete_message(chat_id, wait_msg.message_id)
+            if reply_to is not None:
+                bot.reply_to(reply_to, _normalize_newlines(final_text), parse_mode="Markdown")
+            else:
+                bot.send_message(chat_id, _normalize_newlines(final_text), parse_mode="Markdown")
+        return True
+
+    def _ai_work(user_message, context, chat_id, wait_msg, display_role):
+        """Задание для ai_jobs; в потоковом режиме заглушка дописывается по мере генерации."""
+        def work(cancel_event):
+            on_text = None
+            if gigachat_handler.AI_STREAMING:
+                on_text = StreamingMessage(bot, chat_id, wait_msg.message_id, header=f"🎭 {display_role}:\n").update
+            return gigachat_handler.get_ai_response(user_message, system_prompt=context,
+                                                    cancel_event=cancel_event, on_text=on_text)
+        return work
+
     def _handle_proactive_ai_node(db, bot, chat_id, node_id, node):
         try:
-            type_str = node.get("type", "")
-            patterns = [
-                r'ai_proactive:\s*([a-zA-Z0-9_]+)\s*\("(.+?)"\)',
-                r'ai_proactive:\s*([a-zA-Z0-9_]+)\s*\((.+?)\)'
-            ]
-            role = None; task_prompt = None
-            for p in patterns:
-                m = re.search(p, type_str)
-                if m:
-                    role, task_prompt = m.groups(); break
+            role, task_prompt = node.ai_role, node.ai_task
             if role and task_prompt and AI_AVAILABLE:
-                # NEW: Определяем отображаемое имя роли
-                display_role = role
-                if str(role).lower() in ('true', '1', 'yes', 'on', 'default'):
-                    display_role = AI_DEFAULT_ROLE
-
+                display_role = _display_role(role)
                 wait_msg = bot.send_message(chat_id, "⏳ ...")
                 
                 s = user_sessions[chat_id]
-                context = crud.build_full_context_for_ai(
-                    db, s['session_id'], s['user_id'], task_prompt,
-                    node.get("options", []), event_type="proactive", ai_persona=role
-                )
-                ai_response = gigachat_handler.get_ai_response("", system_prompt=context)
-                
-                if ai_response.startswith("⚠️"):
-                    bot.edit_message_text(ai_response, chat_id, wait_msg.message_id)
-                    crud.pause_session(db, s['session_id'])
-                    return
-                
-                # NEW: Добавляем заголовок с ролью
-                final_text = f"🎭 *{display_role}:*\n{ai_response}"
-                
-                try:
-                    bot.edit_message_text(
-                        _normalize_newlines(final_text), 
-                        chat_id, 
-                        wait_msg.message_id, 
-                        parse_mode="Markdown"
+                session_id, user_id = s['session_id'], s['user_id']
+
+                def finish(ai_response):
+                    # Ответ пришел в потоке задания (или из кеша): узел продолжается в очереди чата,
+                    # как после таймера, — не параллельно с нажатиями и сообщениями игрока
+                    run_node_callback(chat_id, lambda: deliver(ai_response))
+
+                def deliver(ai_response):
+                    if not _is_current_session(chat_id, session_id):
+                        return
+                    with unit_of_work() as job_db:
+                        if ai_response:
+                            if not _deliver_ai_answer(job_db, chat_id, session_id, wait_msg, display_role, ai_response):
+                                return
+                            crud.create_ai_dialogue(job_db, session_id, node_id, f"PROACTIVE: {task_prompt}", ai_response)
+                        else:
+                            _drop_placeholder(chat_id, wait_msg.message_id)
+                        # Вопрос узла — после ответа ИИ, как и раньше
+                        _handle_interactive_node(job_db, bot, chat_id, node_id, node)
+
+                def run(ctx_db, on_result):
+                    context = crud.build_full_context_for_ai(
+                        ctx_db, session_id, user_id, task_prompt,
+                        node.options, event_type="proactive", ai_persona=role
                     )
-                except Exception as e:
-                    print(f"⚠️ Edit error: {e}")
-                    bot.delete_message(chat_id, wait_msg.message_id)
-                    bot.send_message(chat_id, _normalize_newlines(final_text), parse_mode="Markdown")
-                
-                crud.create_ai_dialogue(db, s['session_id'], node_id, f"PROACTIVE: {task_prompt}", ai_response)
+                    work = _ai_work("", context, chat_id, wait_msg, display_role)
+
+                    def on_cancel(job):
+                        on_result(None)
+                        _drop_placeholder(chat_id, wait_msg.message_id)
+
+                    submit_ai_job(gigachat_handler.active_backend(), session_id, work,
+                                  on_done=lambda job: on_result(job.result if job.ok else None),
+                                  on_cancel=on_cancel)
+
+                def run_uncached():
+                    # Генерация лидера или предвыборки не удалась — свой запрос, без кеша
+                    with unit_of_work() as ctx_db:
+                        run(ctx_db, finish)
+
+                # Ответ мог быть сгенерирован заранее, пока игрок читал предыдущий вопрос
+                if AI_PREFETCH_ENABLED:
+                    prefetcher = get_prefetcher()
+                    entry = prefetcher.claim(session_id, node_id, lambda: crud.build_full_context_for_ai(
+                        db, session_id, user_id, task_prompt, node.options, event_type="proactive", ai_persona=role
+                    ))
+                    if entry is not None:
+                        print(f"[AI-PREFETCH] ✅ Узел {node_id}, сессия {session_id}: ответ из предвыборки")
+                        prefetcher.when_ready(entry, lambda result: finish(result) if result else run_uncached())
+                        return
+
+                # Обработчик не ждет LLM: вопрос узла покажет задание
+                cache_key = cache_key_for_node(node, crud.get_session_states(db, user_id, session_id),
+                                               gigachat_handler.COMPLIANCE_MODE)
+                if cache_key is None:
+                    run(db, finish)
+                else:
+                    outcome = get_response_cache().single_flight(
+                        cache_key, lambda complete: run(db, complete), finish, on_leader_failed=run_uncached
+                    )
+                    print(f"[AI-CACHE] Узел {node_id}, сессия {session_id}: {outcome}")
+                return
 
         except Exception:
             traceback.print_exc()
         _handle_interactive_node(db, bot, chat_id, node_id, node)
 
     def _handle_automatic_node(db, bot, chat_id, node):
-        node_type = node.get("type")
+        kind = node.kind
         next_node_id = None
-        if node_type in ("state", "Состояние"):
-            if node.get("text"):
-                _send_message(bot, chat_id, node, _format_text(db, chat_id, node["text"]))
-            next_node_id = node.get("next_node_id")
-        elif node_type in ("condition", "Условие"):
+        if kind is NodeKind.STATE:
+            if node.text:
+                _send_message(bot, chat_id, node, _format_text(db, chat_id, node.text))
+            next_node_id = node.next_node_id
+        elif kind is NodeKind.CONDITION:
             s = user_sessions[chat_id]
-            expr = node.get("text") or node.get("condition_string") or "False"
-            res = _evaluate_condition_enhanced(db, s['user_id'], s['session_id'], expr)
-            then_id, else_id = _extract_condition_targets(node)
+            res = _evaluate_condition_enhanced(db, s['user_id'], s['session_id'], node)
+            then_id, else_id = node.then_node_id, node.else_node_id
             next_node_id = then_id if res else else_id
-            print(f"⚖️ [CONDITION] '{expr}' -> {res}. Переход: {'THEN -> ' + str(then_id) if res else 'ELSE -> ' + str(else_id)}")
-        elif node_type in ("randomizer", "Рандомизатор"):
-            br = node.get("branches", [])
-            if br:
-                next_node_id = random.choices(br, weights=[b.get("weight", 1) for b in br], k=1)[0].get("next_node_id")
+            print(f"⚖️ [CONDITION] '{node.condition_source}' -> {res}. Переход: {'THEN -> ' + str(then_id) if res else 'ELSE -> ' + str(else_id)}")
+        elif kind is NodeKind.RANDOMIZER:
+            next_node_id = choose_branch(node)
         if next_node_id:
             process_node(chat_id, next_node_id)
         else:
             _graceful_finish(db, chat_id, node)
 
     def _handle_interactive_node(db, bot, chat_id, node_id, node):
-        text = _format_text(db, chat_id, node.get("text", "(нет текста)"))
-        options = node.get("options", []).copy()
-        node_type = node.get("type", "")
-        if (node_type in ("task", "Задача") or node_type.startswith("ai_proactive")) and node.get("randomize_options", False):
+        text = _format_text(db, chat_id, node.text if node.text is not None else "(нет текста)")
+        options = list(node.options)
+        if node.shuffle_options:
             random.shuffle(options)
         _save_shuffled_options(chat_id, node_id, options)
         markup = _build_keyboard_from_options(node_id, options)
         _send_message(bot, chat_id, node, text, markup)
+        # Игрок ждет ввода — удобная точка для сброса отложенных изменений состояния
+        s = user_sessions.get(chat_id)
+        if s and AI_AVAILABLE:
+            crud.checkpoint_session_states(db, s['session_id'])
+            if AI_PREFETCH_ENABLED:
+                _prefetch_successors(db, s, node)
+
+    def _prefetch_successors(db, s, node):
+        """Пока игрок читает вопрос — генерация проактивных узлов, в которые ведут варианты."""
+        graph = get_compiled_graph()
+        if graph is None:
+            return
+        session_id, user_id = s['session_id'], s['user_id']
+        prefetcher = get_prefetcher()
+        prefetcher.drop_session(session_id)
+        try:
+            states = crud.get_session_states(db, user_id, session_id)
+            for option in node.options:
+                changes = option_changes(option, states)
+                target = predict_arrival(graph, option_next(node, option), {**states, **changes})
+                if target is None or target.kind is not NodeKind.AI_PROACTIVE or not target.ai_task \
+                        or not is_prefetchable(target):
+                    continue
+                ctx = crud.context_after_choice(db, user_id, session_id, node.id, node.text or "",
+                                                option.answer_text, changes)
+                prompt = crud.build_full_context_for_ai(db, session_id, user_id, target.ai_task, target.options,
+                                                        event_type="proactive", ai_persona=target.ai_role, ctx=ctx)
+
+                def work(cancel_event, prompt=prompt):
+                    return gigachat_handler.get_ai_response("", system_prompt=prompt, cancel_event=cancel_event)
+
+                if not prefetcher.start(graph.graph_id, session_id, node.id, option.text, target.id, prompt,
+                                        lambda on_done, on_cancel, work=work: submit_ai_job(
+                                            gigachat_handler.active_backend(), session_id, work, on_done, on_cancel)):
+                    print(f"[AI-PREFETCH] ⚠️ Граф {graph.graph_id}: лимит предвыборки исчерпан")
+                    break
+        except Exception:
+            traceback.print_exc()
 
     def _build_keyboard_from_options(node_id, options):
         if not options:
             return None
         markup = InlineKeyboardMarkup()
         for i, option in enumerate(options):
-            markup.add(InlineKeyboardButton(text=option["text"], callback_data=f"{node_id}|{i}"))
+            markup.add(InlineKeyboardButton(text=option.text, callback_data=f"{node_id}|{i}"))
         return markup
 
     def _send_message(bot, chat_id, node, text, markup=None):
         processed_text = _normalize_newlines(text)
         try:
-            img = node.get("image_id")
+            img = node.image_id
             server_url = config("SERVER_URL", default=None)
             if img and server_url:
                 sent_msg = bot.send_photo(chat_id, f"{server_url}/images/{img}", caption=processed_text, reply_markup=markup, parse_mode="Markdown")
@@ -332,22 +480,22 @@ def register_handlers(bot: telebot.TeleBot, initial_graph_data: dict):
     @bot.message_handler(commands=['start'])
     def start_game(message):
         chat_id = message.chat.id
-        db = SessionLocal()
-        try:
-            if chat_id in user_sessions and AI_AVAILABLE:
-                crud.end_session(db, user_sessions[chat_id]['session_id'])
-            graph = get_current_graph()
-            if not graph or not AI_AVAILABLE:
-                bot.send_message(chat_id, "Сценарий недоступен или модули не загружены.")
-                return
-            user = crud.get_or_create_user(db, telegram_id=chat_id)
-            session_db = crud.create_session(db, user_id=user.id, graph_id=graph.get("graph_id", "default"))
-            user_sessions[chat_id] = {'session_id': session_db.id, 'user_id': user.id, 'last_message_id': None, 'finished': False}
-            process_node(chat_id, graph["start_node_id"])
-        except Exception:
-            traceback.print_exc()
-        finally:
-            if db: db.close()
+        with _update_unit() as db:
+            _start_game(db, chat_id)
+
+    def _start_game(db, chat_id):
+        if chat_id in user_sessions and AI_AVAILABLE:
+            crud.end_session(db, user_sessions[chat_id]['session_id'])
+            cancel_session_jobs(user_sessions[chat_id]['session_id'])
+            get_prefetcher().drop_session(user_sessions[chat_id]['session_id'])
+        graph = get_compiled_graph()
+        if not graph or not AI_AVAILABLE:
+            bot.send_message(chat_id, "Сценарий недоступен или модули не загружены.")
+            return
+        user = crud.get_or_create_user(db, telegram_id=chat_id)
+        session_db = crud.create_session(db, user_id=user.id, graph_id=graph.graph_id)
+        user_sessions[chat_id] = {'session_id': session_db.id, 'user_id': user.id, 'last_message_id': None, 'finished': False}
+        process_node(chat_id, graph.start_node_id)
 
     @bot.callback_query_handler(func=lambda call: True)
     def button_callback(call):
@@ -371,51 +519,47 @@ def register_handlers(bot: telebot.TeleBot, initial_graph_data: dict):
         except Exception:
             pass
 
-        db = SessionLocal()
-        try:
+        with _update_unit() as db:
             try:
                 node_id, btn_idx_str = call.data.split('|'); btn_idx = int(btn_idx_str)
             except Exception as e:
                 print(f"PARSE ERROR call.data='{call.data}': {e}")
                 return
-            graph = get_current_graph(); node = graph.get("nodes", {}).get(node_id) if graph else None
+            graph = get_compiled_graph(); node = graph.get(node_id) if graph else None
             if not node:
                 return
 
-            options = _get_shuffled_options(chat_id, node_id) or node.get("options", []).copy()
+            options = _get_shuffled_options(chat_id, node_id) or node.options
             if not options or btn_idx >= len(options):
                 return
             option = options[btn_idx]
             _clear_shuffled_options(chat_id, node_id)
+            if AI_PREFETCH_ENABLED:
+                get_prefetcher().choose(s['session_id'], node_id, option.text)
 
-            if option.get("formula"):
-                states_before = crud.get_all_user_states(db, s['user_id'], s['session_id'])
-                states_after = SafeStateCalculator.calculate(option["formula"], states_before)
-                for k, v in states_after.items():
-                    if k not in states_before or states_before[k] != v:
-                        crud.update_user_state(db, s['user_id'], s['session_id'], k, v)
+            if option.compiled_formula:
+                # Состояние берется из кеша сессии; формула записывает только ключи из writes
+                states_before = crud.get_session_states(db, s['user_id'], s['session_id'])
+                changes = option_changes(option, states_before)
+                crud.update_session_states(db, s['user_id'], s['session_id'], changes)
 
-            crud.create_response(db, s['session_id'], node_id, answer_text=option.get("interpretation", option["text"]), node_text=node.get("text", ""))
+            crud.create_response(db, s['session_id'], node_id, answer_text=option.answer_text, node_text=node.text or "")
 
             try:
                 if len(options) == 1:
                     bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=None)
                 else:
-                    original_text = _format_text(db, chat_id, node.get("text", ""))
-                    new_text = f"{_normalize_newlines(original_text)}\n\n*Ваш ответ: {option['text']}*"
+                    original_text = _format_text(db, chat_id, node.text or "")
+                    new_text = f"{_normalize_newlines(original_text)}\n\n*Ваш ответ: {option.text}*"
                     bot.edit_message_text(new_text, chat_id, call.message.message_id, reply_markup=None, parse_mode="Markdown")
             except Exception:
                 pass
 
-            next_node_id = option.get("next_node_id") or node.get("next_node_id")
+            next_node_id = option_next(node, option)
             if next_node_id:
                 process_node(chat_id, next_node_id)
             else:
                 _graceful_finish(db, chat_id, node)
-        except Exception:
-            traceback.print_exc()
-        finally:
-            if db: db.close()
 
     @bot.message_handler(content_types=['text'])
     def text_message_handler(message):
@@ -426,66 +570,50 @@ def register_handlers(bot: telebot.TeleBot, initial_graph_data: dict):
         if not s or not s.get('current_node_id') or s.get('finished'):
             return
         
-        # Проверка паузы сессии
-        db_check = SessionLocal()
-        try:
-            session = db_check.query(models.Session).filter(models.Session.id == s['session_id']).first()
-            if session and session.is_paused:
-                bot.reply_to(message, "⏸️ Игра приостановлена из-за недоступности сервиса. Попробуйте позже.")
-                return
-        finally:
-            db_check.close()
-        
-        graph = get_current_graph(); node = graph.get("nodes", {}).get(s.get('current_node_id')) if graph else None
+        graph = get_compiled_graph(); node = graph.get(s.get('current_node_id')) if graph else None
 
         if not node:
             return
-        db = SessionLocal()
-        try:
-            ai_role = node.get("ai_enabled")
+        # Проверка паузы и обработка сообщения — в одной единице работы
+        with _update_unit() as db:
+            if AI_AVAILABLE:
+                session = db.query(models.Session).filter(models.Session.id == s['session_id']).first()
+                if session and session.is_paused:
+                    bot.reply_to(message, "⏸️ Игра приостановлена из-за недоступности сервиса. Попробуйте позже.")
+                    return
+            ai_role = node.ai_enabled
             if ai_role and AI_AVAILABLE:
-                # NEW: Определяем отображаемое имя роли
-                display_role = ai_role
-                if str(ai_role).lower() in ('true', '1', 'yes', 'on', 'default'):
-                    display_role = AI_DEFAULT_ROLE
-                
+                display_role = _display_role(ai_role)
                 wait_msg = bot.reply_to(message, "⏳ ...")
-                
-                context = crud.build_full_context_for_ai(db, s['session_id'], s['user_id'], message.text, node.get("options", []), event_type="reactive", ai_persona=ai_role)
-                ai_answer = gigachat_handler.get_ai_response(message.text, system_prompt=context)
-                
-                if ai_answer.startswith("⚠️"):
-                    bot.edit_message_text(ai_answer, chat_id, wait_msg.message_id)
-                    crud.pause_session(db, s['session_id'])
-                    return
-                
-                # NEW: Добавляем заголовок с ролью
-                final_text = f"🎭 *{display_role}:*\n{ai_answer}"
-                
-                try:
-                    bot.edit_message_text(
-                        _normalize_newlines(final_text),
-                        chat_id,
-                        wait_msg.message_id,
-                        parse_mode="Markdown"
-                    )
-                except Exception as e:
-                    print(f"⚠️ Edit error: {e}")
-                    bot.delete_message(chat_id, wait_msg.message_id)
-                    bot.reply_to(message, _normalize_newlines(final_text), parse_mode="Markdown")
-                
-                crud.create_ai_dialogue(db, s['session_id'], s.get('current_node_id'), message.text, ai_answer)
-
-            elif node.get("type") == "input_text":
-                crud.create_response(db, s['session_id'], s.get('current_node_id'), answer_text=message.text, node_text=node.get("text", ""))
-                next_node_id = node.get("next_node_id")
+            
+                session_id, node_id = s['session_id'], s.get('current_node_id')
+                context = crud.build_full_context_for_ai(db, session_id, s['user_id'], message.text, node.options, event_type="reactive", ai_persona=ai_role)
+
+                work = _ai_work(message.text, context, chat_id, wait_msg, display_role)
+
+                def on_done(job):
+                    run_node_callback(chat_id, lambda: deliver(job))
+
+                def deliver(job):
+                    if not _is_current_session(chat_id, session_id):
+                        return
+                    if not job.ok:
+                        bot.edit_message_text(AI_BUSY_TEXT, chat_id, wait_msg.message_id)
+                        return
+                    with unit_of_work() as job_db:
+                        if _deliver_ai_answer(job_db, chat_id, session_id, wait_msg, display_role, job.result, reply_to=message):
+                            crud.create_ai_dialogue(job_db, session_id, node_id, message.text, job.result)
+
+                # Ответ допишет задание; соединение с БД возвращается в пул вместе с апдейтом
+                submit_ai_job(gigachat_handler.active_backend(), session_id, work, on_done,
+                              on_cancel=lambda job: _drop_placeholder(chat_id, wait_msg.message_id))
+
+            elif node.is_input_text:
+                crud.create_response(db, s['session_id'], s.get('current_node_id'), answer_text=message.text, node_text=node.text or "")
+                next_node_id = node.next_node_id
                 if next_node_id:
                     process_node(chat_id, next_node_id)
                 else:
                     _graceful_finish(db, chat_id, node)
             else:
                 bot.reply_to(message, "Пожалуйста, используйте кнопки для навигации.")
-        except Exception:
-            traceback.print_exc()
-        finally:
-            if db: db.close()
\ No newline at end of file
@@ -0,0 +1,455 @@
+# app/modules/telegram_sender.py
+"""
+Исходящий диспетчер сообщений Telegram.
+
+Все вызовы send/edit/delete проходят через общую очередь с двумя token bucket:
+глобальным (лимит бота) и на каждый чат. Внутри чата порядок сохраняется
+и одновременно выполняется не более одного запроса; между чатами — по приоритету:
+интерактивные ответы раньше «косметики» (прогресс-бары, обратный отсчет).
+Незапущенная правка того же сообщения заменяется новой (coalescing), а удаление
+или обычная правка сообщения снимает его незапущенные косметические правки. Ответ 429 блокирует чат на retry_after
+и снижает глобальную скорость, которая затем плавно восстанавливается.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, Hashable, Optional
+
+from decouple import config
+
+OUTBOUND_ENABLED = config("OUTBOUND_ENABLED", default=False, cast=bool)
+OUTBOUND_GLOBAL_RATE = config("OUTBOUND_GLOBAL_RATE", default=25.0, cast=float)    # запросов/сек на бота
+OUTBOUND_CHAT_RATE = config("OUTBOUND_CHAT_RATE", default=1.0, cast=float)         # запросов/сек на чат
+OUTBOUND_CHAT_BURST = config("OUTBOUND_CHAT_BURST", default=3, cast=int)
+OUTBOUND_WORKERS = config("OUTBOUND_WORKERS", default=8, cast=int)
+OUTBOUND_MAX_RETRIES = config("OUTBOUND_MAX_RETRIES", default=3, cast=int)
+OUTBOUND_SEND_TIMEOUT = config("OUTBOUND_SEND_TIMEOUT", default=30.0, cast=float)
+
+# Приоритеты (меньше — раньше)
+PRIORITY_INTERACTIVE = 0   # ответы игроку, вопросы с кнопками
+PRIORITY_NORMAL = 1        # служебные сообщения, удаления
+PRIORITY_COSMETIC = 2      # прогресс-бары и обратный отсчет
+
+# Методы, которые идут через очередь; остальные атрибуты бота проксируются напрямую
+QUEUED_METHODS = ("send_message", "send_photo", "reply_to", "edit_message_text",
+                  "edit_message_reply_markup", "delete_message")
+_EDIT_METHODS = ("edit_message_text", "edit_message_reply_markup")
+
+# Восстановление глобальной скорости после 429: +1% от лимита за каждый успешный запрос
+_RATE_BACKOFF = 0.7
+_RATE_RECOVERY = 0.01
+_RATE_FLOOR = 1.0
+_SWEEP_INTERVAL = 60.0
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов/сек, не больше capacity."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(max(1.0, capacity))
+        self.tokens = self.capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько ждать до появления токена (0 — токен есть)."""
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate if self.rate > 0 else 1.0
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1.0
+
+
+class _Request:
+    __slots__ = ("method", "args", "kwargs", "priority", "seq", "chat_key", "coalesce_key",
+                 "future", "attempts", "cancelled", "started", "enqueued_at")
+
+    def __init__(self, method, args, kwargs, priority, seq, chat_key, coalesce_key):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.chat_key = chat_key
+        self.coalesce_key = coalesce_key
+        self.future = Future()
+        self.attempts = 0
+        self.cancelled = False
+        self.started = False
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _ChatState:
+    __slots__ = ("bucket", "queue", "busy", "blocked_until")
+
+    def __init__(self, rate, burst, now):
+        self.bucket = TokenBucket(rate, burst, now)
+        self.queue = []          # heap _Request по (priority, seq)
+        self.busy = False
+        self.blocked_until = 0.0
+
+
+def request_target(method: str, args: tuple, kwargs: dict):
+    """(chat_id, message_id) запроса по сигнатурам методов telebot."""
+    if method == "reply_to":
+        message = args[0] if args else kwargs.get("message")
+        return message.chat.id, None
+    if method == "edit_message_text":
+        # edit_message_text(text, chat_id, message_id, ...)
+        chat_id = kwargs.get("chat_id", args[1] if len(args) > 1 else None)
+        message_id = kwargs.get("message_id", args[2] if len(args) > 2 else None)
+        return chat_id, message_id
+    chat_id = kwargs.get("chat_id", args[0] if args else None)
+    message_id = kwargs.get("message_id", args[1] if len(args) > 1 else None)
+    if method in ("send_message", "send_photo"):
+        message_id = None
+    return chat_id, message_id
+
+
+def retry_after_of(exc) -> Optional[float]:
+    """retry_after из ответа 429 (ApiTelegramException) или None для прочих ошибок."""
+    if getattr(exc, "error_code", None) != 429:
+        return None
+    result_json = getattr(exc, "result_json", None) or {}
+    try:
+        return float((result_json.get("parameters") or {}).get("retry_after", 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+class OutboundSender:
+    """
+    Очередь исходящих запросов к Bot API.
+
+    Args:
+        bot: telebot.TeleBot (или совместимый объект)
+        global_rate: лимит запросов в секунду на весь бот
+        chat_rate / chat_burst: лимит и запас на один чат
+        workers: число потоков, выполняющих HTTP-запросы
+    """
+
+    def __init__(self, bot, global_rate: float = OUTBOUND_GLOBAL_RATE, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 chat_burst: int = OUTBOUND_CHAT_BURST, workers: int = OUTBOUND_WORKERS,
+                 max_retries: int = OUTBOUND_MAX_RETRIES, name: str = "OutboundSender"):
+        self.bot = bot
+        self.global_rate = float(global_rate)
+        self.chat_rate = float(chat_rate)
+        self.chat_burst = max(1, int(chat_burst))
+        self.max_retries = max(0, int(max_retries))
+        self.name = name
+        self._global = TokenBucket(global_rate, max(1.0, global_rate), time.monotonic())
+        self._cond = threading.Condition()
+        self._chats: Dict[Hashable, _ChatState] = {}
+        self._ready = []       # heap (priority, seq, chat_key)
+        self._delayed = []     # heap (ready_at, seq, chat_key)
+        self._edits: Dict[Hashable, _Request] = {}   # coalesce_key -> незапущенная правка
+        self._seq = itertools.count()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix=f"{name}-io")
+        self._running = True
+        self._stats = {
+            "submitted": 0, "sent": 0, "errors": 0, "coalesced": 0, "dropped_superseded": 0,
+            "rate_limited": 0, "retries": 0, "timed_out": 0, "queue_wait_total": 0.0,
+        }
+        self._thread = threading.Thread(target=self._dispatch_loop, daemon=True, name=name)
+        self._thread.start()
+
+    # === Приём ===
+    def submit(self, method: str, *args, priority: int = PRIORITY_NORMAL, coalesce: bool = False, **kwargs) -> Future:
+        """
+        Ставит вызов bot.<method>(*args, **kwargs) в очередь. Возвращает Future с результатом.
+        coalesce=True для правок: незапущенная правка того же сообщения заменяется этой.
+        """
+        return self._enqueue(method, args, kwargs, priority, coalesce).future
+
+    def _enqueue(self, method: str, args: tuple, kwargs: dict, priority: int, coalesce: bool) -> _Request:
+        chat_id, message_id = request_target(method, args, kwargs)
+        coalesce_key = (chat_id, message_id) if coalesce and method in _EDIT_METHODS and message_id else None
+        with self._cond:
+            self._stats["submitted"] += 1
+            if coalesce_key is not None:
+                pending = self._edits.get(coalesce_key)
+                if pending is not None and not pending.started and not pending.cancelled:
+                    # Незапущенная правка устарела: подменяем ее содержимое, место в очереди сохраняется
+                    pending.method, pending.args, pending.kwargs = method, args, kwargs
+                    self._stats["coalesced"] += 1
+                    return pending
+            if message_id is not None and (method == "delete_message" or
+                                           (coalesce_key is None and method in _EDIT_METHODS)):
+                # Удаление или обычная (финальная) правка делают незапущенную косметику устаревшей
+                self._drop_edits(chat_id, message_id)
+
+            req = _Request(method, args, kwargs, priority, next(self._seq), chat_id, coalesce_key)
+            if coalesce_key is not None:
+                self._edits[coalesce_key] = req
+            now = time.monotonic()
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _ChatState(self.chat_rate, self.chat_burst, now)
+            heapq.heappush(chat.queue, req)
+            if not chat.busy and chat.queue[0] is req:
+                heapq.heappush(self._ready, (req.priority, req.seq, chat_id))
+                self._cond.notify()
+            return req
+
+    def call(self, method: str, *args, priority: int = PRIORITY_INTERACTIVE,
+             timeout: float = OUTBOUND_SEND_TIMEOUT, **kwargs):
+        """
+        Синхронный вызов через очередь (нужен результат, например message_id).
+        Не дождавшийся отправки запрос снимается с очереди: вызывающий считает его неудачным
+        (и может повторить), поэтому позже он уйти не должен. Уже выполняющийся запрос дожидаемся.
+        """
+        req = self._enqueue(method, args, kwargs, priority, False)
+        try:
+            return req.future.result(timeout)
+        except FutureTimeoutError:
+            with self._cond:
+                dropped = not req.started and not req.future.done()
+                if dropped:
+                    req.cancelled = True
+                    self._stats["timed_out"] += 1
+            if not dropped:
+                return req.future.result()
+            raise
+
+    def stop(self, timeout: Optional[float] = None):
+        """Останавливает диспетчер после отправки уже принятых запросов."""
+        with self._cond:
+            # Отмененные запросы не ждем: диспетчер снимает их молча, не будя stop()
+            self._cond.wait_for(lambda: not any(c.busy or any(not r.cancelled for r in c.queue)
+                                                for c in self._chats.values()), timeout)
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=True)
+
+    # === Метрики ===
+    def queue_depth(self) -> int:
+        with self._cond:
+            return sum(len(c.queue) for c in self._chats.values())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            sent = self._stats["sent"]
+            stats = {k: v for k, v in self._stats.items() if k != "queue_wait_total"}
+            return {
+                **stats,
+                "pending": sum(len(c.queue) for c in self._chats.values()),
+                "active_chats": len(self._chats),
+                "global_rate_limit": self.global_rate,
+                "global_rate_current": round(self._global.rate, 2),
+                "avg_queue_wait_ms": round(self._stats["queue_wait_total"] / sent * 1000, 2) if sent else 0.0,
+            }
+
+    # --- internal ---
+    def _drop_edits(self, chat_id, message_id):
+        req = self._edits.pop((chat_id, message_id), None)
+        if req is not None and not req.started and not req.cancelled:
+            req.cancelled = True
+            req.future.set_result(None)
+            self._stats["dropped_superseded"] += 1
+
+    def _dispatch_loop(self):
+        next_sweep = time.monotonic() + _SWEEP_INTERVAL
+        with self._cond:
+            while self._running:
+                now = time.monotonic()
+                if now >= next_sweep:
+                    self._sweep_idle_chats(now)
+                    next_sweep = now + _SWEEP_INTERVAL
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, _, chat_key = heapq.heappop(self._delayed)
+                    self._push_head(chat_key)
+                if not self._ready:
+                    timeout = self._delayed[0][0] - now if self._delayed else None
+                    self._cond.wait(timeout)
+                    continue
+                global_wait = self._global.wait_time(now)
+                if global_wait > 0:
+                    self._cond.wait(global_wait)
+                    continue
+
+                priority, seq, chat_key = heapq.heappop(self._ready)
+                chat = self._chats.get(chat_key)
+                if chat is None or chat.busy:
+                    continue
+                # Отмененные (вытесненные) запросы снимаем без расхода токенов
+                while chat.queue and chat.queue[0].cancelled:
+                    heapq.heappop(chat.queue)
+                if not chat.queue:
+                    continue
+                head = chat.queue[0]
+                if (head.priority, head.seq) != (priority, seq):
+                    # Устаревшая запись; актуальная голова поставлена в очередь отдельно
+                    self._push_head(chat_key)
+                    continue
+                chat_wait = max(chat.bucket.wait_time(now), chat.blocked_until - now)
+                if chat_wait > 0:
+                    heapq.heappush(self._delayed, (now + chat_wait, seq, chat_key))
+                    continue
+
+                heapq.heappop(chat.queue)
+                self._global.consume(now)
+                chat.bucket.consume(now)
+                chat.busy = True
+                head.started = True
+                if head.coalesce_key is not None and self._edits.get(head.coalesce_key) is head:
+                    del self._edits[head.coalesce_key]
+                self._stats["queue_wait_total"] += now - head.enqueued_at
+                self._executor.submit(self._execute, chat_key, head)
+
+    def _push_head(self, chat_key):
+        chat = self._chats.get(chat_key)
+        if chat is None or chat.busy:
+            return
+        while chat.queue and chat.queue[0].cancelled:
+            heapq.heappop(chat.queue)
+        if not chat.queue:
+            return
+        head = chat.queue[0]
+        heapq.heappush(self._ready, (head.priority, head.seq, chat_key))
+
+    def _sweep_idle_chats(self, now: float):
+        """Удаляет состояние простаивающих чатов, чей bucket уже полон (лимит не теряется)."""
+        for chat_key in [k for k, c in self._chats.items()
+                         if not c.queue and not c.busy and c.blocked_until <= now
+                         and c.bucket.wait_time(now) == 0 and c.bucket.tokens >= c.bucket.capacity]:
+            del self._chats[chat_key]
+
+    def _execute(self, chat_key, req: _Request):
+        req.attempts += 1
+        result, error, retry_after = None, None, None
+        try:
+            result = getattr(self.bot, req.method)(*req.args, **req.kwargs)
+        except Exception as e:
+            error = e
+            retry_after = retry_after_of(e)
+
+        with self._cond:
+            chat = self._chats.get(chat_key)
+            if retry_after is not None:
+                self._stats["rate_limited"] += 1
+                # Обратная связь: чат ждет retry_after, глобальная скорость снижается
+                self._global.rate = max(_RATE_FLOOR, self._global.rate * _RATE_BACKOFF)
+                if chat is not None:
+                    chat.blocked_until = max(chat.blocked_until, time.monotonic() + retry_after)
+                if req.attempts <= self.max_retries and chat is not None:
+                    error = None
+                    if req.coalesce_key is not None and req.coalesce_key in self._edits:
+                        # Пока правка ждала ответа, пришла более новая — повтор устарел
+                        req.cancelled = True
+                        self._stats["dropped_superseded"] += 1
+                    else:
+                        self._stats["retries"] += 1
+                        req.started = False
+                        if req.coalesce_key is not None:
+                            # Снова незапущенная: новые правки схлопываются в нее, удаление ее снимает
+                            self._edits[req.coalesce_key] = req
+                        heapq.heappush(chat.queue, req)
+            elif error is None:
+                self._stats["sent"] += 1
+                self._global.rate = min(self.global_rate, self._global.rate + self.global_rate * _RATE_RECOVERY)
+            if error is not None:
+                self._stats["errors"] += 1
+            if chat is not None:
+                chat.busy = False
+                self._push_head(chat_key)
+            # Будим и диспетчер, и stop(): они ждут на одном условии
+            self._cond.notify_all()
+
+        if retry_after is not None and error is None:
+            if req.cancelled:
+                req.future.set_result(None)
+            return  # запрос вернулся в очередь чата
+        if error is not None:
+            req.future.set_exception(error)
+        else:
+            req.future.set_result(result)
+
+
+class RateLimitedBot:
+    """
+    Прокси над TeleBot: send/edit/delete идут через OutboundSender, остальное — напрямую.
+    Отправки ждут результата (нужен message_id), ошибки пробрасываются как раньше.
+    """
+
+    def __init__(self, bot, sender: OutboundSender, timeout: float = OUTBOUND_SEND_TIMEOUT):
+        self._bot = bot
+        self.sender = sender
+        self._timeout = timeout
+
+    def __getattr__(self, name):
+        if name in QUEUED_METHODS:
+            def queued(*args, **kwargs):
+                return self.sender.call(name, *args, priority=PRIORITY_INTERACTIVE, timeout=self._timeout, **kwargs)
+            return queued
+        return getattr(self._bot, name)
+
+
+def edit_cosmetic(bot, *args, **kwargs):
+    """
+    Косметическая правка (прогресс-бар, отсчет): низкий приоритет, без ожидания,
+    устаревшие правки того же сообщения схлопываются. Без диспетчера — обычный вызов.
+    """
+    sender = getattr(bot, "sender", None)
+    if isinstance(sender, OutboundSender):
+        future = sender.submit("edit_message_text", *args, priority=PRIORITY_COSMETIC, coalesce=True, **kwargs)
+        future.add_done_callback(_log_failure)
+        return future
+    return bot.edit_message_text(*args, **kwargs)
+
+
+def call_nowait(bot, method: str, *args, **kwargs) -> Future:
+    """
+    Отправка или удаление без ожидания очереди (для задач TimerScheduler): Future с результатом,
+    продолжение вешается на future.add_done_callback. Без диспетчера — обычный вызов.
+    """
+    sender = getattr(bot, "sender", None)
+    if isinstance(sender, OutboundSender):
+        return sender.submit(method, *args, priority=PRIORITY_INTERACTIVE, **kwargs)
+    future = Future()
+    try:
+        future.set_result(getattr(bot, method)(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def _log_failure(future: Future):
+    exc = future.exception()
+    if exc is not None:
+        # Ошибки косметических правок не критичны (сообщение могли удалить)
+        print(f"[OUTBOUND] ⚠️ Косметическая правка не выполнена: {exc}")
+
+
+_default_sender = None
+
+
+def wrap_bot(bot):
+    """Оборачивает бота в RateLimitedBot при OUTBOUND_ENABLED=true, иначе возвращает как есть."""
+    global _default_sender
+    if not OUTBOUND_ENABLED:
+        return bot
+    _default_sender = OutboundSender(bot)
+    print(f"[OUTBOUND] ✅ Очередь исходящих: {OUTBOUND_GLOBAL_RATE}/с на бота, "
+          f"{OUTBOUND_CHAT_RATE}/с на чат (burst {OUTBOUND_CHAT_BURST}), воркеров: {OUTBOUND_WORKERS}")
+    return RateLimitedBot(bot, _default_sender)
+
+
+def get_outbound_sender() -> Optional[OutboundSender]:
+    return _default_sender
@@ -0,0 +1,260 @@
+# app/modules/timer_store.py
+"""
+Персистентные таймеры (FeatureFlags.ENABLE_PERSISTENCE_TIMERS).
+
+TimingEngine регистрирует каждый таймер (паузу, typing, таймаут) в TimerStore.
+Новые таймеры и смены статуса копятся в памяти и пишутся в active_timers пачками
+фоновым потоком: один INSERT на пачку и один UPDATE на статус. Таймер, который сработал
+или был отменен до записи, в БД не попадает вовсе.
+
+При старте recover() загружает все pending-таймеры одним запросом по индексу
+(status, target_timestamp). Просроченные запускаются ограниченными пачками,
+остальные возвращаются в TimerScheduler на свой срок.
+"""
+
+import atexit
+import bisect
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+from decouple import config
+from sqlalchemy import insert, select, update
+
+from app.config.feature_flags import FeatureFlags
+from app.modules.database import models
+
+TIMER_FLUSH_INTERVAL = config("TIMER_FLUSH_INTERVAL", default=0.5, cast=float)
+TIMER_RECOVERY_BATCH = config("TIMER_RECOVERY_BATCH", default=500, cast=int)
+TIMER_RECOVERY_BATCH_INTERVAL = config("TIMER_RECOVERY_BATCH_INTERVAL", default=1.0, cast=float)
+
+_UPDATE_CHUNK = 1000
+
+
+def utc_naive_now() -> datetime:
+    """Текущее время UTC без tzinfo (active_timers.target_timestamp — DateTime без зоны)."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def persistence_enabled() -> bool:
+    return FeatureFlags.is_enabled('ENABLE_PERSISTENCE_TIMERS')
+
+
+class PersistedTimer:
+    """Таймер, переживающий рестарт: что и когда выполнить (узел сценария сессии)."""
+    __slots__ = ('session_id', 'timer_type', 'target', 'node_id', 'data', 'db_id', 'status')
+
+    def __init__(self, session_id: int, timer_type: str, target: datetime, node_id: str,
+                 data: Optional[dict] = None, db_id: Optional[int] = None, status: str = 'pending'):
+        self.session_id = session_id
+        self.timer_type = timer_type
+        self.target = target
+        self.node_id = node_id
+        self.data = data or {}
+        self.db_id = db_id
+        self.status = status
+
+    @classmethod
+    def after(cls, seconds: float, session_id: int, timer_type: str, node_id: str, data: dict = None):
+        return cls(session_id, timer_type, utc_naive_now() + timedelta(seconds=float(seconds or 0)), node_id, data)
+
+
+class TimerStore:
+    """Отложенная пачечная запись таймеров в active_timers и восстановление после рестарта."""
+
+    def __init__(self, session_factory=None, flush_interval: float = TIMER_FLUSH_INTERVAL):
+        self._session_factory = session_factory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._inserts: Dict[PersistedTimer, None] = {}   # упорядоченное множество новых таймеров
+        self._updates: Dict[int, str] = {}               # db_id -> новый статус
+        self._flusher = None
+        self._stats = {'inserted': 0, 'updated': 0, 'skipped_inserts': 0, 'flushes': 0, 'errors': 0}
+
+    # === Регистрация ===
+    def add(self, timer: PersistedTimer) -> PersistedTimer:
+        with self._lock:
+            self._inserts[timer] = None
+        self._ensure_flusher()
+        return timer
+
+    def complete(self, timer: PersistedTimer, status: str = 'executed'):
+        """Таймер сработал ('executed') или отменен ('cancelled')."""
+        with self._lock:
+            if timer.status != 'pending':
+                return
+            timer.status = status
+            if timer in self._inserts:
+                # Еще не записан — и не нужно
+                del self._inserts[timer]
+                self._stats['skipped_inserts'] += 1
+            elif timer.db_id is not None:
+                self._updates[timer.db_id] = status
+            # Иначе INSERT уже выполняется: статус допишет flush() после получения id
+
+    # === Запись ===
+    def flush(self) -> int:
+        """Пишет накопленные таймеры и статусы одной транзакцией. Возвращает число затронутых строк."""
+        with self._lock:
+            inserts = list(self._inserts)
+            self._inserts.clear()
+            updates, self._updates = self._updates, {}
+        if not inserts and not updates:
+            return 0
+        db = self._new_session()
+        try:
+            ids = []
+            if inserts:
+                now = utc_naive_now()
+                rows = [{
+                    'session_id': t.session_id, 'timer_type': t.timer_type, 'target_timestamp': t.target,
+                    'callback_node_id': t.node_id, 'callback_data': t.data, 'status': 'pending', 'created_at': now,
+                } for t in inserts]
+                stmt = insert(models.ActiveTimer).returning(models.ActiveTimer.id, sort_by_parameter_order=True)
+                ids = db.execute(stmt, rows).scalars().all()
+            by_status: Dict[str, List[int]] = {}
+            for db_id, status in updates.items():
+                by_status.setdefault(status, []).append(db_id)
+            for status, db_ids in by_status.items():
+                for i in range(0, len(db_ids), _UPDATE_CHUNK):
+                    db.execute(update(models.ActiveTimer)
+                               .where(models.ActiveTimer.id.in_(db_ids[i:i + _UPDATE_CHUNK]))
+                               .values(status=status))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"❌ [TIMER-STORE] Ошибка записи таймеров: {e}")
+            with self._lock:
+                self._stats['errors'] += 1
+                # Вернем в очередь до следующей попытки
+                for t in inserts:
+                    if t.status == 'pending':
+                        self._inserts[t] = None
+                for db_id, status in updates.items():
+                    self._updates.setdefault(db_id, status)
+            return 0
+        finally:
+            db.close()
+
+        with self._lock:
+            for timer, db_id in zip(inserts, ids):
+                timer.db_id = db_id
+                if timer.status != 'pending':
+                    # Сработал, пока шел INSERT
+                    self._updates[db_id] = timer.status
+            self._stats['flushes'] += 1
+            self._stats['inserted'] += len(inserts)
+            self._stats['updated'] += len(updates)
+        return len(inserts) + len(updates)
+
+    # === Восстановление ===
+    def load_pending(self, db) -> List[PersistedTimer]:
+        """Все ожидающие таймеры одним запросом по индексу (status, target_timestamp)."""
+        t = models.ActiveTimer
+        rows = db.execute(
+            select(t.id, t.session_id, t.timer_type, t.target_timestamp, t.callback_node_id, t.callback_data)
+            .where(t.status == 'pending')
+            .order_by(t.target_timestamp)
+        ).all()
+        return [PersistedTimer(r.session_id, r.timer_type, r.target_timestamp, r.callback_node_id,
+                               r.callback_data, db_id=r.id) for r in rows]
+
+    def recover(self, resume: Callable[[PersistedTimer], None], scheduler,
+                batch_size: int = TIMER_RECOVERY_BATCH,
+                batch_interval: float = TIMER_RECOVERY_BATCH_INTERVAL) -> dict:
+        """
+        Возвращает pending-таймеры в работу после рестарта.
+        Просроченные запускаются пачками по batch_size раз в batch_interval сек, остальные — на свой срок.
+        """
+        started = time.perf_counter()
+        db = self._new_session()
+        try:
+            timers = self.load_pending(db)
+        finally:
+            db.close()
+        loaded = time.perf_counter()
+
+        now = utc_naive_now()
+        mono = time.monotonic()
+        # Список отсортирован по target — просроченные образуют префикс
+        split = bisect.bisect_right([t.target for t in timers], now)
+        overdue, future = timers[:split], timers[split:]
+        batch_size = max(1, int(batch_size))
+        for n, i in enumerate(range(0, len(overdue), batch_size)):
+            scheduler.call_later(n * batch_interval, self._fire_batch, overdue[i:i + batch_size], resume)
+        for timer in future:
+            scheduler.call_at(mono + (timer.target - now).total_seconds(), self._fire, timer, resume)
+        if timers:
+            # Статус 'executed' сработавших таймеров должен дойти до БД и без новых add():
+            # иначе после падения они снова pending и сработают повторно
+            self._ensure_flusher()
+
+        report = {
+            'loaded': len(timers), 'overdue': len(overdue), 'rescheduled': len(future),
+            'overdue_batches': -(-len(overdue) // batch_size),
+            'load_seconds': round(loaded - started, 3),
+            'total_seconds': round(time.perf_counter() - started, 3),
+        }
+        print(f"⏱️ [TIMER-STORE] Восстановлено таймеров: {report['loaded']} "
+              f"(просрочено {report['overdue']} -> {report['overdue_batches']} пачек, "
+              f"на свой срок {report['rescheduled']}) за {report['total_seconds']}s")
+        return report
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, 'pending_inserts': len(self._inserts), 'pending_updates': len(self._updates)}
+
+    # --- internal ---
+    def _new_session(self):
+        if self._session_factory is None:
+            from app.modules.database import SessionLocal
+            self._session_factory = SessionLocal
+        return self._session_factory()
+
+    def _fire(self, timer: PersistedTimer, resume: Callable[[PersistedTimer], None]):
+        if timer.status != 'pending':
+            return
+        self.complete(timer, 'executed')
+        try:
+            resume(timer)
+        except Exception as e:
+            print(f"❌ [TIMER-STORE] Ошибка восстановленного таймера {timer.db_id}: {e}")
+
+    def _fire_batch(self, timers: List[PersistedTimer], resume: Callable[[PersistedTimer], None]):
+        for timer in timers:
+            self._fire(timer, resume)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True, name="TimerStoreFlusher")
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+
+_timer_store: Optional[TimerStore] = None
+_store_lock = threading.Lock()
+
+
+def get_timer_store() -> TimerStore:
+    """Общее хранилище таймеров процесса (создается при первом обращении)."""
+    global _timer_store
+    if _timer_store is None:
+        with _store_lock:
+            if _timer_store is None:
+                _timer_store = TimerStore()
+                # Не теряем накопленные таймеры при штатной остановке
+                atexit.register(_timer_store.flush)
+    return _timer_store
@@ -1,19 +1,194 @@
 # -*- coding: utf-8 -*-
 """
 R-Bot Timing Engine - публичные функции и реализация TimingEngine (с поддержкой отмены таймаутов)
+
+Все таймеры (паузы, таймауты, шаги прогресс-бара и обратного отсчёта) выполняются
+на едином TimerScheduler: куча (heapq) + один поток-диспетчер + небольшой пул исполнителей.
+При ENABLE_PERSISTENCE_TIMERS таймеры узлов дублируются в active_timers (timer_store)
+и после рестарта возвращаются в планировщик через recover_persistent_timers().
+
+Исполнители планировщика выполняют только короткие задачи (тики, шаги отсчёта).
+Узел сценария, до которого дошёл таймер, открывает единицу работы и отправляет
+сообщения — это может занять до OUTBOUND_SEND_TIMEOUT, поэтому он передаётся
+дальше: в диспетчер апдейтов (set_node_callback_runner, очередь чата — порядок
+с нажатиями игрока сохраняется) или в отдельный пул NODE_CALLBACK_WORKERS.
+Тем же путем (run_node_callback) идут ответы фоновых заданий ИИ.
 """
 
+import heapq
+import itertools
 import threading
+import time
 import re
 import logging
-from typing import Dict, Any, Callable
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Dict, Any, Callable, Optional
+
+from decouple import config
 
 from app.modules.timing_primitives.dynamic_pause import DynamicPause
 from app.modules.timing_primitives.temporal_action import TemporalAction
 
 TIMING_ENABLED = True
+TIMER_WORKERS = config("TIMER_WORKERS", default=8, cast=int)
+NODE_CALLBACK_WORKERS = config("NODE_CALLBACK_WORKERS", default=8, cast=int)
 logger = logging.getLogger(__name__)
 
+
+class TimerHandle:
+    """Запланированная задача TimerScheduler. Отмена — пометка O(1), удаление из кучи ленивое."""
+    __slots__ = ('when', 'seq', 'callback', 'args', 'cancelled', 'done', '_scheduler')
+
+    def __init__(self, when: float, seq: int, callback: Callable, args: tuple, scheduler: 'TimerScheduler'):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.done = False
+        self._scheduler = scheduler
+
+    def __lt__(self, other: 'TimerHandle') -> bool:
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self) -> bool:
+        return self._scheduler.cancel(self)
+
+
+class TimerScheduler:
+    """
+    Центральный планировщик таймеров.
+
+    Один поток спит до ближайшего срока в куче и передаёт сработавшие задачи
+    в пул исполнителей, поэтому тысячи ожидающих таймеров не держат тысячи потоков.
+    """
+
+    def __init__(self, workers: int = TIMER_WORKERS, name: str = "TimerScheduler"):
+        self.name = name
+        self.workers = max(1, int(workers))
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._live = 0
+        self._cancelled_in_heap = 0
+        self._stats = {'scheduled': 0, 'fired': 0, 'cancelled': 0, 'errors': 0}
+        self._jitter_total = 0.0
+        self._jitter_max = 0.0
+
+    # === Public API ===
+    def call_later(self, delay: float, callback: Callable, *args) -> TimerHandle:
+        return self.call_at(time.monotonic() + max(float(delay or 0), 0.0), callback, *args)
+
+    def call_soon(self, callback: Callable, *args) -> TimerHandle:
+        return self.call_later(0, callback, *args)
+
+    def call_at(self, when: float, callback: Callable, *args) -> TimerHandle:
+        """Планирует callback(*args) на момент when (шкала time.monotonic)."""
+        self._ensure_started()
+        with self._cond:
+            handle = TimerHandle(when, next(self._seq), callback, args, self)
+            heapq.heappush(self._heap, handle)
+            self._live += 1
+            self._stats['scheduled'] += 1
+            # Будим диспетчер, только если новая задача стала ближайшей
+            if self._heap[0] is handle:
+                self._cond.notify()
+        return handle
+
+    def cancel(self, handle: TimerHandle) -> bool:
+        with self._cond:
+            if handle.cancelled or handle.done:
+                return False
+            handle.cancelled = True
+            self._live -= 1
+            self._cancelled_in_heap += 1
+            self._stats['cancelled'] += 1
+            # Периодическое уплотнение кучи, чтобы отменённые задачи не копились
+            if self._cancelled_in_heap > 1024 and self._cancelled_in_heap * 2 > len(self._heap):
+                self._heap = [h for h in self._heap if not h.cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled_in_heap = 0
+            return True
+
+    def live_timers(self) -> int:
+        return self._live
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            fired = self._stats['fired']
+            return {
+                **self._stats,
+                'live': self._live,
+                'heap_size': len(self._heap),
+                'workers': self.workers,
+                'avg_jitter_ms': round(self._jitter_total / fired * 1000, 3) if fired else 0.0,
+                'max_jitter_ms': round(self._jitter_max * 1000, 3),
+            }
+
+    # --- internal ---
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"{self.name}Worker")
+            self._thread = threading.Thread(target=self._run, daemon=True, name=self.name)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    top = self._heap[0]
+                    if top.cancelled:
+                        heapq.heappop(self._heap)
+                        self._cancelled_in_heap -= 1
+                        continue
+                    delay = top.when - time.monotonic()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                    heapq.heappop(self._heap)
+                    top.done = True
+                    self._live -= 1
+                    break
+            self._executor.submit(self._fire, top)
+
+    def _fire(self, handle: TimerHandle):
+        jitter = time.monotonic() - handle.when
+        callback, args = handle.callback, handle.args
+        # Ссылки на замыкание освобождаем сразу после срабатывания
+        handle.callback, handle.args = None, ()
+        ok = True
+        try:
+            callback(*args)
+        except Exception as e:
+            ok = False
+            logger.error(f"[TimerScheduler] Ошибка в задаче таймера: {e}")
+        with self._cond:
+            self._stats['fired'] += 1
+            if not ok:
+                self._stats['errors'] += 1
+            self._jitter_total += jitter
+            if jitter > self._jitter_max:
+                self._jitter_max = jitter
+
+
+_timer_scheduler = TimerScheduler()
+
+
+def get_timer_scheduler() -> TimerScheduler:
+    """Общий планировщик таймеров процесса."""
+    return _timer_scheduler
+
+
 class TimingEngine:
     _instance = None
 
@@ -28,8 +203,16 @@ class TimingEngine:
         self.enabled = TIMING_ENABLED
         self.parsers = self._init_parsers()
         self.executors = self._init_executors()
+        self.scheduler = get_timer_scheduler()
         # Хранилище активных таймаутов по session_id
         self._active_timeouts: Dict[int, TemporalAction] = {}
+        # Их записи в active_timers (при ENABLE_PERSISTENCE_TIMERS)
+        self._timeout_timers: Dict[int, Any] = {}
+        self._resume_handler: Optional[Callable] = None
+        # Выполнение узлов, до которых дошли таймеры: runner(chat_id, callback) -> принято ли
+        self._node_runner: Optional[Callable[[Any, Callable], bool]] = None
+        self._node_executor: Optional[ThreadPoolExecutor] = None
+        self._node_lock = threading.Lock()
         self.initialized = True
 
     # === Parsers ===
@@ -64,7 +247,8 @@ class TimingEngine:
         pause = DynamicPause(
             bot=ctx.get('bot'), chat_id=ctx.get('chat_id'),
             duration=float(command['duration']), fill_type='progressbar',
-            message_text=command.get('process_name', 'Обработка')
+            message_text=command.get('process_name', 'Обработка'),
+            scheduler=self.scheduler
         )
         pause.execute(on_complete_callback=callback)
 
@@ -86,38 +270,155 @@ class TimingEngine:
                 self._active_timeouts[session_id].cancel()
             except Exception:
                 pass
+            self._complete_persisted(self._timeout_timers.pop(session_id, None), 'cancelled')
+        timer = ctx.get('_persisted_timer')
+        if session_id and timer is not None:
+            self._timeout_timers[session_id] = timer
         action = TemporalAction(
             bot=ctx.get('bot'), chat_id=ctx.get('chat_id'),
             duration=float(command['duration']), target_action=callback,
-            countdown_mode=True
+            countdown_mode=True, scheduler=self.scheduler
         )
         if session_id:
             self._active_timeouts[session_id] = action
         action.execute()
 
     # === Public API ===
-    def execute_timing(self, timing_config: str, callback: Callable, **context) -> None:
+    def parse_timing(self, timing_config: str) -> tuple:
+        """
+        Разбирает строку тайминга ('typing:3s:Анализ; timeout:15s') в кортеж команд.
+        Используется компилятором графа, чтобы не разбирать строку на каждом апдейте.
+        """
         if not (timing_config and isinstance(timing_config, str)):
-            callback(); return
+            return ()
+        commands = []
         for cmd in [c.strip() for c in timing_config.split(';') if c.strip()]:
+            parsed = None
             if cmd.startswith('typing:'):
                 parsed = self._parse_typing(cmd)
-                self._execute_typing(parsed, callback, **context) if parsed else callback()
             elif cmd.startswith('timeout:'):
                 parsed = self._parse_timeout(cmd)
-                self._execute_timeout(parsed, callback, **context) if parsed else callback()
             elif re.match(r'^\d+(?:\.\d+)?s?$', cmd):
-                duration = float(cmd.replace('s', ''))
-                threading.Timer(duration, callback).start()
+                parsed = {'type': 'pause', 'duration': float(cmd.replace('s', ''))}
+            # Нераспознанная команда — немедленный вызов callback
+            commands.append(MappingProxyType(parsed or {'type': 'immediate', 'source': cmd}))
+        return tuple(commands)
+
+    def execute_commands(self, commands: tuple, callback: Callable, **context) -> None:
+        """Выполняет заранее разобранные команды (результат parse_timing)."""
+        if not commands:
+            callback(); return
+        for command in commands:
+            ctype = command['type']
+            timer = self._persist(command, context)
+            cb = self._handoff(context.get('chat_id'), callback)
+            cb = cb if timer is None else self._completing(timer, cb)
+            if ctype == 'typing':
+                self._execute_typing(command, cb, **context)
+            elif ctype == 'timeout':
+                self._execute_timeout(command, cb, _persisted_timer=timer, **context)
+            elif ctype == 'pause':
+                self.scheduler.call_later(command['duration'], cb)
             else:
                 callback()
 
-    def process_timing(self, user_id: int, session_id: int, node_id: str, timing_config: str, callback: Callable, **context) -> None:
+    def execute_timing(self, timing_config, callback: Callable, **context) -> None:
+        if isinstance(timing_config, tuple):
+            commands = timing_config
+        else:
+            commands = self.parse_timing(timing_config)
+        self.execute_commands(commands, callback, **context)
+
+    def process_timing(self, user_id: int, session_id: int, node_id: str, timing_config, callback: Callable, **context) -> None:
         # Проброс session_id для управления отменой
         context = dict(context)
         context.setdefault('session_id', session_id)
+        context.setdefault('current_node_id', node_id)
         self.execute_timing(timing_config, callback, **context)
 
+    # === Node callbacks ===
+    def set_node_runner(self, runner: Optional[Callable[[Any, Callable], bool]]) -> None:
+        """runner(chat_id, callback) ставит узел в очередь чата; False — не принят (тогда пул узлов)."""
+        self._node_runner = runner
+
+    def run_node_callback(self, chat_id, callback: Callable) -> None:
+        """Передает узел, до которого дошел таймер, из исполнителя планировщика дальше."""
+        runner = self._node_runner
+        if runner is not None and chat_id is not None:
+            try:
+                if runner(chat_id, callback):
+                    return
+            except Exception as e:
+                logger.error(f"[TimingEngine] Ошибка передачи узла в очередь чата {chat_id}: {e}")
+        self._node_pool().submit(self._run_node_safely, callback)
+
+    def _handoff(self, chat_id, callback: Callable) -> Callable:
+        def run():
+            self.run_node_callback(chat_id, callback)
+        return run
+
+    def _node_pool(self) -> ThreadPoolExecutor:
+        if self._node_executor is None:
+            with self._node_lock:
+                if self._node_executor is None:
+                    self._node_executor = ThreadPoolExecutor(
+                        max_workers=max(1, NODE_CALLBACK_WORKERS), thread_name_prefix="NodeCallbackWorker")
+        return self._node_executor
+
+    @staticmethod
+    def _run_node_safely(callback: Callable):
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"[TimingEngine] Ошибка в узле после таймера: {e}")
+
+    # === Persistence ===
+    def _persist(self, command, context: dict):
+        """Регистрирует таймер узла в active_timers (пачками, см. timer_store)."""
+        if command['type'] not in ('typing', 'timeout', 'pause'):
+            return None
+        session_id = context.get('session_id') or context.get('session_reference')
+        node_id = context.get('current_node_id')
+        if not (session_id and node_id):
+            return None
+        from app.modules.timer_store import PersistedTimer, get_timer_store, persistence_enabled
+        if not persistence_enabled():
+            return None
+        timer = PersistedTimer.after(command['duration'], session_id, command['type'], node_id, {
+            'chat_id': context.get('chat_id'), 'user_id': context.get('telegram_user_id'),
+        })
+        return get_timer_store().add(timer)
+
+    def _completing(self, timer, callback: Callable) -> Callable:
+        def run():
+            self._complete_persisted(timer, 'executed')
+            callback()
+        return run
+
+    @staticmethod
+    def _complete_persisted(timer, status: str):
+        if timer is None:
+            return
+        from app.modules.timer_store import get_timer_store
+        get_timer_store().complete(timer, status)
+
+    def set_resume_handler(self, handler: Callable) -> None:
+        """handler(timer: PersistedTimer) выполняет узел восстановленного таймера."""
+        self._resume_handler = handler
+
+    def recover(self) -> Optional[dict]:
+        from app.modules.timer_store import get_timer_store, persistence_enabled
+        if not persistence_enabled():
+            return None
+        if self._resume_handler is None:
+            logger.error("[TimingEngine] Восстановление таймеров без обработчика возобновления")
+            return None
+        handler = self._resume_handler
+
+        def resume(timer):
+            self.run_node_callback((timer.data or {}).get('chat_id'), lambda: handler(timer))
+        return get_timer_store().recover(resume, self.scheduler)
+
     # === Cancel API ===
     def cancel_timeout(self, session_id: int) -> bool:
         action = self._active_timeouts.get(session_id)
@@ -126,6 +427,7 @@ class TimingEngine:
         try:
             action.cancel()
             del self._active_timeouts[session_id]
+            self._complete_persisted(self._timeout_timers.pop(session_id, None), 'cancelled')
             return True
         except Exception:
             return False
@@ -133,9 +435,30 @@ class TimingEngine:
 # Глобальные экспортируемые символы
 _timing_engine = TimingEngine()
 
-def process_node_timing(user_id: int, session_id: int, node_id: str, timing_config: str, callback: Callable, **context) -> None:
+def process_node_timing(user_id: int, session_id: int, node_id: str, timing_config, callback: Callable, **context) -> None:
+    """timing_config — строка DSL или кортеж команд из parse_timing_config()."""
     return _timing_engine.process_timing(user_id, session_id, node_id, timing_config, callback, **context)
 
 def cancel_timeout_for_session(session_id: int) -> bool:
     """Публичная функция отмены активного таймаута для сессии."""
     return _timing_engine.cancel_timeout(session_id)
+
+def parse_timing_config(timing_config: str) -> tuple:
+    """Публичная функция разбора строки тайминга в кортеж команд."""
+    return _timing_engine.parse_timing(timing_config)
+
+def set_timer_resume_handler(handler: Callable) -> None:
+    """Регистрирует обработчик восстановленных после рестарта таймеров."""
+    _timing_engine.set_resume_handler(handler)
+
+def set_node_callback_runner(runner: Optional[Callable[[Any, Callable], bool]]) -> None:
+    """Регистрирует передачу узлов после таймеров в очередь чата (диспетчер апдейтов)."""
+    _timing_engine.set_node_runner(runner)
+
+def run_node_callback(chat_id, callback: Callable) -> None:
+    """Выполняет продолжение узла из чужого потока (таймер, задание ИИ) в очереди чата или в пуле узлов."""
+    _timing_engine.run_node_callback(chat_id, callback)
+
+def recover_persistent_timers() -> Optional[dict]:
+    """Загружает pending-таймеры из active_timers и возвращает их в планировщик (при ENABLE_PERSISTENCE_TIMERS)."""
+    return _timing_engine.recover()
@@ -1,8 +1,11 @@
 # app/modules/timing_primitives/dynamic_pause.py
 # ВЕРСИЯ 2.0 (30.10.2025): Полная реализация визуальной паузы с прогресс-баром
+# ВЕРСИЯ 3.0: шаги паузы выполняются на общем TimerScheduler вместо отдельного потока
+# ВЕРСИЯ 3.1: правки прогресс-бара — косметические (низкий приоритет, схлопываются в очереди исходящих)
+# ВЕРСИЯ 3.2: отправка и удаление сообщения паузы не ждут очереди исходящих на исполнителе планировщика
+
+from app.modules.telegram_sender import call_nowait, edit_cosmetic
 
-import time
-import threading
 
 class DynamicPause:
     """
@@ -10,69 +13,92 @@ class DynamicPause:
     Поддерживаемые режимы:
     - silent: простая задержка без визуализации
     - progressbar: прогресс-бар 5 шагов с подписью
+
+    Каждый шаг паузы — отдельная задача общего TimerScheduler, поток на время паузы не занимается.
     """
-    def __init__(self, bot, chat_id: int, duration: float, fill_type: str = 'silent', message_text: str = "Обработка..."):
+    STEPS = 5
+
+    def __init__(self, bot, chat_id: int, duration: float, fill_type: str = 'silent', message_text: str = "Обработка...",
+                 scheduler=None):
         self.bot = bot
         self.chat_id = chat_id
         self.duration = float(duration or 0)
         self.fill_type = (fill_type or 'silent').lower()
         self.message_text = message_text or "Обработка..."
         self._on_complete = None
+        self._scheduler = scheduler
+        self._msg_id = None
+        self._step = 0
 
     def execute(self, on_complete_callback: callable):
         """Запустить паузу. Не блокирует основной поток."""
         self._on_complete = on_complete_callback
-        t = threading.Thread(target=self._run, daemon=True)
-        t.start()
+        if self._scheduler is None:
+            from app.modules.timing_engine import get_timer_scheduler
+            self._scheduler = get_timer_scheduler()
+        self._scheduler.call_soon(self._start)
 
     # --- internal ---
-    def _run(self):
-        try:
-            if self.fill_type == 'progressbar':
-                self._run_progress_bar()
-            else:
-                self._run_silent()
-        finally:
+    def _start(self):
+        if self.fill_type == 'progressbar' and self.bot and self.chat_id:
+            # Начальное сообщение: ждет очереди исходящих не на исполнителе, шаги — после отправки
             try:
-                if callable(self._on_complete):
-                    self._on_complete()
+                future = call_nowait(self.bot, "send_message", self.chat_id, f"⏳ {self.message_text}\n⬜️⬜️⬜️⬜️⬜️ 0%")
             except Exception:
-                pass
+                future = None
+            if future is not None:
+                future.add_done_callback(lambda f: self._scheduler.call_soon(self._started, f))
+                return
+        self._started(None)
 
-    def _run_silent(self):
-        time.sleep(self.duration)
+    def _started(self, future):
+        if future is not None and future.exception() is None:
+            self._msg_id = getattr(future.result(), 'message_id', None)
+        if self._msg_id is None:
+            self._scheduler.call_later(self.duration, self._finish)
+            return
+        self._scheduler.call_later(self._step_duration(), self._progress_step)
+
+    def _step_duration(self) -> float:
+        return max(self.duration / self.STEPS, 0.05)
 
-    def _run_progress_bar(self):
-        if not self.bot or not self.chat_id:
-            time.sleep(self.duration)
+    def _progress_step(self):
+        self._step += 1
+        steps = self.STEPS
+        percent = int(self._step * 100 / steps)
+        filled = "🟩" * self._step
+        empty = "⬜️" * (steps - self._step)
+        try:
+            edit_cosmetic(self.bot, chat_id=self.chat_id, message_id=self._msg_id,
+                          text=f"⏳ {self.message_text}\n{filled}{empty} {percent}%")
+        except Exception:
+            # Игнорируем ошибки редактирования (например, если сообщение уже удалено)
+            pass
+        if self._step < steps:
+            self._scheduler.call_later(self._step_duration(), self._progress_step)
             return
-        
-        # Начальное сообщение
+
+        # Финальная фиксация и мягкое удаление через секунду
         try:
-            msg = self.bot.send_message(self.chat_id, f"⏳ {self.message_text}\n⬜️⬜️⬜️⬜️⬜️ 0%")
+            edit_cosmetic(self.bot, chat_id=self.chat_id, message_id=self._msg_id,
+                          text=f"✅ {self.message_text}")
         except Exception:
-            time.sleep(self.duration)
+            self._finish()
             return
+        self._scheduler.call_later(1.0, self._cleanup)
 
-        steps = 5
-        step_duration = max(self.duration / steps, 0.05)
-        for i in range(1, steps + 1):
-            time.sleep(step_duration)
-            percent = int(i * 100 / steps)
-            filled = "🟩" * i
-            empty = "⬜️" * (steps - i)
-            try:
-                self.bot.edit_message_text(chat_id=self.chat_id, message_id=msg.message_id,
-                                           text=f"⏳ {self.message_text}\n{filled}{empty} {percent}%")
-            except Exception:
-                # Игнорируем ошибки редактирования (например, если сообщение уже удалено)
-                pass
-        
-        # Финальная фиксация и мягкое удаление
+    def _cleanup(self):
+        try:
+            future = call_nowait(self.bot, "delete_message", self.chat_id, self._msg_id)
+        except Exception:
+            self._finish()
+            return
+        # Следующий узел — после удаления, чтобы его сообщения шли за ним в очереди чата
+        future.add_done_callback(lambda f: self._scheduler.call_soon(self._finish))
+
+    def _finish(self):
         try:
-            self.bot.edit_message_text(chat_id=self.chat_id, message_id=msg.message_id,
-                                       text=f"✅ {self.message_text}")
-            time.sleep(1.0)
-            self.bot.delete_message(self.chat_id, msg.message_id)
+            if callable(self._on_complete):
+                self._on_complete()
         except Exception:
-            pass
\ No newline at end of file
+            pass
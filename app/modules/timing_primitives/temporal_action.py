@@ -1,10 +1,14 @@
 # app/modules/timing_primitives/temporal_action.py
 # ВЕРСИЯ 2.0 (31.10.2025): Расширенная поддержка triggermode + улучшенное логирование
+# ВЕРСИЯ 3.0: отсчёт и ожидание выполняются задачами общего TimerScheduler, отмена снимает задачу из очереди
+# ВЕРСИЯ 3.1: правки отсчёта — косметические (низкий приоритет, схлопываются в очереди исходящих)
+# ВЕРСИЯ 3.2: отправка и удаление сообщения отсчёта не ждут очереди исходящих на исполнителе планировщика
 
-import time
 import threading
 import logging
 
+from app.modules.telegram_sender import call_nowait, edit_cosmetic
+
 logger = logging.getLogger(__name__)
 
 class TemporalAction:
@@ -17,7 +21,7 @@ class TemporalAction:
     
     def __init__(self, bot, chat_id: int, duration: float, target_action: callable,
                  triggermode: str = 'beforeend', countdown_mode: bool = None, 
-                 countdown_text: str = "Осталось: {sec} сек"):
+                 countdown_text: str = "Осталось: {sec} сек", scheduler=None):
         """
         Инициализация TemporalAction.
         
@@ -29,6 +33,7 @@ class TemporalAction:
             triggermode: режим работы ('beforeend' или 'afterstart')
             countdown_mode: показывать ли обратный отсчет (если None, определяется по triggermode)
             countdown_text: шаблон текста для обратного отсчета
+            scheduler: TimerScheduler (по умолчанию — общий планировщик timing_engine)
         """
         self.bot = bot
         self.chat_id = chat_id
@@ -44,119 +49,157 @@ class TemporalAction:
             self.countdown_mode = countdown_mode
             
         self._cancel_event = threading.Event()
-        self._thread = None
+        self._lock = threading.Lock()
+        self._scheduler = scheduler
+        self._handle = None
+        self._on_complete = None
+        self._remaining = 0
         self._msg_id = None
         
         # Логирование создания объекта
         logger.info(f"[TemporalAction] Created: duration={self.duration}s, triggermode={self.triggermode}, countdown={self.countdown_mode}")
 
     def execute(self, on_complete_callback: callable = None):
-        """Запуск в отдельном потоке."""
+        """Запуск на планировщике таймеров. Не блокирует вызывающий поток."""
         logger.info(f"[TemporalAction] Starting execution: triggermode={self.triggermode}")
-        self._thread = threading.Thread(target=self._run, args=(on_complete_callback,), daemon=True)
-        self._thread.start()
+        if self._scheduler is None:
+            from app.modules.timing_engine import get_timer_scheduler
+            self._scheduler = get_timer_scheduler()
+        self._on_complete = on_complete_callback
+        self._schedule(0, self._start)
 
     def cancel(self):
         """Мягкая отмена счётчика."""
         logger.info(f"[TemporalAction] Cancel requested: triggermode={self.triggermode}")
-        self._cancel_event.set()
+        with self._lock:
+            if self._cancel_event.is_set():
+                return
+            self._cancel_event.set()
+            handle, self._handle = self._handle, None
+        if handle is not None and handle.cancel():
+            # Задача снята из очереди до срабатывания — уведомляем об отмене сами
+            if self.triggermode == 'beforeend':
+                self._scheduler.call_soon(self._notify_cancelled)
 
     # --- internal ---
-    def _run(self, on_complete_callback):
+    def _schedule(self, delay: float, fn: callable):
+        with self._lock:
+            if self._cancel_event.is_set():
+                return False
+            self._handle = self._scheduler.call_later(delay, fn)
+            return True
+
+    def _start(self):
         try:
             if self.triggermode == 'beforeend':
-                self._run_beforeend_mode(on_complete_callback)
+                self._start_beforeend_mode()
             elif self.triggermode == 'afterstart':
-                self._run_afterstart_mode(on_complete_callback)
+                logger.info(f"[TemporalAction] Running in 'afterstart' mode: {self.duration}s")
+                # Простое ожидание без визуального отсчета
+                self._schedule(self.duration, self._fire)
             else:
                 logger.error(f"[TemporalAction] Unknown triggermode: {self.triggermode}")
-                if on_complete_callback and callable(on_complete_callback):
-                    on_complete_callback()
+                if self._on_complete and callable(self._on_complete):
+                    self._on_complete()
         except Exception as e:
             logger.error(f"[TemporalAction] Runtime error: {e}")
 
-    def _run_beforeend_mode(self, on_complete_callback):
+    def _start_beforeend_mode(self):
         """Режим 'beforeend': таймаут с обратным отсчетом и возможностью отмены."""
         logger.info(f"[TemporalAction] Running in 'beforeend' mode: {self.duration}s")
-        
-        # Показываем обратный отсчет, если включен
+
+        # Показываем обратный отсчет, если включен; отсчет начинается после отправки сообщения,
+        # а ожидание очереди исходящих не занимает исполнителя планировщика
         if self.countdown_mode and self.bot and self.chat_id:
             try:
-                m = self.bot.send_message(self.chat_id, self.countdown_text.format(sec=self.duration))
-                self._msg_id = getattr(m, 'message_id', None)
-                logger.debug(f"[TemporalAction] Countdown message sent: msg_id={self._msg_id}")
+                future = call_nowait(self.bot, "send_message", self.chat_id,
+                                     self.countdown_text.format(sec=self.duration))
             except Exception as e:
+                future = None
                 logger.warning(f"[TemporalAction] Failed to send countdown message: {e}")
                 self.countdown_mode = False
-
-        # Обратный отсчет по секундам
-        for remaining in range(self.duration - 1, -1, -1):
-            if self._cancel_event.is_set():
-                logger.info(f"[TemporalAction] Cancelled during countdown at {remaining}s")
-                self._notify_cancelled()
+            if future is not None:
+                future.add_done_callback(lambda f: self._scheduler.call_soon(self._countdown_started, f))
                 return
-            
-            if self.countdown_mode and self._msg_id:
-                try:
-                    self.bot.edit_message_text(
-                        chat_id=self.chat_id,
-                        message_id=self._msg_id,
-                        text=self.countdown_text.format(sec=max(remaining, 0))
-                    )
-                except Exception as e:
-                    logger.debug(f"[TemporalAction] Failed to update countdown: {e}")
-            
-            time.sleep(1)
+        self._countdown_started(None)
 
-        # Проверяем отмену перед выполнением действия
+    def _countdown_started(self, future):
+        if future is not None:
+            try:
+                self._msg_id = getattr(future.result(), 'message_id', None)
+                logger.debug(f"[TemporalAction] Countdown message sent: msg_id={self._msg_id}")
+            except Exception as e:
+                logger.warning(f"[TemporalAction] Failed to send countdown message: {e}")
+                self.countdown_mode = False
+        # Отмена, пришедшая во время отправки, видна в первом шаге отсчета
+        self._remaining = self.duration
+        self._countdown_tick()
+
+    def _countdown_tick(self):
+        """Один шаг обратного отсчета; следующий шаг планируется через секунду."""
         if self._cancel_event.is_set():
-            logger.info(f"[TemporalAction] Cancelled just before action execution")
+            logger.info(f"[TemporalAction] Cancelled during countdown at {self._remaining}s")
             self._notify_cancelled()
             return
+        if self._remaining <= 0:
+            self._fire()
+            return
+        self._remaining -= 1
+        if self.countdown_mode and self._msg_id:
+            try:
+                edit_cosmetic(
+                    self.bot,
+                    chat_id=self.chat_id,
+                    message_id=self._msg_id,
+                    text=self.countdown_text.format(sec=max(self._remaining, 0))
+                )
+            except Exception as e:
+                logger.debug(f"[TemporalAction] Failed to update countdown: {e}")
+        if not self._schedule(1, self._countdown_tick):
+            # Отмена пришла во время выполнения шага
+            self._notify_cancelled()
 
-        # Выполняем целевое действие
-        logger.info(f"[TemporalAction] Executing target_action (beforeend mode)")
-        if callable(self.target_action):
-            self.target_action()
-
-        if on_complete_callback and callable(on_complete_callback):
-            on_complete_callback()
-
-    def _run_afterstart_mode(self, on_complete_callback):
-        """Режим 'afterstart': простое напоминание через заданное время."""
-        logger.info(f"[TemporalAction] Running in 'afterstart' mode: {self.duration}s")
-        
-        # Простое ожидание без визуального отсчета
-        for remaining in range(self.duration):
-            if self._cancel_event.is_set():
-                logger.info(f"[TemporalAction] Cancelled during sleep in 'afterstart' mode")
-                return
-            time.sleep(1)
-
-        # Проверяем отмену перед выполнением
+    def _fire(self):
+        # Проверяем отмену перед выполнением действия
         if self._cancel_event.is_set():
-            logger.info(f"[TemporalAction] Cancelled just before action execution (afterstart mode)")
+            logger.info(f"[TemporalAction] Cancelled just before action execution ({self.triggermode} mode)")
+            if self.triggermode == 'beforeend':
+                self._notify_cancelled()
             return
 
         # Выполняем целевое действие
-        logger.info(f"[TemporalAction] Executing target_action (afterstart mode)")
-        if callable(self.target_action):
-            self.target_action()
-
-        if on_complete_callback and callable(on_complete_callback):
-            on_complete_callback()
+        logger.info(f"[TemporalAction] Executing target_action ({self.triggermode} mode)")
+        try:
+            if callable(self.target_action):
+                self.target_action()
+            if self._on_complete and callable(self._on_complete):
+                self._on_complete()
+        except Exception as e:
+            logger.error(f"[TemporalAction] Runtime error: {e}")
 
     def _notify_cancelled(self):
         """Уведомление об отмене (только для режима beforeend)."""
         if self.countdown_mode and self._msg_id and self.bot:
             try:
-                self.bot.edit_message_text(
+                edit_cosmetic(
+                    self.bot,
                     chat_id=self.chat_id,
                     message_id=self._msg_id,
                     text="✅ Ответ получен, таймер отменен."
                 )
-                time.sleep(1)
-                self.bot.delete_message(self.chat_id, self._msg_id)
-                logger.info(f"[TemporalAction] Cancellation notification sent and cleaned up")
+                self._scheduler.call_later(1, self._delete_countdown_message)
             except Exception as e:
-                logger.debug(f"[TemporalAction] Failed to notify cancellation: {e}")
\ No newline at end of file
+                logger.debug(f"[TemporalAction] Failed to notify cancellation: {e}")
+
+    def _delete_countdown_message(self):
+        try:
+            call_nowait(self.bot, "delete_message", self.chat_id, self._msg_id).add_done_callback(self._log_deleted)
+        except Exception as e:
+            logger.debug(f"[TemporalAction] Failed to notify cancellation: {e}")
+
+    @staticmethod
+    def _log_deleted(future):
+        if future.exception() is None:
+            logger.info(f"[TemporalAction] Cancellation notification sent and cleaned up")
+        else:
+            logger.debug(f"[TemporalAction] Failed to notify cancellation: {future.exception()}")
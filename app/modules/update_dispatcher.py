@@ -0,0 +1,173 @@
+# app/modules/update_dispatcher.py
+"""
+Асинхронный приём обновлений Telegram.
+
+Webhook только валидирует апдейт и кладёт его в очередь конкретного чата,
+после чего сразу отвечает 200. Ограниченный пул воркеров разбирает очереди:
+внутри одного chat_id порядок FIFO сохраняется, разные чаты обрабатываются
+параллельно. Одновременно один чат обрабатывает не более одного воркера.
+"""
+
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Callable, Dict, Hashable, Optional
+
+# Результаты submit()
+ACCEPTED = "accepted"
+REJECTED = "rejected"   # общая очередь переполнена -> webhook отвечает 503, Telegram повторит доставку
+DROPPED = "dropped"     # переполнена очередь одного чата -> апдейт отбрасывается (защита от флуда)
+
+_STOP = object()
+
+
+def update_chat_key(update) -> Hashable:
+    """Возвращает ключ очереди для апдейта: chat_id, либо update_id для апдейтов без чата."""
+    for attr in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        msg = getattr(update, attr, None)
+        if msg is not None and getattr(msg, "chat", None) is not None:
+            return msg.chat.id
+    call = getattr(update, "callback_query", None)
+    if call is not None:
+        msg = getattr(call, "message", None)
+        if msg is not None and getattr(msg, "chat", None) is not None:
+            return msg.chat.id
+        return ("user", call.from_user.id)
+    return ("update", getattr(update, "update_id", None))
+
+
+class UpdateDispatcher:
+    """
+    Пул воркеров с упорядоченными очередями по чатам.
+
+    Args:
+        process_fn: функция обработки одного апдейта (вызывается в потоке воркера)
+        workers: количество воркеров
+        max_pending: максимальное число апдейтов во всех очередях (backpressure)
+        max_per_chat: максимальная длина очереди одного чата
+    """
+
+    def __init__(self, process_fn: Callable[[Any], None], workers: int = 8,
+                 max_pending: int = 10000, max_per_chat: int = 100,
+                 name: str = "UpdateWorker"):
+        self._process = process_fn
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.max_per_chat = max(1, int(max_per_chat))
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # Наличие ключа в словаре означает, что чат уже стоит в _ready или обрабатывается
+        self._queues: Dict[Hashable, deque] = {}
+        self._ready: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._pending = 0
+        self._busy = 0
+        self._threads = []
+        self._started = False
+        self._stats = {
+            "accepted": 0, "processed": 0, "errors": 0,
+            "rejected_full": 0, "dropped_chat_overflow": 0,
+            "max_pending_seen": 0,
+        }
+        self._wait_total = 0.0
+
+    # === Жизненный цикл ===
+    def start(self) -> "UpdateDispatcher":
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker_loop, daemon=True, name=f"{self.name}-{i}")
+            t.start()
+            self._threads.append(t)
+        print(f"[DISPATCHER] ✅ Запущено воркеров: {self.workers}, "
+              f"лимит очереди: {self.max_pending}, лимит на чат: {self.max_per_chat}")
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        """Останавливает воркеры после обработки уже принятых апдейтов."""
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0, timeout)
+        for _ in self._threads:
+            self._ready.put(_STOP)
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+        self._started = False
+
+    # === Приём ===
+    def submit(self, chat_key: Hashable, item: Any) -> str:
+        """Ставит апдейт в очередь чата. Не блокирует вызывающий поток."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._stats["rejected_full"] += 1
+                return REJECTED
+            q = self._queues.get(chat_key)
+            schedule = q is None
+            if schedule:
+                q = self._queues[chat_key] = deque()
+            elif len(q) >= self.max_per_chat:
+                self._stats["dropped_chat_overflow"] += 1
+                return DROPPED
+            q.append((time.monotonic(), item))
+            self._pending += 1
+            self._stats["accepted"] += 1
+            if self._pending > self._stats["max_pending_seen"]:
+                self._stats["max_pending_seen"] = self._pending
+        if schedule:
+            self._ready.put(chat_key)
+        return ACCEPTED
+
+    # === Метрики ===
+    def queue_depth(self) -> int:
+        return self._pending
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            processed = self._stats["processed"]
+            return {
+                **self._stats,
+                "pending": self._pending,
+                "active_chats": len(self._queues),
+                "busy_workers": self._busy,
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "max_per_chat": self.max_per_chat,
+                "avg_queue_wait_ms": round(self._wait_total / processed * 1000, 2) if processed else 0.0,
+            }
+
+    # --- internal ---
+    def _worker_loop(self):
+        while True:
+            chat_key = self._ready.get()
+            if chat_key is _STOP:
+                return
+            with self._lock:
+                enqueued_at, item = self._queues[chat_key].popleft()
+                self._busy += 1
+            wait = time.monotonic() - enqueued_at
+            ok = True
+            try:
+                self._process(item)
+            except Exception:
+                ok = False
+                traceback.print_exc()
+            with self._lock:
+                self._busy -= 1
+                self._pending -= 1
+                self._stats["processed"] += 1
+                self._wait_total += wait
+                if not ok:
+                    self._stats["errors"] += 1
+                reschedule = bool(self._queues[chat_key])
+                if not reschedule:
+                    del self._queues[chat_key]
+                if self._pending == 0:
+                    self._idle.notify_all()
+            if reschedule:
+                # Чат уходит в конец очереди готовых — честное чередование между чатами
+                self._ready.put(chat_key)
@@ -0,0 +1,44 @@
+# conftest.py
+# Общие фикстуры тестов: временная SQLite-база со схемой models (во временном каталоге pytest)
+
+import inspect
+import os
+import pathlib
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine
+
+from app.modules.database import models
+
+
+def create_sqlite_engine(directory):
+    """Файловая SQLite-база со всеми таблицами models в каталоге directory."""
+    engine = create_engine(f"sqlite:///{os.path.join(str(directory), 'test.db')}")
+    models.Base.metadata.create_all(bind=engine)
+    return engine
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path):
+    engine = create_sqlite_engine(tmp_path)
+    yield engine
+    engine.dispose()
+
+
+def run_test(test):
+    """Запуск теста из блока __main__: фикстуры sqlite_engine и tmp_path — во временном каталоге, который удаляется."""
+    parameters = inspect.signature(test).parameters
+    if not parameters:
+        return test()
+    with tempfile.TemporaryDirectory() as tmp:
+        kwargs = {}
+        if "tmp_path" in parameters:
+            kwargs["tmp_path"] = pathlib.Path(tmp)
+        if "sqlite_engine" in parameters:
+            kwargs["sqlite_engine"] = create_sqlite_engine(tmp)
+        try:
+            return test(**kwargs)
+        finally:
+            if "sqlite_engine" in kwargs:
+                kwargs["sqlite_engine"].dispose()
@@ -0,0 +1,97 @@
+# test_ai_cache.py
+# Тестирование кеша ответов проактивных узлов: отпечаток, TTL + LRU, single-flight
+
+from types import MappingProxyType, SimpleNamespace
+
+from app.modules import ai_cache
+from app.modules.ai_cache import HIT, JOINED, LEADER, ResponseCache, cache_key_for_node, fingerprint, parse_state_keys
+
+
+def _node(**raw):
+    options = [SimpleNamespace(text="Купить"), SimpleNamespace(text="Продать")]
+    return SimpleNamespace(ai_role="financial_advisor", ai_task="Оцени портфель", options=options,
+                           raw=MappingProxyType(raw))
+
+
+def test_fingerprint_buckets_state_and_per_node_switch():
+    """Близкие значения score попадают в одну корзину; узел может отключить кеш или задать свои ключи"""
+    keys = parse_state_keys("score:10000, risk")
+    assert keys == {"score": 10000.0, "risk": 0.0}
+    options = [{"text": "Купить"}, {"text": "Продать"}]
+    a = fingerprint("advisor", "Задача", options, {"score": "251000", "risk": "high", "other": 1}, keys)
+    b = fingerprint("advisor", "Задача", options, {"score": 259999, "risk": "high", "other": 2}, keys)
+    c = fingerprint("advisor", "Задача", options, {"score": 260000, "risk": "high"}, keys)
+    assert a == b and a != c
+    assert fingerprint("advisor", "Другая задача", options, {"score": 251000, "risk": "high"}, keys) != a
+
+    states = {"score": 255000}
+    original = (ai_cache.AI_CACHE_ENABLED, ai_cache.AI_CACHE_IN_COMPLIANCE)
+    try:
+        ai_cache.AI_CACHE_ENABLED, ai_cache.AI_CACHE_IN_COMPLIANCE = True, False
+        assert cache_key_for_node(_node(), states, compliance_mode=False) is not None
+        assert cache_key_for_node(_node(ai_cache=False), states, compliance_mode=False) is None
+        assert cache_key_for_node(_node(), states, compliance_mode=True) is None
+        own = cache_key_for_node(_node(ai_cache=["score:100000"]), states, compliance_mode=False)
+        assert own == cache_key_for_node(_node(ai_cache=["score:100000"]), {"score": 201000}, compliance_mode=False)
+        assert own != cache_key_for_node(_node(), {"score": 201000}, compliance_mode=False)
+
+        ai_cache.AI_CACHE_IN_COMPLIANCE = True
+        assert cache_key_for_node(_node(), states, compliance_mode=True) is not None
+        ai_cache.AI_CACHE_ENABLED = False
+        assert cache_key_for_node(_node(), states, compliance_mode=False) is None
+    finally:
+        ai_cache.AI_CACHE_ENABLED, ai_cache.AI_CACHE_IN_COMPLIANCE = original
+
+
+def test_ttl_and_lru_eviction():
+    """Записи истекают по TTL, при переполнении вытесняется давно не использованная; ошибки не кешируются"""
+    now = [0.0]
+    cache = ResponseCache(ttl=10, max_entries=2, clock=lambda: now[0])
+    cache.put("a", "ответ A")
+    cache.put("b", "ответ B")
+    assert cache.get("a") == "ответ A"      # a стала свежей
+    cache.put("c", "ответ C")               # вытесняется b
+    assert cache.get("b") is None and cache.get("a") == "ответ A" and cache.get("c") == "ответ C"
+
+    now[0] = 11
+    assert cache.get("a") is None
+    cache.put("d", "⚠️ Сервис ИИ временно недоступен")
+    cache.put("e", "")
+    assert cache.get("d") is None and cache.get("e") is None
+
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["expired"] == 1 and stats["entries"] == 1
+
+
+def test_single_flight_shares_one_generation():
+    """Одинаковые запросы во время генерации ждут ее; после — берут из кеша; при ошибке — свой запрос"""
+    cache = ResponseCache(ttl=60, max_entries=10)
+    generations, delivered, fallbacks = [], [], []
+
+    def start(complete):
+        generations.append(complete)
+
+    assert cache.single_flight("k", start, delivered.append) == LEADER
+    for _ in range(3):
+        assert cache.single_flight("k", start, delivered.append) == JOINED
+    assert len(generations) == 1 and delivered == []
+
+    generations[0]("общий ответ")
+    assert delivered == ["общий ответ"] * 4
+    assert cache.single_flight("k", start, delivered.append) == HIT
+    assert len(generations) == 1 and delivered[-1] == "общий ответ"
+
+    # Генерация лидера не удалась: ожидающие уходят в свой запрос, в кеш ничего не попадает
+    assert cache.single_flight("x", start, delivered.append) == LEADER
+    cache.single_flight("x", start, delivered.append, on_leader_failed=lambda: fallbacks.append("x"))
+    generations[1](None)
+    assert delivered[-1] is None and fallbacks == ["x"]
+    assert cache.get("x") is None and cache.stats()["inflight"] == 0
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ КЕША ОТВЕТОВ ИИ")
+    for test in (test_fingerprint_buckets_state_and_per_node_switch, test_ttl_and_lru_eviction,
+                 test_single_flight_shares_one_generation):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,137 @@
+# test_ai_context.py
+# Тестирование накопителя контекста ИИ: промпт без перечитывания истории сессии
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from app.modules.database import crud, models
+from app.modules.database.unit_of_work import unit_of_work
+
+
+def _make_factory(engine):
+    selects = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            selects.append(statement)
+
+    event.listen(engine, "before_cursor_execute", on_execute)
+    return sessionmaker(bind=engine), selects
+
+
+def _play(db, user_id, session_id, steps, start=0):
+    for i in range(start, start + steps):
+        node_id = "q_возраст" if i == 0 else f"step_{i}"
+        crud.create_response(db, session_id, node_id, node_text=f"Событие {i}", answer_text=f"Ответ {i}")
+        crud.bulk_update_user_states(db, user_id, session_id, {"score": i * 10, "coins": 5})
+
+
+def _prompts(db, user_id, session_id):
+    return (crud.build_full_context_for_ai(db, session_id, user_id, "Что делать?", [], ai_persona="financial_advisor"),
+            crud.build_full_context_for_ai(db, session_id, user_id, "Что делать?", [], ai_persona="game_master"))
+
+
+def test_incremental_context_matches_rebuild_without_queries(sqlite_engine):
+    """После первой загрузки промпт собирается из памяти и совпадает с пересборкой из БД"""
+    factory, selects = _make_factory(sqlite_engine)
+    crud.context_cache.clear()
+    db = factory()
+    user = crud.get_or_create_user(db, telegram_id=1)
+    session = crud.create_session(db, user_id=user.id, graph_id="test")
+    _play(db, user.id, session.id, 5)
+    _prompts(db, user.id, session.id)
+
+    _play(db, user.id, session.id, 50, start=5)
+    selects.clear()
+    advisor, persona = _prompts(db, user.id, session.id)
+    assert not [s for s in selects if "responses" in s or "user_states" in s]
+    assert "- Ответ 0" in advisor and "«Событие 54»" in advisor and advisor.count("Решение игрока") == 54
+    assert "Событие 52 → Ответ 52" in persona and "Событие 51 →" not in persona
+    # Живой накопитель видит предыдущее значение (в user_states — одна строка на переменную)
+    assert "current=540; previous=530; delta=+10" in advisor and "действие: «Событие 54 — Ответ 54»" in advisor
+
+    crud.context_cache.clear()
+    assert _prompts(db, user.id, session.id) == (advisor, persona)
+    db.close()
+
+
+def test_state_history_survives_cache_loss(sqlite_engine):
+    """previous/delta/total считаются от начала сессии — и в живом накопителе, и после пересборки"""
+    factory, _ = _make_factory(sqlite_engine)
+    crud.context_cache.clear()
+    db = factory()
+    user = crud.get_or_create_user(db, telegram_id=3)
+    session = crud.create_session(db, user_id=user.id, graph_id="test")
+    crud.create_response(db, session.id, "step_1", node_text="Событие", answer_text="Ответ")
+    crud.bulk_update_user_states(db, user.id, session.id, {"score": 0})
+    crud.update_user_state(db, user.id, session.id, "score", 100)
+    # Накопитель загружается посреди сессии
+    _prompts(db, user.id, session.id)
+    crud.bulk_update_user_states(db, user.id, session.id, {"score": 250})
+    live = _prompts(db, user.id, session.id)
+    assert "current=250; previous=100; delta=+150" in live[0] and "total=+250" in live[0]
+
+    crud.context_cache.clear()
+    assert _prompts(db, user.id, session.id) == live
+    db.close()
+
+
+def test_rollback_invalidates_and_rebuilds(sqlite_engine):
+    """Откат апдейта сбрасывает накопитель — откатившиеся ответы не попадают в промпт"""
+    factory, _ = _make_factory(sqlite_engine)
+    crud.context_cache.clear()
+    with unit_of_work(factory) as db:
+        user_id = crud.get_or_create_user(db, telegram_id=2).id
+        session_id = crud.create_session(db, user_id=user_id, graph_id="test").id
+        _play(db, user_id, session_id, 3)
+        _prompts(db, user_id, session_id)
+    try:
+        with unit_of_work(factory) as db:
+            crud.create_response(db, session_id, "step_x", node_text="Фантом", answer_text="Откат")
+            assert "Фантом" in _prompts(db, user_id, session_id)[0]
+            raise RuntimeError("сбой апдейта")
+    except RuntimeError:
+        pass
+    assert crud.context_cache.stats()["sessions"] == 0
+    with unit_of_work(factory) as db:
+        advisor, _ = _prompts(db, user_id, session_id)
+        assert "Фантом" not in advisor and "«Событие 2»" in advisor
+        crud.end_session(db, session_id)
+    assert crud.context_cache.stats()["sessions"] == 0
+
+
+def test_deferred_states_reach_prompt_without_flush(sqlite_engine):
+    """batched/on_end: изменения из кеша состояния попадают в промпт, а user_states не пишется"""
+    factory, _ = _make_factory(sqlite_engine)
+    crud.context_cache.clear()
+    saved = crud.state_cache
+    db = factory()
+    try:
+        for mode in ("batched", "on_end"):
+            crud.state_cache = crud.SessionStateCache(mode=mode, flush_interval=3600)
+            user = crud.get_or_create_user(db, telegram_id=mode)
+            session = crud.create_session(db, user_id=user.id, graph_id="test")
+            crud.create_response(db, session.id, "step_1", node_text="Событие", answer_text="Ответ")
+            crud.update_session_states(db, user.id, session.id, {"score": 100})
+            # Накопитель еще не загружен: пересборка из БД дописывает несброшенные изменения
+            assert "current=100" in _prompts(db, user.id, session.id)[0]
+            crud.update_session_states(db, user.id, session.id, {"score": 250})
+            advisor = crud.context_after_choice(db, user.id, session.id, "step_2", "Событие 2", "Ответ 2", {})
+            assert "current=250; previous=100; delta=+150" in crud.build_universal_state_summary(
+                db, user.id, session.id, advisor)
+            assert "current=250; previous=100" in _prompts(db, user.id, session.id)[0]
+            assert db.query(models.UserState).filter(models.UserState.session_id == session.id).count() == 0
+            assert crud.state_cache.stats()["dirty_keys"] == 1
+    finally:
+        crud.state_cache = saved
+        db.close()
+
+
+if __name__ == "__main__":
+    from conftest import run_test
+
+    print("🚀 ТЕСТИРОВАНИЕ НАКОПИТЕЛЯ КОНТЕКСТА ИИ")
+    for test in (test_incremental_context_matches_rebuild_without_queries, test_state_history_survives_cache_loss,
+                 test_rollback_invalidates_and_rebuilds, test_deferred_states_reach_prompt_without_flush):
+        run_test(test)
+        print(f"✅ {test.__name__}")
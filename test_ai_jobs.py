@@ -0,0 +1,103 @@
+# test_ai_jobs.py
+# Тестирование фоновых заданий ИИ: лимиты по бэкендам, очередь, отмена по сессии
+
+import threading
+import time
+
+from app.modules.ai_jobs import CANCELLED, DONE, REJECTED, AIJobExecutor
+
+
+def test_per_backend_limits_and_queue_metric():
+    """Одновременно к бэкенду идет не больше limit запросов; очередь видна в метриках"""
+    executor = AIJobExecutor(limits={"gigachat": 2, "vsegpt": 3}, max_queue=100)
+    lock = threading.Lock()
+    running = {"gigachat": 0, "vsegpt": 0}
+    peak = {"gigachat": 0, "vsegpt": 0}
+    release = threading.Event()
+    done = []
+
+    def make_work(backend):
+        def work(cancel_event):
+            with lock:
+                running[backend] += 1
+                peak[backend] = max(peak[backend], running[backend])
+            release.wait(5)
+            time.sleep(0.01)
+            with lock:
+                running[backend] -= 1
+            return backend
+        return work
+
+    for i in range(10):
+        executor.submit("gigachat", i, make_work("gigachat"), done.append)
+        executor.submit("vsegpt", 100 + i, make_work("vsegpt"), done.append)
+    time.sleep(0.1)
+    stats = executor.stats()
+    assert stats["backends"]["gigachat"]["running"] == 2 and stats["backends"]["gigachat"]["queued"] == 8
+    assert stats["backends"]["vsegpt"]["running"] == 3 and executor.queue_length("vsegpt") == 7
+    assert executor.queue_length() == 15
+
+    release.set()
+    assert executor.join(5)
+    assert peak == {"gigachat": 2, "vsegpt": 3}
+    assert len(done) == 20 and all(job.status == DONE for job in done)
+    assert executor.stats()["completed"] == 20 and executor.queue_length() == 0
+
+
+def test_submit_does_not_block_and_rejects_when_full():
+    """submit возвращается сразу; сверх max_queue задание отклоняется с вызовом on_done"""
+    executor = AIJobExecutor(limits={"gigachat": 1}, max_queue=2)
+    gate, started = threading.Event(), threading.Event()
+    results = []
+
+    def work(cancel_event):
+        started.set()
+        return gate.wait(5) and "ok"
+
+    t0 = time.monotonic()
+    executor.submit("gigachat", 1, work, results.append)
+    assert started.wait(5)
+    for i in range(3):
+        executor.submit("gigachat", 1, work, results.append)
+    assert time.monotonic() - t0 < 0.5
+
+    rejected = [job for job in results if job.status == REJECTED]
+    assert len(rejected) == 1 and executor.stats()["rejected"] == 1
+    gate.set()
+    assert executor.join(5)
+    assert sorted(job.status for job in results) == [DONE, DONE, DONE, REJECTED]
+
+
+def test_cancel_session_drops_queued_and_interrupts_running():
+    """Конец сессии снимает ее задания; результат выполняющегося отбрасывается"""
+    executor = AIJobExecutor(limits={"vsegpt": 1}, max_queue=10)
+    started = threading.Event()
+    done, cancelled = [], []
+
+    def slow(cancel_event):
+        started.set()
+        # Как пауза между повторами в get_ai_response: прерывается отменой
+        return "прервано" if cancel_event.wait(5) else "ответ"
+
+    running = executor.submit("vsegpt", 7, slow, done.append, cancelled.append)
+    queued = executor.submit("vsegpt", 7, slow, done.append, cancelled.append)
+    other = executor.submit("vsegpt", 8, lambda cancel: "чужой", done.append, cancelled.append)
+    assert started.wait(5)
+
+    t0 = time.monotonic()
+    assert executor.cancel_session(7) == 2
+    assert executor.join(5)
+    assert time.monotonic() - t0 < 1
+    assert running.status == CANCELLED and queued.status == CANCELLED
+    assert sorted(job.job_id for job in cancelled) == [running.job_id, queued.job_id]
+    assert done == [other] and other.result == "чужой"
+    assert executor.cancel_session(7) == 0
+    assert executor.stats()["cancelled"] == 2
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ ФОНОВЫХ ЗАДАНИЙ ИИ")
+    for test in (test_per_backend_limits_and_queue_metric, test_submit_does_not_block_and_rejects_when_full,
+                 test_cancel_session_drops_queued_and_interrupts_running):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,99 @@
+# test_ai_prefetch.py
+# Тестирование предвыборки проактивных узлов: прогноз узла, совпадение промпта, лимит расхода графа
+
+from types import SimpleNamespace
+
+from app.modules.ai_prefetch import Prefetcher
+from app.modules.graph_compiler import compile_graph
+from app.modules.node_logic import option_changes, option_next, predict_arrival
+
+
+def _graph():
+    return compile_graph({"graph_id": "g", "start_node_id": "q", "nodes": {
+        "q": {"type": "question", "text": "Куда?", "options": [
+            {"text": "Вклад", "next_node_id": "c", "formula": "score = score + 1000"},
+            {"text": "Акции", "next_node_id": "p2"},
+            {"text": "Наугад", "next_node_id": "r"}]},
+        "c": {"type": "condition", "text": "{score} > 500", "then_node_id": "p1", "else_node_id": "p2"},
+        "r": {"type": "randomizer", "branches": [{"next_node_id": "p1"}, {"next_node_id": "p2"}]},
+        "p1": {"type": "ai_proactive:master(\"Оцени вклад\")", "text": "?"},
+        "p2": {"type": "ai_proactive:master(\"Оцени акции\")", "text": "?"},
+    }})
+
+
+class FakeJob(SimpleNamespace):
+    pass
+
+
+def test_predict_arrival_follows_condition_with_new_state():
+    """Прогноз учитывает формулу варианта; исход рандомизатора не предсказывается"""
+    graph = _graph()
+    node = graph.get("q")
+    states = {"score": 0}
+    targets = []
+    for option in node.options:
+        changes = option_changes(option, states)
+        target = predict_arrival(graph, option_next(node, option), {**states, **changes})
+        targets.append(target.id if target else None)
+    assert targets == ["p1", "p2", None]
+    assert predict_arrival(graph, "c", {"score": 0}).id == "p2"
+
+
+def test_claim_uses_matching_prompt_and_drops_others():
+    """Совпавший промпт — ответ из предвыборки; остальные снимаются и считаются лишними"""
+    now = [0.0]
+    cancelled = []
+    prefetcher = Prefetcher(max_inflight=10, tokens_per_hour=0, cancel_job=cancelled.append, clock=lambda: now[0])
+    jobs = {}
+
+    def submit_for(name):
+        def submit(on_done, on_cancel):
+            jobs[name] = job = FakeJob(started_at=0.0, on_done=on_done, on_cancel=on_cancel)
+            return job
+        return submit
+
+    assert prefetcher.start("g", 1, "q", "Вклад", "p1", "промпт p1", submit_for("p1"))
+    assert prefetcher.start("g", 1, "q", "Акции", "p2", "промпт p2", submit_for("p2"))
+    now[0] = 2.0
+    jobs["p1"].on_done(FakeJob(ok=True, result="совет по вкладу"))
+
+    prefetcher.choose(1, "q", "Вклад")
+    assert cancelled == [jobs["p2"]]
+    now[0] = 5.0
+    entry = prefetcher.claim(1, "p1", lambda: "промпт p1")
+    assert entry is not None
+    delivered = []
+    prefetcher.when_ready(entry, delivered.append)
+    assert delivered == ["совет по вкладу"]
+
+    # Промпт изменился (например, состояние поменял таймер) — предвыборка не используется
+    assert prefetcher.start("g", 2, "q", "Вклад", "p1", "старый промпт", submit_for("p3"))
+    assert prefetcher.claim(2, "p1", lambda: "новый промпт") is None
+    stats = prefetcher.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["saved_seconds"] == 2.0
+    assert stats["wasted"] == 2 and stats["pending"] == 0
+
+
+def test_per_graph_spend_cap():
+    """Лимиты одновременных предвыборок и токенов в час считаются по графу"""
+    prefetcher = Prefetcher(max_inflight=2, tokens_per_hour=0)
+    submit = lambda on_done, on_cancel: FakeJob(started_at=None)
+    assert prefetcher.start("g", 1, "q", "a", "p1", "x", submit)
+    assert prefetcher.start("g", 2, "q", "a", "p1", "x", submit)
+    assert not prefetcher.start("g", 3, "q", "a", "p1", "x", submit)
+    assert prefetcher.start("other", 3, "q", "a", "p1", "x", submit)
+
+    now = [0.0]
+    budgeted = Prefetcher(max_inflight=100, tokens_per_hour=50, clock=lambda: now[0])
+    long_prompt = "слово " * 40      # ~97 ток.
+    assert not budgeted.start("g", 1, "q", "a", "p1", long_prompt, submit)
+    assert budgeted.start("g", 1, "q", "a", "p1", "коротко", submit)
+    assert budgeted.stats()["skipped_cap"] == 1
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ ПРЕДВЫБОРКИ ИИ")
+    for test in (test_predict_arrival_follows_condition_with_new_state, test_claim_uses_matching_prompt_and_drops_others,
+                 test_per_graph_spend_cap):
+        test()
+        print(f"✅ {test.__name__}")
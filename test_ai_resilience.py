@@ -0,0 +1,100 @@
+# test_ai_resilience.py
+# Тестирование предохранителя моделей и дублирующих запросов (hedging)
+
+import threading
+import time
+
+from app.modules import ai_resilience
+from app.modules.ai_resilience import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, call_with_breaker, get_breaker, hedged_call
+)
+
+
+def test_breaker_opens_fails_fast_and_recovers():
+    """N ошибок подряд размыкают цепь; через reset_timeout — один пробный запрос"""
+    now = [0.0]
+    breaker = CircuitBreaker("test-model", failure_threshold=3, reset_timeout=30, clock=lambda: now[0])
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow()
+
+    now[0] = 31
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow() and not breaker.allow()     # только один пробный
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+    now[0] = 62
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.allow()
+    stats = breaker.stats()
+    assert stats["opened"] == 2 and stats["rejected"] == 2 and stats["consecutive_failures"] == 0
+
+
+def test_call_with_breaker_rejects_without_calling():
+    """Разомкнутый предохранитель отказывает сразу, не обращаясь к модели"""
+    name = "test-down-model"
+    calls = []
+
+    def failing():
+        calls.append(1)
+        raise ConnectionError("connection refused")
+
+    for _ in range(ai_resilience.AI_BREAKER_FAILURES):
+        try:
+            call_with_breaker(name, failing)
+        except ConnectionError:
+            pass
+    assert get_breaker(name).state == OPEN
+    t0 = time.monotonic()
+    try:
+        call_with_breaker(name, failing)
+        assert False, "ожидался CircuitOpenError"
+    except CircuitOpenError:
+        pass
+    assert time.monotonic() - t0 < 0.1 and len(calls) == ai_resilience.AI_BREAKER_FAILURES
+
+
+def test_hedged_call_takes_first_answer():
+    """Медленная основная модель: через delay уходит дубль, берется первый ответ; быстрая — без дубля"""
+    release = threading.Event()
+
+    def slow():
+        release.wait(5)
+        return "основная"
+
+    before = ai_resilience.resilience_stats()["hedging"]
+    t0 = time.monotonic()
+    assert hedged_call("test-slow", slow, "test-hedge", lambda: "дубль", delay=0.05) == "дубль"
+    assert time.monotonic() - t0 < 1
+    release.set()
+
+    calls = []
+    assert hedged_call("test-fast", lambda: "быстро", "test-hedge", lambda: calls.append(1), delay=1) == "быстро"
+    assert calls == []
+
+    # Дубль упал — ждем основную
+    def late():
+        time.sleep(0.1)
+        return "поздно, но верно"
+
+    def broken():
+        raise TimeoutError("timeout")
+
+    assert hedged_call("test-late", late, "test-hedge-broken", broken, delay=0.01) == "поздно, но верно"
+
+    after = ai_resilience.resilience_stats()["hedging"]
+    assert after["calls"] - before["calls"] == 3 and after["hedged"] - before["hedged"] == 2
+    assert after["hedge_wins"] - before["hedge_wins"] == 1 and after["primary_wins"] - before["primary_wins"] == 1
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ ПРЕДОХРАНИТЕЛЯ И HEDGING")
+    for test in (test_breaker_opens_fails_fast_and_recovers, test_call_with_breaker_rejects_without_calling,
+                 test_hedged_call_takes_first_answer):
+        test()
+        print(f"✅ {test.__name__}")
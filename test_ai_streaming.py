@@ -0,0 +1,147 @@
+# test_ai_streaming.py
+# Тестирование потоковых ответов ИИ на локальном фейковом SSE-сервере (OpenAI-совместимый и GigaChat)
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+from gigachat import GigaChat
+from gigachat.models import Chat, Messages, MessagesRole
+
+from app.modules.ai_streaming import (
+    EditThrottle, StreamingMessage, collect_stream, gigachat_deltas, openai_deltas,
+)
+
+CHUNKS = ["Добро ", "пожаловать ", "в ", "игру, ", "капитан!"]
+FIRST_CHUNK_DELAY = 0.1
+CHUNK_INTERVAL = 0.15
+
+
+class _FakeLLMHandler(BaseHTTPRequestHandler):
+    """POST .../chat/completions со stream=true: чанки SSE с паузами, как у живой модели."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions") or not body.get("stream"):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        time.sleep(FIRST_CHUNK_DELAY)
+        for i, piece in enumerate(CHUNKS):
+            if i:
+                time.sleep(CHUNK_INTERVAL)
+            chunk = {"id": "fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model", "fake"),
+                     "choices": [{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeLLMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class RecordingBot:
+    def __init__(self):
+        self.edits = []
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.edits.append((time.monotonic(), chat_id, text))
+
+
+def _timed(deltas):
+    t0 = time.monotonic()
+    seen = []
+    text = collect_stream(deltas, lambda acc: seen.append((time.monotonic() - t0, acc)), None, "fake")
+    return text, seen
+
+
+def test_openai_compatible_stream_first_token_latency():
+    """VseGPT-клиент: первый фрагмент — через задержку первого чанка, а не всего ответа"""
+    server, url = _start_server()
+    try:
+        client = openai.OpenAI(api_key="test", base_url=f"{url}/v1")
+        messages = [{"role": "system", "content": "роль"}, {"role": "user", "content": "привет"}]
+        text, seen = _timed(openai_deltas(client, "fake-model", messages, 0.6))
+    finally:
+        server.shutdown()
+    total = FIRST_CHUNK_DELAY + CHUNK_INTERVAL * (len(CHUNKS) - 1)
+    assert text == "".join(CHUNKS)
+    assert len(seen) == len(CHUNKS) and seen[-1][1] == text
+    assert seen[0][0] < total / 2
+    assert seen[-1][0] >= total * 0.9
+
+
+def test_gigachat_stream():
+    """GigaChat.stream читает тот же SSE-поток"""
+    server, url = _start_server()
+    try:
+        client = GigaChat(base_url=url, access_token="test", verify_ssl_certs=False)
+        chat = Chat(messages=[Messages(role=MessagesRole.USER, content="привет")], model="GigaChat-2-Pro")
+        text, seen = _timed(gigachat_deltas(client, chat))
+    finally:
+        server.shutdown()
+    assert text == "".join(CHUNKS)
+    assert seen[0][0] < FIRST_CHUNK_DELAY + CHUNK_INTERVAL
+
+
+def test_progressive_edits_are_throttled_per_chat():
+    """Правки заглушки: первая — сразу после первого фрагмента, дальше не чаще interval на чат"""
+    server, url = _start_server()
+    bot = RecordingBot()
+    throttle = EditThrottle(interval=0.3)
+    # Клиент создается заранее: задержка первой правки — только от потока, без настройки клиента
+    client = openai.OpenAI(api_key="test", base_url=f"{url}/v1")
+    message = StreamingMessage(bot, chat_id=1, message_id=10, header="🎭 Мастер:\n", throttle=throttle)
+    try:
+        text = collect_stream(openai_deltas(client, "fake-model", [{"role": "user", "content": "?"}], 0.6),
+                              message.update, None, "fake")
+        # Сразу после потока, до shutdown (он может занять больше interval)
+        same_chat_allowed, other_chat_allowed = throttle.allow(1), throttle.allow(2)
+    finally:
+        server.shutdown()
+    assert text == "".join(CHUNKS)
+    assert 2 <= message.edits < len(CHUNKS) and message.skipped >= 1
+    assert message.first_edit_latency < FIRST_CHUNK_DELAY + CHUNK_INTERVAL
+    gaps = [b[0] - a[0] for a, b in zip(bot.edits, bot.edits[1:])]
+    assert min(gaps) >= 0.29
+    assert all(text.startswith("🎭 Мастер:\n") and text.endswith("▌") for _, _, text in bot.edits)
+    # Второй поток в том же чате делит тот же лимит
+    assert not same_chat_allowed and other_chat_allowed
+
+
+def test_broken_stream_keeps_received_text():
+    """Обрыв после первых фрагментов не превращается в ошибку"""
+    def deltas():
+        yield "Начало "
+        yield "ответа"
+        raise ConnectionError("connection reset")
+
+    assert collect_stream(deltas(), lambda text: None, None) == "Начало ответа"
+    cancel = threading.Event()
+    cancel.set()
+    assert collect_stream(iter(["а", "б", "в"]), lambda text: None, cancel) == "а"
+    try:
+        collect_stream(iter([]), lambda text: None, None)
+        assert False, "пустой поток должен быть ошибкой"
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ ПОТОКОВЫХ ОТВЕТОВ ИИ")
+    for test in (test_openai_compatible_stream_first_token_latency, test_gigachat_stream,
+                 test_progressive_edits_are_throttled_per_chat, test_broken_stream_keeps_received_text):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,188 @@
+# test_analytics.py
+# Тестирование агрегатов аналитики: инкрементальные проходы по курсорам совпадают с полным пересчетом
+
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.orm import sessionmaker
+
+from app.modules.database import models
+from app.modules.database.analytics import (
+    AnalyticsRefresher, choice_distribution, dwell_histogram, funnel, node_dropoff, rebuild_analytics,
+    refresh_analytics,
+)
+
+T0 = datetime(2026, 3, 1, 9, 0, tzinfo=timezone.utc)
+
+
+def _session(db, user_id, graph_id="g", start=T0):
+    session = models.Session(user_id=user_id, graph_id=graph_id, start_time=start)
+    db.add(session)
+    db.flush()
+    return session
+
+
+def _answer(db, session, node_id, answer_text, at):
+    db.add(models.Response(session_id=session.id, node_id=node_id, node_text="?", answer_text=answer_text,
+                           timestamp=at))
+
+
+def test_aggregates_follow_new_rows(sqlite_engine):
+    """Выборы, воронка, отвалы и время на узле; второй проход учитывает только новое"""
+    factory = sessionmaker(bind=sqlite_engine)
+    db = factory()
+    user = models.User(telegram_id="1")
+    db.add(user)
+    db.flush()
+    a, b = _session(db, user.id), _session(db, user.id)
+    _answer(db, a, "q1", "Да", T0 + timedelta(seconds=3))
+    _answer(db, a, "q2", "Рискнуть", T0 + timedelta(seconds=40))
+    _answer(db, b, "q1", "Нет", T0 + timedelta(seconds=15))
+    db.commit()
+
+    assert refresh_analytics(factory, settle_seconds=0)["responses"] == 3
+    assert [(r["node_id"], r["answer_text"], r["count"], r["share"]) for r in choice_distribution(db, "g")] == [
+        ("q1", "Да", 1, 0.5), ("q1", "Нет", 1, 0.5), ("q2", "Рискнуть", 1, 1.0)]
+    result = funnel(db, "g")
+    assert result["sessions"] == 2 and result["completed"] == 0
+    assert [(s["step"], s["sessions"]) for s in result["steps"]] == [(0, 2), (1, 2), (2, 1)]
+    # a стоит после q2, b — после q1
+    assert {r["node_id"]: r["dropoffs"] for r in node_dropoff(db, "g")} == {"q1": 1, "q2": 1}
+    dwell = dwell_histogram(db, "g", "q1")
+    assert dwell["count"] == 2 and dwell["mean_seconds"] == 9.0
+    assert [b["count"] for b in dwell["buckets"] if b["count"]] == [1, 1]   # 2–5 с и 10–20 с
+
+    # Завершение a и новый ответ b: только дельта
+    db.get(models.Session, a.id).end_time = T0 + timedelta(minutes=1)
+    _answer(db, b, "q2", "Подождать", T0 + timedelta(seconds=75))
+    db.commit()
+    assert refresh_analytics(factory, settle_seconds=0) | {"ms": 0} == {
+        "sessions": 0, "responses": 1, "completions": 1, "ms": 0}
+    assert refresh_analytics(factory, settle_seconds=0)["responses"] == 0
+    result = funnel(db, "g")
+    assert result["completed"] == 1 and result["completion_rate"] == 0.5 and result["steps"][2]["sessions"] == 2
+    assert {r["node_id"]: r["dropoffs"] for r in node_dropoff(db, "g")} == {"q1": 0, "q2": 1}
+    assert dwell_histogram(db, "g", "q2")["mean_seconds"] == 48.5
+    db.close()
+
+
+def test_fresh_rows_wait_for_settle(sqlite_engine):
+    """Строки моложе ANALYTICS_SETTLE_SECONDS не учитываются и не теряются"""
+    factory = sessionmaker(bind=sqlite_engine)
+    db = factory()
+    user = models.User(telegram_id="1")
+    db.add(user)
+    db.flush()
+    now = datetime.now(timezone.utc)
+    session = _session(db, user.id, start=now - timedelta(minutes=5))
+    _answer(db, session, "q1", "Да", now - timedelta(minutes=4))
+    _answer(db, session, "q2", "Нет", now)
+    db.commit()
+    assert refresh_analytics(factory, settle_seconds=60)["responses"] == 1
+    assert refresh_analytics(factory, settle_seconds=0)["responses"] == 1
+    assert funnel(db, "g")["responses"] == 2
+    db.close()
+
+
+def test_late_commit_with_lower_id_is_counted(sqlite_engine):
+    """Меньший id, зафиксированный после учтенного большего (апдейт ждал отправки), не теряется"""
+    factory = sessionmaker(bind=sqlite_engine)
+    db = factory()
+    user = models.User(telegram_id="1")
+    db.add(user)
+    db.flush()
+    now = datetime.now(timezone.utc)
+    session = _session(db, user.id, start=now - timedelta(minutes=5))
+    db.commit()
+    # Апдейт A начался 30 с назад и получил id 5, но висит на отправке; апдейт B (id 6) уже зафиксирован
+    db.add(models.Response(id=6, session_id=session.id, node_id="q2", node_text="?", answer_text="Нет",
+                           timestamp=now - timedelta(seconds=20)))
+    db.commit()
+    assert refresh_analytics(factory)["responses"] == 0
+    db.add(models.Response(id=5, session_id=session.id, node_id="q1", node_text="?", answer_text="Да",
+                           timestamp=now - timedelta(seconds=30)))
+    db.commit()
+    assert refresh_analytics(factory, settle_seconds=0)["responses"] == 2
+    assert [(r["node_id"], r["count"]) for r in choice_distribution(db, "g")] == [("q1", 1), ("q2", 1)]
+    db.close()
+
+
+def _expected(db):
+    """Эталон — полный пересчет по сырым таблицам."""
+    choices, dropoffs, steps = Counter(), Counter(), Counter()
+    for session in db.query(models.Session).all():
+        answers = sorted(session.responses, key=lambda r: r.id)
+        steps.update(range(len(answers) + 1))
+        for r in answers:
+            choices[(r.node_id, r.answer_text)] += 1
+        if answers and session.end_time is None:
+            dropoffs[answers[-1].node_id] += 1
+    return choices, dropoffs, steps
+
+
+def test_incremental_batches_match_full_scan(sqlite_engine):
+    """Много маленьких пачек, проходы между вставками — итог как у полного пересчета и rebuild"""
+    factory = sessionmaker(bind=sqlite_engine)
+    db = factory()
+    user = models.User(telegram_id="1")
+    db.add(user)
+    db.flush()
+    rng = random.Random(5)
+    sessions = []
+    for round_no in range(4):
+        sessions += [_session(db, user.id, start=T0 + timedelta(minutes=round_no)) for _ in range(15)]
+        for session in [rng.choice(sessions) for _ in range(30)]:
+            node = f"q{rng.randint(1, 6)}"
+            _answer(db, session, node, rng.choice(["A", "B", "C"]), T0 + timedelta(minutes=round_no, seconds=30))
+        for session in rng.sample(sessions, 5):
+            if session.end_time is None:
+                session.end_time = T0 + timedelta(minutes=round_no, seconds=50)
+        db.commit()
+        refresh_analytics(factory, batch_size=7, settle_seconds=0)
+
+    choices, dropoffs, steps = _expected(db)
+    assert {(r["node_id"], r["answer_text"]): r["count"] for r in choice_distribution(db, "g")} == dict(choices)
+    assert {r["node_id"]: r["dropoffs"] for r in node_dropoff(db, "g") if r["dropoffs"]} == dict(dropoffs)
+    assert {s["step"]: s["sessions"] for s in funnel(db, "g")["steps"]} == dict(steps)
+    incremental = funnel(db, "g")
+    db.close()
+
+    result = rebuild_analytics(factory, settle_seconds=0)
+    assert result["sessions"] == 60 and result["responses"] == 120
+    db = factory()
+    assert funnel(db, "g") == incremental
+    db.close()
+
+
+def test_refresher_runs_on_nudge(sqlite_engine):
+    """on_write: nudge() запускает проход, не дожидаясь интервала"""
+    factory = sessionmaker(bind=sqlite_engine)
+    db = factory()
+    user = models.User(telegram_id="1")
+    db.add(user)
+    db.flush()
+    _session(db, user.id)
+    db.commit()
+    db.close()
+    refresher = AnalyticsRefresher(interval=60, write_delay=0, session_factory=factory, settle_seconds=0).start()
+    try:
+        refresher.nudge()
+        deadline = time.time() + 5
+        while refresher.stats()["runs"] == 0 and time.time() < deadline:
+            time.sleep(0.02)
+    finally:
+        refresher.stop()
+    stats = refresher.stats()
+    assert stats["runs"] >= 1 and stats["sessions"] == 1 and stats["errors"] == 0
+
+
+if __name__ == "__main__":
+    from conftest import run_test
+
+    print("🚀 ТЕСТИРОВАНИЕ АГРЕГАТОВ АНАЛИТИКИ")
+    for test in (test_aggregates_follow_new_rows, test_fresh_rows_wait_for_settle,
+                 test_late_commit_with_lower_id_is_counted, test_incremental_batches_match_full_scan, test_refresher_runs_on_nudge):
+        run_test(test)
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,201 @@
+# test_export_data.py
+# Тестирование выгрузки данных исследования (tools/export_data.py): события без перекрестного произведения, чанки, время МСК
+
+import csv
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.orm import sessionmaker
+
+from app.modules.database import models
+from tools.export_data import (
+    PARQUET_AVAILABLE, PARQUET_TABLES_BY_NAME, advance_mark, export_data_to_csv, export_data_to_csv_parallel,
+    export_incremental_parquet, incremental_chunks, load_watermarks, read_parquet_table, session_id_ranges,
+)
+
+T0 = datetime(2026, 3, 1, 9, 0, tzinfo=timezone.utc)
+
+
+def _database(engine):
+    db = sessionmaker(bind=engine)()
+    user = models.User(telegram_id="42")
+    db.add(user)
+    db.flush()
+    busy = models.Session(user_id=user.id, graph_id="g", start_time=T0)
+    empty = models.Session(user_id=user.id, graph_id="g", start_time=T0 + timedelta(hours=1))
+    db.add_all([busy, empty])
+    db.flush()
+    for i in range(3):
+        db.add(models.Response(session_id=busy.id, node_id=f"q{i}", node_text="Вопрос", answer_text=f"Ответ {i}",
+                               timestamp=T0 + timedelta(minutes=2 * i)))
+    for i in range(2):
+        db.add(models.AIDialogue(session_id=busy.id, node_id=f"ai{i}", user_message="Привет", ai_response="Здравствуйте",
+                                 timestamp=T0 + timedelta(minutes=2 * i + 1)))
+    ids = busy.id, empty.id
+    db.commit()
+    db.close()
+    return ids
+
+
+def _read(path):
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def test_events_are_union_not_cross_product(sqlite_engine, tmp_path):
+    """3 ответа и 2 диалога дают 5 строк, а не 6; сессия без событий — одна строка; время в МСК"""
+    engine = sqlite_engine
+    busy_id, empty_id = _database(engine)
+    path = os.path.join(tmp_path, "results.csv")
+    assert export_data_to_csv(path, chunk_size=2, bind=engine) == 6
+    rows = _read(path)
+
+    busy = [r for r in rows if r["session_id"] == str(busy_id)]
+    assert [r["event_type"] for r in busy] == ["response", "ai_dialogue", "response", "ai_dialogue", "response"]
+    assert [r["answer_text"] or r["ai_node_id"] for r in busy] == ["Ответ 0", "ai0", "Ответ 1", "ai1", "Ответ 2"]
+    assert busy[0]["response_timestamp_msk"].startswith("2026-03-01 12:00:00") and busy[0]["ai_timestamp_msk"] == ""
+    assert busy[1]["ai_timestamp_msk"].endswith("+03:00")
+    empty = [r for r in rows if r["session_id"] == str(empty_id)]
+    assert len(empty) == 1 and empty[0]["event_type"] == "session" and empty[0]["session_start_msk"].startswith("2026-03-01 13:00")
+    assert "event_id" not in rows[0] and rows[0]["telegram_id"] == "42"
+
+
+def test_split_streams(sqlite_engine, tmp_path):
+    """--split: сессии, ответы и диалоги — отдельные файлы"""
+    engine = sqlite_engine
+    _database(engine)
+    path = os.path.join(tmp_path, "results.csv")
+    assert export_data_to_csv(path, chunk_size=1, split=True, bind=engine) == 2 + 3 + 2
+    sessions = _read(os.path.join(tmp_path, "results_sessions.csv"))
+    responses = _read(os.path.join(tmp_path, "results_responses.csv"))
+    dialogues = _read(os.path.join(tmp_path, "results_ai_dialogues.csv"))
+    assert len(sessions) == 2 and len(responses) == 3 and len(dialogues) == 2
+    assert [r["answer_text"] for r in responses] == ["Ответ 0", "Ответ 1", "Ответ 2"]
+    assert dialogues[0]["ai_timestamp_msk"].endswith("+03:00")
+
+
+def test_parallel_export_matches_serial(sqlite_engine, tmp_path):
+    """Параллельная выгрузка по диапазонам session_id дает тот же файл, что и последовательная"""
+    engine = sqlite_engine
+    busy_id, empty_id = _database(engine)
+    assert session_id_ranges(engine, 8) == [(busy_id, busy_id), (empty_id, empty_id)]
+    serial = os.path.join(tmp_path, "serial.csv")
+    parallel = os.path.join(tmp_path, "parallel.csv")
+    export_data_to_csv(serial, bind=engine)
+    assert export_data_to_csv_parallel(parallel, workers=2, chunk_size=2, bind=engine) == 6
+    assert _read(parallel) == _read(serial) and not os.path.exists(os.path.join(tmp_path, "parallel.parts"))
+
+    # --split --no-merge: части по шардам и индекс вместо склейки
+    assert export_data_to_csv_parallel(parallel, workers=2, split=True, merge=False, bind=engine) == 2 + 3 + 2
+    with open(os.path.join(tmp_path, "parallel.parts", "index.json"), encoding="utf-8") as f:
+        index = json.load(f)["parts"]
+    assert len(index) == 3 * 2 and sum(part["rows"] for part in index) == 7
+    responses = [part for part in index if part["target"] == "responses"]
+    assert [(part["lo"], part["rows"]) for part in responses] == [(busy_id, 3), (empty_id, 0)]
+    assert len(_read(os.path.join(tmp_path, "parallel.parts", responses[0]["file"]))) == 3
+
+
+def _collect(engine, name, mark, settle_seconds=0):
+    table = PARQUET_TABLES_BY_NAME[name]
+    ids = []
+    for df in incremental_chunks(engine, table, mark, chunk_size=2, settle_seconds=settle_seconds):
+        mark = advance_mark(mark, df, table)
+        ids += df[table.keys[0]].tolist()
+    return ids, mark
+
+
+def test_incremental_watermarks(sqlite_engine):
+    """Повторный запуск отдает только новые строки; у изменяемых таблиц — и строки с той же секундой"""
+    engine = sqlite_engine
+    busy_id, _ = _database(engine)
+    ids, mark = _collect(engine, "responses", None)
+    assert len(ids) == 3 and mark == {"value": max(ids), "boundary": []}
+    assert _collect(engine, "responses", mark)[0] == []
+
+    db = sessionmaker(bind=engine)()
+    stamp = T0 + timedelta(hours=1)
+    for key in ("score", "risk"):
+        db.add(models.UserState(user_id=1, session_id=busy_id, state_key=key, state_value="1", timestamp=stamp))
+    db.add(models.Response(session_id=busy_id, node_id="q9", node_text="Вопрос", answer_text="Новый"))
+    db.commit()
+    assert len(_collect(engine, "responses", mark)[0]) == 1
+
+    state_ids, state_mark = _collect(engine, "user_states", None)
+    assert len(state_ids) == 2 and sorted(state_mark["boundary"]) == sorted(state_ids)
+    assert _collect(engine, "user_states", state_mark)[0] == []
+    # Новая строка с той же секундой, что и отметка, не теряется
+    db.add(models.UserState(user_id=1, session_id=busy_id, state_key="mood", state_value="ok", timestamp=stamp))
+    db.commit()
+    late_ids, late_mark = _collect(engine, "user_states", state_mark)
+    assert len(late_ids) == 1 and len(late_mark["boundary"]) == 3
+    db.close()
+
+
+def test_fresh_rows_hold_back_the_watermark(sqlite_engine):
+    """Строка моложе settle_seconds и все после нее ждут следующего запуска — даже устоявшиеся"""
+    engine = sqlite_engine
+    busy_id, _ = _database(engine)
+    ids, mark = _collect(engine, "responses", None, settle_seconds=60)
+    db = sessionmaker(bind=engine)()
+    now = datetime.now(timezone.utc)
+    # Меньший id, но транзакция еще «открыта» (строка свежая); больший id — уже старый
+    db.add(models.Response(session_id=busy_id, node_id="late", node_text="Вопрос", answer_text="Поздний",
+                           timestamp=now))
+    db.add(models.Response(session_id=busy_id, node_id="old", node_text="Вопрос", answer_text="Старый",
+                           timestamp=T0 + timedelta(hours=2)))
+    db.commit()
+    db.close()
+    held, held_mark = _collect(engine, "responses", mark, settle_seconds=60)
+    assert held == [] and held_mark == mark
+    late, _ = _collect(engine, "responses", mark, settle_seconds=0)
+    assert len(late) == 2
+
+
+def test_parquet_incremental_and_full_rebuild(sqlite_engine, tmp_path):
+    """Parquet: первый запуск — все строки, второй — только новые и измененные; чтение отдает последние версии"""
+    if not PARQUET_AVAILABLE:
+        print("pyarrow не установлен — проверка Parquet пропущена")
+        return
+    engine = sqlite_engine
+    busy_id, empty_id = _database(engine)
+    root = os.path.join(tmp_path, "parquet")
+    assert export_incremental_parquet(root, bind=engine, chunk_size=2) == {
+        "sessions": 2, "responses": 3, "ai_dialogues": 2, "user_states": 0}
+    assert os.path.isdir(os.path.join(root, "responses", "date=2026-03-01"))
+
+    db = sessionmaker(bind=engine)()
+    db.add(models.Response(session_id=busy_id, node_id="q9", node_text="Вопрос", answer_text="Новый",
+                           timestamp=T0 + timedelta(days=1)))
+    db.get(models.Session, empty_id).end_time = T0 + timedelta(days=1)
+    db.commit()
+    db.close()
+    counts = export_incremental_parquet(root, bind=engine)
+    assert counts["responses"] == 1 and counts["ai_dialogues"] == 0 and counts["sessions"] == 1
+    assert load_watermarks(root)["last_incremental_seconds"] >= 0
+
+    responses = read_parquet_table(root, "responses")
+    assert len(responses) == 4 and sorted(responses["date"].astype(str).unique()) == ["2026-03-01", "2026-03-02"]
+    sessions = read_parquet_table(root, "sessions")
+    assert len(sessions) == 2 and sessions["session_end_utc"].notna().sum() == 1
+    assert str(sessions["session_end_utc"].dt.tz) == "UTC"
+
+    try:
+        export_incremental_parquet(root, partition_by="graph_id", bind=engine)
+        assert False, "смена разбиения без --full должна быть ошибкой"
+    except ValueError:
+        pass
+    assert sum(export_incremental_parquet(root, partition_by="graph_id", full=True, bind=engine).values()) == 2 + 4 + 2
+    assert os.listdir(os.path.join(root, "responses")) == ["graph_id=g"]
+    assert len(read_parquet_table(root, "responses")) == 4
+
+
+if __name__ == "__main__":
+    from conftest import run_test
+
+    print("🚀 ТЕСТИРОВАНИЕ ВЫГРУЗКИ ДАННЫХ")
+    for test in (test_events_are_union_not_cross_product, test_split_streams, test_parallel_export_matches_serial,
+                 test_incremental_watermarks, test_fresh_rows_hold_back_the_watermark,
+                 test_parquet_incremental_and_full_rebuild):
+        run_test(test)
+        print(f"✅ {test.__name__}")
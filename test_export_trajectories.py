@@ -0,0 +1,91 @@
+# test_export_trajectories.py
+# Тестирование выгрузки траекторий состояний (tools/export_trajectories.py): шаги, перенос значений, mmap
+
+import os
+
+import numpy as np
+from sqlalchemy.orm import sessionmaker
+
+from app.modules.database import crud, models
+from tools.export_trajectories import build_trajectories, load_trajectories, parse_state_values, save_trajectories
+
+
+def _database(engine):
+    db = sessionmaker(bind=engine)()
+    user = crud.get_or_create_user(db, telegram_id=7)
+    first = crud.create_session(db, user.id, "g")
+    second = crud.create_session(db, user.id, "g")
+    other = crud.create_session(db, user.id, "other")
+    return engine, db, user.id, first.id, second.id, other.id
+
+
+def test_parse_state_values():
+    """Числа, True/False и мусор разбираются одним векторным проходом"""
+    parsed = parse_state_values(["10", " 2.5", "-3e2", "True", "false", "abc", "", None])
+    assert parsed[:5].tolist() == [10.0, 2.5, -300.0, 1.0, 0.0]
+    assert np.isnan(parsed[5:]).all()
+
+
+def test_history_steps_are_forward_filled(sqlite_engine):
+    """Шаг — изменения одного клика; неизмененные ключи переносятся вперед, чужой сценарий не попадает"""
+    saved = crud.STATE_HISTORY_ENABLED
+    crud.STATE_HISTORY_ENABLED = True
+    crud.state_cache._sessions.clear()
+    engine, db, user_id, first, second, other = _database(sqlite_engine)
+    try:
+        crud.update_session_states(db, user_id, first, {"score": 100, "mood": "ok"})
+        crud.update_session_states(db, user_id, first, {"score": 150})
+        crud.update_session_states(db, user_id, first, {"health": 3, "flag": True})
+        crud.update_session_states(db, user_id, other, {"score": 999})
+    finally:
+        crud.STATE_HISTORY_ENABLED = saved
+    assert db.query(models.UserStateHistory).count() == 6
+
+    traj = build_trajectories(engine, "g", chunk_size=2)
+    assert traj.keys == ["flag", "health", "mood", "score"]
+    assert traj.offsets.tolist() == [0, 3, 3] and traj.lengths.tolist() == [3, 0]
+    score, health = traj.key_index("score"), traj.key_index("health")
+    assert traj.session(first)[:, score].tolist() == [100.0, 150.0, 150.0]
+    assert np.isnan(traj.session(first)[:2, health]).all() and traj.session(first)[2, health] == 3.0
+    assert np.isnan(traj.session(first)[:, traj.key_index("mood")]).all()   # текст -> NaN
+    assert traj.session(second).shape == (0, 4) and len(traj.step_times) == 3
+
+    dense = build_trajectories(engine, "g", keys=["score"], dtype="float32").to_dense()
+    assert dense.values.shape == (2, 3, 1) and dense.values.dtype == np.float32
+    assert np.isnan(dense.values[1]).all() and dense.values[0, :, 0].tolist() == [100.0, 150.0, 150.0]
+
+    # latest: один шаг на сессию из user_states
+    latest = build_trajectories(engine, "g", source="latest")
+    assert latest.lengths.tolist() == [1, 0] and latest.session(first)[0, latest.key_index("score")] == 150.0
+    db.close()
+
+
+def test_save_and_mmap_load(sqlite_engine, tmp_path):
+    """Выгрузка на диск: .npy открываются через mmap, справочники сессий и ключей рядом; npz — одним файлом"""
+    crud.state_cache._sessions.clear()
+    engine, db, user_id, first, second, _ = _database(sqlite_engine)
+    for session_id, changes in ((first, {"score": 5}), (first, {"score": 6}), (second, {"score": 1})):
+        crud.record_state_history(db, session_id, changes)
+    traj = build_trajectories(engine, "g")
+    out = os.path.join(tmp_path, "ragged")
+    meta = save_trajectories(traj, out)
+    assert meta["steps"] == 3 and meta["shape"] == [3, 1] and meta["sessions"] == 2
+    loaded = load_trajectories(out)
+    assert isinstance(loaded.values, np.memmap)
+    assert loaded.session(first)[:, 0].tolist() == [5.0, 6.0] and loaded.session(second)[:, 0].tolist() == [1.0]
+    assert loaded.sessions["telegram_id"].tolist() == ["7", "7"] and loaded.sessions["steps"].tolist() == [2, 1]
+
+    save_trajectories(traj, os.path.join(tmp_path, "dense"), layout="dense", npz=True)
+    dense = load_trajectories(os.path.join(tmp_path, "dense"))
+    assert dense.layout == "dense" and dense.values.shape == (2, 2, 1)
+    assert dense.session(second)[:, 0].tolist() == [1.0]
+    db.close()
+
+
+if __name__ == "__main__":
+    from conftest import run_test
+
+    print("🚀 ТЕСТИРОВАНИЕ ВЫГРУЗКИ ТРАЕКТОРИЙ")
+    for test in (test_parse_state_values, test_history_steps_are_forward_filled, test_save_and_mmap_load):
+        run_test(test)
+        print(f"✅ {test.__name__}")
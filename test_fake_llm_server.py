@@ -0,0 +1,81 @@
+# test_fake_llm_server.py
+# Тестирование заглушки LLM (tools/fake_llm_server.py): задержки, сбои и совместимость с клиентами openai и GigaChat
+
+import base64
+import statistics
+
+import openai
+from gigachat import GigaChat
+from gigachat.models import Chat, Messages, MessagesRole
+
+from app.modules.ai_streaming import collect_stream, gigachat_deltas
+from tools.fake_llm_server import FakeLLMServer, FaultProfile
+
+
+def test_profile_latency_and_fault_rates():
+    """Логнормальная задержка попадает в заданные медиану и p95; доли сбоев соблюдаются"""
+    profile = FaultProfile(latency_median=1.0, latency_p95=3.0, rate_429=0.1, rate_500=0.05, rate_timeout=0.05, seed=7)
+    samples = sorted(profile.latency() for _ in range(20000))
+    assert 0.9 < statistics.median(samples) < 1.1
+    assert 2.6 < samples[int(0.95 * len(samples))] < 3.4
+
+    outcomes = [profile.outcome() for _ in range(20000)]
+    assert 0.08 < outcomes.count("429") / len(outcomes) < 0.12
+    assert 0.035 < outcomes.count("500") / len(outcomes) < 0.065
+    assert 0.035 < outcomes.count("timeout") / len(outcomes) < 0.065
+    assert FaultProfile(latency_median=0).latency() == 0.0
+
+
+def test_openai_client_answers_and_faults():
+    """VseGPT-клиент получает ответ с usage; 429 и зависание видны клиенту как ошибки"""
+    server = FakeLLMServer(FaultProfile(latency_median=0.01, latency_p95=0.02))
+    url = server.start()
+    try:
+        client = openai.OpenAI(api_key="test", base_url=f"{url}/v1", max_retries=0, timeout=0.5)
+        messages = [{"role": "system", "content": "роль"}, {"role": "user", "content": "привет"}]
+        response = client.chat.completions.create(model="fake-model", messages=messages)
+        assert response.choices[0].message.content.startswith("Ответ заглушки")
+        assert response.usage.prompt_tokens > 0
+
+        server.profile.rate_429 = 1.0
+        try:
+            client.chat.completions.create(model="fake-model", messages=messages)
+            assert False, "ожидалась ошибка 429"
+        except openai.RateLimitError as e:
+            assert "429" in str(e)
+
+        server.profile.rate_429, server.profile.rate_timeout = 0.0, 1.0
+        try:
+            client.chat.completions.create(model="fake-model", messages=messages)
+            assert False, "ожидался таймаут"
+        except openai.APITimeoutError:
+            pass
+    finally:
+        server.stop()
+    assert server.stats() == {"requests": 3, "ok": 1, "streams": 0, "429": 1, "500": 0, "timeout": 1, "auth": 0}
+
+
+def test_gigachat_client_auth_and_stream():
+    """GigaChat-клиент проходит OAuth заглушки и читает обычный и потоковый ответы"""
+    server = FakeLLMServer(FaultProfile(latency_median=0.02, latency_p95=0.05, chunks=4))
+    url = server.start()
+    try:
+        client = GigaChat(base_url=f"{url}/v1", auth_url=f"{url}/oauth", verify_ssl_certs=False,
+                          credentials=base64.b64encode(b"test:test").decode())
+        chat = Chat(messages=[Messages(role=MessagesRole.USER, content="привет")], model="GigaChat-2-Pro")
+        answer = client.chat(chat).choices[0].message.content
+        seen = []
+        streamed = collect_stream(gigachat_deltas(client, chat), seen.append, None, "fake")
+    finally:
+        server.stop()
+    assert answer == streamed and len(seen) == 4
+    stats = server.stats()
+    assert stats["auth"] == 1 and stats["ok"] == 2 and stats["streams"] == 1
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ ЗАГЛУШКИ LLM")
+    for test in (test_profile_latency_and_fault_rates, test_openai_client_answers_and_faults,
+                 test_gigachat_client_auth_and_stream):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,62 @@
+# test_formula_engine.py
+# Тестирование компилятора формул (AST-проверка, кеш, reads/writes)
+
+from app.modules.state_calculator import FormulaError, SafeStateCalculator, compile_formula, compile_condition
+
+
+def test_expression_and_assignments():
+    """Выражение пишется в score, присваивания — в свои переменные"""
+    f = compile_formula("score = score * 2, coins = 5")
+    assert f.evaluate({"score": 10}) == {"score": 20, "coins": 5}
+    assert f.reads == {"score"} and f.writes == {"score", "coins"}
+
+    g = compile_formula("score + 5000")
+    assert g.evaluate({"score": 1}) == {"score": 5001}
+    assert g.changes({"score": 1}) == {"score": 5001}
+
+
+def test_commas_inside_calls():
+    """Запятые внутри скобок не разделяют операторы (раньше формула падала)"""
+    f = compile_formula("score + random.choice([-10000, 20000]), debt = max(debt, 0)")
+    result = f.evaluate({"score": 0, "debt": -5})
+    assert result["score"] in (-10000, 20000)
+    assert result["debt"] == 0
+    assert f.reads == {"score", "debt"}
+
+
+def test_reads_exclude_own_writes():
+    f = compile_formula("a = 1, b = a + c")
+    assert f.reads == {"c"}
+    assert f.writes == {"a", "b"}
+
+
+def test_whitelist_rejects_unsafe_code():
+    for source in ("__import__('os').system('ls')", "().__class__", "(lambda: 1)()",
+                   "open('x')", "random._inst", "[x for x in y]", "score == 1 = 2"):
+        try:
+            compile_formula(source)
+        except FormulaError:
+            continue
+        raise AssertionError(f"формула должна быть отклонена: {source}")
+    try:
+        compile_condition("score.__class__")
+    except FormulaError:
+        pass
+    else:
+        raise AssertionError("условие должно быть отклонено")
+
+
+def test_cache_and_runtime_errors():
+    """Формула компилируется один раз; ошибка вычисления оставляет состояние прежним"""
+    assert compile_formula("score + 1") is compile_formula("score + 1")
+    state = {"score": 1}
+    assert SafeStateCalculator.calculate("score / 0", state) is state
+    assert SafeStateCalculator.calculate("score +", state) is state
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ ДВИЖКА ФОРМУЛ")
+    for test in (test_expression_and_assignments, test_commas_inside_calls, test_reads_exclude_own_writes,
+                 test_whitelist_rejects_unsafe_code, test_cache_and_runtime_errors):
+        test()
+        print(f"✅ {test.__name__}")
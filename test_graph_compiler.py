@@ -0,0 +1,72 @@
+# test_graph_compiler.py
+# Тестирование компиляции сценария в CompiledGraph
+
+import json
+
+from app.modules.graph_compiler import NodeKind, compile_graph
+from app.modules.state_calculator import SafeStateCalculator
+
+
+def _load_default_graph():
+    with open("data/default_interview.json", "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_default_interview_compiles():
+    """Основной сценарий компилируется, типы узлов сведены к NodeKind"""
+    graph = compile_graph(_load_default_graph())
+    assert graph.start_node_id == "game_start"
+    assert graph.get("game_start").kind is NodeKind.INTERACTIVE
+    assert graph.get("round_1_result").kind is NodeKind.STATE
+    assert graph.get("pause1").kind is NodeKind.FINAL
+    assert any("'pause1': неизвестный тип 'pause'" in w for w in graph.warnings)
+
+    check = graph.get("game_end_check")
+    assert check.kind is NodeKind.CONDITION
+    assert (check.then_node_id, check.else_node_id) == ("game_success", "game_failure")
+    assert eval(check.condition_code, SafeStateCalculator.SAFE_GLOBALS, {"score": 400000}) is True
+
+
+def test_compiled_graph_is_immutable():
+    graph = compile_graph(_load_default_graph())
+    try:
+        graph.get("game_start").kind = NodeKind.FINAL
+    except Exception:
+        pass
+    else:
+        raise AssertionError("CompiledNode должен быть неизменяемым")
+    assert graph.get("game_start").kind is NodeKind.INTERACTIVE
+
+
+def test_timing_ai_and_edges():
+    """Тайминг, ai_proactive и рандомизатор разбираются заранее; висячие ссылки попадают в warnings"""
+    graph = compile_graph({
+        "start_node_id": "a",
+        "nodes": {
+            "a": {"type": "ai_proactive:detective(\"Оцени улики\")", "text": "?",
+                  "timing": "typing:3s:Анализ; 2s", "randomize_options": True,
+                  "options": [{"text": "ok", "next_node_id": "r", "formula": "score + 1"}]},
+            "r": {"type": "randomizer", "branches": [{"next_node_id": "a", "weight": 2}, {"next_node_id": "missing"}]},
+            "c": {"type": "Условие", "condition_string": "{score} > 1",
+                  "options": [{"label": "тогда", "next_node_id": "a"}, {"label": "иначе", "next_node_id": "r"}]},
+        },
+    })
+    a = graph.get("a")
+    assert a.kind is NodeKind.AI_PROACTIVE
+    assert (a.ai_role, a.ai_task) == ("detective", "Оцени улики")
+    assert a.shuffle_options
+    assert [c["type"] for c in a.timing] == ["typing", "pause"]
+    assert a.timing[0]["duration"] == 3.0 and a.timing[0]["process_name"] == "Анализ"
+    assert SafeStateCalculator.calculate(a.options[0].compiled_formula, {"score": 1})["score"] == 2
+
+    r = graph.get("r")
+    assert r.branch_targets == ("a", "missing") and r.branch_weights == (2, 1)
+    assert (graph.get("c").then_node_id, graph.get("c").else_node_id) == ("a", "r")
+    assert any("missing" in w for w in graph.warnings)
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ КОМПИЛЯТОРА ГРАФА")
+    for test in (test_default_interview_compiles, test_compiled_graph_is_immutable, test_timing_ai_and_edges):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,124 @@
+# test_http_transport.py
+# Тестирование общего HTTP-транспорта: keep-alive пулы для клиентов LLM и Telegram, статистика переиспользования
+
+import base64
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+from gigachat import GigaChat
+from gigachat.models import Chat, Messages, MessagesRole
+from telebot import apihelper
+
+from app.modules import http_transport
+from app.modules.http_transport import configure_telegram_transport, endpoint_stats, llm_http_client, warm_up
+from tools.fake_llm_server import FakeLLMServer, FaultProfile
+
+
+class _FakeBotAPI(BaseHTTPRequestHandler):
+    """Bot API: любой метод отвечает ok; HTTP/1.1 — соединение остается открытым."""
+    protocol_version = "HTTP/1.1"
+
+    def _ok(self):
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length:
+            self.rfile.read(length)
+        body = json.dumps({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "bench"}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _ok
+
+    def log_message(self, *args):
+        pass
+
+
+def _run_threads(count, target):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_llm_clients_reuse_pooled_connections():
+    """openai и GigaChat через пуловый httpx-клиент: одно соединение на последовательные запросы"""
+    server = FakeLLMServer(FaultProfile(latency_median=0.01, latency_p95=0.02))
+    url = server.start()
+    try:
+        client = openai.OpenAI(api_key="test", base_url=f"{url}/v1", max_retries=0,
+                               http_client=llm_http_client("test-openai", read_timeout=5))
+        for _ in range(5):
+            client.chat.completions.create(model="fake-model", messages=[{"role": "user", "content": "привет"}])
+        stats = endpoint_stats("test-openai").snapshot()
+        assert stats["requests"] == 5 and stats["connections"] == 1 and stats["reused"] == 4
+        assert stats["reuse_rate"] == 0.8 and stats["errors"] == 0
+
+        # Параллельные запросы открывают не больше соединений, чем потоков
+        _run_threads(4, lambda: client.chat.completions.create(
+            model="fake-model", messages=[{"role": "user", "content": "?"}]))
+        stats = endpoint_stats("test-openai").snapshot()
+        assert stats["requests"] == 9 and stats["connections"] <= 5
+
+        giga = GigaChat(base_url=f"{url}/v1", auth_url=f"{url}/oauth", verify_ssl_certs=False,
+                        credentials=base64.b64encode(b"test:test").decode())
+        giga._client_instance = llm_http_client("test-gigachat", base_url=f"{url}/v1", verify=False)
+        chat = Chat(messages=[Messages(role=MessagesRole.USER, content="привет")], model="GigaChat-2-Pro")
+        for _ in range(3):
+            assert giga.chat(chat).choices[0].message.content
+        stats = endpoint_stats("test-gigachat").snapshot()
+        assert stats["requests"] == 3 and stats["connections"] == 1
+    finally:
+        server.stop()
+
+
+def test_telegram_calls_share_one_pool():
+    """Вызовы telebot из разных потоков идут через одну сессию; таймауты берутся из настроек"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeBotAPI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    saved = (apihelper.API_URL, apihelper.CUSTOM_REQUEST_SENDER, apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT)
+    try:
+        apihelper.API_URL = f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}"
+        configure_telegram_transport(pool_maxsize=4, connect_timeout=2, read_timeout=7)
+        assert (apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT) == (2, 7)
+
+        def player():
+            for _ in range(5):
+                assert apihelper.get_me("123:test")["is_bot"]
+
+        _run_threads(3, player)
+        stats = endpoint_stats("telegram").snapshot()
+        assert stats["requests"] == 15 and 1 <= stats["connections"] <= 3
+        assert stats["reused"] >= 12 and stats["errors"] == 0
+        assert "telegram" in http_transport.transport_stats()["endpoints"]
+    finally:
+        apihelper.API_URL, apihelper.CUSTOM_REQUEST_SENDER, apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT = saved
+        server.shutdown()
+        server.server_close()
+
+
+def test_warm_up_logs_failures():
+    """Прогрев выполняет все цели; ошибка одной не мешает остальным"""
+    calls = []
+
+    def broken():
+        calls.append("broken")
+        raise ConnectionError("нет сети")
+
+    warm_up([("broken", broken), ("ok", lambda: calls.append("ok"))], background=False)
+    assert calls == ["broken", "ok"]
+    warm_up([("ok", lambda: calls.append("bg"))]).join(timeout=2)
+    assert calls[-1] == "bg"
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ HTTP-ТРАНСПОРТА")
+    for test in (test_llm_clients_reuse_pooled_connections, test_telegram_calls_share_one_pool,
+                 test_warm_up_logs_failures):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,76 @@
+# test_prompt_budget.py
+# Тестирование бюджета токенов контекста ИИ (локальная оценка, урезание секций по приоритету)
+
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+from app.modules.database import crud
+from app.modules.prompt_budget import OMITTED_TEXT, PromptSection, estimate_tokens, fit_sections
+
+
+def test_estimate_tokens():
+    """Кириллица «дороже» латиницы; оценка быстрая и без сети"""
+    assert estimate_tokens("") == 0
+    ru, en = "Привет, игрок! " * 100, "Hello, player! " * 100
+    assert len(ru) == len(en) and estimate_tokens(ru) > estimate_tokens(en) * 1.4
+    assert 500 < estimate_tokens(ru) < 700
+    big = ru * 1000
+    t0 = time.perf_counter()
+    estimate_tokens(big)
+    assert time.perf_counter() - t0 < 0.05
+
+
+def test_sections_trimmed_in_priority_order():
+    """Сначала урезается досье, потом хронология (с сохранением новых событий), потом остальное"""
+    history = "\n".join(f"- Событие: «шаг {i}»\n  - Решение игрока: «ответ {i}»" for i in range(200))
+    sections = [
+        PromptSection("profile", "\n".join(f"- профиль {i}" for i in range(50))),
+        PromptSection("history", history),
+        PromptSection("state", "Игровое состояние:\n- капитал: current=100", keep="head"),
+        PromptSection("options", "- Купить\n- Продать", keep="head"),
+    ]
+    fixed = "Ты — консультант. " * 10
+    texts, report = fit_sections(fixed, sections, budget=10**6)
+    assert not report.changed and texts["history"] == history
+
+    budget = 800
+    texts, report = fit_sections(fixed, sections, budget)
+    assert report.dropped == ["profile"] and report.trimmed == ["history"]
+    assert texts["profile"] == OMITTED_TEXT
+    assert "«шаг 199»" in texts["history"] and "«шаг 0»" not in texts["history"]
+    assert "Решение игрока: «ответ 199»" in texts["history"] and texts["history"].startswith("… (ранее: ещё")
+    assert texts["state"] == sections[2].text and texts["options"] == sections[3].text
+    assert report.tokens_after <= budget < report.tokens_before
+    assert estimate_tokens(fixed) + sum(estimate_tokens(t) for t in texts.values()) == report.tokens_after
+
+
+def test_long_session_prompt_fits_role_budget(sqlite_engine):
+    """Промпт длинной сессии укладывается в бюджет роли из prompts.json"""
+    db = sessionmaker(bind=sqlite_engine)()
+    user_id = crud.get_or_create_user(db, telegram_id=1).id
+    session_id = crud.create_session(db, user_id=user_id, graph_id="test").id
+    for i in range(1000):
+        crud.create_response(db, session_id, f"step_{i}", node_text=f"Событие {i}: рынок изменился",
+                             answer_text=f"Решение {i}: держать позицию")
+    crud.bulk_update_user_states(db, user_id, session_id, {"score": 1000})
+
+    budget = crud.get_token_budget("financial_advisor")
+    assert budget > 0
+    prompt = crud.build_full_context_for_ai(db, session_id, user_id, "Что делать?", [], ai_persona="financial_advisor")
+    assert estimate_tokens(prompt) <= budget
+    assert "Событие 999" in prompt and "Событие 0:" not in prompt and "current=1 000" in prompt
+
+    short = crud.build_full_context_for_ai(db, session_id, user_id, "Что делать?", [], ai_persona="game_master")
+    assert estimate_tokens(short) <= crud.get_token_budget("game_master")
+    assert OMITTED_TEXT not in short
+    db.close()
+
+
+if __name__ == "__main__":
+    from conftest import run_test
+
+    print("🚀 ТЕСТИРОВАНИЕ БЮДЖЕТА ТОКЕНОВ")
+    for test in (test_estimate_tokens, test_sections_trimmed_in_priority_order, test_long_session_prompt_fits_role_budget):
+        run_test(test)
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,97 @@
+# test_session_memory.py
+# Тестирование иерархической памяти сессии: ограниченный промпт, сводки в session_metadata, рестарт без пересвертки
+
+
+from sqlalchemy.orm import sessionmaker
+
+from app.config.feature_flags import FeatureFlags
+from app.modules.database import crud, models
+from app.modules.database import session_memory
+from app.modules.database.session_memory import SessionMemoryCache, extractive_summary
+
+
+def _counting_summarizer(calls):
+    def summarize(texts):
+        calls.append(len(texts))
+        return extractive_summary(texts)
+    return summarize
+
+
+def _play(db, session_id, steps, start=0):
+    for i in range(start, start + steps):
+        # Вопрос к ИИ задается в узле до ответа на него
+        if i % 5 == 4:
+            crud.create_ai_dialogue(db, session_id, f"step_{i}", f"Что с шагом {i}?", f"Совет по шагу {i}")
+        crud.create_response(db, session_id, f"step_{i}", node_text=f"Событие {i}", answer_text=f"Ответ {i}")
+
+
+def test_prompt_stays_bounded_and_summaries_survive_restart(sqlite_engine):
+    """Длина блока истории не растет с игрой; после рестарта сводки читаются из session_metadata"""
+    factory = sessionmaker(bind=sqlite_engine)
+    calls = []
+    original_cache = crud.memory_cache
+    FeatureFlags.enable_feature('ENABLE_HIERARCHICAL_MEMORY')
+    try:
+        crud.memory_cache = SessionMemoryCache(summarize=_counting_summarizer(calls), session_factory=factory)
+        crud.context_cache.clear()
+        db = factory()
+        user = crud.get_or_create_user(db, telegram_id=1)
+        session = crud.create_session(db, user_id=user.id, graph_id="test")
+
+        sizes = []
+        for round_no in range(6):
+            _play(db, session.id, 40, start=round_no * 40)
+            prompt = crud.build_full_context_for_ai(db, session.id, user.id, "Что делать?", [], ai_persona="game_master")
+            sizes.append(len(prompt))
+        # 240 шагов + 48 реплик ИИ: после заполнения уровней памяти промпт перестает расти
+        assert max(sizes[2:]) - min(sizes[2:]) < 100, sizes
+        budget = (session_memory.MEMORY_MAX_CHUNKS + 1) * session_memory.MEMORY_SUMMARY_CHARS + \
+            (session_memory.MEMORY_RECENT_EVENTS + session_memory.MEMORY_CHUNK_EVENTS) * 2 * session_memory.EVENT_TEXT_LIMIT
+        assert max(sizes) < budget + 2000
+        assert "Событие 239" in prompt and "Совет по шагу 234" in prompt and "Давние события (сводка)" in prompt
+
+        memory = crud.memory_cache.get(db, session.id)
+        assert len(memory.chunks) <= session_memory.MEMORY_MAX_CHUNKS
+        assert len(memory.events) <= session_memory.MEMORY_RECENT_EVENTS + session_memory.MEMORY_CHUNK_EVENTS
+        rendered = memory.render()
+
+        db.expire_all()
+        stored = db.get(models.Session, session.id).session_metadata["memory"]
+        assert stored["covered"]["response"] > 200 and stored["digest"]
+
+        # «Рестарт»: новый кеш читает сводки и только несвернутые события, без суммаризации
+        restart_calls = []
+        crud.memory_cache = SessionMemoryCache(summarize=_counting_summarizer(restart_calls), session_factory=factory)
+        assert crud.memory_cache.get(db, session.id).render() == rendered
+        assert restart_calls == [] and calls
+    finally:
+        crud.memory_cache = original_cache
+        FeatureFlags.disable_feature('ENABLE_HIERARCHICAL_MEMORY')
+        crud.context_cache.clear()
+
+
+def test_failed_summary_falls_back_to_extractive(sqlite_engine):
+    """ИИ не ответил (пусто / ⚠️) — сводка строится без сети и не длиннее лимита"""
+    factory = sessionmaker(bind=sqlite_engine)
+    db = factory()
+    user = crud.get_or_create_user(db, telegram_id=2)
+    session = crud.create_session(db, user_id=user.id, graph_id="test")
+    cache = SessionMemoryCache(summarize=lambda texts: "⚠️ Сервис временно недоступен.", session_factory=factory)
+    memory = cache.get(db, session.id)
+    assert memory.render() == ""
+    for i in range(session_memory.MEMORY_RECENT_EVENTS + session_memory.MEMORY_CHUNK_EVENTS + 1):
+        cache.record(session.id, "response", i + 1, "x" * 500)
+    cache.maybe_fold(session.id)
+    memory = cache.get(db, session.id)
+    assert len(memory.chunks) == 1 and not memory.chunks[0].startswith("⚠️")
+    assert len(memory.chunks[0]) <= session_memory.MEMORY_SUMMARY_CHARS
+    assert cache.stats()["folds"] == 1
+
+
+if __name__ == "__main__":
+    from conftest import run_test
+
+    print("🚀 ТЕСТИРОВАНИЕ ИЕРАРХИЧЕСКОЙ ПАМЯТИ СЕССИИ")
+    for test in (test_prompt_stays_bounded_and_summaries_survive_restart, test_failed_summary_falls_back_to_extractive):
+        run_test(test)
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,101 @@
+# test_simulator.py
+# Тестирование headless-симулятора сценария
+
+import json
+
+from app.modules.simulator import (
+    FINISHED, MISSING_NODE, STUCK, GraphSimulator, first_policy, scripted_policy, simulate,
+)
+
+GRAPH = {
+    "graph_id": "sim_test",
+    "start_node_id": "start",
+    "nodes": {
+        "start": {"type": "task", "text": "Капитал: {score}", "options": [
+            {"text": "Рискнуть", "formula": "score = score + 100", "next_node_id": "coin"},
+            {"text": "Осторожно", "formula": "score = score + 10", "next_node_id": "check"},
+        ]},
+        "coin": {"type": "randomizer", "branches": [
+            {"next_node_id": "win", "weight": 1}, {"next_node_id": "lose", "weight": 1}]},
+        "win": {"type": "state", "text": "Выигрыш", "next_node_id": "check"},
+        "lose": {"type": "question", "text": "Проигрыш", "options": [
+            {"text": "Дальше", "formula": "score = score - 50", "next_node_id": "check"}]},
+        "check": {"type": "condition", "text": "{score} > 60", "then_node_id": "rich", "else_node_id": "poor"},
+        "rich": {"type": "task", "text": "Богач", "options": [{"text": "Ок"}]},
+        "poor": {"type": "task", "text": "Бедняк: {unknown_var}", "options": []},
+    },
+}
+
+
+def test_traversal_matches_handler_rules():
+    """Формулы, рандомизатор, условие и финалы — по правилам обработчика"""
+    report = simulate(GRAPH, players=2000, seed=42)
+    assert report.sessions == 2000
+    # «Осторожно» -> 10 -> poor (тупик: нет кнопок и ввода)
+    # «Рискнуть» -> win -> 100 -> rich (финиш) | lose -> 50 -> poor (тупик)
+    assert set(report.scores) == {10, 50, 100}
+    assert report.statuses[FINISHED] + report.statuses[STUCK] == 2000
+    assert report.final_nodes["rich"] == report.statuses[FINISHED]
+    assert 0.15 < report.statuses[FINISHED] / 2000 < 0.35
+    assert report.node_coverage == 1.0
+    assert any("unknown_var" in issue for issue in report.issues)
+    assert not report.ok
+
+
+def test_scripted_policy_and_determinism():
+    """Сценарий ответов по тексту кнопки; одинаковое зерно — одинаковый результат"""
+    policy = scripted_policy({"start": "Рискнуть", "lose": [0]})
+    a = GraphSimulator(GRAPH, policy=policy, seed=7).run(500)
+    b = GraphSimulator(GRAPH, policy=policy, seed=7).run(500)
+    assert a.node_visits == b.node_visits and a.scores == b.scores
+    assert a.node_visits["start"] == 500 and 10 not in a.scores
+
+    result = GraphSimulator(GRAPH, policy=first_policy, seed=1).play()
+    assert result.path[:2] == ["start", "coin"]
+
+
+def test_missing_node_and_default_scenario():
+    """Битый переход фиксируется; в штатном сценарии узлы типа pause обрывают игру после раунда 1"""
+    broken = json.loads(json.dumps(GRAPH))
+    broken["nodes"]["win"]["next_node_id"] = "nowhere"
+    report = simulate(broken, players=200, policy=scripted_policy({"start": 0, "lose": 0}), seed=3)
+    assert report.statuses[MISSING_NODE] > 0
+
+    with open("data/default_interview.json", "r", encoding="utf-8") as f:
+        graph = json.load(f)
+    report = simulate(graph, players=300, policy=first_policy)
+    assert report.statuses == {FINISHED: 300}
+    # pause1 — тип 'pause' обработчик не знает: игра на нем завершается, остальное недостижимо
+    assert report.final_nodes == {"pause1": 300}
+    assert list(report.issues) == ["узел 'pause1': неизвестный тип 'pause', переходы не выполняются — игра завершается"]
+    assert len(report.unreachable_nodes) == 13 and "game_end" in report.unreachable_nodes
+    assert not report.ok
+    # Тот же результат, что дает обработчик Telegram при нажатии первых кнопок
+    assert set(report.scores) == {255000}
+
+
+def test_unknown_type_and_unreachable_nodes_fail_check():
+    """Узел неизвестного типа с переходами и недостижимые узлы не проходят проверку"""
+    graph = json.loads(json.dumps(GRAPH))
+    graph["nodes"]["win"]["type"] = "pause"
+    graph["nodes"]["orphan"] = {"type": "task", "text": "Сирота", "options": [{"text": "Ок"}]}
+    report = simulate(graph, players=300, policy=scripted_policy({"start": 0}), seed=3)
+    assert any("'win': неизвестный тип 'pause'" in issue for issue in report.issues)
+    assert any("'win': неизвестный тип 'pause'" in warning for warning in report.graph_warnings)
+    assert report.unreachable_nodes == ["orphan"]
+    assert not report.ok
+
+    # Узел без типа и без переходов — обычный финал
+    graph = json.loads(json.dumps(GRAPH))
+    graph["nodes"]["rich"] = {"text": "Конец"}
+    report = simulate(graph, players=50, policy=scripted_policy({"start": 0, "lose": 0}), seed=3)
+    assert not any("неизвестный тип" in issue for issue in report.issues)
+    assert not report.graph_warnings and not report.unreachable_nodes
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ СИМУЛЯТОРА СЦЕНАРИЯ")
+    for test in (test_traversal_matches_handler_rules, test_scripted_policy_and_determinism,
+                 test_missing_node_and_default_scenario, test_unknown_type_and_unreachable_nodes_fail_check):
+        test()
+        print(f"✅ {test.__name__}")
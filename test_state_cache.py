@@ -0,0 +1,140 @@
+# test_state_cache.py
+# Тестирование кеша состояния сессии (SessionStateCache)
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+
+from app.modules.database import crud, models
+from app.modules.database.migrations import migrate_user_states_unique
+from app.modules.database.unit_of_work import unit_of_work
+
+
+def _make_db(engine):
+    statements = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    db = sessionmaker(bind=engine)()
+    user = crud.get_or_create_user(db, telegram_id=1)
+    session = crud.create_session(db, user_id=user.id, graph_id="test")
+    return db, user.id, session.id, statements
+
+
+def _state_selects(statements):
+    return [s for s in statements if s.lstrip().upper().startswith("SELECT") and "user_states" in s]
+
+
+def test_reads_hit_memory_after_first_load(sqlite_engine):
+    """После первой загрузки чтения состояния не ходят в БД"""
+    db, user_id, session_id, statements = _make_db(sqlite_engine)
+    cache = crud.SessionStateCache(mode="sync")
+    assert cache.get_states(db, user_id, session_id)["score"] == 0
+    statements.clear()
+    for _ in range(10):
+        cache.get_states(db, user_id, session_id)
+    assert _state_selects(statements) == []
+    assert cache.stats()["hits"] == 10
+
+
+def test_batched_mode_defers_writes(sqlite_engine):
+    """В режиме batched изменения пишутся только при сбросе"""
+    db, user_id, session_id, statements = _make_db(sqlite_engine)
+    cache = crud.SessionStateCache(mode="batched", flush_interval=3600)
+    cache.get_states(db, user_id, session_id)
+    cache.apply(db, user_id, session_id, {"score": 100, "coins": 3})
+    assert cache.get_states(db, user_id, session_id)["score"] == 100
+    assert db.query(models.UserState).count() == 0
+    assert cache.stats()["dirty_keys"] == 2
+
+    assert cache.flush(db, session_id) == 2
+    rows = {r.state_key: r.state_value for r in db.query(models.UserState).all()}
+    assert rows == {"score": "100", "coins": "3"}
+
+
+def test_sync_mode_and_end(sqlite_engine):
+    """В режиме sync изменения сразу в БД; end() выгружает сессию из памяти"""
+    db, user_id, session_id, _ = _make_db(sqlite_engine)
+    cache = crud.SessionStateCache(mode="sync")
+    cache.apply(db, user_id, session_id, {"score": 7})
+    assert crud.get_all_user_states(db, user_id, session_id)["score"] == 7
+    cache.end(db, session_id)
+    assert cache.stats()["sessions"] == 0
+
+
+def _rolled_back(factory, step):
+    try:
+        with unit_of_work(factory) as db:
+            step(db)
+            raise RuntimeError("сбой апдейта")
+    except RuntimeError:
+        pass
+
+
+def test_evicted_and_ended_sessions_survive_rollback(sqlite_engine):
+    """Вытеснение или завершение сессии в откатившемся апдейте не теряет ее несброшенные изменения"""
+    db, user_id, session_a, _ = _make_db(sqlite_engine)
+    session_b = crud.create_session(db, user_id=user_id, graph_id="test").id
+    factory = sessionmaker(bind=sqlite_engine)
+    cache = crud.SessionStateCache(mode="on_end", max_sessions=1)
+    cache.apply(db, user_id, session_a, {"score": 111})
+    # Загрузка B вытесняет A и пишет ее изменения в транзакцию апдейта, которая откатывается
+    _rolled_back(factory, lambda uow_db: cache.get_states(uow_db, user_id, session_b))
+    assert cache.pending(session_a) == {"score": 111}
+    assert cache.flush(db) == 1
+    assert crud.get_all_user_states(db, user_id, session_a)["score"] == 111
+
+    cache.apply(db, user_id, session_a, {"score": 222})
+    _rolled_back(factory, lambda uow_db: cache.end(uow_db, session_a))
+    assert cache.pending(session_a) == {"score": 222}
+    cache.end(db, session_a)
+    assert crud.get_all_user_states(db, user_id, session_a)["score"] == 222
+    assert cache.stats()["dirty_keys"] == 0
+
+
+def test_bulk_update_is_single_upsert(sqlite_engine):
+    """Все изменения клика — один INSERT ... ON CONFLICT, повторная запись обновляет строки"""
+    db, user_id, session_id, statements = _make_db(sqlite_engine)
+    statements.clear()
+    crud.bulk_update_user_states(db, user_id, session_id, {"score": 1, "coins": 2, "debt": 3})
+    inserts = [s for s in statements if "INSERT" in s.upper()]
+    assert len(inserts) == 1 and "ON CONFLICT" in inserts[0].upper()
+
+    crud.bulk_update_user_states(db, user_id, session_id, {"score": 10, "coins": 20})
+    rows = {r.state_key: r.state_value for r in db.query(models.UserState).all()}
+    assert rows == {"score": "10", "coins": "20", "debt": "3"}
+
+
+def test_migration_removes_duplicates():
+    """Миграция оставляет последнюю запись каждого ключа и создает уникальный индекс"""
+    engine = create_engine("sqlite://")  # старая схема без уникального индекса, а не models
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE user_states (id INTEGER PRIMARY KEY, user_id INTEGER, session_id INTEGER, "
+                          "state_key VARCHAR, state_value VARCHAR, timestamp DATETIME)"))
+        for i, value in enumerate(["1", "2", "3"]):
+            conn.execute(text("INSERT INTO user_states (id, user_id, session_id, state_key, state_value) "
+                              "VALUES (:id, 1, 1, 'score', :v)"), {"id": i + 1, "v": value})
+    migrate_user_states_unique(engine)
+    statements = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    migrate_user_states_unique(engine)  # идемпотентна: индекс уже есть — таблица не сканируется
+    assert not [s for s in statements if "DELETE" in s.upper()]
+    with engine.begin() as conn:
+        assert conn.execute(text("SELECT state_value FROM user_states")).fetchall() == [("3",)]
+        try:
+            conn.execute(text("INSERT INTO user_states (user_id, session_id, state_key, state_value) "
+                              "VALUES (1, 1, 'score', '4')"))
+        except Exception:
+            pass
+        else:
+            raise AssertionError("дубликат должен нарушать уникальный индекс")
+
+
+if __name__ == "__main__":
+    from conftest import run_test
+
+    print("🚀 ТЕСТИРОВАНИЕ КЕША СОСТОЯНИЯ")
+    for test in (test_reads_hit_memory_after_first_load, test_batched_mode_defers_writes, test_sync_mode_and_end,
+                 test_evicted_and_ended_sessions_survive_rollback, test_bulk_update_is_single_upsert,
+                 test_migration_removes_duplicates):
+        run_test(test)
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,223 @@
+# test_telegram_sender.py
+# Тестирование очереди исходящих сообщений (лимиты, приоритеты, схлопывание правок, 429)
+
+import threading
+import time
+import types
+
+from telebot.apihelper import ApiTelegramException
+
+from app.modules.telegram_sender import (
+    OutboundSender, RateLimitedBot, edit_cosmetic,
+    PRIORITY_COSMETIC, PRIORITY_INTERACTIVE,
+)
+
+
+class FakeBot:
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+        self.gate = None
+        self.fail_429 = 0
+
+    def _record(self, name, chat_id, payload):
+        if self.gate is not None:
+            self.gate.wait(5)
+        with self.lock:
+            if self.fail_429:
+                self.fail_429 -= 1
+                raise ApiTelegramException(name, None, {
+                    "error_code": 429, "description": "Too Many Requests",
+                    "parameters": {"retry_after": 0.2}})
+            self.calls.append((time.monotonic(), name, chat_id, payload))
+        return types.SimpleNamespace(message_id=len(self.calls))
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._record("send_message", chat_id, text)
+
+    def edit_message_text(self, text=None, chat_id=None, message_id=None, **kwargs):
+        return self._record("edit_message_text", chat_id, text)
+
+    def delete_message(self, chat_id, message_id):
+        return self._record("delete_message", chat_id, message_id)
+
+    def get_me(self):
+        return "me"
+
+
+def test_chat_order_and_rate():
+    """Внутри чата порядок сохраняется, скорость ограничена bucket чата"""
+    bot = FakeBot()
+    sender = OutboundSender(bot, global_rate=1000, chat_rate=20, chat_burst=1, workers=4)
+    futures = [sender.submit("send_message", 1, f"m{i}", priority=PRIORITY_INTERACTIVE) for i in range(5)]
+    for f in futures:
+        f.result(5)
+    sender.stop(5)
+    assert [c[3] for c in bot.calls] == ["m0", "m1", "m2", "m3", "m4"]
+    gaps = [b[0] - a[0] for a, b in zip(bot.calls, bot.calls[1:])]
+    assert min(gaps) >= 0.04
+
+
+def test_interactive_overtakes_cosmetic():
+    """Интерактивный ответ уходит раньше косметических правок других чатов"""
+    bot = FakeBot()
+    sender = OutboundSender(bot, global_rate=5, chat_rate=100, chat_burst=10, workers=1)
+    # Выбираем глобальный запас токенов
+    for i in range(5):
+        sender.submit("send_message", 100 + i, "warmup").result(5)
+    cosmetic = [sender.submit("edit_message_text", f"tick{i}", 200 + i, 1, priority=PRIORITY_COSMETIC)
+                for i in range(3)]
+    answer = sender.submit("send_message", 300, "answer", priority=PRIORITY_INTERACTIVE)
+    answer.result(5)
+    for f in cosmetic:
+        f.result(5)
+    sender.stop(5)
+    payloads = [c[3] for c in bot.calls[5:]]
+    assert payloads[0] == "answer"
+
+
+def test_edits_coalesce_and_delete_drops_them():
+    """Незапущенные правки одного сообщения схлопываются, удаление и финальная правка снимают их"""
+    bot = FakeBot()
+    bot.gate = threading.Event()
+    sender = OutboundSender(bot, global_rate=1000, chat_rate=1000, chat_burst=100, workers=1)
+    first = sender.submit("edit_message_text", "t0", 1, 10, priority=PRIORITY_COSMETIC, coalesce=True)
+    time.sleep(0.05)  # первая правка уже выполняется
+    for i in range(1, 6):
+        sender.submit("edit_message_text", f"t{i}", 1, 10, priority=PRIORITY_COSMETIC, coalesce=True)
+    bot.gate.set()
+    first.result(5)
+    sender.stop(5)
+    assert [c[3] for c in bot.calls] == ["t0", "t5"]
+    assert sender.stats()["coalesced"] == 4
+
+    bot = FakeBot()
+    bot.gate = threading.Event()
+    sender = OutboundSender(bot, global_rate=1000, chat_rate=1000, chat_burst=100, workers=1)
+    sender.submit("send_message", 1, "busy")
+    time.sleep(0.05)
+    stale = sender.submit("edit_message_text", "99%", 1, 10, priority=PRIORITY_COSMETIC, coalesce=True)
+    sender.submit("delete_message", 1, 10)
+    bot.gate.set()
+    assert stale.result(5) is None
+    sender.stop(5)
+    assert [c[1] for c in bot.calls] == ["send_message", "delete_message"]
+    assert sender.stats()["dropped_superseded"] == 1
+
+    # Финальная (обычная) правка снимает незапущенную косметическую — иначе та перезаписала бы итог
+    bot = FakeBot()
+    bot.gate = threading.Event()
+    sender = OutboundSender(bot, global_rate=1000, chat_rate=1000, chat_burst=100, workers=1)
+    sender.submit("send_message", 1, "busy")
+    time.sleep(0.05)
+    stale = sender.submit("edit_message_text", "черновик ▌", 1, 10, priority=PRIORITY_COSMETIC, coalesce=True)
+    sender.submit("edit_message_text", "итог", 1, 10, priority=PRIORITY_INTERACTIVE)
+    bot.gate.set()
+    assert stale.result(5) is None
+    sender.stop(5)
+    assert [c[3] for c in bot.calls] == ["busy", "итог"]
+
+
+def test_429_retry_after_feedback():
+    """429 блокирует чат на retry_after, запрос повторяется, глобальная скорость снижается"""
+    bot = FakeBot()
+    bot.fail_429 = 1
+    sender = OutboundSender(bot, global_rate=100, chat_rate=1000, chat_burst=10, workers=2)
+    t0 = time.monotonic()
+    result = sender.submit("send_message", 1, "hello", priority=PRIORITY_INTERACTIVE).result(5)
+    assert result.message_id == 1
+    assert bot.calls[0][0] - t0 >= 0.2
+    stats = sender.stats()
+    assert stats["rate_limited"] == 1 and stats["retries"] == 1 and stats["sent"] == 1
+    assert stats["global_rate_current"] < 100
+    sender.stop(5)
+
+
+def _wait_rate_limited(sender):
+    deadline = time.monotonic() + 5
+    while sender.stats()["rate_limited"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_429_requeued_edit_still_coalesces():
+    """Правка, вернувшаяся в очередь после 429, снова схлопывается с новыми и снимается удалением"""
+    bot = FakeBot()
+    bot.fail_429 = 1
+    sender = OutboundSender(bot, global_rate=1000, chat_rate=1000, chat_burst=10, workers=1)
+    first = sender.submit("edit_message_text", "t0", 1, 10, priority=PRIORITY_COSMETIC, coalesce=True)
+    _wait_rate_limited(sender)
+    for i in range(1, 3):
+        assert sender.submit("edit_message_text", f"t{i}", 1, 10, priority=PRIORITY_COSMETIC, coalesce=True) is first
+    first.result(5)
+    sender.stop(5)
+    assert [c[3] for c in bot.calls] == ["t2"] and sender.stats()["coalesced"] == 2
+
+    bot = FakeBot()
+    bot.fail_429 = 1
+    sender = OutboundSender(bot, global_rate=1000, chat_rate=1000, chat_burst=10, workers=1)
+    stale = sender.submit("edit_message_text", "99%", 1, 10, priority=PRIORITY_COSMETIC, coalesce=True)
+    _wait_rate_limited(sender)
+    sender.submit("delete_message", 1, 10)
+    assert stale.result(5) is None
+    sender.stop(5)
+    assert [c[1] for c in bot.calls] == ["delete_message"]
+
+    # Новая правка пришла, пока старая ждала ответа: после 429 старая не повторяется
+    bot = FakeBot()
+    bot.fail_429 = 1
+    bot.gate = threading.Event()
+    sender = OutboundSender(bot, global_rate=1000, chat_rate=1000, chat_burst=10, workers=1)
+    old = sender.submit("edit_message_text", "t0", 1, 10, priority=PRIORITY_COSMETIC, coalesce=True)
+    time.sleep(0.05)
+    new = sender.submit("edit_message_text", "t1", 1, 10, priority=PRIORITY_COSMETIC, coalesce=True)
+    bot.gate.set()
+    assert old.result(5) is None
+    new.result(5)
+    sender.stop(5)
+    assert [c[3] for c in bot.calls] == ["t1"]
+    stats = sender.stats()
+    assert stats["dropped_superseded"] == 1 and stats["retries"] == 0
+
+
+def test_timed_out_call_is_not_sent_later():
+    """Вызов, не дождавшийся отправки (чат заблокирован 429), снимается с очереди"""
+    bot = FakeBot()
+    bot.fail_429 = 1
+    sender = OutboundSender(bot, global_rate=1000, chat_rate=1000, chat_burst=10, workers=2)
+    blocked = sender.submit("send_message", 1, "first", priority=PRIORITY_INTERACTIVE)
+    try:
+        sender.call("send_message", 1, "question", timeout=0.05)
+        raise AssertionError("ожидался таймаут")
+    except TimeoutError:
+        pass
+    # Повтор вызывающего (как fallback в _send_message) уходит один раз
+    assert sender.call("send_message", 1, "question", timeout=5).message_id == 2
+    blocked.result(5)
+    sender.stop(5)
+    assert [c[3] for c in bot.calls] == ["first", "question"]
+    assert sender.stats()["timed_out"] == 1
+
+
+def test_proxy_and_direct_fallback():
+    """RateLimitedBot ставит отправки в очередь, остальное проксирует; без очереди правка идет напрямую"""
+    bot = FakeBot()
+    sender = OutboundSender(bot, global_rate=1000, chat_rate=1000, chat_burst=10)
+    proxy = RateLimitedBot(bot, sender)
+    assert proxy.send_message(5, "hi").message_id == 1
+    assert proxy.get_me() == "me"
+    edit_cosmetic(proxy, "tick", 5, 1).result(5)
+    sender.stop(5)
+
+    plain = FakeBot()
+    edit_cosmetic(plain, chat_id=5, message_id=1, text="tick")
+    assert plain.calls[0][1] == "edit_message_text"
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ ОЧЕРЕДИ ИСХОДЯЩИХ")
+    for test in (test_chat_order_and_rate, test_interactive_overtakes_cosmetic,
+                 test_edits_coalesce_and_delete_drops_them, test_429_retry_after_feedback,
+                 test_429_requeued_edit_still_coalesces,
+                 test_timed_out_call_is_not_sent_later, test_proxy_and_direct_fallback):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,138 @@
+# test_timer_scheduler.py
+# Тестирование центрального планировщика таймеров
+
+import threading
+import time
+import types
+
+from app.modules.telegram_sender import OutboundSender, RateLimitedBot
+from app.modules.timing_engine import (
+    TimerScheduler, get_timer_scheduler, process_node_timing, set_node_callback_runner,
+)
+from app.modules.timing_primitives.dynamic_pause import DynamicPause
+from app.modules.timing_primitives.temporal_action import TemporalAction
+
+
+def test_fires_in_deadline_order():
+    """Таймеры срабатывают в порядке сроков, а не в порядке постановки"""
+    scheduler = TimerScheduler(workers=1)
+    order = []
+    done = threading.Event()
+    scheduler.call_later(0.06, order.append, 3)
+    scheduler.call_later(0.02, order.append, 1)
+    scheduler.call_later(0.04, order.append, 2)
+    scheduler.call_later(0.08, done.set)
+    assert done.wait(2)
+    assert order == [1, 2, 3]
+    assert scheduler.stats()["fired"] == 4
+
+
+def test_cancel():
+    """Отменённый таймер не срабатывает и не считается живым"""
+    scheduler = TimerScheduler(workers=1)
+    fired = []
+    handle = scheduler.call_later(0.05, fired.append, "x")
+    assert scheduler.live_timers() == 1
+    assert handle.cancel()
+    assert not handle.cancel()
+    assert scheduler.live_timers() == 0
+    time.sleep(0.1)
+    assert fired == []
+
+
+def test_temporal_action_cancel_on_scheduler():
+    """TemporalAction работает на планировщике без отдельного потока и отменяется"""
+    scheduler = TimerScheduler(workers=2)
+    fired = []
+    threads_before = threading.active_count()
+    action = TemporalAction(bot=None, chat_id=None, duration=1, target_action=lambda: fired.append(1),
+                            triggermode='afterstart', scheduler=scheduler)
+    action.execute()
+    time.sleep(0.05)
+    action.cancel()
+    time.sleep(1.1)
+    assert fired == []
+    # Только диспетчер и исполнители планировщика
+    assert threading.active_count() <= threads_before + 1 + 2
+
+
+def test_slow_node_callbacks_do_not_stall_timers():
+    """Медленные узлы после паузы не занимают исполнителей планировщика"""
+    scheduler = get_timer_scheduler()
+    released = threading.Event()
+    for i in range(scheduler.workers + 2):
+        process_node_timing(user_id=1, session_id=None, node_id=f"slow{i}", timing_config="0.02s",
+                            callback=lambda: released.wait(2), chat_id=1000 + i)
+    ticked = threading.Event()
+    started = time.monotonic()
+    scheduler.call_later(0.1, ticked.set)
+    try:
+        assert ticked.wait(2)
+        assert time.monotonic() - started < 0.4
+    finally:
+        released.set()
+
+
+def test_queued_sends_do_not_stall_timers():
+    """Сообщения паузы и отсчета ждут очереди исходящих не на исполнителях планировщика"""
+    gate = threading.Event()
+
+    class GatedBot:
+        def send_message(self, chat_id, text, **kwargs):
+            gate.wait(5)
+            return types.SimpleNamespace(message_id=chat_id)
+
+        def edit_message_text(self, *args, **kwargs):
+            pass
+
+        def delete_message(self, chat_id, message_id):
+            pass
+
+    sender = OutboundSender(GatedBot(), global_rate=1000, chat_rate=1000, chat_burst=10, workers=8)
+    bot = RateLimitedBot(GatedBot(), sender)
+    scheduler = TimerScheduler(workers=2)
+    paused = threading.Event()
+    try:
+        for chat_id in range(1, 4):
+            TemporalAction(bot, chat_id, duration=1, target_action=lambda: None, scheduler=scheduler).execute()
+        DynamicPause(bot, 9, duration=0.1, fill_type='progressbar', scheduler=scheduler).execute(paused.set)
+        ticked = threading.Event()
+        started = time.monotonic()
+        scheduler.call_later(0.05, ticked.set)
+        assert ticked.wait(2) and time.monotonic() - started < 0.4
+        assert not paused.is_set()
+    finally:
+        gate.set()
+    # После отправки шаги идут своим чередом
+    assert paused.wait(3)
+    sender.stop(5)
+
+
+def test_node_callbacks_go_to_chat_runner():
+    """Узел после таймера передается в очередь своего чата; отказ очереди — отдельный пул"""
+    handed, ran = [], threading.Event()
+
+    def runner(chat_id, callback):
+        handed.append(chat_id)
+        callback()
+        return chat_id != 2
+
+    set_node_callback_runner(runner)
+    try:
+        process_node_timing(user_id=1, session_id=None, node_id="n", timing_config="0.01s",
+                            callback=lambda: None, chat_id=1)
+        process_node_timing(user_id=1, session_id=None, node_id="n", timing_config="0.02s",
+                            callback=lambda: ran.set() if handed == [1, 2] else None, chat_id=2)
+        assert ran.wait(2)
+        assert handed == [1, 2]
+    finally:
+        set_node_callback_runner(None)
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ TIMER SCHEDULER")
+    for test in (test_fires_in_deadline_order, test_cancel, test_temporal_action_cancel_on_scheduler,
+                 test_slow_node_callbacks_do_not_stall_timers, test_queued_sends_do_not_stall_timers,
+                 test_node_callbacks_go_to_chat_runner):
+        test()
+        print(f"✅ {test.__name__}")
@@ -0,0 +1,134 @@
+# test_timer_store.py
+# Тестирование персистентных таймеров (active_timers) и восстановления после рестарта
+
+import threading
+import time
+from datetime import timedelta
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from app.config.feature_flags import FeatureFlags
+from app.modules import timer_store, timing_engine
+from app.modules.database import models
+from app.modules.timer_store import PersistedTimer, TimerStore, utc_naive_now
+from app.modules.timing_engine import TimerScheduler
+
+
+def _statuses(factory):
+    db = factory()
+    try:
+        return sorted((t.callback_node_id, t.status) for t in db.query(models.ActiveTimer).all())
+    finally:
+        db.close()
+
+
+def test_batched_writes_skip_finished_timers(sqlite_engine):
+    """Таймеры пишутся пачкой; сработавшие до записи в БД не попадают"""
+    factory = sessionmaker(bind=sqlite_engine)
+    store = TimerStore(factory, flush_interval=3600)
+    a = store.add(PersistedTimer.after(60, 1, 'timeout', 'a', {'chat_id': 10}))
+    store.add(PersistedTimer.after(60, 1, 'pause', 'b'))
+    c = store.add(PersistedTimer.after(60, 2, 'typing', 'c'))
+    store.complete(c, 'executed')
+    assert store.flush() == 2
+    assert _statuses(factory) == [('a', 'pending'), ('b', 'pending')]
+    assert store.stats()['skipped_inserts'] == 1
+
+    store.complete(a, 'cancelled')
+    assert store.flush() == 1
+    assert _statuses(factory) == [('a', 'cancelled'), ('b', 'pending')]
+
+
+def test_recovery_fires_overdue_in_batches_and_reschedules_rest(sqlite_engine):
+    """После рестарта просроченные таймеры идут пачками, остальные — на свой срок"""
+    factory, engine = sessionmaker(bind=sqlite_engine), sqlite_engine
+    store = TimerStore(factory, flush_interval=3600)
+    now = utc_naive_now()
+    for i in range(5):
+        store.add(PersistedTimer(1, 'pause', now - timedelta(seconds=10 - i), f"old{i}", {'chat_id': i}))
+    store.add(PersistedTimer(1, 'timeout', now + timedelta(seconds=0.3), "future", {'chat_id': 99}))
+    store.flush()
+
+    # Запрос восстановления идет по индексу (status, target_timestamp)
+    with engine.connect() as conn:
+        plan = " ".join(str(r) for r in conn.execute(text(
+            "EXPLAIN QUERY PLAN SELECT id FROM active_timers "
+            "WHERE status = 'pending' ORDER BY target_timestamp")))
+    assert "ix_active_timers_status_target" in plan
+
+    fired = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def resume(timer):
+        with lock:
+            fired.append((time.monotonic(), timer.node_id, timer.data['chat_id']))
+            if len(fired) == 6:
+                done.set()
+
+    restarted = TimerStore(factory, flush_interval=3600)
+    t0 = time.monotonic()
+    report = restarted.recover(resume, TimerScheduler(workers=1), batch_size=2, batch_interval=0.1)
+    assert report['loaded'] == 6 and report['overdue'] == 5 and report['overdue_batches'] == 3
+    assert done.wait(5)
+
+    order = [node for _, node, _ in fired]
+    assert order == ["old0", "old1", "old2", "old3", "old4", "future"]
+    # Третья пачка просроченных — не раньше чем через 2 интервала
+    assert fired[4][0] - t0 >= 0.19
+    assert fired[5][0] - t0 >= 0.25
+    restarted.flush()
+    assert all(status == 'executed' for _, status in _statuses(factory))
+
+
+def test_recovered_timers_marked_executed_without_new_timers(sqlite_engine):
+    """Статус восстановленных таймеров пишет фоновый поток, без add() и без flush() при остановке"""
+    factory = sessionmaker(bind=sqlite_engine)
+    store = TimerStore(factory, flush_interval=3600)
+    store.add(PersistedTimer(1, 'pause', utc_naive_now() - timedelta(seconds=5), "old", {'chat_id': 1}))
+    store.flush()
+
+    fired = threading.Event()
+    restarted = TimerStore(factory, flush_interval=0.05)
+    restarted.recover(lambda timer: fired.set(), TimerScheduler(workers=1))
+    assert fired.wait(5)
+    deadline = time.time() + 5
+    while _statuses(factory) != [('old', 'executed')] and time.time() < deadline:
+        time.sleep(0.02)
+    assert _statuses(factory) == [('old', 'executed')]
+
+
+def test_timing_engine_persists_and_cancels(sqlite_engine):
+    """TimingEngine регистрирует таймеры узлов и отмечает срабатывание и отмену"""
+    factory = sessionmaker(bind=sqlite_engine)
+    store = TimerStore(factory, flush_interval=3600)
+    saved_store = timer_store._timer_store
+    timer_store._timer_store = store
+    FeatureFlags.enable_feature('ENABLE_PERSISTENCE_TIMERS')
+    try:
+        fired = threading.Event()
+        timing_engine.process_node_timing(1, 501, "paused_node", "0.3s", fired.set, chat_id=7)
+        timing_engine.process_node_timing(1, 502, "timeout_node", "timeout:30s", lambda: None, chat_id=8)
+        store.flush()
+        assert _statuses(factory) == [('paused_node', 'pending'), ('timeout_node', 'pending')]
+
+        assert fired.wait(5)
+        assert timing_engine.cancel_timeout_for_session(502)
+        store.flush()
+        assert _statuses(factory) == [('paused_node', 'executed'), ('timeout_node', 'cancelled')]
+    finally:
+        FeatureFlags.disable_feature('ENABLE_PERSISTENCE_TIMERS')
+        timer_store._timer_store = saved_store
+
+
+if __name__ == "__main__":
+    from conftest import run_test
+
+    print("🚀 ТЕСТИРОВАНИЕ ПЕРСИСТЕНТНЫХ ТАЙМЕРОВ")
+    for test in (test_batched_writes_skip_finished_timers,
+                 test_recovery_fires_overdue_in_batches_and_reschedules_rest,
+                 test_recovered_timers_marked_executed_without_new_timers,
+                 test_timing_engine_persists_and_cancels):
+        run_test(test)
+        print(f"✅ {test.__name__}")
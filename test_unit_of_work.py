@@ -0,0 +1,237 @@
+# test_unit_of_work.py
+# Тестирование единицы работы на апдейт (одна сессия БД и один коммит)
+
+import os
+import threading
+import types
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+# Обработчикам нужны настоящие модули ИИ (иначе telegram_handler включает заглушки без БД);
+# без сертифицированного GigaChat импорт в официальном режиме запрещен
+os.environ.setdefault("COMPLIANCE_MODE", "false")
+
+from app.modules import database, gigachat_handler, telegram_handler  # noqa: E402
+from app.modules.database import crud, models  # noqa: E402
+from app.modules.database.unit_of_work import current_session, unit_of_work  # noqa: E402
+from app.modules.graph_compiler import compile_graph  # noqa: E402
+from app.modules.timing_engine import set_node_callback_runner  # noqa: E402
+
+
+def _make_factory(engine):
+    counters = {"checkouts": 0, "commits": 0}
+
+    def on_checkout(*args):
+        counters["checkouts"] += 1
+
+    def on_commit(conn):
+        counters["commits"] += 1
+
+    event.listen(engine, "checkout", on_checkout)
+    event.listen(engine, "commit", on_commit)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine), counters
+
+
+def _simulate_click(factory, cache, telegram_id=1):
+    """Типичный апдейт: пользователь, сессия, изменение состояния, ответ, вложенный process_node."""
+    with unit_of_work(factory) as db:
+        user = crud.get_or_create_user(db, telegram_id=telegram_id)
+        session = crud.create_session(db, user_id=user.id, graph_id="test")
+        cache.apply(db, user.id, session.id, {"score": 10})
+        crud.create_response(db, session.id, "n1", node_text="Вопрос", answer_text="Ответ")
+        with unit_of_work(factory) as nested:
+            assert nested is db
+            crud.create_response(db, session.id, "n2", node_text="Вопрос 2", answer_text="Ответ 2")
+        return user.id, session.id
+
+
+def test_one_checkout_one_commit_per_update(sqlite_engine):
+    """Все записи апдейта — одно соединение из пула и один коммит"""
+    factory, counters = _make_factory(sqlite_engine)
+    cache = crud.SessionStateCache(mode="sync")
+    user_id, session_id = _simulate_click(factory, cache)
+    assert counters == {"checkouts": 1, "commits": 1}
+    assert current_session() is None
+
+    db = factory()
+    assert db.query(models.Response).count() == 2
+    assert crud.get_all_user_states(db, user_id, session_id)["score"] == 10
+    db.close()
+
+
+def _failed_update(factory, cache, user_id, session_id, changes):
+    try:
+        with unit_of_work(factory) as db:
+            cache.apply(db, user_id, session_id, changes)
+            crud.create_response(db, session_id, "n1", node_text="", answer_text="x")
+            raise RuntimeError("сбой посреди апдейта")
+    except RuntimeError:
+        pass
+
+
+def test_rollback_discards_whole_update(sqlite_engine):
+    """Исключение откатывает все записи апдейта вместе с изменениями состояния в кеше"""
+    factory, _ = _make_factory(sqlite_engine)
+    cache = crud.SessionStateCache(mode="sync")
+    with unit_of_work(factory) as db:
+        user_id = crud.get_or_create_user(db, telegram_id=2).id
+        session_id = crud.create_session(db, user_id=user_id, graph_id="test").id
+    _failed_update(factory, cache, user_id, session_id, {"score": 500, "bonus": 1})
+
+    db = factory()
+    assert db.query(models.Response).count() == 0
+    assert db.query(models.UserState).count() == 0
+    states = cache.get_states(db, user_id, session_id)
+    assert states["score"] == 0 and "bonus" not in states
+    assert cache.stats()["dirty_keys"] == 0 and cache.flush(db, session_id) == 0
+    # Повторный клик применяет формулу к состоянию до сбоя, а не поверх откатившегося
+    with unit_of_work(factory) as clean_db:
+        cache.apply(clean_db, user_id, session_id, {"coins": 3})
+    assert crud.get_all_user_states(db, user_id, session_id)["score"] == 0
+    db.close()
+
+
+def test_rollback_keeps_earlier_deferred_changes(sqlite_engine):
+    """batched: откат апдейта не теряет несброшенные изменения прошлых апдейтов"""
+    factory, _ = _make_factory(sqlite_engine)
+    cache = crud.SessionStateCache(mode="batched", flush_interval=3600)
+    with unit_of_work(factory) as db:
+        user_id = crud.get_or_create_user(db, telegram_id=5).id
+        session_id = crud.create_session(db, user_id=user_id, graph_id="test").id
+        cache.apply(db, user_id, session_id, {"score": 10})
+    _failed_update(factory, cache, user_id, session_id, {"score": 15})
+    assert cache.pending(session_id) == {"score": 10}
+    db = factory()
+    assert cache.flush(db, session_id) == 1
+    assert crud.get_all_user_states(db, user_id, session_id)["score"] == 10
+    db.close()
+
+
+def test_helpers_still_commit_outside_unit_of_work(sqlite_engine):
+    """Вне единицы работы хелперы crud коммитят сами, как раньше"""
+    factory, counters = _make_factory(sqlite_engine)
+    db = factory()
+    user = crud.get_or_create_user(db, telegram_id=4)
+    crud.create_session(db, user_id=user.id, graph_id="test")
+    db.close()
+    assert counters["commits"] == 2
+
+
+class _HandlerBot:
+    """Bot API в памяти: обработчики telebot и отправленные тексты."""
+
+    def __init__(self):
+        self.handlers, self.sent = {}, []
+
+    def message_handler(self, commands=None, **kwargs):
+        def deco(f):
+            self.handlers["start" if commands else "text"] = f
+            return f
+        return deco
+
+    def callback_query_handler(self, **kwargs):
+        def deco(f):
+            self.handlers["callback"] = f
+            return f
+        return deco
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+        return types.SimpleNamespace(message_id=len(self.sent), chat=types.SimpleNamespace(id=chat_id))
+
+    def edit_message_text(self, *args, **kwargs):
+        pass
+
+    def edit_message_reply_markup(self, *args, **kwargs):
+        pass
+
+    def answer_callback_query(self, *args, **kwargs):
+        pass
+
+
+def test_failed_step_rolls_back_whole_click(sqlite_engine):
+    """Сбой flush в process_node: ответ и состояние клика не фиксируются, обработчик не падает"""
+    assert telegram_handler.AI_AVAILABLE
+    factory, _ = _make_factory(sqlite_engine)
+    graph = compile_graph({"graph_id": "uow", "start_node_id": "q", "nodes": {
+        "q": {"type": "question", "text": "Рискнуть?",
+              "options": [{"text": "Да", "next_node_id": "end", "formula": "score = score + 5"}]},
+        "end": {"type": "state", "text": "Конец"},
+    }})
+
+    def failing_end_session(db, session_id):
+        db.add(models.Response(session_id=session_id, node_id=None, node_text="", answer_text=""))
+        db.flush()   # IntegrityError: сессия БД требует отката
+
+    saved = database.SessionLocal, telegram_handler.get_compiled_graph, crud.end_session
+    database.SessionLocal, telegram_handler.get_compiled_graph = factory, lambda: graph
+    crud.end_session = failing_end_session
+    bot = _HandlerBot()
+    try:
+        telegram_handler.register_handlers(bot, {})
+        bot.handlers["start"](types.SimpleNamespace(chat=types.SimpleNamespace(id=77), text="/start"))
+        question = types.SimpleNamespace(message_id=100, chat=types.SimpleNamespace(id=77))
+        bot.handlers["callback"](types.SimpleNamespace(id="cb", data="q|0", message=question))
+    finally:
+        database.SessionLocal, telegram_handler.get_compiled_graph, crud.end_session = saved
+        session_id = telegram_handler.user_sessions.pop(77)["session_id"]
+
+    assert bot.sent[-1] == "Критическая ошибка движка. /start"
+    db = factory()
+    assert db.query(models.Response).count() == 0
+    assert crud.get_all_user_states(db, 1, session_id).get("score", 0) == 0
+    # Кеш состояния откатился вместе с транзакцией: нечего дописывать, формула не применена
+    assert crud.state_cache.get_states(db, 1, session_id)["score"] == 0
+    assert crud.state_cache.pending(session_id) == {}
+    crud.state_cache.end(db, session_id)
+    assert db.get(models.Session, session_id).end_time is None
+    db.close()
+
+
+def test_ai_answer_continues_in_chat_queue(sqlite_engine):
+    """Ответ проактивного ИИ и вопрос узла обрабатываются в очереди чата, а не в потоке задания"""
+    factory, _ = _make_factory(sqlite_engine)
+    graph = compile_graph({"graph_id": "uow_ai", "start_node_id": "p", "nodes": {
+        "p": {"type": 'ai_proactive:default("Дай совет")', "text": "Рискнуть?",
+              "options": [{"text": "Да", "next_node_id": "p"}]},
+    }})
+    handed, done = [], threading.Event()
+
+    def runner(chat_id, callback):
+        handed.append((chat_id, threading.current_thread().name))
+        callback()
+        done.set()
+        return True
+
+    saved = database.SessionLocal, telegram_handler.get_compiled_graph, gigachat_handler.get_ai_response
+    database.SessionLocal, telegram_handler.get_compiled_graph = factory, lambda: graph
+    gigachat_handler.get_ai_response = lambda *args, **kwargs: "Совет ИИ"
+    set_node_callback_runner(runner)
+    bot = _HandlerBot()
+    try:
+        telegram_handler.register_handlers(bot, {})
+        bot.handlers["start"](types.SimpleNamespace(chat=types.SimpleNamespace(id=78), text="/start"))
+        assert done.wait(5)
+    finally:
+        set_node_callback_runner(None)
+        database.SessionLocal, telegram_handler.get_compiled_graph, gigachat_handler.get_ai_response = saved
+        telegram_handler.user_sessions.pop(78, None)
+
+    assert [chat_id for chat_id, _ in handed] == [78]
+    assert bot.sent[-1] == "Рискнуть?"
+    db = factory()
+    assert [d.ai_response for d in db.query(models.AIDialogue).all()] == ["Совет ИИ"]
+    db.close()
+
+
+if __name__ == "__main__":
+    from conftest import run_test
+
+    print("🚀 ТЕСТИРОВАНИЕ UNIT OF WORK")
+    for test in (test_one_checkout_one_commit_per_update, test_rollback_discards_whole_update,
+                 test_rollback_keeps_earlier_deferred_changes,
+                 test_helpers_still_commit_outside_unit_of_work, test_failed_step_rolls_back_whole_click,
+                 test_ai_answer_continues_in_chat_queue):
+        run_test(test)
+        print(f"✅ {test.__name__}")
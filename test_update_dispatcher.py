@@ -0,0 +1,71 @@
+# test_update_dispatcher.py
+# Тестирование асинхронного приёма апдейтов (очереди по чатам)
+
+import threading
+import time
+
+from app.modules.update_dispatcher import UpdateDispatcher, ACCEPTED, REJECTED, DROPPED
+
+
+def test_order_within_chat():
+    """Внутри одного чата апдейты обрабатываются строго по порядку"""
+    seen = {}
+    lock = threading.Lock()
+
+    def process(item):
+        chat, n = item
+        time.sleep(0.001)
+        with lock:
+            seen.setdefault(chat, []).append(n)
+
+    d = UpdateDispatcher(process, workers=4).start()
+    for n in range(50):
+        for chat in range(5):
+            assert d.submit(chat, (chat, n)) == ACCEPTED
+    d.stop(timeout=10)
+
+    for chat in range(5):
+        assert seen[chat] == list(range(50))
+    assert d.stats()["processed"] == 250
+    assert d.queue_depth() == 0
+
+
+def test_chats_run_in_parallel():
+    """Медленный чат не блокирует остальные"""
+    release = threading.Event()
+    fast_done = threading.Event()
+
+    def process(item):
+        if item == "slow":
+            release.wait(5)
+        else:
+            fast_done.set()
+
+    d = UpdateDispatcher(process, workers=2).start()
+    d.submit(1, "slow")
+    d.submit(2, "fast")
+    assert fast_done.wait(2)
+    release.set()
+    d.stop(timeout=5)
+
+
+def test_backpressure():
+    """Переполнение общей очереди и очереди одного чата"""
+    d = UpdateDispatcher(lambda item: None, workers=1, max_pending=3, max_per_chat=2)
+    # Воркеры не запущены — апдейты копятся в очередях
+    assert d.submit(1, "a") == ACCEPTED
+    assert d.submit(1, "b") == ACCEPTED
+    assert d.submit(1, "c") == DROPPED
+    assert d.submit(2, "d") == ACCEPTED
+    assert d.submit(3, "e") == REJECTED
+    stats = d.stats()
+    assert stats["pending"] == 3
+    assert stats["rejected_full"] == 1
+    assert stats["dropped_chat_overflow"] == 1
+
+
+if __name__ == "__main__":
+    print("🚀 ТЕСТИРОВАНИЕ ДИСПЕТЧЕРА АПДЕЙТОВ")
+    for test in (test_order_within_chat, test_chats_run_in_parallel, test_backpressure):
+        test()
+        print(f"✅ {test.__name__}")
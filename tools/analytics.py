@@ -0,0 +1,98 @@
+# tools/analytics.py
+# Аналитика сценариев из агрегатов (app/modules/database/analytics.py): выборы, воронка, отвалы, время на узле.
+# Запуск: PYTHONPATH=. python tools/analytics.py refresh                 (дельта-задание по курсорам)
+#         PYTHONPATH=. python tools/analytics.py rebuild                 (пересчет агрегатов с нуля)
+#         PYTHONPATH=. python tools/analytics.py choices GRAPH [--node NODE]
+#         PYTHONPATH=. python tools/analytics.py funnel GRAPH
+#         PYTHONPATH=. python tools/analytics.py dropoff GRAPH [--top 20]
+#         PYTHONPATH=. python tools/analytics.py dwell GRAPH NODE
+#         (--json — вывод в JSON; --refresh — перед запросом догнать курсоры)
+
+import argparse
+import json
+import time
+
+from app.modules.database import SessionLocal
+from app.modules.database.analytics import (
+    choice_distribution, dwell_histogram, funnel, node_dropoff, rebuild_analytics, refresh_analytics,
+)
+
+
+def _print_choices(rows):
+    node = None
+    for row in rows:
+        if row["node_id"] != node:
+            node = row["node_id"]
+            print(f"\n{node}")
+        print(f"  {row['count']:>8}  {row['share']:>6.1%}  {row['answer_text']}")
+
+
+def _print_funnel(result):
+    print(f"Сценарий {result['graph_id']}: начато {result['sessions']}, завершено {result['completed']} "
+          f"({result['completion_rate']:.1%}), ответов {result['responses']}")
+    for step in result["steps"]:
+        print(f"  шаг {step['step']:>4}: {step['sessions']:>8}  {step['share']:>6.1%}")
+
+
+def _print_dropoff(rows, top):
+    print(f"{'узел':<30} {'ответов':>9} {'отвалов':>9} {'доля':>7} {'ср. время, с':>13}")
+    for row in rows[:top]:
+        dwell = f"{row['avg_dwell_seconds']:.1f}" if row["avg_dwell_seconds"] is not None else "—"
+        print(f"{row['node_id']:<30} {row['visits']:>9} {row['dropoffs']:>9} {row['dropoff_rate']:>7.1%} {dwell:>13}")
+
+
+def _print_dwell(result):
+    print(f"{result['graph_id']} / {result['node_id']}: {result['count']} ответов, "
+          f"среднее {result['mean_seconds']} с, медиана ≈{result['p50_seconds']} с, p90 ≈{result['p90_seconds']} с")
+    for bucket in result["buckets"]:
+        upper = f"{bucket['to']}" if bucket["to"] is not None else "∞"
+        print(f"  {bucket['from']:>5}–{upper:<5} с: {bucket['count']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Аналитика сценариев из агрегатов")
+    parser.add_argument("command", choices=["refresh", "rebuild", "choices", "funnel", "dropoff", "dwell"])
+    parser.add_argument("graph_id", nargs="?")
+    parser.add_argument("node_id", nargs="?")
+    parser.add_argument("--node", default=None, help="choices: только этот узел")
+    parser.add_argument("--top", type=int, default=20, help="dropoff: сколько узлов показать")
+    parser.add_argument("--refresh", action="store_true", help="перед запросом выполнить дельта-задание")
+    parser.add_argument("--json", action="store_true", help="вывод в JSON")
+    args = parser.parse_args()
+
+    if args.command in ("refresh", "rebuild"):
+        result = (rebuild_analytics if args.command == "rebuild" else refresh_analytics)()
+        print(f"✅ Учтено: сессий {result['sessions']}, ответов {result['responses']}, "
+              f"завершений {result['completions']} за {result['ms']:.0f} мс")
+        raise SystemExit(0)
+    if not args.graph_id or (args.command == "dwell" and not args.node_id):
+        parser.error("укажите GRAPH (и NODE для dwell)")
+
+    if args.refresh:
+        refresh_analytics()
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        if args.command == "choices":
+            result = choice_distribution(db, args.graph_id, args.node or args.node_id)
+        elif args.command == "funnel":
+            result = funnel(db, args.graph_id)
+        elif args.command == "dropoff":
+            result = node_dropoff(db, args.graph_id)
+        else:
+            result = dwell_histogram(db, args.graph_id, args.node_id)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+    finally:
+        db.close()
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    elif args.command == "choices":
+        _print_choices(result)
+    elif args.command == "funnel":
+        _print_funnel(result)
+    elif args.command == "dropoff":
+        _print_dropoff(result, args.top)
+    else:
+        _print_dwell(result)
+    print(f"\n(ответ из агрегатов за {elapsed_ms:.1f} мс)")
@@ -0,0 +1,79 @@
+# tools/bench_ai_context.py
+# Бенчмарк сборки контекста ИИ: полная пересборка из БД на каждый ход vs накопитель сессии (ai_context).
+# Запуск: DATABASE_URL=sqlite:// PYTHONPATH=. python tools/bench_ai_context.py --steps 10 100 1000 --turns 50
+# По умолчанию — временная SQLite; для Postgres: --database-url postgresql://...
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app.modules.database import crud, models
+
+
+def _turn(db, user_id, session_id, i):
+    crud.create_response(db, session_id, f"step_{i}", node_text=f"Событие {i}: рынок изменился",
+                         answer_text=f"Решение {i}: держать позицию")
+    crud.bulk_update_user_states(db, user_id, session_id, {"score": i * 100, "capital_before": (i - 1) * 100})
+
+
+def _measure(factory, selects, steps: int, turns: int, incremental: bool):
+    db = factory()
+    user_id = crud.get_or_create_user(db, telegram_id=steps * 10 + int(incremental)).id
+    session_id = crud.create_session(db, user_id=user_id, graph_id="bench").id
+    for i in range(steps):
+        _turn(db, user_id, session_id, i)
+    crud.context_cache.clear()
+
+    elapsed, queries, size = 0.0, 0, 0
+    sink = io.StringIO()
+    for i in range(steps, steps + turns):
+        _turn(db, user_id, session_id, i)
+        if not incremental:
+            crud.context_cache.invalidate(session_id)   # как раньше: вся история из БД на каждый вызов
+        before = len(selects)
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(sink):
+            prompt = crud.build_full_context_for_ai(db, session_id, user_id, "Что посоветуешь?", [],
+                                                    ai_persona="financial_advisor")
+        elapsed += time.perf_counter() - t0
+        queries += len(selects) - before
+        size = len(prompt)
+    db.close()
+    return elapsed / turns * 1000, queries / turns, size
+
+
+def main(steps_list, turns: int, database_url: str):
+    if not database_url:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'ai_context.db')}"
+    engine = create_engine(database_url)
+    models.Base.metadata.create_all(bind=engine)
+    selects = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_selects(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            selects.append(1)
+
+    factory = sessionmaker(bind=engine)
+    print(f"{'шагов':>6} | {'пересборка, мс':>15} {'SELECT':>7} | {'накопитель, мс':>15} {'SELECT':>7} | {'ускорение':>9} | промпт, симв.")
+    for steps in steps_list:
+        full_ms, full_q, size = _measure(factory, selects, steps, turns, incremental=False)
+        inc_ms, inc_q, _ = _measure(factory, selects, steps, turns, incremental=True)
+        print(f"{steps:>6} | {full_ms:>15.3f} {full_q:>7.1f} | {inc_ms:>15.3f} {inc_q:>7.1f} | "
+              f"{full_ms / inc_ms:>8.1f}x | {size}")
+    print(f"Кеш контекста: {crud.context_cache.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк сборки контекста ИИ")
+    parser.add_argument("--steps", type=int, nargs="+", default=[10, 100, 1000], help="длина сессии в шагах")
+    parser.add_argument("--turns", type=int, default=50, help="вызовов ИИ на замер")
+    parser.add_argument("--database-url", default=None)
+    args = parser.parse_args()
+    main(args.steps, args.turns, args.database_url)
@@ -0,0 +1,266 @@
+# tools/bench_ai_latency.py
+# Нагрузочный прогон ИИ-узлов: N синтетических игроков одновременно идут по цепочке проактивных узлов,
+# бот работает через настоящие обработчики telegram_handler, а LLM — заглушка tools/fake_llm_server.py.
+# Отчет: пропускная способность, p50/p95/p99 от нажатия кнопки до следующего вопроса,
+# повторы (наши и клиента), паузы сессий, предохранитель и очереди ai_jobs при заданных сбоях.
+# Запуск: PYTHONPATH=. python tools/bench_ai_latency.py --players 50 --steps 5 --rate-429 0.05 --rate-500 0.05
+#         PYTHONPATH=. python tools/bench_ai_latency.py --backend vsegpt --rate-timeout 0.02 --timeout 5 --streaming
+# По умолчанию — временная SQLite; DATABASE_URL=postgresql://... — своя БД.
+# Параметры бота (AI_CONCURRENCY_*, AI_CACHE_ENABLED, AI_PREFETCH_ENABLED, ...) берутся из окружения как обычно.
+
+import argparse
+import base64
+import contextlib
+import io
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_llm_server import FakeLLMServer, add_profile_arguments, profile_from_args  # noqa: E402
+
+PAUSED = "paused"
+STUCK = "stuck"
+
+
+def _graph(steps: int) -> dict:
+    nodes = {"intro": {"type": "question", "text": "Готовы начать?",
+                       "options": [{"text": "Да", "next_node_id": "ai_1"}]}}
+    for i in range(1, steps + 1):
+        nodes[f"ai_{i}"] = {
+            "type": f'ai_proactive:master("Прокомментируй ход {i} и подскажи, что делать дальше")',
+            "text": f"Ход {i}. Продолжаем?",
+            "options": [{"text": "Дальше", "next_node_id": f"ai_{i + 1}" if i < steps else "end",
+                         "formula": f"score = score + {i * 1000}"}],
+        }
+    nodes["end"] = {"type": "state", "text": "Игра окончена", "next_node_id": None}
+    return {"graph_id": "bench_ai", "start_node_id": "intro", "nodes": nodes}
+
+
+class _Message:
+    _ids = itertools.count(1)
+
+    def __init__(self, chat_id, text=None):
+        self.message_id = next(self._ids)
+        self.chat = types.SimpleNamespace(id=chat_id)
+        self.text = text
+
+
+class BenchBot:
+    """Bot API в памяти: события по чатам и ожидание следующего вопроса игрока."""
+
+    def __init__(self):
+        self.handlers = {}
+        self._events = defaultdict(list)
+        self._cond = threading.Condition()
+
+    # --- регистрация обработчиков (как telebot) ---
+    def message_handler(self, commands=None, content_types=None, **kwargs):
+        def deco(f):
+            self.handlers["start" if commands else "text"] = f
+            return f
+        return deco
+
+    def callback_query_handler(self, func=None, **kwargs):
+        def deco(f):
+            self.handlers["callback"] = f
+            return f
+        return deco
+
+    # --- методы Bot API ---
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        message = _Message(chat_id, text)
+        self._record(chat_id, ("send", text, reply_markup, message))
+        return message
+
+    def send_photo(self, chat_id, photo=None, caption="", reply_markup=None, **kwargs):
+        return self.send_message(chat_id, caption, reply_markup)
+
+    def reply_to(self, message, text, **kwargs):
+        return self.send_message(message.chat.id, text)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self._record(chat_id, ("edit", text, None, None))
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        self._record(chat_id, ("delete", "", None, None))
+
+    def edit_message_reply_markup(self, *args, **kwargs):
+        pass
+
+    def answer_callback_query(self, *args, **kwargs):
+        pass
+
+    # --- ожидание ---
+    def mark(self, chat_id) -> int:
+        with self._cond:
+            return len(self._events[chat_id])
+
+    def wait_question(self, chat_id, since: int, timeout: float):
+        """Следующий вопрос с кнопками после since: (событие, ответ ИИ был?) | (PAUSED, ...) | (STUCK, ...)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                events = self._events[chat_id][since:]
+                answered = any(kind == "edit" and text.startswith("🎭") for kind, text, _, _ in events)
+                for kind, text, markup, message in events:
+                    if kind == "edit" and text.startswith("⚠️"):
+                        return PAUSED, answered
+                    if kind == "send" and markup is not None:
+                        return (message, markup), answered
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return STUCK, answered
+                self._cond.wait(left)
+
+    def _record(self, chat_id, event):
+        with self._cond:
+            self._events[chat_id].append(event)
+            self._cond.notify_all()
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def _play(bot, chat_id, steps, wait_limit, think_time, latencies, outcomes, lock):
+    since = bot.mark(chat_id)
+    bot.handlers["start"](_Message(chat_id, "/start"))
+    question, _ = bot.wait_question(chat_id, since, wait_limit)
+    for _ in range(steps):
+        if question in (PAUSED, STUCK):
+            break
+        time.sleep(think_time)
+        message, markup = question
+        since = bot.mark(chat_id)
+        started = time.perf_counter()
+        bot.handlers["callback"](types.SimpleNamespace(id=f"cb{chat_id}", data=markup.keyboard[0][0].callback_data,
+                                                       message=message))
+        question, answered = bot.wait_question(chat_id, since, wait_limit)
+        elapsed = time.perf_counter() - started
+        with lock:
+            if question in (PAUSED, STUCK):
+                outcomes[question] += 1
+            else:
+                latencies.append(elapsed)
+                outcomes["answered" if answered else "empty"] += 1
+    if question in (PAUSED, STUCK):
+        with lock:
+            outcomes[f"players_{question}"] += 1
+
+
+def _configure_env(args, url):
+    # Потоки игроков и заданий делят БД: SQLite в памяти у каждого потока своя, нужен файл
+    if os.environ.get("DATABASE_URL", "sqlite://") in ("", "sqlite://"):
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench_ai.db')}"
+    os.environ["AI_REQUEST_TIMEOUT"] = str(args.timeout)
+    os.environ["AI_STREAMING"] = "true" if args.streaming else "false"
+    if args.backend == "gigachat":
+        os.environ["COMPLIANCE_MODE"] = "true"
+        os.environ["GIGACHAT_CREDENTIALS"] = base64.b64encode(b"bench:bench").decode()
+        os.environ["GIGACHAT_BASE_URL"] = f"{url}/v1"
+        os.environ["GIGACHAT_AUTH_URL"] = f"{url}/oauth"
+    else:
+        os.environ["COMPLIANCE_MODE"] = "false"
+        os.environ["ACTIVE_MODEL"] = args.model
+        os.environ["VSEGPT_API_KEY"] = "bench"
+        os.environ["VSEGPT_BASE_URL"] = f"{url}/v1"
+        os.environ["VSEGPT_SDK_RETRIES"] = str(args.sdk_retries)
+
+
+def main(args):
+    server = FakeLLMServer(profile_from_args(args))
+    url = server.start()
+    _configure_env(args, url)
+
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        from app.modules import gigachat_handler, hot_reload
+        from app.modules import telegram_handler
+        from app.modules.ai_jobs import get_ai_executor
+        from app.modules.ai_resilience import resilience_stats
+        from app.modules.database import init_db
+        from app.modules.http_transport import transport_stats
+
+        init_db()
+        graph_path = os.path.join(tempfile.mkdtemp(), "bench_ai_graph.json")
+        with open(graph_path, "w", encoding="utf-8") as f:
+            json.dump(_graph(args.steps), f, ensure_ascii=False)
+        hot_reload.reload_graph_data(graph_path)
+        bot = BenchBot()
+        telegram_handler.register_handlers(bot, hot_reload.get_current_graph())
+
+    if not telegram_handler.AI_AVAILABLE:
+        print("❌ ИИ недоступен в telegram_handler — проверьте окружение:")
+        print(log.getvalue()[-2000:])
+        server.stop()
+        sys.exit(1)
+
+    latencies, outcomes, lock = [], defaultdict(int), threading.Lock()
+    players = [threading.Thread(target=_play, args=(bot, 10_000 + i, args.steps, args.wait_limit, args.think_time,
+                                                    latencies, outcomes, lock), daemon=True)
+               for i in range(args.players)]
+    print(f"🚀 {args.players} игроков x {args.steps} ИИ-узлов, бэкенд {args.backend}, заглушка {url}")
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        for player in players:
+            player.start()
+        for player in players:
+            player.join()
+    wall = time.perf_counter() - started
+
+    lines = log.getvalue().splitlines()
+    calls = sum(1 for line in lines if "[AI] Попытка 1/" in line)
+    attempts = sum(1 for line in lines if "[AI] Попытка " in line)
+    refusals = sum(1 for line in lines if "[AI] 🚫 Отказ" in line)
+    fake = server.stats()
+    server.stop()
+
+    steps_done = len(latencies)
+    print(f"\n⏱️  Время прогона: {wall:.1f} сек")
+    print(f"📈 Пропускная способность: {steps_done / wall:.2f} ИИ-узлов/сек ({steps_done} из {args.players * args.steps})")
+    if latencies:
+        print(f"🎯 От нажатия до следующего вопроса: p50={_percentile(latencies, 0.50):.2f} "
+              f"p95={_percentile(latencies, 0.95):.2f} p99={_percentile(latencies, 0.99):.2f} "
+              f"max={max(latencies):.2f} mean={statistics.mean(latencies):.2f} сек")
+    print(f"🧾 Узлы: с ответом ИИ {outcomes['answered']}, без ответа (пустой) {outcomes['empty']}, "
+          f"пауза {outcomes[PAUSED]}, не дождались {outcomes[STUCK]}")
+    print(f"⏸️  Игроков на паузе: {outcomes['players_' + PAUSED]}, зависших: {outcomes['players_' + STUCK]}")
+    print(f"🔁 Вызовы get_ai_response: {calls}, попыток: {attempts} (повторов {attempts - calls}), отказов: {refusals}")
+    print(f"🛰️  Заглушка: {fake} — HTTP-запросов сверх попыток (повторы клиента, hedging): "
+          f"{max(0, fake['requests'] - attempts)}")
+    stats = resilience_stats()
+    print(f"🔌 Предохранители: { {name: (b['state'], b['opened'], b['rejected']) for name, b in stats['breakers'].items()} } "
+          f"(состояние, размыканий, отклонено)")
+    print(f"🧵 ai_jobs: {get_ai_executor().stats()}")
+    if transport_stats()["pooled"]:
+        print(f"🔗 HTTP-пулы: {transport_stats()['endpoints']}")
+    if args.log:
+        with open(args.log, "w", encoding="utf-8") as f:
+            f.write(log.getvalue())
+        print(f"📝 Лог бота: {args.log}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк ИИ-узлов на заглушке LLM")
+    parser.add_argument("--players", type=int, default=20)
+    parser.add_argument("--steps", type=int, default=3, help="проактивных узлов на игрока")
+    parser.add_argument("--backend", choices=("gigachat", "vsegpt"), default="gigachat",
+                        help="gigachat — COMPLIANCE_MODE=true (сбой ставит сессию на паузу), vsegpt — эксперимент")
+    parser.add_argument("--model", default="deepseek-main", help="ACTIVE_MODEL для --backend vsegpt")
+    parser.add_argument("--timeout", type=float, default=10.0, help="AI_REQUEST_TIMEOUT, сек")
+    parser.add_argument("--sdk-retries", type=int, default=2, help="VSEGPT_SDK_RETRIES")
+    parser.add_argument("--streaming", action="store_true", help="AI_STREAMING=true")
+    parser.add_argument("--think-time", type=float, default=0.2, help="пауза игрока перед нажатием, сек")
+    parser.add_argument("--wait-limit", type=float, default=300.0, help="сколько ждать следующий вопрос, сек")
+    parser.add_argument("--log", default=None, help="сохранить вывод бота в файл")
+    add_profile_arguments(parser)
+    main(parser.parse_args())
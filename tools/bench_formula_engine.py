@@ -0,0 +1,82 @@
+# tools/bench_formula_engine.py
+# Микро-бенчмарк: старый путь SafeStateCalculator (split + regex + exec/eval исходника на каждый клик)
+# против скомпилированных и закешированных формул на формулах из data/default_interview.json.
+# Запуск: PYTHONPATH=. python tools/bench_formula_engine.py --iterations 100000
+
+import argparse
+import json
+import math
+import random
+import re
+import timeit
+
+from app.modules.state_calculator import FormulaError, compile_formula
+
+LEGACY_GLOBALS = {"__builtins__": None, "random": random, "math": math,
+                  "int": int, "float": float, "round": round, "max": max, "min": min, "abs": abs,
+                  "True": True, "False": False, "None": None}
+LEGACY_ASSIGN_RE = re.compile(r"^\s*[A-Za-z_][A-Za-z0-9_]*\s*=")
+
+
+def legacy_calculate(formula: str, current_state: dict) -> dict:
+    """Копия прежнего SafeStateCalculator.calculate (до компиляции формул)."""
+    statements = [s.strip() for s in formula.split(',') if s.strip()]
+    local_vars = dict(current_state)
+    try:
+        for stmt in statements:
+            if LEGACY_ASSIGN_RE.match(stmt):
+                exec(stmt, LEGACY_GLOBALS, local_vars)
+            else:
+                local_vars["score"] = eval(stmt, LEGACY_GLOBALS, local_vars)
+        return local_vars
+    except Exception:
+        return current_state
+
+
+def collect_formulas(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        graph = json.load(f)
+    formulas = []
+    for node in graph.get("nodes", {}).values():
+        for opt in node.get("options", []):
+            if opt.get("formula"):
+                formulas.append(str(opt["formula"]))
+    return formulas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк движка формул")
+    parser.add_argument("--graph", default="data/default_interview.json")
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    formulas = collect_formulas(args.graph)
+    state = {"score": 250000, "capital_before": 150000}
+    print(f"Формул в сценарии: {len(formulas)} (уникальных: {len(set(formulas))})")
+
+    compile_formula.cache_clear()
+    t_compile = timeit.timeit(lambda: [compile_formula(f) for f in set(formulas)], number=1)
+    compile_formula.cache_clear()
+
+    print(f"{'формула':45} {'старый, мкс':>12} {'новый, мкс':>12} {'ускорение':>10}")
+    total_legacy = total_new = 0.0
+    for formula in dict.fromkeys(formulas):
+        n = args.iterations
+        legacy = timeit.timeit(lambda: legacy_calculate(formula, state), number=n) / n * 1e6
+        try:
+            new = timeit.timeit(lambda: compile_formula(formula).evaluate(state), number=n) / n * 1e6
+        except FormulaError as e:
+            print(f"{formula[:45]:45} {legacy:12.2f} {'ошибка':>12}  ({e})")
+            continue
+        total_legacy += legacy
+        total_new += new
+        # Старый путь делил формулу по всем запятым и падал на вызовах со списками
+        note = "  (старый путь: ошибка разбора, состояние не менялось)" if legacy_calculate(formula, state) is state else ""
+        print(f"{formula[:45]:45} {legacy:12.2f} {new:12.2f} {legacy / new:9.1f}x{note}")
+        # Проверка, что результат совпадает там, где старый путь работал
+        if "random" not in formula:
+            assert legacy_calculate(formula, state) == compile_formula(formula).evaluate(state)
+
+    print(f"Итого на набор формул: старый {total_legacy:.2f} мкс, новый {total_new:.2f} мкс "
+          f"({total_legacy / total_new if total_new else 0:.1f}x)")
+    print(f"Разовая компиляция всех формул: {t_compile * 1e3:.2f} мс; кеш: {compile_formula.cache_info()}")
@@ -0,0 +1,149 @@
+# tools/bench_outbound_sender.py
+# Бенчмарк очереди исходящих: фейковый Bot API с фиксированным бюджетом (глобальный и на чат лимит, 429 с retry_after).
+# Сравнивает прямые вызовы из потоков обработчиков и OutboundSender.
+# Запуск: PYTHONPATH=. python tools/bench_outbound_sender.py --chats 50 --duration 10 --budget 30
+
+import argparse
+import statistics
+import threading
+import time
+import types
+
+from telebot.apihelper import ApiTelegramException
+
+from app.modules.telegram_sender import (
+    OutboundSender, TokenBucket, PRIORITY_COSMETIC, PRIORITY_INTERACTIVE,
+)
+
+
+class FakeTelegramAPI:
+    """Bot API с лимитами: budget запросов/сек на бота и chat_rate на чат; сверх лимита — 429."""
+
+    def __init__(self, budget: float, chat_rate: float, chat_burst: int, latency: float):
+        self.latency = latency
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(budget, budget)
+        self._chats = {}
+        self._lock = threading.Lock()
+        self.ok = {"send_message": 0, "edit_message_text": 0}
+        self.rejected = 0
+
+    def _admit(self, name, chat_id):
+        time.sleep(self.latency)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+            wait = max(self._global.wait_time(now), bucket.wait_time(now))
+            if wait > 0:
+                self.rejected += 1
+                raise ApiTelegramException(name, None, {
+                    "error_code": 429, "description": "Too Many Requests: retry later",
+                    "parameters": {"retry_after": max(1, int(wait + 0.999))}})
+            self._global.consume(now)
+            bucket.consume(now)
+            self.ok[name] += 1
+        return types.SimpleNamespace(message_id=1)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._admit("send_message", chat_id)
+
+    def edit_message_text(self, text=None, chat_id=None, message_id=None, **kwargs):
+        return self._admit("edit_message_text", chat_id)
+
+
+def _workload(chat_id, duration, answer_every, send, edit, latencies, lost, lock):
+    """Один игрок: ответ бота раз в answer_every сек и правка обратного отсчета каждую секунду."""
+    start = time.monotonic()
+    tick = 0
+    next_answer = start
+    while True:
+        now = time.monotonic()
+        if now - start >= duration:
+            return
+        if now >= next_answer:
+            t0 = time.monotonic()
+            try:
+                send(chat_id, "answer")
+                with lock:
+                    latencies.append(time.monotonic() - t0)
+            except Exception:
+                with lock:
+                    lost.append(chat_id)
+            next_answer += answer_every
+        tick += 1
+        try:
+            edit(chat_id, tick)
+        except Exception:
+            pass
+        time.sleep(max(0.0, start + tick - time.monotonic()))
+
+
+def run(mode, chats, duration, budget, chat_rate, chat_burst, latency, answer_every):
+    api = FakeTelegramAPI(budget, chat_rate, chat_burst, latency)
+    latencies, lost, lock = [], [], threading.Lock()
+    sender = None
+    if mode == "direct":
+        def send(chat_id, text):
+            return api.send_message(chat_id, text)
+
+        def edit(chat_id, tick):
+            return api.edit_message_text(f"Осталось: {tick}", chat_id, 1)
+    else:
+        # Небольшой запас относительно бюджета API
+        sender = OutboundSender(api, global_rate=budget * 0.9, chat_rate=chat_rate * 0.9,
+                                chat_burst=chat_burst, workers=16, name="BenchSender")
+
+        def send(chat_id, text):
+            return sender.call("send_message", chat_id, text, priority=PRIORITY_INTERACTIVE, timeout=60)
+
+        def edit(chat_id, tick):
+            sender.submit("edit_message_text", f"Осталось: {tick}", chat_id, 1,
+                          priority=PRIORITY_COSMETIC, coalesce=True)
+
+    threads = [threading.Thread(target=_workload, daemon=True,
+                                args=(c, duration, answer_every, send, edit, latencies, lost, lock))
+               for c in range(chats)]
+    t0 = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if sender is not None:
+        sender.stop(60)
+    elapsed = time.monotonic() - t0
+
+    total_ok = sum(api.ok.values())
+    print(f"=== {mode} ===")
+    print(f"Чатов: {chats}, длительность: {duration}s, бюджет API: {budget}/с, на чат: {chat_rate}/с")
+    print(f"Доставлено ответов: {api.ok['send_message']}, потеряно: {len(lost)}, "
+          f"правок отсчета: {api.ok['edit_message_text']}")
+    print(f"Ответов 429: {api.rejected}, успешных запросов/с: {total_ok / elapsed:.1f}")
+    if latencies:
+        ms = sorted(x * 1000 for x in latencies)
+        print(f"Задержка ответа, мс: p50={ms[len(ms) // 2]:.0f} p95={ms[int(len(ms) * 0.95)]:.0f} "
+              f"max={ms[-1]:.0f} mean={statistics.mean(ms):.0f}")
+    if sender is not None:
+        s = sender.stats()
+        print(f"Очередь: схлопнуто правок {s['coalesced']}, повторов после 429 {s['retries']}, "
+              f"ошибок {s['errors']}, ср. ожидание {s['avg_queue_wait_ms']} мс")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк очереди исходящих сообщений")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--budget", type=float, default=30.0, help="лимит Bot API, запросов/сек")
+    parser.add_argument("--chat-rate", type=float, default=1.0)
+    parser.add_argument("--chat-burst", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.03, help="задержка одного запроса, сек")
+    parser.add_argument("--answer-every", type=float, default=3.0, help="период ответов игроку, сек")
+    parser.add_argument("--mode", choices=("direct", "queued", "both"), default="both")
+    args = parser.parse_args()
+
+    modes = ("direct", "queued") if args.mode == "both" else (args.mode,)
+    for mode in modes:
+        run(mode, args.chats, args.duration, args.budget, args.chat_rate, args.chat_burst,
+            args.latency, args.answer_every)
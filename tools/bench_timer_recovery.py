@@ -0,0 +1,87 @@
+# tools/bench_timer_recovery.py
+# Бенчмарк персистентных таймеров: пачечная запись в active_timers и восстановление N pending-таймеров при старте.
+# Запуск: DATABASE_URL=sqlite:// PYTHONPATH=. python tools/bench_timer_recovery.py --timers 100000 --overdue 0.2
+# По умолчанию — временная SQLite; для Postgres: --database-url postgresql://...
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+from sqlalchemy import create_engine, delete
+from sqlalchemy.orm import sessionmaker
+
+from app.modules.database import models
+from app.modules.database.migrations import migrate_active_timers_index
+from app.modules.timer_store import PersistedTimer, TimerStore, utc_naive_now
+from app.modules.timing_engine import TimerScheduler
+
+
+def main(timers: int, overdue_ratio: float, spread: float, batch: int, database_url: str):
+    if not database_url:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'timers.db')}"
+    engine = create_engine(database_url)
+    models.Base.metadata.create_all(bind=engine, tables=[models.ActiveTimer.__table__])
+    migrate_active_timers_index(engine)
+    factory = sessionmaker(bind=engine)
+    with factory() as db:
+        db.execute(delete(models.ActiveTimer))
+        db.commit()
+
+    # --- Запись: регистрация и один пачечный flush ---
+    store = TimerStore(factory, flush_interval=3600)
+    now = utc_naive_now()
+    n_overdue = int(timers * overdue_ratio)
+    t0 = time.perf_counter()
+    for i in range(timers):
+        offset = -random.random() * 60 if i < n_overdue else 5 + random.random() * spread
+        store.add(PersistedTimer(i % 5000 + 1, 'timeout', now + timedelta(seconds=offset), f"node_{i % 50}",
+                                 {'chat_id': i}))
+    register_time = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    store.flush()
+    flush_time = time.perf_counter() - t0
+
+    print("=== Запись ===")
+    print(f"Таймеров: {timers}; регистрация: {register_time * 1e6 / timers:.2f} мкс/таймер, "
+          f"запись пачкой: {flush_time:.2f}s ({timers / flush_time:.0f} строк/с)")
+
+    # --- Восстановление после «рестарта» ---
+    fired = [0]
+    lock = threading.Lock()
+    all_overdue = threading.Event()
+
+    def resume(timer):
+        with lock:
+            fired[0] += 1
+            if fired[0] >= n_overdue:
+                all_overdue.set()
+
+    scheduler = TimerScheduler(workers=4, name="BenchRecovery")
+    restarted = TimerStore(factory, flush_interval=3600)
+    t0 = time.perf_counter()
+    report = restarted.recover(resume, scheduler, batch_size=batch, batch_interval=0.05)
+    recover_time = time.perf_counter() - t0
+    all_overdue.wait(60)
+    overdue_time = time.perf_counter() - t0
+
+    print("=== Восстановление ===")
+    print(f"Загружено: {report['loaded']} (запрос: {report['load_seconds']}s), "
+          f"восстановление целиком: {recover_time:.2f}s")
+    print(f"Просрочено: {report['overdue']} -> {report['overdue_batches']} пачек по {batch}, "
+          f"все сработали через {overdue_time:.2f}s")
+    print(f"Возвращено в планировщик: {report['rescheduled']}, живых таймеров: {scheduler.live_timers()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк восстановления персистентных таймеров")
+    parser.add_argument("--timers", type=int, default=100000)
+    parser.add_argument("--overdue", type=float, default=0.2, help="доля просроченных к моменту рестарта")
+    parser.add_argument("--spread", type=float, default=600.0, help="разброс сроков остальных, сек")
+    parser.add_argument("--batch", type=int, default=500, help="размер пачки просроченных")
+    parser.add_argument("--database-url", default=None)
+    args = parser.parse_args()
+    main(args.timers, args.overdue, args.spread, args.batch, args.database_url)
@@ -0,0 +1,111 @@
+# tools/bench_timer_scheduler.py
+# Бенчмарк TimerScheduler: сколько живых таймеров держит один поток и какова точность срабатывания.
+# Запуск: PYTHONPATH=. python tools/bench_timer_scheduler.py --timers 100000 --spread 5
+
+import argparse
+import random
+import resource
+import statistics
+import threading
+import time
+
+from app.modules.timing_engine import TimerScheduler
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def bench_scheduler(timers: int, spread: float, cancel_ratio: float, workers: int):
+    scheduler = TimerScheduler(workers=workers, name="BenchScheduler")
+    jitters = []
+    lock = threading.Lock()
+    done = threading.Event()
+    expected = timers - int(timers * cancel_ratio)
+
+    def on_fire(deadline):
+        j = time.monotonic() - deadline
+        with lock:
+            jitters.append(j)
+            if len(jitters) >= expected:
+                done.set()
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    threads_before = threading.active_count()
+    t0 = time.perf_counter()
+    handles = []
+    # Запас времени, чтобы все таймеры успели встать в очередь до первого срабатывания
+    base = time.monotonic() + 1.0 + timers * 3e-5
+    for _ in range(timers):
+        deadline = base + random.random() * spread
+        handles.append(scheduler.call_at(deadline, on_fire, deadline))
+    schedule_time = time.perf_counter() - t0
+    live_peak = scheduler.live_timers()
+    rss_delta = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) * 1024
+
+    t0 = time.perf_counter()
+    for h in random.sample(handles, int(timers * cancel_ratio)):
+        h.cancel()
+    cancel_time = time.perf_counter() - t0
+
+    done.wait(base - time.monotonic() + spread + 30)
+    threads_during = threading.active_count()
+    stats = scheduler.stats()
+
+    print("=== TimerScheduler ===")
+    print(f"Таймеров: {timers}, разброс: {spread}s, отменено: {int(timers * cancel_ratio)}")
+    print(f"Живых таймеров на пике: {live_peak}")
+    print(f"Потоков: до={threads_before}, после срабатываний={threads_during} (1 диспетчер + до {workers} исполнителей)")
+    print(f"Планирование: {schedule_time * 1e6 / timers:.2f} мкс/таймер, отмена: {cancel_time * 1e6 / max(1, int(timers * cancel_ratio)):.2f} мкс/таймер")
+    print(f"Прирост RSS: {rss_delta / 1024 / 1024:.1f} МБ ({rss_delta / timers:.0f} байт/таймер)")
+    print(f"Сработало: {stats['fired']}, ошибок: {stats['errors']}")
+    if jitters:
+        ms = [j * 1000 for j in jitters]
+        print(f"Джиттер, мс: p50={_percentile(ms, 0.5):.3f} p95={_percentile(ms, 0.95):.3f} "
+              f"p99={_percentile(ms, 0.99):.3f} max={max(ms):.3f} mean={statistics.mean(ms):.3f}")
+
+
+def bench_thread_timers(timers: int, spread: float):
+    """Старый подход: threading.Timer на каждый таймер (для сравнения, на небольшом N)."""
+    jitters = []
+    lock = threading.Lock()
+    t0 = time.perf_counter()
+    started = []
+    base = time.monotonic() + 1.0
+    for _ in range(timers):
+        deadline = base + random.random() * spread
+        delay = deadline - time.monotonic()
+
+        def fire(d=deadline):
+            with lock:
+                jitters.append(time.monotonic() - d)
+        t = threading.Timer(delay, fire)
+        t.daemon = True
+        t.start()
+        started.append(t)
+    schedule_time = time.perf_counter() - t0
+    peak_threads = threading.active_count()
+    for t in started:
+        t.join()
+    ms = [j * 1000 for j in jitters]
+    print("=== threading.Timer (старый подход) ===")
+    print(f"Таймеров: {timers}, потоков на пике: {peak_threads}")
+    print(f"Планирование: {schedule_time * 1e6 / timers:.2f} мкс/таймер")
+    print(f"Джиттер, мс: p50={_percentile(ms, 0.5):.3f} p99={_percentile(ms, 0.99):.3f} max={max(ms):.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк TimerScheduler")
+    parser.add_argument("--timers", type=int, default=100000)
+    parser.add_argument("--spread", type=float, default=5.0, help="разброс сроков, сек")
+    parser.add_argument("--cancel", type=float, default=0.3, help="доля отменяемых таймеров")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--compare", type=int, default=0, help="N таймеров для сравнения с threading.Timer")
+    args = parser.parse_args()
+
+    bench_scheduler(args.timers, args.spread, args.cancel, args.workers)
+    if args.compare:
+        bench_thread_timers(args.compare, args.spread)
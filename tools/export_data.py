@@ -1,83 +1,611 @@
 # tools/export_data.py
+# Выгрузка данных исследования в CSV: потоково, чанками через серверный курсор.
+# Запуск: PYTHONPATH=. python tools/export_data.py --output results.csv
+#         PYTHONPATH=. python tools/export_data.py --split --output results.csv   (sessions / responses / ai_dialogues отдельно)
+#         PYTHONPATH=. python tools/export_data.py --workers 4 --output results.csv   (параллельно по диапазонам session_id)
+#         PYTHONPATH=. python tools/export_data.py --parquet export/ [--partition-by graph_id] [--full]
+#         (инкрементальная выгрузка в Parquet: дописываются только новые строки, --full — пересборка;
+#          строки моложе EXPORT_SETTLE_SECONDS ждут следующего запуска, --settle 0 — не ждать)
 
+import argparse
+import json
 import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import pandas as pd
 import pytz
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from decouple import config
 
+# Комментарий: pyarrow нужен только для --parquet; CSV-выгрузка работает без него.
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pa_dataset
+    import pyarrow.parquet as pq
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
 # Комментарий: Подключаемся к базе данных, используя ту же логику, что и в основном приложении.
 # Скрипт автоматически подхватит DATABASE_URL из вашего .env файла.
 DATABASE_URL = config("DATABASE_URL")
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-def export_data_to_csv(filename: str = "results.csv"):
+# Комментарий: Сколько строк читается с сервера и пишется в файл за раз — от него зависит память, а не от размера таблиц.
+EXPORT_CHUNK_SIZE = config("EXPORT_CHUNK_SIZE", default=20000, cast=int)
+# Комментарий: Транзакции апдейтов (unit of work) открыты и во время отправок в Telegram, поэтому строки
+# фиксируются не в порядке id. Отметка не заходит за строки моложе этого интервала — иначе строка
+# с меньшим id, зафиксированная позже, не выгрузится никогда (то же окно — ANALYTICS_SETTLE_SECONDS в аналитике).
+EXPORT_SETTLE_SECONDS = config("EXPORT_SETTLE_SECONDS", default=60.0, cast=float)
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+# Комментарий: Каждая строка — одно событие: ответ на узел ИЛИ диалог с ИИ (UNION ALL).
+# Раньше responses и ai_dialogues присоединялись к сессии одновременно, и сессия
+# с R ответами и D диалогами давала R×D строк. Колонки прежние, плюс event_type.
+EVENTS_QUERY_TEMPLATE = """
+    SELECT * FROM (
+        SELECT
+            'response' AS event_type,
+            s.id AS session_id,
+            u.telegram_id,
+            s.graph_id,
+            s.start_time AS session_start_utc,
+            s.end_time AS session_end_utc,
+            r.node_id AS response_node_id,
+            r.answer_text,
+            r.timestamp AS response_timestamp_utc,
+            NULL AS ai_node_id,
+            NULL AS user_message,
+            NULL AS ai_response,
+            NULL AS ai_timestamp_utc,
+            r.timestamp AS event_timestamp,
+            r.id AS event_id
+        FROM responses r
+        JOIN sessions s ON r.session_id = s.id
+        JOIN users u ON s.user_id = u.id
+        WHERE {r}
+        UNION ALL
+        SELECT
+            'ai_dialogue', s.id, u.telegram_id, s.graph_id, s.start_time, s.end_time,
+            NULL, NULL, NULL,
+            d.node_id, d.user_message, d.ai_response, d.timestamp,
+            d.timestamp, d.id
+        FROM ai_dialogues d
+        JOIN sessions s ON d.session_id = s.id
+        JOIN users u ON s.user_id = u.id
+        WHERE {d}
+        UNION ALL
+        SELECT
+            'session', s.id, u.telegram_id, s.graph_id, s.start_time, s.end_time,
+            NULL, NULL, NULL, NULL, NULL, NULL, NULL,
+            s.start_time, s.id
+        FROM sessions s
+        JOIN users u ON s.user_id = u.id
+        -- Комментарий: NOT IN по множеству (hash anti-join), а не коррелированный NOT EXISTS:
+        -- на базах без ix_responses_session_id (до миграции) NOT EXISTS сканировал бы таблицу на каждую сессию
+        WHERE {s} AND s.id NOT IN (
+            SELECT r.session_id FROM responses r WHERE {r} UNION SELECT d.session_id FROM ai_dialogues d WHERE {d})
+    ) events
+    ORDER BY session_id, event_timestamp, event_type, event_id
+"""
+
+# Комментарий: {s}/{r}/{d} — фильтр по диапазону session_id для параллельной выгрузки (--workers);
+# без шардов подставляется 1 = 1.
+SHARD_COLUMNS = {"s": "s.id", "r": "r.session_id", "d": "d.session_id"}
+
+
+def shard_query(template: str, sharded: bool = False) -> str:
+    """Подставляет в шаблон запроса фильтр session_id BETWEEN :lo AND :hi (или пустое условие)."""
+    return template.format(**{key: f"{column} BETWEEN :lo AND :hi" if sharded else "1 = 1"
+                              for key, column in SHARD_COLUMNS.items()})
+
+
+EVENTS_QUERY = shard_query(EVENTS_QUERY_TEMPLATE)
+EVENTS_TIME_COLUMNS = ['session_start_utc', 'session_end_utc', 'response_timestamp_utc', 'ai_timestamp_utc']
+
+EVENTS_DROP_COLUMNS = ("event_timestamp", "event_id")
+
+# Комментарий: Режим --split — три отдельных потока строк, без объединения (шаблоны, см. shard_query).
+SPLIT_QUERIES = {
+    "sessions": ("""
+        SELECT s.id AS session_id, u.telegram_id, s.graph_id, s.start_time AS session_start_utc,
+               s.end_time AS session_end_utc, s.is_paused, s.is_official_research, s.group_id
+        FROM sessions s JOIN users u ON s.user_id = u.id
+        WHERE {s}
+        ORDER BY s.id
+    """, ['session_start_utc', 'session_end_utc']),
+    "responses": ("""
+        SELECT r.id AS response_id, r.session_id, r.node_id, r.node_text, r.answer_text,
+               r.timestamp AS response_timestamp_utc
+        FROM responses r
+        WHERE {r}
+        ORDER BY r.session_id, r.id
+    """, ['response_timestamp_utc']),
+    "ai_dialogues": ("""
+        SELECT d.id AS dialogue_id, d.session_id, d.node_id, d.user_message, d.ai_response,
+               d.timestamp AS ai_timestamp_utc
+        FROM ai_dialogues d
+        WHERE {d}
+        ORDER BY d.session_id, d.id
+    """, ['ai_timestamp_utc']),
+}
+
+
+def stream_query(bind, query: str, params: dict = None, chunk_size: int = EXPORT_CHUNK_SIZE):
     """
-    Собирает все данные из таблиц users, sessions, responses, ai_dialogues,
-    объединяет их, преобразует время в московское и сохраняет в CSV-файл.
+    Отдает результат запроса DataFrame-чанками по chunk_size строк.
+    stream_results=True — серверный (именованный) курсор в PostgreSQL: строки
+    не буферизуются драйвером целиком, в памяти только текущий чанк.
     """
-    db = SessionLocal()
+    with bind.connect() as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(
+            text(query), params or {})
+        columns = list(result.keys())
+        for rows in result.partitions(chunk_size):
+            yield pd.DataFrame.from_records(rows, columns=columns)
+
+
+def to_moscow(df: pd.DataFrame, time_columns) -> pd.DataFrame:
+    """Добавляет к каждой колонке *_utc колонку *_msk (московское время); пустые значения — NaT."""
+    for col in time_columns:
+        # Комментарий: utc=True — значения без зоны (SQLite) считаются UTC, как и пишет приложение
+        utc = pd.to_datetime(df[col], utc=True, format="ISO8601", errors="coerce")
+        df[col.replace('_utc', '_msk')] = utc.dt.tz_convert(MOSCOW_TZ)
+    return df
+
+
+def write_csv_stream(chunks, filename: str, time_columns, drop_columns=(), label: str = "") -> int:
+    """Пишет чанки в CSV по мере чтения. Возвращает число строк; label — префикс строк прогресса."""
+    rows = 0
+    with open(filename, "w", encoding="utf-8-sig", newline="") as f:
+        for i, df in enumerate(chunks):
+            df = to_moscow(df, time_columns).drop(columns=list(drop_columns))
+            # Комментарий: encoding='utf-8-sig' (BOM один раз в начале файла) важен для кириллицы в Excel.
+            df.to_csv(f, index=False, header=(i == 0))
+            rows += len(df)
+            print(f"  {label}... {rows} строк")
+    return rows
+
+
+def export_data_to_csv(filename: str = "results.csv", chunk_size: int = EXPORT_CHUNK_SIZE,
+                       split: bool = False, bind=None) -> int:
+    """
+    Выгружает сессии, ответы и диалоги с ИИ в CSV, преобразуя время в московское.
+    Данные читаются и пишутся чанками — память не зависит от размера таблиц.
+
+    split=False: один файл, строка = событие (ответ, диалог или сессия без событий).
+    split=True: <имя>_sessions.csv, <имя>_responses.csv, <имя>_ai_dialogues.csv.
+    Возвращает общее число выгруженных строк.
+    """
+    bind = bind or engine
+    started = time.perf_counter()
     print("Подключение к базе данных...")
-    
+    total = 0
     try:
-        # Комментарий: Этот сложный SQL-запрос с помощью LEFT JOIN объединяет все наши таблицы
-        # в одну большую "плоскую" таблицу, где каждая строка представляет собой одно событие (ответ или диалог).
-        query = text("""
-            SELECT
-                s.id AS session_id,
-                u.telegram_id,
-                s.graph_id,
-                s.start_time AS session_start_utc,
-                s.end_time AS session_end_utc,
-                r.node_id AS response_node_id,
-                r.answer_text,
-                r.timestamp AS response_timestamp_utc,
-                d.node_id AS ai_node_id,
-                d.user_message,
-                d.ai_response,
-                d.timestamp AS ai_timestamp_utc
-            FROM sessions s
-            JOIN users u ON s.user_id = u.id
-            LEFT JOIN responses r ON r.session_id = s.id
-            LEFT JOIN ai_dialogues d ON d.session_id = s.id
-            ORDER BY s.id, r.timestamp, d.timestamp
-        """)
-
-        print("Выполнение запроса к базе данных...")
-        # Комментарий: Использование pandas.read_sql_query - это удобный способ сразу
-        # выполнить запрос и загрузить результат в DataFrame.
-        df = pd.read_sql_query(query, db.bind)
-
-        print(f"Получено {len(df)} строк. Начинаем обработку времени...")
-        
-        # --- Преобразование времени в московское ---
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        
-        # Список колонок с временем, которые нужно преобразовать
-        time_columns = [
-            'session_start_utc', 'session_end_utc', 
-            'response_timestamp_utc', 'ai_timestamp_utc'
-        ]
-        
-        for col in time_columns:
-            # Новое имя колонки, например, session_start_msk
-            new_col_name = col.replace('_utc', '_msk')
-            # Преобразуем время, игнорируя пустые значения (NaT)
-            df[new_col_name] = pd.to_datetime(df[col]).dt.tz_convert(moscow_tz)
-
-        print("Преобразование времени завершено. Сохранение в файл...")
-        # Сохраняем в CSV. encoding='utf-8-sig' важен для корректного отображения кириллицы в Excel.
-        df.to_csv(filename, index=False, encoding='utf-8-sig')
-
-        print(f"✅ Данные успешно выгружены в файл: {filename}")
-
+        if split:
+            stem, ext = os.path.splitext(filename)
+            for name, (query, time_columns) in SPLIT_QUERIES.items():
+                path = f"{stem}_{name}{ext or '.csv'}"
+                print(f"Выгрузка {name} -> {path}")
+                total += write_csv_stream(stream_query(bind, shard_query(query), chunk_size=chunk_size),
+                                          path, time_columns)
+        else:
+            print("Выполнение запроса к базе данных...")
+            total = write_csv_stream(stream_query(bind, EVENTS_QUERY, chunk_size=chunk_size), filename,
+                                     EVENTS_TIME_COLUMNS, drop_columns=EVENTS_DROP_COLUMNS)
+        print(f"✅ Данные успешно выгружены ({total} строк за {time.perf_counter() - started:.1f} сек): {filename}")
     except Exception as e:
         print(f"❌ Произошла ошибка при выгрузке данных: {e}")
     finally:
         print("Закрытие соединения с базой данных.")
-        db.close()
+    return total
+
+
+# === ПАРАЛЛЕЛЬНАЯ ВЫГРУЗКА ПО ДИАПАЗОНАМ SESSION_ID ===
+
+# Комментарий: Шардов больше, чем воркеров: длинные и короткие диапазоны выравниваются по времени,
+# а освободившийся воркер берет следующий диапазон.
+SHARDS_PER_WORKER = 4
+
+_worker_engine = None
+
+
+def session_id_ranges(bind, shards: int):
+    """
+    Делит id сессий на shards диапазонов [lo, hi] с примерно равным числом сессий.
+    Границы — id сессии с номером k*N/shards (по индексу первичного ключа), а не равные
+    отрезки [min, max]: id с пропусками и сессии разной длины не дают пустых шардов.
+    """
+    with bind.connect() as conn:
+        count = conn.execute(text("SELECT COUNT(*) FROM sessions")).scalar() or 0
+        if not count:
+            return []
+        shards = max(1, min(int(shards), count))
+        bounds = [conn.execute(text("SELECT id FROM sessions ORDER BY id LIMIT 1 OFFSET :offset"),
+                               {"offset": count * k // shards}).scalar() for k in range(shards)]
+        max_id = conn.execute(text("SELECT MAX(id) FROM sessions")).scalar()
+    bounds = sorted(set(bounds))
+    return [(lo, bounds[i + 1] - 1 if i + 1 < len(bounds) else max_id) for i, lo in enumerate(bounds)]
+
+
+def _init_worker(database_url: str):
+    """Инициализация процесса пула: одно соединение на воркер, унаследованный от родителя пул не трогаем."""
+    global _worker_engine
+    engine.dispose(close=False)
+    _worker_engine = create_engine(database_url, pool_size=1, max_overflow=0)
+
+
+def _export_shard(job: dict) -> dict:
+    """Выгружает один диапазон session_id в файл-часть (выполняется в процессе пула)."""
+    started = time.perf_counter()
+    query = shard_query(job["template"], sharded=True)
+    chunks = stream_query(_worker_engine, query, {"lo": job["lo"], "hi": job["hi"]}, job["chunk_size"])
+    rows = write_csv_stream(chunks, job["path"], job["time_columns"], job["drop_columns"], label=f"[{job['label']}] ")
+    return {**job, "rows": rows, "seconds": time.perf_counter() - started}
+
+
+def merge_csv_parts(paths, filename: str) -> int:
+    """Склеивает части по порядку в один CSV: один BOM и одна строка заголовка. Возвращает размер в байтах."""
+    header_written = False
+    with open(filename, "wb") as out:
+        for path in paths:
+            with open(path, "rb") as part:
+                head = part.readline()
+                if not head:
+                    continue   # Комментарий: пустой диапазон — файл без заголовка
+                if not header_written:
+                    out.write(head)
+                    header_written = True
+                shutil.copyfileobj(part, out, 1024 * 1024)
+        return out.tell()
+
+
+def export_data_to_csv_parallel(filename: str = "results.csv", workers: int = 4, shards: int = None,
+                                chunk_size: int = EXPORT_CHUNK_SIZE, split: bool = False, merge: bool = True,
+                                bind=None) -> int:
+    """
+    Та же выгрузка, что export_data_to_csv, но диапазоны session_id обрабатываются
+    параллельно в пуле из workers процессов (у каждого — одно соединение с БД).
+
+    Каждый шард пишет свою часть в <имя>.parts/; merge=True — части склеиваются по
+    порядку в итоговый файл (результат совпадает с последовательной выгрузкой) и удаляются,
+    merge=False — части остаются, рядом пишется index.json с диапазонами и числом строк.
+    По каждому шарду и в итоге печатается скорость (строк/с) — по ней подбирается число воркеров.
+    """
+    bind = bind or engine
+    started = time.perf_counter()
+    stem, ext = os.path.splitext(filename)
+    ext = ext or ".csv"
+    parts_dir = f"{stem}.parts"
+    if split:
+        targets = [(name, template, time_columns, (), f"{stem}_{name}{ext}")
+                   for name, (template, time_columns) in SPLIT_QUERIES.items()]
+    else:
+        targets = [("events", EVENTS_QUERY_TEMPLATE, EVENTS_TIME_COLUMNS, EVENTS_DROP_COLUMNS, filename)]
+
+    ranges = session_id_ranges(bind, shards or max(1, workers) * SHARDS_PER_WORKER)
+    jobs = [{"target": name, "template": template, "time_columns": time_columns, "drop_columns": drop_columns,
+             "output": output, "lo": lo, "hi": hi, "chunk_size": chunk_size,
+             "path": os.path.join(parts_dir, f"{name}-{i:05d}{ext}"), "label": f"{name} {i + 1}/{len(ranges)}"}
+            for name, template, time_columns, drop_columns, output in targets
+            for i, (lo, hi) in enumerate(ranges)]
+    print(f"Параллельная выгрузка: {len(ranges)} диапазонов session_id x {len(targets)} потоков, воркеров: {workers}")
+
+    os.makedirs(parts_dir, exist_ok=True)
+    done = []
+    total = 0
+    try:
+        database_url = bind.url.render_as_string(hide_password=False)
+        with ProcessPoolExecutor(max_workers=max(1, workers), initializer=_init_worker,
+                                 initargs=(database_url,)) as pool:
+            for future in as_completed([pool.submit(_export_shard, job) for job in jobs]):
+                shard = future.result()
+                done.append(shard)
+                total += shard["rows"]
+                speed = shard["rows"] / shard["seconds"] if shard["seconds"] else 0.0
+                print(f"  [{shard['label']}] session_id {shard['lo']}–{shard['hi']}: {shard['rows']} строк "
+                      f"за {shard['seconds']:.1f} сек ({speed:.0f} строк/с) — готово {len(done)}/{len(jobs)}")
+
+        done.sort(key=lambda shard: shard["path"])
+        if merge:
+            merge_started = time.perf_counter()
+            for name, _, _, _, output in targets:
+                merge_csv_parts([shard["path"] for shard in done if shard["target"] == name], output)
+            shutil.rmtree(parts_dir)
+            print(f"Части склеены за {time.perf_counter() - merge_started:.1f} сек")
+        else:
+            index = [{key: shard[key] for key in ("target", "output", "lo", "hi", "rows", "seconds")}
+                     | {"file": os.path.basename(shard["path"])} for shard in done]
+            with open(os.path.join(parts_dir, "index.json"), "w", encoding="utf-8") as f:
+                json.dump({"parts": index}, f, ensure_ascii=False, indent=2)
+            print(f"Части оставлены в {parts_dir}, индекс: {os.path.join(parts_dir, 'index.json')}")
+
+        elapsed = time.perf_counter() - started
+        busy = sum(shard["seconds"] for shard in done)
+        # Комментарий: загрузка = суммарное время шардов / (время x воркеры); если она заметно ниже 1,
+        # узкое место — БД или диск, и новые воркеры скорости не добавят
+        utilization = busy / (elapsed * max(1, workers)) if elapsed else 0.0
+        print(f"✅ Данные успешно выгружены ({total} строк за {elapsed:.1f} сек, "
+              f"{total / elapsed if elapsed else 0:.0f} строк/с, воркеров: {workers}, загрузка {utilization:.0%})")
+    except Exception as e:
+        print(f"❌ Произошла ошибка при выгрузке данных: {e}")
+    return total
+
+
+# === ИНКРЕМЕНТАЛЬНАЯ ВЫГРУЗКА В PARQUET ===
+
+class ParquetTable:
+    """
+    Набор данных Parquet для одной таблицы.
+
+    watermark — выражение «отметки уровня»: строки с отметкой выше сохраненной считаются новыми.
+    Для неизменяемых таблиц (ответы, диалоги) это id. Сессии (end_time) и user_states (UPSERT)
+    меняются задним числом — для них отметка по времени изменения, строка выгружается
+    заново при каждом изменении, а read_parquet_table оставляет последнюю версию по keys.
+    Свежесть строки (EXPORT_SETTLE_SECONDS) — по ее времени: date_column, у изменяемых — сама отметка.
+    """
+
+    def __init__(self, name, select, source, watermark, keys, date_column, dtypes, mutable=False):
+        self.name = name
+        self.select = select
+        self.source = source
+        self.watermark = watermark
+        self.keys = keys
+        self.date_column = date_column
+        self.dtypes = dtypes
+        self.mutable = mutable
+
+    def query(self, has_watermark: bool) -> str:
+        # Комментарий: для изменяемых таблиц >= — строки с той же секундой, записанные после прошлой
+        # выгрузки, не теряются; повтор граничной строки снимает дедупликация при чтении
+        where = f"WHERE {self.watermark} {'>=' if self.mutable else '>'} :watermark" if has_watermark else ""
+        return f"SELECT {self.select}, {self.watermark} AS _watermark FROM {self.source} {where} ORDER BY _watermark"
+
+    @property
+    def settle_column(self) -> str:
+        return "_watermark" if self.mutable else self.date_column
+
+
+_TEXT = "string"
+PARQUET_TABLES = [
+    ParquetTable(
+        "sessions",
+        "s.id AS session_id, u.telegram_id, s.graph_id, s.start_time AS session_start_utc, "
+        "s.end_time AS session_end_utc, s.is_paused, s.is_official_research, s.group_id",
+        "sessions s JOIN users u ON s.user_id = u.id",
+        "COALESCE(s.end_time, s.start_time)", ["session_id"], "session_start_utc",
+        {"telegram_id": _TEXT, "graph_id": _TEXT, "is_paused": "boolean", "is_official_research": "boolean",
+         "group_id": "Int64"},
+        mutable=True,
+    ),
+    ParquetTable(
+        "responses",
+        "r.id AS response_id, r.session_id, s.graph_id, r.node_id, r.node_text, r.answer_text, "
+        "r.timestamp AS response_timestamp_utc",
+        "responses r JOIN sessions s ON r.session_id = s.id",
+        "r.id", ["response_id"], "response_timestamp_utc",
+        {"graph_id": _TEXT, "node_id": _TEXT, "node_text": _TEXT, "answer_text": _TEXT},
+    ),
+    ParquetTable(
+        "ai_dialogues",
+        "d.id AS dialogue_id, d.session_id, s.graph_id, d.node_id, d.user_message, d.ai_response, "
+        "d.timestamp AS ai_timestamp_utc",
+        "ai_dialogues d JOIN sessions s ON d.session_id = s.id",
+        "d.id", ["dialogue_id"], "ai_timestamp_utc",
+        {"graph_id": _TEXT, "node_id": _TEXT, "user_message": _TEXT, "ai_response": _TEXT},
+    ),
+    ParquetTable(
+        "user_states",
+        "us.id AS state_id, us.user_id, us.session_id, s.graph_id, us.state_key, us.state_value, "
+        "us.timestamp AS state_timestamp_utc",
+        "user_states us JOIN sessions s ON us.session_id = s.id",
+        "us.timestamp", ["state_id"], "state_timestamp_utc",
+        {"graph_id": _TEXT, "state_key": _TEXT, "state_value": _TEXT},
+        mutable=True,
+    ),
+]
+PARQUET_TABLES_BY_NAME = {t.name: t for t in PARQUET_TABLES}
+PARTITION_CHOICES = ("date", "graph_id")
+WATERMARKS_FILE = "_watermarks.json"
+
+
+def load_watermarks(root: str) -> dict:
+    path = os.path.join(root, WATERMARKS_FILE)
+    if not os.path.exists(path):
+        return {"tables": {}}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_watermarks(root: str, state: dict):
+    """Атомарная запись: отметки меняются только после того, как файлы данных на месте."""
+    path = os.path.join(root, WATERMARKS_FILE)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2, default=str)
+    os.replace(tmp, path)
+
+
+def incremental_chunks(bind, table: ParquetTable, mark: dict = None, chunk_size: int = EXPORT_CHUNK_SIZE,
+                       settle_seconds: float = EXPORT_SETTLE_SECONDS):
+    """
+    Новые строки таблицы DataFrame-чанками с колонкой _watermark.
+    mark = {"value": отметка, "boundary": [id]} из прошлого запуска; строки изменяемых таблиц
+    с отметкой, равной сохраненной, и уже выгруженные тогда (boundary), пропускаются.
+    Выгрузка останавливается на первой (по отметке) строке моложе settle_seconds: она и все
+    следующие ждут следующего запуска.
+    """
+    value = (mark or {}).get("value")
+    boundary = set((mark or {}).get("boundary") or ())
+    params = {"watermark": value} if value is not None else {}
+    settled = pd.Timestamp.now(tz="UTC") - pd.Timedelta(seconds=settle_seconds)
+    for df in stream_query(bind, table.query(value is not None), params, chunk_size):
+        if boundary:
+            df = df[~((df["_watermark"].astype(str) == str(value)) & df[table.keys[0]].isin(boundary))]
+            if df.empty:
+                continue
+        # Комментарий: время без зоны (SQLite) считается UTC; строка без времени считается устоявшейся
+        stamps = pd.to_datetime(df[table.settle_column], utc=True, format="ISO8601", errors="coerce")
+        fresh = (stamps > settled).to_numpy()
+        if fresh.any():
+            df = df.iloc[:fresh.argmax()]
+            if not df.empty:
+                yield df
+            return
+        yield df
+
+
+def advance_mark(mark: dict, df: pd.DataFrame, table: ParquetTable) -> dict:
+    """Отметка после чанка (чанки упорядочены по _watermark) и id строк на самой отметке."""
+    value = _chunk_watermark(df, table)
+    if not table.mutable:
+        return {"value": value, "boundary": []}
+    at_value = df.loc[df["_watermark"].astype(str) == value, table.keys[0]].tolist()
+    if mark and mark.get("value") == value:
+        at_value += mark.get("boundary") or []
+    return {"value": value, "boundary": sorted(set(int(i) for i in at_value))}
+
+
+def prepare_parquet_chunk(df: pd.DataFrame, table: ParquetTable, partition_by: str) -> pd.DataFrame:
+    """Типы колонок одинаковы во всех чанках (иначе пустой чанк даст null-колонку), время — UTC."""
+    df = df.drop(columns=["_watermark"])
+    for col in df.columns:
+        if col.endswith("_utc"):
+            df[col] = pd.to_datetime(df[col], utc=True, format="ISO8601", errors="coerce")
+    df = df.astype(table.dtypes)
+    if partition_by == "date":
+        df["date"] = df[table.date_column].dt.strftime("%Y-%m-%d").fillna("unknown")
+    else:
+        df["graph_id"] = df["graph_id"].fillna("unknown")
+    return df
+
+
+def _chunk_watermark(df: pd.DataFrame, table: ParquetTable):
+    """Отметка чанка: id — числом, время — в том виде, в каком его вернула БД (для сравнения в SQL)."""
+    value = df["_watermark"].max()
+    return str(value) if table.mutable else int(value)
+
+
+def _move_tree(src: str, dst: str):
+    """Переносит файлы частей из staging в набор данных, сохраняя каталоги партиций."""
+    for folder, _, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(folder, src))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            os.replace(os.path.join(folder, name), os.path.join(target, name))
+
+
+def export_incremental_parquet(root: str, partition_by: str = "date", full: bool = False,
+                               chunk_size: int = EXPORT_CHUNK_SIZE, bind=None, tables=None,
+                               settle_seconds: float = EXPORT_SETTLE_SECONDS) -> dict:
+    """
+    Дописывает в root/<таблица>/<партиция>=<значение>/part-*.parquet строки, появившиеся
+    после прошлого запуска (отметки в root/_watermarks.json). full=True — пересборка с нуля.
+    Части пишутся в staging и переносятся на место вместе с обновлением отметок.
+    Строки моложе settle_seconds выгружаются следующим запуском.
+    Возвращает {таблица: строк}.
+    """
+    if not PARQUET_AVAILABLE:
+        raise RuntimeError("Для --parquet нужен pyarrow: pip install pyarrow")
+    if partition_by not in PARTITION_CHOICES:
+        raise ValueError(f"partition_by: {PARTITION_CHOICES}")
+    bind = bind or engine
+    os.makedirs(root, exist_ok=True)
+    state = load_watermarks(root)
+    if not full and state["tables"] and state.get("partition_by") != partition_by:
+        raise ValueError(f"Набор разбит по {state.get('partition_by')}; для {partition_by} нужен --full")
+
+    run_id = uuid.uuid4().hex[:8]
+    staging = os.path.join(root, f".staging-{run_id}")
+    started = time.perf_counter()
+    counts = {}
+    try:
+        for table in tables or PARQUET_TABLES:
+            table_started = time.perf_counter()
+            mark = None if full else state["tables"].get(table.name)
+            rows, new_mark = 0, mark
+            for i, df in enumerate(incremental_chunks(bind, table, mark, chunk_size, settle_seconds)):
+                new_mark = advance_mark(new_mark, df, table)
+                rows += len(df)
+                pq.write_to_dataset(
+                    pa.Table.from_pandas(prepare_parquet_chunk(df, table, partition_by), preserve_index=False),
+                    root_path=os.path.join(staging, table.name), partition_cols=[partition_by],
+                    basename_template=f"part-{run_id}-{i:05d}-{{i}}.parquet",
+                    existing_data_behavior="overwrite_or_ignore",
+                )
+            dataset_path = os.path.join(root, table.name)
+            if full and os.path.isdir(dataset_path):
+                shutil.rmtree(dataset_path)
+            if rows:
+                _move_tree(os.path.join(staging, table.name), dataset_path)
+            state["tables"][table.name] = new_mark
+            save_watermarks(root, {**state, "partition_by": partition_by})
+            counts[table.name] = rows
+            print(f"  {table.name}: +{rows} строк за {time.perf_counter() - table_started:.2f} сек "
+                  f"(отметка {(mark or {}).get('value')} -> {(new_mark or {}).get('value')})")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    elapsed = time.perf_counter() - started
+    mode = "full" if full or not state.get("last_full_seconds") else "incremental"
+    state.update({"partition_by": partition_by, f"last_{mode}_seconds": round(elapsed, 3)})
+    save_watermarks(root, state)
+    if mode == "full":
+        print(f"✅ Полная выгрузка Parquet: {sum(counts.values())} строк за {elapsed:.2f} сек -> {root}")
+    else:
+        print(f"✅ Инкрементальная выгрузка Parquet: +{sum(counts.values())} строк за {elapsed:.2f} сек "
+              f"(последняя полная: {state['last_full_seconds']:.2f} сек) -> {root}")
+    return counts
+
+
+def open_parquet_dataset(root: str, name: str):
+    """Ленивый pyarrow.dataset: фильтры и выбор колонок выполняются при чтении, по партициям."""
+    return pa_dataset.dataset(os.path.join(root, name), format="parquet", partitioning="hive")
+
+
+def read_parquet_table(root: str, name: str, columns=None, filters=None, latest: bool = True) -> pd.DataFrame:
+    """
+    Таблица из набора в pandas. latest=True — по одной (последней) версии строки:
+    изменяемые таблицы выгружаются при каждом изменении, а сбой между переносом
+    частей и записью отметок может повторить строки.
+    """
+    table = PARQUET_TABLES_BY_NAME[name]
+    df = open_parquet_dataset(root, name).to_table(columns=columns, filter=filters).to_pandas()
+    if latest and set(table.keys) <= set(df.columns):
+        order = [c for c in df.columns if c.endswith("_utc")]
+        df = df.sort_values(table.keys + order, na_position="first", kind="stable")
+        df = df.drop_duplicates(table.keys, keep="last").reset_index(drop=True)
+    return df
+
 
 if __name__ == "__main__":
-    export_data_to_csv()
+    parser = argparse.ArgumentParser(description="Выгрузка данных исследования")
+    parser.add_argument("--output", default="results.csv")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    parser.add_argument("--split", action="store_true", help="сессии, ответы и диалоги — отдельными файлами")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="параллельная выгрузка CSV: число процессов (по одному соединению с БД)")
+    parser.add_argument("--shards", type=int, default=None,
+                        help=f"с --workers: число диапазонов session_id (по умолчанию воркеры x {SHARDS_PER_WORKER})")
+    parser.add_argument("--no-merge", action="store_true",
+                        help="с --workers: не склеивать части, оставить их с index.json")
+    parser.add_argument("--parquet", metavar="DIR", default=None,
+                        help="инкрементальная выгрузка в Parquet (sessions, responses, ai_dialogues, user_states)")
+    parser.add_argument("--partition-by", choices=PARTITION_CHOICES, default="date")
+    parser.add_argument("--full", action="store_true", help="с --parquet: пересобрать наборы с нуля")
+    parser.add_argument("--settle", type=float, default=EXPORT_SETTLE_SECONDS,
+                        help="с --parquet: строки моложе стольких секунд оставить следующему запуску")
+    args = parser.parse_args()
+    if args.parquet:
+        export_incremental_parquet(args.parquet, args.partition_by, full=args.full, chunk_size=args.chunk_size,
+                                   settle_seconds=args.settle)
+    elif args.workers > 0:
+        export_data_to_csv_parallel(args.output, workers=args.workers, shards=args.shards, chunk_size=args.chunk_size,
+                                    split=args.split, merge=not args.no_merge)
+    else:
+        export_data_to_csv(args.output, chunk_size=args.chunk_size, split=args.split)
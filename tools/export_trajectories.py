@@ -0,0 +1,281 @@
+# tools/export_trajectories.py
+# Траектории числовых состояний сессий сценария для исследований: массивы NumPy (сессии × шаги × ключи).
+# Запуск: PYTHONPATH=. python tools/export_trajectories.py --graph GRAPH_ID --output trajectories/
+#         PYTHONPATH=. python tools/export_trajectories.py --graph GRAPH_ID --layout dense --keys score,health
+#         PYTHONPATH=. python tools/export_trajectories.py --graph GRAPH_ID --source latest   (без истории)
+#         (--dtype float32 — вдвое меньше места; --npz — один файл trajectories.npz вместо .npy)
+# Чтение: load_trajectories("trajectories/") — .npy открываются через mmap, в память ничего не читается.
+#
+# Источник history — user_state_history (STATE_HISTORY_ENABLED=true): шаг = изменения одного клика,
+# значения ключей между изменениями переносятся вперед. Источник latest — user_states (последнее
+# значение ключа): один шаг на сессию, работает и на базах без истории.
+#
+# Раскладка ragged: values.npy (все шаги подряд × ключи) и offsets.npy — шаги сессии i это
+# values[offsets[i]:offsets[i + 1]]. Раскладка dense: values.npy (сессии × max шагов × ключи),
+# хвосты короче max заполнены NaN, длины — lengths.npy. В обеих: step_times.npy (время шага,
+# по порядку ragged), sessions.csv, keys.json и meta.json.
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from decouple import config
+from sqlalchemy import create_engine, text
+
+TRAJECTORY_CHUNK_SIZE = config("TRAJECTORY_CHUNK_SIZE", default=200000, cast=int)
+LAYOUTS = ("ragged", "dense")
+SOURCES = ("history", "latest")
+
+SESSIONS_QUERY = """
+    SELECT s.id AS session_id, s.user_id, u.telegram_id, s.start_time, s.end_time
+    FROM sessions s JOIN users u ON s.user_id = u.id
+    WHERE s.graph_id = :graph_id
+    ORDER BY s.id
+"""
+# Комментарий: порядок (сессия, время шага, id) — шаги идут подряд, границы шагов находятся без группировки
+STATE_QUERIES = {
+    "history": """
+        SELECT h.session_id, h.state_key, h.state_value, h.timestamp
+        FROM user_state_history h JOIN sessions s ON s.id = h.session_id
+        WHERE s.graph_id = :graph_id
+        ORDER BY h.session_id, h.timestamp, h.id
+    """,
+    "latest": """
+        SELECT us.session_id, us.state_key, us.state_value, us.timestamp
+        FROM user_states us JOIN sessions s ON s.id = us.session_id
+        WHERE s.graph_id = :graph_id
+        ORDER BY us.session_id, us.id
+    """,
+}
+
+
+def parse_state_values(values) -> np.ndarray:
+    """
+    Строки state_value -> float64 одним векторным проходом: числа как есть, True/False -> 1/0,
+    остальное (текст, пусто) -> NaN.
+    """
+    strings = pd.Series(values, dtype="object")
+    numbers = np.array(pd.to_numeric(strings, errors="coerce"), dtype="float64")
+    # Комментарий: True/False ищутся только среди нечисловых значений — их обычно единицы процентов
+    missing = np.flatnonzero(np.isnan(numbers))
+    if len(missing):
+        lowered = strings.iloc[missing].astype("string").str.strip().str.lower()
+        flags = {"true": 1.0, "false": 0.0}
+        numbers[missing] = lowered.map(flags).to_numpy(dtype="float64", na_value=np.nan)
+    return numbers
+
+
+def _to_ns(column) -> np.ndarray:
+    # Комментарий: время без зоны (SQLite) считается UTC, как и пишет приложение
+    stamps = pd.to_datetime(column, utc=True, format="ISO8601", errors="coerce")
+    return stamps.to_numpy(dtype="datetime64[ns]").view("int64")
+
+
+class StateTrajectories:
+    """
+    Траектории состояний сессий одного сценария.
+
+    values — ragged (шаги × ключи) с offsets или dense (сессии × шаги × ключи) с lengths;
+    step_times — время каждого шага (datetime64[ns], порядок ragged); sessions — справочник
+    сессий (строка i — сессия i массивов); keys — имена ключей (столбец j — ключ j).
+    """
+
+    def __init__(self, values, offsets, step_times, sessions: pd.DataFrame, keys, layout="ragged",
+                 graph_id=None, source="history"):
+        self.values = values
+        self.offsets = np.asarray(offsets)
+        self.step_times = step_times
+        self.sessions = sessions
+        self.keys = list(keys)
+        self.layout = layout
+        self.graph_id = graph_id
+        self.source = source
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def session_ids(self) -> np.ndarray:
+        return self.sessions["session_id"].to_numpy()
+
+    def key_index(self, key: str) -> int:
+        return self.keys.index(key)
+
+    def session_index(self, session_id: int) -> int:
+        ids = self.session_ids
+        i = int(np.searchsorted(ids, session_id))
+        if i >= len(ids) or ids[i] != session_id:
+            raise KeyError(f"сессии {session_id} нет в выгрузке")
+        return i
+
+    def session(self, session_id: int) -> np.ndarray:
+        """Траектория одной сессии: (шаги × ключи), без копирования."""
+        i = self.session_index(session_id)
+        if self.layout == "dense":
+            return self.values[i, :self.lengths[i]]
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def to_dense(self) -> "StateTrajectories":
+        if self.layout == "dense":
+            return self
+        lengths = self.lengths
+        dense = np.full((len(lengths), int(lengths.max(initial=0)), len(self.keys)), np.nan, dtype=self.values.dtype)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        dense[rows, np.arange(len(rows)) - self.offsets[rows]] = self.values
+        return StateTrajectories(dense, self.offsets, self.step_times, self.sessions, self.keys, "dense",
+                                 self.graph_id, self.source)
+
+
+def _read_chunks(bind, query: str, params: dict, chunk_size: int):
+    with bind.connect() as conn:
+        conn = conn.execution_options(stream_results=True, max_row_buffer=chunk_size)
+        yield from pd.read_sql_query(text(query), conn, params=params, chunksize=chunk_size)
+
+
+def build_trajectories(bind, graph_id: str, source: str = "history", keys=None, dtype="float64",
+                       chunk_size: int = TRAJECTORY_CHUNK_SIZE) -> StateTrajectories:
+    """
+    Читает состояния всех сессий сценария чанками и строит ragged-траектории векторно:
+    без обхода ORM-объектов и без Python-цикла по строкам.
+    keys — только эти ключи (в этом порядке); по умолчанию все, по алфавиту.
+    """
+    sessions = pd.concat(list(_read_chunks(bind, SESSIONS_QUERY, {"graph_id": graph_id}, chunk_size)) or
+                         [pd.DataFrame(columns=["session_id", "user_id", "telegram_id", "start_time", "end_time"])],
+                         ignore_index=True)
+    session_ids = sessions["session_id"].to_numpy(dtype="int64")
+
+    key_codes = {key: i for i, key in enumerate(keys)} if keys else {}
+    parts = {"session": [], "key": [], "value": [], "time": []}
+    for chunk in _read_chunks(bind, STATE_QUERIES[source], {"graph_id": graph_id}, chunk_size):
+        codes, uniques = pd.factorize(chunk["state_key"])
+        if keys:
+            remap = np.array([key_codes.get(key, -1) for key in uniques], dtype="int64")
+        else:
+            remap = np.array([key_codes.setdefault(key, len(key_codes)) for key in uniques], dtype="int64")
+        # Комментарий: строки невыбранных ключей (код -1) остаются — шаги не зависят от набора --keys
+        parts["session"].append(np.searchsorted(session_ids, chunk["session_id"].to_numpy(dtype="int64")))
+        parts["key"].append(remap[codes] if len(codes) else codes.astype("int64"))
+        parts["value"].append(parse_state_values(chunk["state_value"].to_numpy()))
+        parts["time"].append(_to_ns(chunk["timestamp"]))
+    session, key, value, stamp = (np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype="int64")
+                                  for name in ("session", "key", "value", "time"))
+
+    if not keys:
+        # Ключи по алфавиту — стабильный порядок столбцов между выгрузками
+        names = sorted(key_codes)
+        position = {name: i for i, name in enumerate(names)}
+        order = np.array([position[name] for name in key_codes], dtype="int64")
+        key = order[key] if len(key) else key
+        key_codes = {name: i for i, name in enumerate(names)}
+    n_keys = len(key_codes)
+
+    # Граница шага: новая сессия или (для истории) новое время клика
+    boundary = np.ones(len(session), dtype=bool)
+    if len(session) > 1:
+        changed = session[1:] != session[:-1]
+        if source == "history":
+            changed |= stamp[1:] != stamp[:-1]
+        boundary[1:] = changed
+    step = np.cumsum(boundary) - 1
+    n_steps = int(boundary.sum())
+    lengths = np.bincount(session[boundary], minlength=len(session_ids)) if n_steps else np.zeros(len(session_ids), "int64")
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype("int64")
+
+    # Изменения по шагам, затем перенос значений вперед внутри сессии (по каждому ключу векторно)
+    changes = np.full((n_steps, n_keys), np.nan, dtype="float64")
+    is_set = np.zeros((n_steps, n_keys), dtype=bool)
+    selected = key >= 0
+    changes[step[selected], key[selected]] = value[selected]
+    is_set[step[selected], key[selected]] = True
+    step_start = np.repeat(offsets[:-1], lengths)
+    positions = np.arange(n_steps)
+    for j in range(n_keys):
+        # Индекс последнего шага, где ключ задан; задание в прошлой сессии не считается
+        last_set = np.maximum.accumulate(np.where(is_set[:, j], positions, -1))
+        column = changes[:, j].copy()
+        changes[:, j] = np.where(last_set >= step_start, column[np.maximum(last_set, 0)], np.nan)
+    values = changes.astype(dtype, copy=False)
+
+    step_times = stamp[boundary].view("datetime64[ns]")
+    sessions = sessions.assign(steps=lengths, offset=offsets[:-1])
+    return StateTrajectories(values, offsets, step_times, sessions, list(key_codes), "ragged", graph_id, source)
+
+
+def save_trajectories(trajectories: StateTrajectories, path: str, layout: str = "ragged", npz: bool = False) -> dict:
+    """
+    Сохраняет массивы и справочники в каталог path. .npy (по умолчанию) открываются через mmap;
+    npz=True — один несжатый trajectories.npz (переносимее, но без mmap). Возвращает meta.
+    """
+    if layout == "dense":
+        trajectories = trajectories.to_dense()
+    os.makedirs(path, exist_ok=True)
+    arrays = {"values": trajectories.values, "offsets": trajectories.offsets,
+              "step_times": trajectories.step_times}
+    if layout == "dense":
+        arrays["lengths"] = trajectories.lengths
+    if npz:
+        np.savez(os.path.join(path, "trajectories.npz"), **arrays)
+    else:
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), array)
+
+    sessions = trajectories.sessions.copy()
+    sessions.insert(0, "index", np.arange(len(sessions)))
+    sessions.to_csv(os.path.join(path, "sessions.csv"), index=False)
+    with open(os.path.join(path, "keys.json"), "w", encoding="utf-8") as f:
+        json.dump(trajectories.keys, f, ensure_ascii=False, indent=2)
+    meta = {
+        "graph_id": trajectories.graph_id, "source": trajectories.source, "layout": layout,
+        "format": "npz" if npz else "npy", "dtype": str(trajectories.values.dtype),
+        "shape": list(trajectories.values.shape), "sessions": len(sessions),
+        "steps": int(trajectories.offsets[-1]) if len(trajectories.offsets) else 0,
+        "keys": len(trajectories.keys), "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+def load_trajectories(path: str, mmap: bool = True) -> StateTrajectories:
+    """Открывает выгрузку save_trajectories; mmap=True — массивы .npy отображаются в память, а не читаются."""
+    with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    with open(os.path.join(path, "keys.json"), encoding="utf-8") as f:
+        keys = json.load(f)
+    if meta["format"] == "npz":
+        bundle = np.load(os.path.join(path, "trajectories.npz"))
+        arrays = {name: bundle[name] for name in bundle.files}
+    else:
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+                  for name in ("values", "offsets", "step_times")}
+    sessions = pd.read_csv(os.path.join(path, "sessions.csv"), dtype={"telegram_id": "string"}).drop(columns=["index"])
+    return StateTrajectories(arrays["values"], arrays["offsets"], arrays["step_times"], sessions, keys,
+                             meta["layout"], meta["graph_id"], meta["source"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Выгрузка траекторий состояний в NumPy")
+    parser.add_argument("--graph", required=True, help="graph_id сценария")
+    parser.add_argument("--output", default="trajectories")
+    parser.add_argument("--source", choices=SOURCES, default="history")
+    parser.add_argument("--layout", choices=LAYOUTS, default="ragged")
+    parser.add_argument("--keys", default=None, help="ключи через запятую (по умолчанию все)")
+    parser.add_argument("--dtype", choices=["float64", "float32"], default="float64")
+    parser.add_argument("--npz", action="store_true", help="один файл trajectories.npz вместо .npy")
+    parser.add_argument("--chunk-size", type=int, default=TRAJECTORY_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    engine = create_engine(config("DATABASE_URL"))
+    keys = [key.strip() for key in args.keys.split(",") if key.strip()] if args.keys else None
+    trajectories = build_trajectories(engine, args.graph, args.source, keys, args.dtype, args.chunk_size)
+    built = time.perf_counter() - started
+    meta = save_trajectories(trajectories, args.output, args.layout, args.npz)
+    print(f"✅ {meta['sessions']} сессий, {meta['steps']} шагов, {meta['keys']} ключей, массив {meta['shape']} "
+          f"{meta['dtype']}: построено за {built:.1f} сек, сохранено за {time.perf_counter() - started - built:.1f} сек "
+          f"-> {args.output}")
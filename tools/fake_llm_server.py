@@ -0,0 +1,250 @@
+# tools/fake_llm_server.py
+# Заглушка LLM для нагрузочных прогонов: OpenAI-совместимый (VseGPT) и GigaChat-совместимый API.
+# Запуск: PYTHONPATH=. python tools/fake_llm_server.py --port 8090 --latency-median 1.5 --latency-p95 4 --rate-429 0.05
+# Бот направляется на заглушку через .env (адреса печатаются при старте):
+#   VSEGPT_BASE_URL=http://127.0.0.1:8090/v1
+#   GIGACHAT_BASE_URL=http://127.0.0.1:8090/v1  GIGACHAT_AUTH_URL=http://127.0.0.1:8090/oauth
+#
+# Задержка ответа — логнормальная, задается медианой и p95. Сбои: доля ответов 429, 500
+# и «зависаний» (соединение молчит --hang-seconds, клиент уходит по таймауту).
+# POST .../chat/completions — обычный ответ или SSE-поток (stream=true): первый чанк
+# через --first-chunk-share задержки, остальные равномерно. POST .../oauth — токен GigaChat.
+# GET /stats — счетчики заглушки.
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FaultProfile:
+    """Распределение задержек и доли сбоев заглушки."""
+
+    def __init__(self, latency_median: float = 1.0, latency_p95: float = 3.0, rate_429: float = 0.0,
+                 rate_500: float = 0.0, rate_timeout: float = 0.0, hang_seconds: float = 120.0,
+                 first_chunk_share: float = 0.3, chunks: int = 8, seed=None):
+        self.latency_median = max(0.0, float(latency_median))
+        self.latency_p95 = max(self.latency_median, float(latency_p95))
+        self.rate_429 = float(rate_429)
+        self.rate_500 = float(rate_500)
+        self.rate_timeout = float(rate_timeout)
+        self.hang_seconds = float(hang_seconds)
+        self.first_chunk_share = min(1.0, max(0.0, float(first_chunk_share)))
+        self.chunks = max(1, int(chunks))
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def latency(self) -> float:
+        """Логнормальная задержка: медиана latency_median, 95-й перцентиль latency_p95."""
+        if self.latency_median <= 0:
+            return 0.0
+        sigma = math.log(self.latency_p95 / self.latency_median) / 1.645
+        with self._lock:
+            return self._random.lognormvariate(math.log(self.latency_median), sigma)
+
+    def outcome(self) -> str:
+        """'429', '500', 'timeout' или 'ok'."""
+        with self._lock:
+            roll = self._random.random()
+        for name, rate in (("429", self.rate_429), ("500", self.rate_500), ("timeout", self.rate_timeout)):
+            if roll < rate:
+                return name
+            roll -= rate
+        return "ok"
+
+
+class FakeLLMServer:
+    """Заглушка в отдельном потоке: start() -> base_url, stop()."""
+
+    def __init__(self, profile: FaultProfile = None, host: str = "127.0.0.1", port: int = 0):
+        self.profile = profile or FaultProfile()
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "ok": 0, "streams": 0, "429": 0, "500": 0, "timeout": 0, "auth": 0}
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="FakeLLM", daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._stopping.set()          # будит «зависшие» запросы
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def sleep(self, seconds: float) -> bool:
+        """Пауза; False — заглушку останавливают."""
+        return not self._stopping.wait(seconds)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def fake(self) -> FakeLLMServer:
+        return self.server.fake
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._json(200, {"object": "list", "data": [{"id": "fake-model", "object": "model", "owned_by": "fake"}]})
+        elif self.path == "/stats":
+            self._json(200, self.fake.stats())
+        else:
+            self._json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/oauth") or path.endswith("/token"):
+            self.fake.count("auth")
+            # GigaChat: expires_at в миллисекундах
+            self._json(200, {"access_token": "fake-token", "expires_at": int((time.time() + 3600) * 1000)})
+            return
+        if not path.endswith("/chat/completions"):
+            self._json(404, {"error": {"message": "not found"}})
+            return
+
+        try:
+            body = json.loads(raw or b"{}")
+        except ValueError:
+            self._json(400, {"error": {"message": "invalid json"}})
+            return
+        fake, profile = self.fake, self.fake.profile
+        fake.count("requests")
+        outcome = profile.outcome()
+        if outcome == "timeout":
+            fake.count("timeout")
+            fake.sleep(profile.hang_seconds)
+            self.close_connection = True
+            return
+        if outcome in ("429", "500"):
+            fake.count(outcome)
+            message = "Too Many Requests" if outcome == "429" else "Internal Server Error"
+            self._json(int(outcome), {"error": {"message": message, "type": "fake_fault", "code": int(outcome)}})
+            return
+
+        text = _reply_text(body)
+        latency = profile.latency()
+        if body.get("stream"):
+            fake.count("streams")
+            self._stream(body, text, latency)
+        else:
+            if not fake.sleep(latency):
+                return
+            self._json(200, {
+                "id": f"fake-{time.time_ns()}", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "fake-model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": _usage(body, text),
+            })
+        fake.count("ok")
+
+    def _stream(self, body: dict, text: str, latency: float):
+        profile = self.fake.profile
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        size = max(1, math.ceil(len(text) / profile.chunks))
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        first = latency * profile.first_chunk_share
+        interval = (latency - first) / max(1, len(pieces) - 1)
+        for i, piece in enumerate(pieces):
+            if not self.fake.sleep(first if i == 0 else interval):
+                return
+            chunk = {"id": "fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model", "fake-model"),
+                     "choices": [{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _json(self, status: int, payload: dict):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def _reply_text(body: dict) -> str:
+    messages = body.get("messages") or []
+    prompt = " ".join(str(m.get("content", "")) for m in messages if isinstance(m, dict))
+    return f"Ответ заглушки на запрос из {len(prompt)} символов. Решение за вами, капитан!"
+
+
+def _usage(body: dict, text: str) -> dict:
+    prompt_chars = sum(len(str(m.get("content", ""))) for m in body.get("messages") or [] if isinstance(m, dict))
+    prompt_tokens, completion_tokens = prompt_chars // 4 + 1, len(text) // 4 + 1
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """Параметры FaultProfile в командной строке (общие для заглушки и бенчмарка)."""
+    parser.add_argument("--latency-median", type=float, default=1.0, help="медиана задержки, сек")
+    parser.add_argument("--latency-p95", type=float, default=3.0, help="95-й перцентиль задержки, сек")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--rate-500", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--rate-timeout", type=float, default=0.0, help="доля зависших запросов")
+    parser.add_argument("--hang-seconds", type=float, default=120.0, help="сколько молчит зависший запрос")
+    parser.add_argument("--first-chunk-share", type=float, default=0.3, help="доля задержки до первого чанка")
+    parser.add_argument("--chunks", type=int, default=8, help="чанков в потоковом ответе")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def profile_from_args(args) -> FaultProfile:
+    return FaultProfile(args.latency_median, args.latency_p95, args.rate_429, args.rate_500, args.rate_timeout,
+                        args.hang_seconds, args.first_chunk_share, args.chunks, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка OpenAI/GigaChat API с задержками и сбоями")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeLLMServer(profile_from_args(args), args.host, args.port)
+    url = server.start()
+    print(f"Заглушка LLM слушает {url}")
+    print(f"  VSEGPT_BASE_URL={url}/v1")
+    print(f"  GIGACHAT_BASE_URL={url}/v1  GIGACHAT_AUTH_URL={url}/oauth  GIGACHAT_CREDENTIALS=ZmFrZTpmYWtl")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"[FAKE-LLM] {server.stats()}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
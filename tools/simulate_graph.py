@@ -0,0 +1,42 @@
+# tools/simulate_graph.py
+# Headless-прогон сценария синтетическими игроками: бенчмарк и проверка перед деплоем.
+# Запуск: PYTHONPATH=. python tools/simulate_graph.py --graph data/default_interview.json --players 10000
+#         PYTHONPATH=. python tools/simulate_graph.py --script answers.json --strict   (код выхода 1 при тупиках/ошибках)
+
+import argparse
+import json
+import sys
+
+from app.modules.simulator import GraphSimulator, first_policy, random_policy, scripted_policy
+
+POLICIES = {"random": random_policy, "first": first_policy}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless-симулятор сценария")
+    parser.add_argument("--graph", default="data/default_interview.json")
+    parser.add_argument("--players", type=int, default=10000)
+    parser.add_argument("--policy", choices=sorted(POLICIES), default="random",
+                        help="выбор кнопок (для узлов вне --script)")
+    parser.add_argument("--script", default=None,
+                        help='JSON {node_id: индекс | текст кнопки | [по посещениям]}')
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--max-steps", type=int, default=1000)
+    parser.add_argument("--top", type=int, default=10, help="сколько горячих узлов показать")
+    parser.add_argument("--strict", action="store_true",
+                        help="код выхода 1, если есть тупики, циклы, битые переходы, узлы неизвестного типа "
+                             "с переходами, недостижимые узлы или ошибки условий/шаблонов")
+    args = parser.parse_args()
+
+    with open(args.graph, "r", encoding="utf-8") as f:
+        graph = json.load(f)
+    policy = POLICIES[args.policy]
+    if args.script:
+        with open(args.script, "r", encoding="utf-8") as f:
+            policy = scripted_policy(json.load(f), fallback=policy)
+
+    report = GraphSimulator(graph, policy=policy, seed=args.seed, max_steps=args.max_steps).run(args.players)
+    print(report.format(top=args.top))
+    if args.strict and not report.ok:
+        print("❌ Сценарий не прошел проверку")
+        sys.exit(1)